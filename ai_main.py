@@ -3,11 +3,22 @@ from datetime import datetime, timedelta # ZMIENIONE: Dodano timedelta
 import pandas as pd
 import numpy as np
 import math
+import json
+import logging
 import time
 import warnings
 import os
 import joblib
 import sqlite3 # NOWE: Do obsługi bazy danych
+import db # Wspólna warstwa dostępu do bazy (WAL, pula połączeń)
+import data_coverage
+from sensors import SUNSHINE_THRESHOLD # Próg wspólny z retention.py
+from model_registry import ModelRegistry
+from ai_pipeline import (StageTimer, Laps, measure, PipelineError, InsufficientDataError, DataFetchError, AggregationError,
+                         FeatureEngineeringError, ModelLoadError, InferenceError)
+
+# Komunikaty potoku przez logging (poziom modułu 'ai_main' w config.Config.LOG_LEVELS, logs.py)
+log = logging.getLogger(__name__)
 
 # Ignoruj ostrzeżenia (bez zmian)
 warnings.filterwarnings('ignore', category=RuntimeWarning)
@@ -25,10 +36,9 @@ MODEL_SAVE_DIR = "trained_models_wien"
 
 # --- === NOWA KONFIGURACJA DLA DANYCH Z BAZY === ---
 USE_DATABASE_INPUT = True # Ustaw na True, aby używać danych z bazy
-DB_PATH = 'measurements.db' # Ścieżka do Twojej bazy SQLite
+DB_PATH = db.DB_PATH # Ścieżka do bazy SQLite (połączenia z puli w db.py)
 
-# Parametry dla przetwarzania danych z bazy (DOSTOSUJ DO SWOICH CZUJNIKÓW!)
-SUNSHINE_THRESHOLD = 30
+# Parametry dla przetwarzania danych z bazy (DOSTOSUJ DO SWOICH CZUJNIKÓW!); SUNSHINE_THRESHOLD w sensors.py
 MAX_PRECIP_RATE_MM_PER_HOUR_FOR_INTENSITY_1 = 25.0 # mm/h dla prcp_intensity = 1.0
 TEMP_THRESHOLD_SNOW = 0.5  # Temperatura (C) poniżej której opad jest śniegiem
 WATER_TO_SNOW_RATIO = 10.0 # mm śniegu z 1 mm wody
@@ -51,10 +61,10 @@ MAX_ACCUMULATED_SNOW_DEPTH_MM = 1000 # Max symulowana grubość pokrywy śnieżn
 try:
     from meteostat import Hourly, Stations # Meteostat będzie używany tylko jeśli USE_DATABASE_INPUT=False
 except ImportError:
-    print("OSTRZEŻENIE: Biblioteka Meteostat nie jest zainstalowana. Wymagane, jeśli USE_DATABASE_INPUT=False.")
+    log.warning("OSTRZEŻENIE: Biblioteka Meteostat nie jest zainstalowana. Wymagane, jeśli USE_DATABASE_INPUT=False.")
     if not USE_DATABASE_INPUT:
-        print("BŁĄD: Meteostat wymagany i niedostępny. Przerywam.")
-        exit()
+        log.error("BŁĄD: Meteostat wymagany i niedostępny. Przerywam.")
+        raise
 
 try:
     from sklearn.model_selection import train_test_split # Mniej istotne dla predykcji
@@ -63,39 +73,47 @@ try:
     from sklearn.utils import class_weight # Mniej istotne dla predykcji
     SKLEARN_AVAILABLE = True
 except ImportError:
-    print("BŁĄD: Kluczowe biblioteki scikit-learn nie są zainstalowane.")
-    exit()
+    log.error("BŁĄD: Kluczowe biblioteki scikit-learn nie są zainstalowane.")
+    raise
 try:
     import xgboost as xgb
     XGB_AVAILABLE = True
 except ImportError:
-    print("BŁĄD: Biblioteka 'xgboost' nie jest zainstalowana.")
+    log.error("BŁĄD: Biblioteka 'xgboost' nie jest zainstalowana.")
     XGB_AVAILABLE = False
-    exit()
+    raise
 try:
     from imblearn.over_sampling import SMOTE # Mniej istotne dla predykcji
     SMOTE_AVAILABLE = True
 except ImportError:
-    print("OSTRZEŻENIE: Biblioteka 'imblearn' (dla SMOTE) nie jest zainstalowana.")
+    log.warning("OSTRZEŻENIE: Biblioteka 'imblearn' (dla SMOTE) nie jest zainstalowana.")
     SMOTE_AVAILABLE = False
-    if USE_SMOTE: print("   Wyłączam USE_SMOTE."); USE_SMOTE = False
+    if USE_SMOTE: log.warning("Wyłączam USE_SMOTE."); USE_SMOTE = False
 try:
     import matplotlib.pyplot as plt
     import seaborn as sns
     VIZ_AVAILABLE = True
 except ImportError:
     VIZ_AVAILABLE = False
-    print("Ostrzeżenie: Wizualizacja (matplotlib, seaborn) niedostępna.")
+    log.warning("Ostrzeżenie: Wizualizacja (matplotlib, seaborn) niedostępna.")
+try:
+    from numba import njit # Opcjonalnie: kompilacja symulacji pokrywy śnieżnej (bez numby - pętla w Pythonie)
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
 
 # Utwórz katalog na modele (bez zmian)
 if not os.path.exists(MODEL_SAVE_DIR):
     try:
         os.makedirs(MODEL_SAVE_DIR)
-        print(f"Utworzono katalog na modele: {MODEL_SAVE_DIR}")
+        log.debug("Utworzono katalog na modele: %s", MODEL_SAVE_DIR)
     except OSError as e:
-        print(f"BŁĄD: Nie można utworzyć katalogu na modele '{MODEL_SAVE_DIR}': {e}")
+        log.error("BŁĄD: Nie można utworzyć katalogu na modele '%s': %s", MODEL_SAVE_DIR, e)
         MODEL_SAVE_DIR = "."
-        print(f"Modele będą zapisywane w katalogu bieżącym.")
+        log.debug("Modele będą zapisywane w katalogu bieżącym.")
+
+# Rejestr modeli współdzielony przez wątki predykcji (wczytanie raz, przeładowanie po zmianie plików)
+model_registry = ModelRegistry(MODEL_SAVE_DIR)
 
 
 # 2. Funkcja do obliczania punktu rosy (bez zmian)
@@ -107,6 +125,62 @@ def calculateDewPoint(temperature, humidity):
     if dewPoint < -80: return np.nan
     return dewPoint
 
+# 2a. Wektorowa wersja calculateDewPoint dla całych kolumn (te same progi i obsługa NaN)
+def calculateDewPoint_array(temperature, humidity):
+    """
+    Punkt rosy dla całych kolumn, bit w bit jak calculateDewPoint wiersz po wierszu.
+    Logarytm wilgotności liczony jest math.log po elementach (~0.15 us na wiersz), a nie np.log:
+    na procesorach z AVX-512 np.log (SVML) różni się od math.log o 1 ulp w ~20% wartości.
+    Reszta wzoru i progi są wektorowe.
+    """
+    t = np.asarray(temperature, dtype=np.float64).ravel()
+    h = np.asarray(humidity, dtype=np.float64).ravel()
+    valid = ~np.isnan(t) & (h > 0) & (h <= 100) # NaN w h daje False w obu porównaniach
+    a=17.27; b=237.7
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        log_h = np.fromiter(map(math.log, (np.where(valid, h, 100.0) / 100.0).tolist()), dtype=np.float64, count=len(h))
+        gamma = (a * t) / (b + t) + log_h
+        dewPoint = (b * gamma) / (a - gamma)
+        result = np.where(dewPoint > t + 0.5, t, np.where(dewPoint < -80, np.nan, dewPoint))
+    result[~valid] = np.nan
+    return result
+
+# 2b. Symulacja pokrywy śnieżnej (akumulacja opadu poniżej TEMP_THRESHOLD_SNOW, topnienie powyżej 0°C)
+def _snow_cover_recurrence(prcp, temp, out, temp_threshold, water_to_snow, melt_rate, max_depth):
+    depth = 0.0
+    for i in range(len(prcp)):
+        p = prcp[i]; t = temp[i]
+        if p > 0 and t < temp_threshold:
+            depth += p * water_to_snow
+        if depth > 0 and t > 0:
+            depth -= melt_rate * t * water_to_snow
+        if not depth > 0: depth = 0.0 # max(0, depth)
+        if depth > max_depth: depth = max_depth
+        out[i] = depth
+    return out
+
+if NUMBA_AVAILABLE:
+    _snow_cover_kernel = njit(cache=True)(_snow_cover_recurrence)
+else:
+    _snow_cover_kernel = _snow_cover_recurrence
+
+def simulate_snow_cover(prcp, temp):
+    """
+    Grubość pokrywy śnieżnej [mm] dla kolejnych godzin (zaokrąglona do 0.01, jak w pętli po iterrows).
+    numba jest opcjonalna (requirements-optional.txt): gdy jest zainstalowana, rekurencja jest kompilowana
+    (njit), bez niej ta sama pętla idzie w Pythonie na listach - wyniki są identyczne.
+    """
+    prcp = np.asarray(prcp, dtype=np.float64)
+    temp = np.asarray(temp, dtype=np.float64)
+    args = (TEMP_THRESHOLD_SNOW, WATER_TO_SNOW_RATIO, HOURLY_MELT_RATE_PER_DEG_ABOVE_FREEZING, float(MAX_ACCUMULATED_SNOW_DEPTH_MM))
+    if NUMBA_AVAILABLE:
+        depth = _snow_cover_kernel(prcp, temp, np.empty(len(prcp)), *args).tolist()
+    else:
+        # Bez numby pętla na listach Pythona (bez narzutu Series z iterrows)
+        depth = _snow_cover_kernel(prcp.tolist(), temp.tolist(), [0.0] * len(prcp), *args)
+    # round() Pythona, nie np.round - identyczne zaokrąglenie jak wcześniej
+    return np.array([round(d, 2) for d in depth], dtype=np.float64)
+
 # 3. Funkcja Agregacji Coco (bez zmian)
 def aggregate_coco_FINAL_user_v2(coco_code):
     if pd.isna(coco_code): return "Unknown"
@@ -121,14 +195,1075 @@ def aggregate_coco_FINAL_user_v2(coco_code):
     return "Unknown"
 
 
-def run_prediction(start_date_str, end_date_str):
+# --- Definicje List Cech z ANOVA v8 (Wiedeń) ---
+# UPEWNIJ SIĘ, ŻE TE LISTY SĄ IDENTYCZNE JAK W SKRYPCIE TRENINGOWYM
+FEATURES_M1 = [
+    'was_precip_category_lag1h', 'flag_light_precip', 'flag_has_precip', 'flag_gusty_and_precip',
+    'was_rain_lag1h', 'flag_windy_and_precip', 'was_precip_category_lag2h', 'was_rain_lag2h',
+    'was_precip_category_lag3h', 'was_rain_lag3h', 'prcp_roll6h_median', 'prcp_roll3h_sum',
+    'prcp_roll3h_mean', 'prcp_roll6h_mean', 'prcp_roll6h_sum', 'prcp_roll3h_median',
+    'prcp_roll3h_min', 'prcp_roll12h_mean', 'prcp_roll12h_sum', 'prcp_roll12h_median',
+    'prcp_roll3h_max', 'prcp', 'prcp_roll6h_min', 'flag_moderate_precip',
+    'prcp_roll6h_max', 'prcp_lag_1h', 'was_precip_category_lag6h', 'prcp_roll6h_std',
+    'prcp_roll3h_std', 'flag_near_freezing_precip'
+]
+FEATURES_M2 = [
+    'was_fog_lag1h', 'flag_damp_conditions', 'was_fog_lag2h', 'flag_fog_ratio',
+    'flag_near_saturation', 'flag_close_saturation', 'was_fog_lag3h', 'flag_very_humid',
+    'flag_cold_and_humid', 'flag_moderate_humid', 'flag_humid', 'rhum_x_spread',
+    'was_fog_lag6h', 'rhum_pow2', 'rhum_x_rhum', 'flag_moderate_spread',
+    'rhum_roll6h_min', 'rhum_div_roll24h_std_safe', 'rhum_roll3h_min', 'rhum_roll12h_min',
+    'rhum_x_pres', 'rhum', 'rhum_roll3h_mean', 'rhum_roll24h_min',
+    'rhum_div_pres_safe', 'rhum_roll24h_mean', 'rhum_roll6h_mean', 'rhum_roll3h_median',
+    'rhum_roll12h_mean', 'rhum_lag_1h'
+]
+FEATURES_M3 = [
+    'flag_potential_snow', 'flag_dp_below_freezing', 'flag_near_freezing_precip', 'flag_near_freezing_low',
+    'was_snow_sleet_freezing_lag1h', 'flag_below_freezing', 'flag_below_freezing_precip', 'was_snow_sleet_freezing_lag2h',
+    'was_snow_sleet_freezing_lag3h', 'temp_x_rhum', 'temp_div_pres_safe', 'temp',
+    'temp_x_pres', 'temp_roll3h_min', 'temp_roll3h_mean', 'dew_point_roll3h_max',
+    'dew_point_roll6h_max', 'temp_roll3h_median', 'dew_point_roll3h_mean', 'dew_point_roll12h_max',
+    'temp_lag_1h', 'dew_point',
+    'dew_point_div_pres_safe', 'dew_point_x_pres',
+    'dew_point_roll3h_median', 'dew_point_lag_1h', 'dew_point_roll24h_max', 'temp_roll3h_max',
+    'temp_roll6h_min', 'rhum_x_dew_point'
+]
+FEATURES_M4 = [
+    'was_clear_fair_lag1h', 'was_cloudy_overcast_lag1h', 'was_clear_fair_lag2h', 'was_cloudy_overcast_lag2h',
+    'was_clear_fair_lag3h', 'was_cloudy_overcast_lag3h', 'was_clear_fair_lag6h', 'was_cloudy_overcast_lag6h',
+    'temp_roll12h_range', 'tsun_roll24h_sum', 'tsun_roll24h_mean', 'temp_roll12h_std',
+    'temp_roll24h_std', 'temp_roll24h_range', 'tsun_roll12h_sum', 'tsun_roll12h_mean',
+    'spread_roll24h_std', 'spread_roll12h_max', 'rhum_roll12h_min', 'rhum_roll24h_min',
+    'spread_roll12h_range', 'spread_roll24h_range', 'spread_roll24h_max', 'spread_roll12h_std',
+    'tsun_roll12h_max', 'tsun_roll12h_std', 'abs_tsun_diff_12h', 'rhum_roll24h_std',
+    'tsun_roll24h_std', 'tsun_roll6h_mean'
+]
+
+
+def fetch_raw_measurements(start_dt, end_dt, mac_address=None):
+    """
+    Pobiera surowe pomiary z bazy dla zakresu [start_dt, end_dt] (posortowane wg czasu).
+    Z podanym mac_address czyta tylko jedną stację (indeks mac_address, server_timestamp);
+    bez niego - wszystkie stacje razem (dawne zachowanie).
+    """
+    with db.reader() as conn:
+        params = [start_dt.strftime('%Y-%m-%d %H:%M:%S'), end_dt.strftime('%Y-%m-%d %H:%M:%S')]
+        station_filter = ""
+        if mac_address is not None:
+            station_filter = "AND mac_address = ?"
+            params.append(mac_address)
+        query = f"""
+            SELECT server_timestamp, temperature, pressure, humidity, sunshine, wind_speed, precipitation
+            FROM measurements
+            WHERE server_timestamp BETWEEN ? AND ? {station_filter}
+            ORDER BY server_timestamp ASC
+        """
+        with measure('data_fetch.sql_raw') as stage:
+            df_raw = pd.read_sql_query(query, conn, params=params)
+            stage['rows'] = len(df_raw)
+        return df_raw
+
+
+def fetch_stored_features_bulk(mac_address, hours):
+    """
+    Wiersze cech wielu zamkniętych godzin stacji z tabeli hourly_features (feature_store.py) jednym
+    zapytaniem: DataFrame z MODEL_FEATURES indeksowany godziną. Godziny niepoliczone jeszcze przez
+    feature store albo zapisane dla innego zestawu cech są pomijane.
+    """
+    hours = set(hours)
+    rows = []
+    if hours:
+        try:
+            with db.reader() as conn:
+                rows = conn.execute(
+                    "SELECT hour, features FROM hourly_features WHERE mac_address = ? AND hour BETWEEN ? AND ?",
+                    (mac_address, min(hours).strftime('%Y-%m-%d %H:%M:%S'), max(hours).strftime('%Y-%m-%d %H:%M:%S'))
+                ).fetchall()
+        except sqlite3.OperationalError:
+            rows = [] # Baza bez tabeli hourly_features (przed migracją)
+    index, records = [], []
+    for hour_str, features_json in rows:
+        hour = datetime.strptime(hour_str, '%Y-%m-%d %H:%M:%S')
+        if hour not in hours:
+            continue
+        features = json.loads(features_json)
+        if any(feature not in features for feature in MODEL_FEATURES):
+            continue # Wiersz zapisany dla innego zestawu cech - liczymy od zera
+        index.append(hour)
+        records.append(features)
+    return pd.DataFrame(records, index=pd.DatetimeIndex(index), columns=MODEL_FEATURES)
+
+
+def fetch_stored_features(mac_address, hour):
+    """
+    Wiersz cech zamkniętej godziny `hour` stacji z tabeli hourly_features (feature_store.py)
+    jako jednowierszowy DataFrame z MODEL_FEATURES; None, gdy godzina nie jest jeszcze policzona.
+    """
+    df_features = fetch_stored_features_bulk(mac_address, [hour])
+    return None if df_features.empty else df_features
+
+
+def _check_availability(hour, has_target_hour, hours_with_data):
+    """Reguła historii: InsufficientDataError, gdy godzina nie ma pomiaru albo ma za krótką historię."""
+    if not has_target_hour:
+        raise InsufficientDataError(f"Brak pomiarów w godzinie {hour}.", "Brak danych dla wybranej godziny.")
+    if hours_with_data < data_coverage.MIN_HISTORY_HOURS:
+        raise InsufficientDataError(
+            f"Dane z {hours_with_data} z {data_coverage.HISTORY_HOURS} godzin przed {hour} (wymagane {data_coverage.MIN_HISTORY_HOURS}).",
+            "Niewystarczająca ilość danych historycznych (48h).")
+
+
+def check_prediction_data(mac_address, hour):
+    """
+    Sprawdzenie danych przed pobraniem pomiarów i inżynierią cech (jak check_data_availability
+    panelu AI, z tabeli daily_coverage): godzina docelowa musi mieć pomiar, a 48 godzin przed nią
+    co najmniej data_coverage.MIN_HISTORY_HOURS godzin z danymi. Inaczej InsufficientDataError.
+    """
+    try:
+        with db.reader() as conn:
+            has_target_hour, hours_with_data = data_coverage.window_availability(conn, mac_address, hour)
+    except sqlite3.OperationalError:
+        return # Baza bez tabeli daily_coverage (przed migracją) - decyduje pełny przebieg
+    _check_availability(hour, has_target_hour, hours_with_data)
+
+
+HOURLY_AGGREGATE_COLS = ['temp', 'pres', 'rhum', 'wspd', 'wpgt', 'tsun', 'prcp']
+
+
+def fetch_compacted_hourly(start_dt, end_dt, mac_address):
+    """
+    Agregaty godzinowe (hourly_aggregates) stacji dla godzin z [start_dt, end_dt], których surowe
+    pomiary usunął już job retencji (retention.py, znacznik 'raw' w retention_watermarks).
+    Pusty DataFrame, gdy nic nie zostało skompaktowane.
+    """
+    empty = pd.DataFrame(columns=HOURLY_AGGREGATE_COLS, index=pd.DatetimeIndex([]), dtype=float)
+    try:
+        with db.reader() as conn:
+            row = conn.execute(
+                "SELECT compacted_before FROM retention_watermarks WHERE mac_address = ? AND tier = 'raw'", (mac_address,)
+            ).fetchone()
+            first_hour = start_dt.replace(minute=0, second=0, microsecond=0).strftime('%Y-%m-%d %H:%M:%S')
+            if row is None or row[0] <= first_hour:
+                return empty
+            with measure('data_fetch.sql_compacted') as stage:
+                df_hourly = pd.read_sql_query(f"""
+                    SELECT hour, {', '.join(HOURLY_AGGREGATE_COLS)}
+                    FROM hourly_aggregates
+                    WHERE mac_address = ? AND hour >= ? AND hour <= ? AND hour < ?
+                    ORDER BY hour ASC
+                """, conn, params=[mac_address, first_hour, end_dt.strftime('%Y-%m-%d %H:%M:%S'), row[0]])
+                stage['rows'] = len(df_hourly)
+    except sqlite3.OperationalError:
+        return empty # Baza sprzed migracji retencji
+    df_hourly.index = pd.DatetimeIndex(pd.to_datetime(df_hourly.pop('hour')))
+    return df_hourly.astype(float)
+
+
+def fill_hourly_gaps(df_hourly, last_hour=None):
+    """
+    Uzupełnia brakujące godziny (do last_hour włącznie) wierszami NaN, z sumami tsun/prcp = 0 -
+    tak jak resample surowych pomiarów dla godzin bez odczytów.
+    """
+    frame = df_hourly.reindex(pd.date_range(df_hourly.index[0], last_hour or df_hourly.index[-1], freq='H'))
+    frame[['tsun', 'prcp']] = frame[['tsun', 'prcp']].fillna(0.0)
+    return frame
+
+
+def hourly_window_frame(df_hourly, hour, buffer_hours=48):
+    """
+    Wejście engineer_features dla predykcji godziny `hour` z agregatów godzin z danymi (df_hourly):
+    okno [hour - 48h, hour] od pierwszej godziny z danymi, luki jak w resample surowego okna,
+    śnieg symulowany od początku okna - te same wiersze co w run_prediction i feature_store.
+    """
+    window = df_hourly[(df_hourly.index >= hour - timedelta(hours=buffer_hours)) & (df_hourly.index <= hour)]
+    return complete_hourly_frame(fill_hourly_gaps(window, hour))
+
+
+def resample_raw_to_hourly(df_raw):
+    """
+    Konwersja jednostek i agregacja godzinowa surowych pomiarów (indeks: server_timestamp)
+    do kolumn HOURLY_AGGREGATE_COLS. Godziny bez pomiarów w środku zakresu dostają NaN
+    (sumy tsun/prcp: 0). Wspólne dla aggregate_raw_to_hourly i feature_store.
+    """
+    laps = Laps('aggregation', len(df_raw))
+    df_converted = df_raw.copy()
+    df_converted.rename(columns={
+        'temperature': 'temp_celsius', 'pressure': 'pres_hpa', 'humidity': 'rhum_fraction',
+        'sunshine': 'sunshine_analog', 'wind_speed': 'wspd_kmh', 'precipitation': 'prcp_intensity'
+    }, inplace=True)
+
+    df_converted['temp'] = df_converted['temp_celsius']
+    df_converted['pres'] = df_converted['pres_hpa']
+    df_converted['rhum'] = df_converted['rhum_fraction'] * 100
+    df_converted['wspd_mps'] = df_converted['wspd_kmh'] / 3.6
+    df_converted['is_sunny_interval'] = (df_converted['sunshine_analog'] > SUNSHINE_THRESHOLD).astype(int)
+    df_converted['sunshine_minutes_interval'] = df_converted['is_sunny_interval'] * (5.0 / 60.0)
+    _MAX_PRECIP_MM_PER_5SEC_FOR_INTENSITY_1 = (MAX_PRECIP_RATE_MM_PER_HOUR_FOR_INTENSITY_1 / 3600.0) * 5.0
+    df_converted['prcp_mm_interval'] = df_converted['prcp_intensity'] * _MAX_PRECIP_MM_PER_5SEC_FOR_INTENSITY_1
+
+    final_cols_before_agg = ['temp', 'pres', 'rhum', 'wspd_mps', 'sunshine_minutes_interval', 'prcp_mm_interval']
+    current_cols = df_converted.columns.tolist()
+    missing_raw_cols = [col for col in final_cols_before_agg if col not in current_cols]
+    if missing_raw_cols:
+        raise ValueError(f"Brakuje kolumn do agregacji po konwersji: {missing_raw_cols}")
+    df_for_aggregation = df_converted[final_cols_before_agg].copy()
+    laps.lap('unit_conversion')
+
+    agg_functions_db = {
+        'temp': 'mean', 'pres': 'mean', 'rhum': 'mean',
+        'wspd_mps': ['mean', 'max'],
+        'sunshine_minutes_interval': 'sum', 'prcp_mm_interval': 'sum'
+    }
+    _cols_to_fill_na_db = ['wspd_mps', 'sunshine_minutes_interval', 'prcp_mm_interval', 'temp', 'pres', 'rhum']
+    for col in _cols_to_fill_na_db:
+        if col in df_for_aggregation.columns: df_for_aggregation[col].fillna(0, inplace=True) # Wypełnij NaN przed agregacją
+
+    df_hourly_multiindex = df_for_aggregation.resample('H').agg(agg_functions_db)
+
+    df_hourly_from_db = pd.DataFrame()
+    df_hourly_from_db['temp'] = df_hourly_multiindex[('temp', 'mean')]
+    df_hourly_from_db['pres'] = df_hourly_multiindex[('pres', 'mean')]
+    df_hourly_from_db['rhum'] = df_hourly_multiindex[('rhum', 'mean')]
+    df_hourly_from_db['wspd'] = df_hourly_multiindex[('wspd_mps', 'mean')]
+    df_hourly_from_db['wpgt'] = df_hourly_multiindex[('wspd_mps', 'max')]
+    df_hourly_from_db['tsun'] = df_hourly_multiindex[('sunshine_minutes_interval', 'sum')]
+    df_hourly_from_db['prcp'] = df_hourly_multiindex[('prcp_mm_interval', 'sum')]
+
+    df_hourly_from_db['tsun'] = np.clip(df_hourly_from_db['tsun'], 0, 60)
+    df_hourly_from_db['rhum'] = np.clip(df_hourly_from_db['rhum'], 0, 100)
+    laps.lap('resample')
+    return df_hourly_from_db
+
+
+def complete_hourly_frame(df_hourly):
+    """
+    Dokłada do agregatów godzinowych symulację pokrywy śnieżnej (od zera na początku zakresu),
+    'coco', 'weather_category' i 'year' - wejście engineer_features.
+    """
+    df_hourly.sort_index(inplace=True)
+    with measure('aggregation.snow_simulation', len(df_hourly)):
+        df_hourly['snow'] = simulate_snow_cover(df_hourly['prcp'].to_numpy(), df_hourly['temp'].to_numpy())
+    df_hourly['coco'] = 1 # Placeholder
+    df_hourly['weather_category'] = df_hourly['coco'].apply(aggregate_coco_FINAL_user_v2)
+    df_hourly['year'] = df_hourly.index.year
+    return df_hourly
+
+
+def merge_compacted_hourly(df_hourly, df_compacted):
+    """Agregaty z surowych pomiarów (lub None) uzupełnione godzinami skompaktowanymi, posortowane po godzinie."""
+    # Agregaty skompaktowanych godzin są ostateczne - spóźnione surowe odczyty z tych godzin pomijamy
+    frames = [df_compacted[HOURLY_AGGREGATE_COLS]]
+    if df_hourly is not None:
+        frames.append(df_hourly[~df_hourly.index.isin(df_compacted.index)])
+    return pd.concat(frames).sort_index()
+
+
+def aggregate_raw_to_hourly(df_raw, df_compacted=None):
+    """
+    Konwertuje surowe pomiary z bazy (kolumny jak w tabeli measurements) na rekordy godzinowe
+    w formacie Meteostat (temp, pres, rhum, wspd, wpgt, tsun, prcp) z symulacją pokrywy śnieżnej.
+    df_compacted: agregaty godzin bez surowych pomiarów (fetch_compacted_hourly), wstawiane przed nimi.
+    """
+    df_raw['server_timestamp'] = pd.to_datetime(df_raw['server_timestamp'])
+    df_raw.set_index('server_timestamp', inplace=True)
+    log.debug("Wczytano %s surowych rekordów z bazy.", len(df_raw))
+    has_compacted = df_compacted is not None and not df_compacted.empty
+
+    if df_raw.empty and not has_compacted:
+        raise InsufficientDataError("Brak danych do agregacji.")
+    try:
+        df_hourly_from_db = resample_raw_to_hourly(df_raw) if not df_raw.empty else None
+    except ValueError as e:
+        log.error("BŁĄD: %s. Sprawdź nazwy w bazie i logikę konwersji.", e)
+        raise AggregationError(str(e)) from e
+    if has_compacted:
+        df_hourly_from_db = fill_hourly_gaps(merge_compacted_hourly(df_hourly_from_db, df_compacted))
+        log.debug("Dołączono %s godzin z agregatów (surowe pomiary skompaktowane).", len(df_compacted))
+    if df_hourly_from_db.empty:
+        raise AggregationError("Agregacja nie dała wyników (pusty DataFrame).")
+    log.debug("Zagregowano dane z bazy do %s rekordów godzinowych.", len(df_hourly_from_db))
+
+    complete_hourly_frame(df_hourly_from_db)
+    log.debug("Zakończono symulację pokrywy śnieżnej dla danych z bazy.")
+
+    log.debug("Przygotowano %s rekordów z bazy do dalszego przetwarzania (inżynieria cech).", len(df_hourly_from_db))
+    return df_hourly_from_db
+
+
+# Suma list cech M1-M4 - tylko te cechy (z zależnościami) liczy inżynieria cech przy predykcji
+MODEL_FEATURES = sorted(set(FEATURES_M1 + FEATURES_M2 + FEATURES_M3 + FEATURES_M4))
+
+# --- Parametry inżynierii cech (wspólne dla engineer_features i planera cech) ---
+FE_BASE_COLS = ['temp', 'rhum', 'dew_point', 'spread', 'pres', 'wspd', 'prcp', 'tsun', 'wpgt', 'snow']
+FE_DIFF_PERIODS = [1, 2, 3, 6, 12, 24]
+FE_LAG_PERIODS = [1, 2, 3, 6, 12, 24]
+FE_CATEGORY_LAGS = [1, 2, 3, 6]
+FE_WINDOW_SIZES = [3, 6, 12, 24]
+FE_INTERACTION_COLS = ['temp', 'rhum', 'dew_point', 'spread', 'pres', 'wspd', 'tsun', 'wpgt'] # snow można dodać
+FE_REL_TO_MEAN_COLS = ['temp', 'rhum', 'spread', 'pres', 'wspd']
+FE_ADV_MATH_COLS = ['temp', 'rhum', 'dew_point', 'spread', 'pres', 'wspd'] # snow można dodać
+FE_USER_CATEGORIES = ['Clear/Fair', 'Cloudy/Overcast', 'Fog', 'Rain', 'Snow/Sleet/Freezing', 'Thunderstorm/Severe']
+
+FLAG_THRESHOLDS = {
+    'flag_sunny': ('tsun', '>', 45), 'flag_partly_sunny': ('tsun', '>', 15), 'flag_mostly_dark': ('tsun', '<', 10), 'flag_dark': ('tsun', '<', 1),
+    'flag_very_humid': ('rhum', '>', 96), 'flag_humid': ('rhum', '>', 85), 'flag_moderate_humid': ('rhum', '<=', 85), 'flag_dry': ('rhum', '<', 65), 'flag_very_dry': ('rhum', '<', 45),
+    'flag_near_saturation': ('spread', '<', 0.7), 'flag_close_saturation': ('spread', '<', 1.5), 'flag_moderate_spread': ('spread', '>', 3.0), 'flag_far_from_saturation': ('spread', '>', 6.0),
+    'flag_calm': ('wspd', '<', 2.5), 'flag_light_breeze': ('wspd', '>', 5.0), 'flag_moderate_wind': ('wspd', '>', 8.0), 'flag_windy': ('wspd', '>', 12.0), 'flag_very_windy': ('wspd', '>', 18.0),
+    'flag_has_precip': ('prcp', '>', 0), 'flag_light_precip': ('prcp', '>', 0.1), 'flag_moderate_precip': ('prcp', '>', 1.0), 'flag_heavy_precip': ('prcp', '>', 3.0),
+    'flag_very_high_pres': ('pres', '>', 1030), 'flag_high_pres': ('pres', '>', 1020), 'flag_moderate_pres': ('pres', '<=', 1020), 'flag_low_pres': ('pres', '<', 1005), 'flag_very_low_pres': ('pres', '<', 990),
+    'flag_below_freezing': ('temp', '<=', 0), 'flag_near_freezing_low': ('temp', '<=', 2), 'flag_near_freezing_high': ('temp', '<=', 5), 'flag_cool': ('temp', '<', 10), 'flag_mild': ('temp', '>=', 10), 'flag_warm': ('temp', '>', 18), 'flag_hot': ('temp', '>', 25),
+    'flag_dp_below_freezing': ('dew_point', '<=', 0), 'flag_dp_low': ('dew_point', '<', 5), 'flag_dp_high': ('dew_point', '>', 15), 'flag_dp_very_high': ('dew_point', '>', 20),
+    'flag_has_gusts': ('wpgt', '>', 0), 'flag_strong_gusts': ('wpgt', '>', 15), 'flag_severe_gusts': ('wpgt', '>', 25),
+    'flag_has_snow_cover': ('snow', '>', 0), 'flag_sig_snow_cover': ('snow', '>', 50), # Używa oszacowanego 'snow'
+    'flag_temp_rising_fast': ('temp_diff_1h', '>', 1.5), 'flag_temp_falling_fast': ('temp_diff_1h', '<', -1.5),
+    'flag_pres_rising_fast': ('pres_diff_1h', '>', 1.0), 'flag_pres_falling_fast': ('pres_diff_1h', '<', -1.0), 'flag_pres_falling_sig': ('pres_diff_1h', '<', -0.5),
+    'flag_rhum_rising_fast': ('rhum_diff_1h', '>', 10), 'flag_rhum_falling_fast': ('rhum_diff_1h', '<', -10),
+    'flag_spread_closing_fast': ('spread_diff_1h', '<', -0.8), 'flag_spread_opening_fast': ('spread_diff_1h', '>', 1.0),
+    'flag_wspd_increasing': ('wspd_diff_1h', '>', 2.0), 'flag_wspd_decreasing': ('wspd_diff_1h', '<', -2.0),
+    'flag_fog_ratio': ('rhum_div_spread_safe', '>', 120), 'flag_clear_ratio_rhum_spread': ('rhum_div_spread_safe', '<', 20), 'flag_clear_ratio_tsun_rhum': ('tsun_div_rhum_safe', '>', 0.6),
+    'flag_high_temp_range_6h': ('temp_roll6h_range', '>', 5), 'flag_low_pres_range_12h': ('pres_roll12h_range', '<', 5),
+    'flag_temp_accel_positive': ('temp_diff_1h_diff_1h', '>', 0.5), 'flag_pres_accel_negative': ('pres_diff_1h_diff_1h', '<', -0.3),
+    'flag_high_rhum_volatility': ('rhum_diff_1h_roll6h_std', '>', 8),
+    'flag_cold_and_humid': (('temp', '<', 5), ('rhum', '>', 90)), 'flag_warm_and_dry': (('temp', '>', 20), ('rhum', '<', 50)),
+    'flag_windy_and_precip': (('flag_windy', '==', 1), ('flag_has_precip', '==', 1)), 'flag_gusty_and_precip': (('flag_strong_gusts', '==', 1), ('flag_has_precip', '==', 1)),
+    'flag_near_freezing_precip': (('flag_near_freezing_low', '==', 1), ('flag_has_precip', '==', 1)), 'flag_below_freezing_precip': (('flag_below_freezing', '==', 1), ('flag_has_precip', '==', 1)),
+    'flag_fog_conditions_met': (('flag_near_saturation', '==', 1), ('flag_calm', '==', 1), ('flag_very_humid', '==', 1)),
+    'flag_potential_thunder_convection': (('temp', '>', 15), ('spread', '<', 8), ('flag_pres_falling_sig', '==', 1)),
+    'flag_potential_snow': (('flag_near_freezing_low', '==', 1), ('flag_dp_below_freezing', '==', 1), ('flag_has_precip', '==', 1)),
+    'flag_saturating_trend': (('flag_rhum_rising_fast', '==', 1), ('flag_spread_closing_fast', '==', 1)),
+    'flag_damp_conditions': (('rhum', '>', 92), ('spread', '<', 1.5)), 'flag_frontal_drizzle_potential': (('flag_pres_falling_sig', '==', 1), ('rhum', '>', 85), ('spread', '<', 3.0)),
+}
+
+# Cechy z nazwą ustaloną na sztywno (nazwa -> kolumny, z których powstaje)
+FE_NAMED_INTERACTIONS = {
+    'abs_temp_diff_div_wspd_safe': ['temp_diff_1h', 'wspd'],
+    'abs_pres_diff_div_wspd_safe': ['pres_diff_1h', 'wspd'],
+    'temp_x_abs_pres_diff_1h': ['temp', 'pres_diff_1h'],
+    'rhum_x_abs_spread_diff_1h': ['rhum', 'spread_diff_1h'],
+    'prcp_lag_1h_x_temp': ['prcp_lag_1h', 'temp'],
+    'dp_div_temp_safe': ['dew_point', 'temp'],
+    'spread_div_temp_safe': ['spread', 'temp'],
+    'temp_x_hour_sin': ['temp', 'hour_sin'],
+    'wspd_x_day_of_year_cos': ['wspd', 'day_of_year_cos'],
+    'rhum_x_pres_diff_1h': ['rhum', 'pres_diff_1h'],
+}
+
+def _safe_category_name(category):
+    return category.replace('/', '_').replace(' ', '_').replace('-', '_').lower()
+
+def _build_feature_catalog():
+    """
+    Katalog wszystkich cech tworzonych przez engineer_features: {nazwa: [bezpośrednie zależności]}.
+    Odwzorowuje kolejne etapy engineer_features; kolumny wejściowe (temp, rhum, ..., weather_category) nie mają wpisu.
+    """
+    catalog = {}
+    def add(name, deps):
+        catalog.setdefault(name, [])
+        catalog[name].extend(d for d in deps if d not in catalog[name])
+
+    # 1. Cechy podstawowe i czasowe
+    add('dew_point', ['temp', 'rhum']); add('spread', ['temp', 'dew_point'])
+    for name in ['hour', 'day_of_year', 'month', 'day_of_week', 'week_of_year', 'quarter']:
+        add(name, [])
+    add('is_weekend', ['day_of_week'])
+    for base in ['hour', 'day_of_year', 'month']:
+        add(f'{base}_sin', [base]); add(f'{base}_cos', [base])
+    add('is_daytime_approx', ['tsun'])
+    # 2. Różnice czasowe
+    diff_names = []
+    for period in FE_DIFF_PERIODS:
+        for col in FE_BASE_COLS:
+            add(f'{col}_diff_{period}h', [col]); add(f'abs_{col}_diff_{period}h', [f'{col}_diff_{period}h'])
+            diff_names.extend([f'{col}_diff_{period}h', f'abs_{col}_diff_{period}h'])
+    # 3. Wartości opóźnione
+    for period in FE_LAG_PERIODS:
+        for col in FE_BASE_COLS + [f for f in diff_names if '_diff_1h' in f]:
+            add(f'{col}_lag_{period}h', [col])
+    # 4. Opóźnione flagi kategorii
+    for lag in FE_CATEGORY_LAGS:
+        for category in FE_USER_CATEGORIES:
+            add(f'was_{_safe_category_name(category)}_lag{lag}h', ['weather_category'])
+        add(f'was_precip_category_lag{lag}h', ['weather_category'])
+    # 5. Statystyki kroczące
+    for window in FE_WINDOW_SIZES:
+        for col in FE_BASE_COLS:
+            for op_name in ['mean', 'std', 'median', 'min', 'max'] + (['sum'] if col in ['prcp', 'tsun'] else []):
+                add(f'{col}_roll{window}h_{op_name}', [col])
+    # 6. Interakcje i cechy pochodne
+    for i in range(len(FE_INTERACTION_COLS)):
+        for j in range(i, len(FE_INTERACTION_COLS)):
+            col1, col2 = FE_INTERACTION_COLS[i], FE_INTERACTION_COLS[j]
+            add(f'{col1}_x_{col2}', [col1, col2]); add(f'{col1}_div_{col2}_safe', [col1, col2])
+            if i != j: add(f'{col2}_div_{col1}_safe', [col1, col2])
+    for col in FE_INTERACTION_COLS + ['prcp', 'snow']:
+        add(f'{col}_pow2', [col])
+        if col in ['wspd', 'spread', 'prcp', 'snow']: add(f'{col}_pow3', [col])
+    for name, deps in FE_NAMED_INTERACTIONS.items():
+        add(name, deps)
+    for window in FE_WINDOW_SIZES:
+        for col in FE_REL_TO_MEAN_COLS:
+            add(f'{col}_rel_to_roll{window}h_mean', [col, f'{col}_roll{window}h_mean'])
+    # 7. Dodatkowe cechy matematyczne
+    for window in FE_WINDOW_SIZES:
+        for col in FE_ADV_MATH_COLS:
+            add(f'{col}_roll{window}h_range', [f'{col}_roll{window}h_min', f'{col}_roll{window}h_max'])
+            add(f'{col}_div_roll{window}h_std_safe', [col, f'{col}_roll{window}h_std'])
+            add(f'{col}_diff_1h_roll{window}h_std', [f'{col}_diff_1h'])
+    for col in FE_ADV_MATH_COLS:
+        add(f'{col}_diff_1h_diff_1h', [f'{col}_diff_1h'])
+    # 8. Flagi binarne
+    for flag_name, conditions in FLAG_THRESHOLDS.items():
+        add(flag_name, [c[0] for c in conditions] if isinstance(conditions[0], tuple) else [conditions[0]])
+    return catalog
+
+FEATURE_CATALOG = _build_feature_catalog()
+
+def plan_features(required_features):
+    """
+    Zbiór cech, które engineer_features musi policzyć, aby powstały `required_features`
+    (wraz z przechodnimi zależnościami, np. flag_windy_and_precip -> flag_windy, flag_has_precip -> wspd, prcp).
+    """
+    needed = set()
+    stack = list(required_features)
+    while stack:
+        name = stack.pop()
+        if name in needed:
+            continue
+        needed.add(name)
+        stack.extend(FEATURE_CATALOG.get(name, []))
+    return needed
+
+
+def engineer_features(df_for_feature_engineering, required_features=None):
+    """
+    Rozszerzona inżynieria cech v2 na rekordach godzinowych (jedna stacja, ciągły zakres czasu).
+    Z `required_features` liczone są tylko te cechy i ich zależności (plan_features); wartości
+    są identyczne jak przy pełnym przebiegu, bo każdy etap (także imputacja NaN) działa kolumnowo.
+    Zwraca krotkę (DataFrame z cechami po imputacji NaN, lista nazw utworzonych flag binarnych).
+    """
+    # --- Etap 2: Rozszerzona Inżynieria Cech v2 ---
+    # Ten blok operuje na `df_for_feature_engineering` i zapisuje wynik do `df_processed_final`
+    log.info("--- Etap 2: Rozszerzona Inżynieria Cech v2 ---")
+    feature_engineering_start_time_actual = time.time() # Zmieniona nazwa zmiennej, żeby nie kolidowała
+    df = df_for_feature_engineering.copy() # Używamy nazwy 'df' tak jak w oryginalnym bloku FE
+    epsilon = 1e-6
+    laps = Laps('feature_engineering', len(df)) # Czas każdej rodziny cech -> metryki (ai_pipeline)
+
+    needed = plan_features(required_features) if required_features is not None else None
+    def want(feature_name):
+        return needed is None or feature_name in needed
+    if needed is not None:
+        log.debug("Plan cech: %s z %s cech potrzebnych dla %s wymaganych.", len(needed & FEATURE_CATALOG.keys()), len(FEATURE_CATALOG), len(set(required_features)))
+
+    # 1. Cechy Podstawowe i Czasowe
+    log.debug("Tworzenie cech podstawowych i czasowych...")
+    if want('dew_point'): df['dew_point'] = calculateDewPoint_array(df['temp'].to_numpy(), df['rhum'].to_numpy())
+    if want('spread'): df['spread'] = df['temp'] - df['dew_point']
+    if want('hour'): df['hour'] = df.index.hour
+    if want('day_of_year'): df['day_of_year'] = df.index.dayofyear
+    if want('month'): df['month'] = df.index.month
+    # 'year' już powinno być w df
+    if want('day_of_week'): df['day_of_week'] = df.index.dayofweek
+    if want('week_of_year'): df['week_of_year'] = df.index.isocalendar().week.astype(int)
+    if want('quarter'): df['quarter'] = df.index.quarter
+    if want('is_weekend'): df['is_weekend'] = (df['day_of_week'] >= 5).astype(int)
+    if want('hour_sin'): df['hour_sin'] = np.sin(2 * np.pi * df['hour']/24.0)
+    if want('hour_cos'): df['hour_cos'] = np.cos(2 * np.pi * df['hour']/24.0)
+    if want('day_of_year_sin'): df['day_of_year_sin'] = np.sin(2 * np.pi * df['day_of_year']/366.0)
+    if want('day_of_year_cos'): df['day_of_year_cos'] = np.cos(2 * np.pi * df['day_of_year']/366.0)
+    if want('month_sin'): df['month_sin'] = np.sin(2 * np.pi * df['month']/12.0)
+    if want('month_cos'): df['month_cos'] = np.cos(2 * np.pi * df['month']/12.0)
+    if not want('is_daytime_approx'):
+        pass
+    elif 'tsun' in df.columns and pd.api.types.is_numeric_dtype(df['tsun']): # Dodano sprawdzenie typu
+        df['is_daytime_approx'] = (df['tsun'] > 0).astype(int)
+    else:
+        df['is_daytime_approx'] = 0 # Jeśli tsun nie istnieje lub nie jest numeryczne
+
+    laps.lap('basic_time')
+    # 2. Różnice Czasowe
+    log.debug("Tworzenie cech różnic czasowych...")
+    periods_diff = FE_DIFF_PERIODS
+    cols_to_diff = FE_BASE_COLS
+    diff_feature_names = []
+    for period in periods_diff:
+        for col in cols_to_diff:
+            diff_col_name = f'{col}_diff_{period}h'
+            abs_diff_col_name = f'abs_{col}_diff_{period}h'
+            if not want(diff_col_name):
+                continue
+            if col in df.columns and pd.api.types.is_numeric_dtype(df[col]): # Sprawdzenie czy kolumna jest numeryczna
+                df[diff_col_name] = df[col].diff(periods=period)
+                diff_feature_names.append(diff_col_name)
+                if want(abs_diff_col_name):
+                    df[abs_diff_col_name] = df[diff_col_name].abs()
+                    diff_feature_names.append(abs_diff_col_name)
+            elif col in df.columns:
+                log.warning("Ostrzeżenie: Kolumna '%s' do różnicowania nie jest numeryczna i zostanie pominięta.", col)
+            # else: # Kolumna nie istnieje, pomijamy po cichu
+            #    pass
+
+
+    laps.lap('diffs')
+    # 3. Wartości Opóźnione
+    log.debug("Tworzenie cech opóźnionych...")
+    periods_lag = FE_LAG_PERIODS
+    # Dodajemy nowo utworzone diff_1h do listy cech do opóźniania
+    # Upewnijmy się, że bierzemy tylko te diff_1h, które faktycznie zostały utworzone i są numeryczne
+    valid_diff_1h_features = [f_name for f_name in diff_feature_names if '_diff_1h' in f_name and f_name in df.columns and pd.api.types.is_numeric_dtype(df[f_name])]
+    cols_to_lag = FE_BASE_COLS + valid_diff_1h_features
+    lagged_feature_names = []
+    for period in periods_lag:
+        for col in cols_to_lag:
+            lag_col_name = f'{col}_lag_{period}h'
+            if not want(lag_col_name):
+                continue
+            if col in df.columns and pd.api.types.is_numeric_dtype(df[col]): # Sprawdzenie czy kolumna jest numeryczna
+                df[lag_col_name] = df[col].shift(periods=period)
+                lagged_feature_names.append(lag_col_name)
+            elif col in df.columns:
+                log.warning("Ostrzeżenie: Kolumna '%s' do opóźniania nie jest numeryczna i zostanie pominięta.", col)
+            # else: # Kolumna nie istnieje (np. diff_1h nie powstał), pomijamy
+            #    pass
+
+
+    laps.lap('lags')
+    # 4. Opóźnione Flagi Kategorii
+    log.debug("Tworzenie opóźnionych flag kategorii...")
+    lagged_cat_feature_names = []
+
+    # Jeśli 'weather_category' nie istnieje (np. błąd wcześniej), stwórz placeholder
+    if 'weather_category' not in df.columns:
+        log.warning("OSTRZEŻENIE: Brak kolumny 'weather_category' do tworzenia flag opóźnionych. Używam placeholdera 'Unknown'.")
+        df['weather_category'] = "Unknown"
+
+    # ZMIENIONE: Użyj wszystkich możliwych kategorii zdefiniowanych globalnie,
+    # a nie tylko tych, które aktualnie występują w df['weather_category']
+    # (bo w trybie predykcji z placeholderem coco, df['weather_category'] może być stałe)
+    all_possible_user_categories = FE_USER_CATEGORIES
+    # lub jeśli masz `all_categories_user` zdefiniowane globalnie:
+    # all_possible_user_categories = all_categories_user # Upewnij się, że ta lista zawiera wszystkie 6 kategorii
+
+    log.debug("Tworzenie flag opóźnionych dla potencjalnych kategorii: %s", all_possible_user_categories)
+    for lag in FE_CATEGORY_LAGS:
+        shifted_cat = df['weather_category'].shift(lag) # To nadal bazuje na aktualnej (może być stałej) weather_category
+
+        # Twórz flagi dla WSZYSTKICH zdefiniowanych kategorii użytkownika
+        for cat_possible in all_possible_user_categories:
+            safe_cat_name = _safe_category_name(cat_possible)
+            flag_name = f'was_{safe_cat_name}_lag{lag}h'
+            if not want(flag_name):
+                continue
+            # Jeśli aktualna (przesunięta) kategoria to `cat_possible`, flaga = 1, inaczej 0.
+            # Nawet jeśli `shifted_cat` jest zawsze 'Clear/Fair', to dla `cat_possible` = 'Rain',
+            # warunek `(shifted_cat == cat_possible)` będzie False, więc flaga `was_rain_lagXh` będzie 0.
+            # To jest poprawne zachowanie.
+            df[flag_name] = (shifted_cat == cat_possible).astype(int)
+            lagged_cat_feature_names.append(flag_name)
+
+        # Flaga dla kategorii opadowych - pozostaje bez zmian, bazuje na shifted_cat
+        precip_flag_name = f'was_precip_category_lag{lag}h'
+        # precip_categories_user powinno być zdefiniowane globalnie
+        if want(precip_flag_name):
+            df[precip_flag_name] = shifted_cat.isin(precip_categories_user).astype(int)
+            lagged_cat_feature_names.append(precip_flag_name)
+
+    laps.lap('category_lags')
+    # 5. Statystyki Kroczące
+    log.debug("Tworzenie statystyk kroczących...")
+    window_sizes = FE_WINDOW_SIZES
+    cols_for_rolling = FE_BASE_COLS # Dodano snow
+    rolling_feature_names = []
+    for window in window_sizes:
+        for col in cols_for_rolling:
+            if col in df.columns and pd.api.types.is_numeric_dtype(df[col]):
+                rolling_window = df[col].rolling(window=window, closed='right', min_periods=max(1, window // 2))
+                ops = {'mean': rolling_window.mean, 'std': rolling_window.std,
+                    'median': rolling_window.median, 'min': rolling_window.min, 'max': rolling_window.max}
+                if col in ['prcp', 'tsun']:
+                    ops['sum'] = rolling_window.sum
+                for op_name, op_func in ops.items():
+                    feat_name = f'{col}_roll{window}h_{op_name}'
+                    if not want(feat_name):
+                        continue
+                    df[feat_name] = op_func()
+                    rolling_feature_names.append(feat_name)
+            elif col in df.columns:
+                log.warning("Ostrzeżenie: Kolumna '%s' dla statystyk kroczących nie jest numeryczna i zostanie pominięta.", col)
+
+
+    laps.lap('rolling')
+    # 6. Interakcje i Cechy Pochodne
+    log.debug("Tworzenie interakcji i cech pochodnych...")
+    derived_feature_names = []
+    base_cols = FE_INTERACTION_COLS # snow można dodać
+    for i in range(len(base_cols)):
+        for j in range(i, len(base_cols)):
+            col1, col2 = base_cols[i], base_cols[j]
+            # Sprawdzenie czy obie kolumny istnieją i są numeryczne
+            if col1 in df.columns and pd.api.types.is_numeric_dtype(df[col1]) and \
+            col2 in df.columns and pd.api.types.is_numeric_dtype(df[col2]):
+                if want(f'{col1}_x_{col2}') and f'{col1}_x_{col2}' not in df.columns: df[f'{col1}_x_{col2}'] = df[col1] * df[col2]; derived_feature_names.append(f'{col1}_x_{col2}')
+                if want(f'{col1}_div_{col2}_safe') and f'{col1}_div_{col2}_safe' not in df.columns: df[f'{col1}_div_{col2}_safe'] = df[col1] / (df[col2] + epsilon); derived_feature_names.append(f'{col1}_div_{col2}_safe')
+                if i != j and want(f'{col2}_div_{col1}_safe') and f'{col2}_div_{col1}_safe' not in df.columns: df[f'{col2}_div_{col1}_safe'] = df[col2] / (df[col1] + epsilon); derived_feature_names.append(f'{col2}_div_{col1}_safe')
+
+    cols_for_pow = base_cols + ['prcp', 'snow'] # Dodano snow
+    for col in cols_for_pow:
+        if col in df.columns and pd.api.types.is_numeric_dtype(df[col]):
+            if want(f'{col}_pow2') and f'{col}_pow2' not in df.columns: df[f'{col}_pow2'] = df[col].pow(2); derived_feature_names.append(f'{col}_pow2')
+            if col in ['wspd', 'spread', 'prcp', 'snow'] and want(f'{col}_pow3') and f'{col}_pow3' not in df.columns: df[f'{col}_pow3'] = df[col].pow(3); derived_feature_names.append(f'{col}_pow3')
+
+    # Sprawdzenia dla konkretnych interakcji
+    def check_and_create_interaction(df_ref, derived_list, new_feat_name, col_list, operation_str):
+        if not want(new_feat_name):
+            return
+        # Sprawdza czy wszystkie potrzebne kolumny istnieją i są numeryczne
+        valid_cols = all(c in df_ref.columns and pd.api.types.is_numeric_dtype(df_ref[c]) for c in col_list)
+        if valid_cols:
+            try:
+                # Używamy eval do wykonania operacji, wymaga ostrożności
+                # Alternatywnie, można użyć if/else dla każdej operacji
+                df_ref[new_feat_name] = eval(operation_str, {'df': df_ref, 'epsilon': epsilon, 'abs': abs, 'np': np})
+                derived_list.append(new_feat_name)
+            except Exception as e:
+                log.error("Błąd przy tworzeniu cechy interakcji '%s': %s", new_feat_name, e)
+        # else:
+        #    print(f"    Pominięto tworzenie '{new_feat_name}' z powodu braku/niepoprawnego typu kolumn: {col_list}")
+
+
+    check_and_create_interaction(df, derived_feature_names, 'abs_temp_diff_div_wspd_safe', ['temp_diff_1h', 'wspd'], "abs(df['temp_diff_1h']) / (df['wspd'] + epsilon)")
+    check_and_create_interaction(df, derived_feature_names, 'abs_pres_diff_div_wspd_safe', ['pres_diff_1h', 'wspd'], "abs(df['pres_diff_1h']) / (df['wspd'] + epsilon)")
+    check_and_create_interaction(df, derived_feature_names, 'temp_x_abs_pres_diff_1h', ['temp', 'pres_diff_1h'], "df['temp'] * abs(df['pres_diff_1h'])")
+    check_and_create_interaction(df, derived_feature_names, 'rhum_x_abs_spread_diff_1h', ['rhum', 'spread_diff_1h'], "df['rhum'] * abs(df['spread_diff_1h'])")
+    check_and_create_interaction(df, derived_feature_names, 'prcp_lag_1h_x_temp', ['prcp_lag_1h', 'temp'], "df['prcp_lag_1h'] * df['temp']")
+
+    for window in window_sizes:
+        for col in FE_REL_TO_MEAN_COLS:
+            mean_col_name = f'{col}_roll{window}h_mean'
+            rel_col_name = f'{col}_rel_to_roll{window}h_mean'
+            check_and_create_interaction(df, derived_feature_names, rel_col_name, [col, mean_col_name], f"df['{col}'] - df['{mean_col_name}']")
+
+
+    laps.lap('interactions')
+    # 7. Dodatkowe Cechy Matematyczne
+    log.debug("Tworzenie dodatkowych cech matematycznych...")
+    additional_math_features = []
+    cols_for_adv_math = FE_ADV_MATH_COLS # snow można dodać
+    for window in window_sizes:
+        for col in cols_for_adv_math:
+            min_col=f'{col}_roll{window}h_min'; max_col=f'{col}_roll{window}h_max'; range_col=f'{col}_roll{window}h_range'
+            std_col=f'{col}_roll{window}h_std'; ratio_std_col=f'{col}_div_roll{window}h_std_safe'
+            diff_1h_col=f'{col}_diff_1h'; volatility_col=f'{diff_1h_col}_roll{window}h_std'
+
+            check_and_create_interaction(df, additional_math_features, range_col, [min_col, max_col], f"df['{max_col}'] - df['{min_col}']")
+            check_and_create_interaction(df, additional_math_features, ratio_std_col, [col, std_col], f"df['{col}'] / (df['{std_col}'] + epsilon)")
+
+            if want(volatility_col) and diff_1h_col in df.columns and pd.api.types.is_numeric_dtype(df[diff_1h_col]):
+                df[volatility_col] = df[diff_1h_col].rolling(window=window, min_periods=max(1, window//2)).std()
+                additional_math_features.append(volatility_col)
+
+    for col in cols_for_adv_math:
+        diff_1h_col = f'{col}_diff_1h'; accel_col = f'{diff_1h_col}_diff_1h'
+        if want(accel_col) and diff_1h_col in df.columns and pd.api.types.is_numeric_dtype(df[diff_1h_col]):
+            df[accel_col] = df[diff_1h_col].diff(1)
+            additional_math_features.append(accel_col)
+
+    check_and_create_interaction(df, additional_math_features, 'dp_div_temp_safe', ['dew_point', 'temp'], "df['dew_point'] / (df['temp'] + np.sign(df['temp'])*epsilon + epsilon)")
+    check_and_create_interaction(df, additional_math_features, 'spread_div_temp_safe', ['spread', 'temp'], "df['spread'] / (df['temp'] + np.sign(df['temp'])*epsilon + epsilon)")
+    check_and_create_interaction(df, additional_math_features, 'temp_x_hour_sin', ['temp', 'hour_sin'], "df['temp'] * df['hour_sin']")
+    check_and_create_interaction(df, additional_math_features, 'wspd_x_day_of_year_cos', ['wspd', 'day_of_year_cos'], "df['wspd'] * df['day_of_year_cos']")
+    check_and_create_interaction(df, additional_math_features, 'rhum_x_pres_diff_1h', ['rhum', 'pres_diff_1h'], "df['rhum'] * df['pres_diff_1h']")
+
+
+    laps.lap('math')
+    # 8. Rozszerzone Flagi Binarne
+    log.debug("Obliczanie flag binarnych...")
+    thresholds = FLAG_THRESHOLDS
+    calculated_flags = set()
+    flags_to_calculate = [flag_name for flag_name in thresholds if want(flag_name)]
+    max_iterations = 5
+    iteration = 0
+    threshold_flags_names = [] # Lista do przechowywania nazw utworzonych flag
+    thresholds_copy = thresholds.copy() # Kopia do bezpiecznego usuwania
+
+    while flags_to_calculate and iteration < max_iterations:
+        newly_calculated_in_iter = [] # Flagi obliczone w tej iteracji
+        remaining_flags_for_next_iter = []
+
+        for flag_name in list(flags_to_calculate): # Iterujemy po kopii listy, aby móc ją modyfikować
+            if flag_name not in thresholds_copy: # Jeśli flaga została usunięta z powodu błędu
+                if flag_name in flags_to_calculate: flags_to_calculate.remove(flag_name) # Upewnij się, że jest usunięta
+                continue
+
+            conditions = thresholds_copy[flag_name]
+            can_calculate_flag = True
+
+            current_required_features_for_flag = []
+            is_combined_flag = isinstance(conditions[0], tuple)
+            if is_combined_flag:
+                current_required_features_for_flag = [cond[0] for cond in conditions]
+            else:
+                current_required_features_for_flag = [conditions[0]]
+
+            for feature_needed in current_required_features_for_flag:
+                is_dependency_on_other_flag = feature_needed.startswith('flag_')
+                if is_dependency_on_other_flag and feature_needed not in calculated_flags:
+                    can_calculate_flag = False; break
+                elif not is_dependency_on_other_flag and (feature_needed not in df.columns or not pd.api.types.is_numeric_dtype(df[feature_needed])):
+                    log.error("BŁĄD KRYTYCZNY: Bazowa cecha '%s' (numeryczna) dla flagi '%s' nie istnieje lub nie jest numeryczna. Pomijam flagę '%s'.", feature_needed, flag_name, flag_name)
+                    if flag_name in thresholds_copy: del thresholds_copy[flag_name]
+                    if flag_name in flags_to_calculate: flags_to_calculate.remove(flag_name)
+                    can_calculate_flag = False; break
+
+            if not can_calculate_flag:
+                if flag_name in thresholds_copy: # Jeśli błąd nie był krytyczny (tylko zależność)
+                    remaining_flags_for_next_iter.append(flag_name)
+                continue
+
+            # Obliczanie flagi
+            final_condition_series = pd.Series(True, index=df.index)
+            process_condition_lambda = lambda feat, op, thr: {
+                '<': df[feat] < thr, '>': df[feat] > thr,
+                '<=': df[feat] <= thr, '>=': df[feat] >= thr,
+                '==': df[feat] == thr, '!=': df[feat] != thr
+            }.get(op, pd.Series(False, index=df.index)) # Fallback na False
+
+            try:
+                if is_combined_flag:
+                    for feature, operator, threshold_val in conditions:
+                        if feature not in df.columns or not pd.api.types.is_numeric_dtype(df[feature]): # Podwójne sprawdzenie
+                            raise KeyError(f"Cecha '{feature}' dla flagi '{flag_name}' nie istnieje lub nie jest numeryczna w df podczas budowania warunku.")
+                        final_condition_series &= process_condition_lambda(feature, operator, threshold_val)
+                else:
+                    feature, operator, threshold_val = conditions
+                    if feature not in df.columns or not pd.api.types.is_numeric_dtype(df[feature]): # Podwójne sprawdzenie
+                        raise KeyError(f"Cecha '{feature}' dla flagi '{flag_name}' nie istnieje lub nie jest numeryczna w df podczas budowania warunku.")
+                    final_condition_series = process_condition_lambda(feature, operator, threshold_val)
+
+                df[flag_name] = final_condition_series.astype(int)
+                threshold_flags_names.append(flag_name)
+                calculated_flags.add(flag_name)
+                newly_calculated_in_iter.append(flag_name)
+                if flag_name in flags_to_calculate: flags_to_calculate.remove(flag_name)
+                if flag_name in thresholds_copy: del thresholds_copy[flag_name]
+
+            except KeyError as ke_flag:
+                log.error("BŁĄD KRYTYCZNY (KeyError) przy obliczaniu flagi '%s': %s. Pomijam flagę.", flag_name, ke_flag)
+                if flag_name in thresholds_copy: del thresholds_copy[flag_name]
+                if flag_name in flags_to_calculate: flags_to_calculate.remove(flag_name)
+            except Exception as e_flag:
+                log.error("BŁĄD (Inny) przy obliczaniu flagi '%s': %s. Spróbuję później.", flag_name, e_flag)
+                if flag_name not in remaining_flags_for_next_iter and flag_name in thresholds_copy:
+                    remaining_flags_for_next_iter.append(flag_name)
+
+        flags_to_calculate = remaining_flags_for_next_iter
+        iteration += 1
+        if not newly_calculated_in_iter and flags_to_calculate:
+            log.warning("OSTRZEŻENIE: W iteracji %s nie udało się obliczyć żadnych nowych flag. Pozostałe flagi do obliczenia: %s", iteration, flags_to_calculate)
+            unresolved_dependencies_report = {}
+            for fname_report in flags_to_calculate:
+                if fname_report in thresholds_copy:
+                    conds_report = thresholds_copy[fname_report]
+                    is_comb_report = isinstance(conds_report[0], tuple)
+                    req_feats_report = [c[0] for c in conds_report] if is_comb_report else [conds_report[0]]
+                    missing_deps_report = [rf for rf in req_feats_report if rf.startswith('flag_') and rf not in calculated_flags]
+                    if missing_deps_report: unresolved_dependencies_report[fname_report] = missing_deps_report
+            if unresolved_dependencies_report: log.warning("Nierozwiązane zależności flag: %s", unresolved_dependencies_report)
+            break 
+
+    if flags_to_calculate:
+        log.warning("OSTRZEŻENIE KOŃCOWE: Nie udało się obliczyć wszystkich flag po %s iteracjach. Nieuobliczone: %s", max_iterations, flags_to_calculate)
+    log.debug("Utworzono %s flag binarnych.", len(threshold_flags_names))
+    laps.lap('flags')
+    # Koniec bloku flag binarnych
+
+    feature_engineering_duration_actual = time.time() - feature_engineering_start_time_actual
+    log.info("--- Zakończono Rozszerzoną Inżynierię Cech v2 (%.1f sek) ---", feature_engineering_duration_actual)
+
+
+    log.debug("Wypełnianie brakujących wartości (NaN) metodą 'forward fill'...")
+    # Zidentyfikuj kolumny, które mają być wypełnione. Powinny to być wszystkie wygenerowane cechy.
+    # Możemy po prostu zadziałać na całym DataFrame, ale ostrożnie.
+    # Kolumny, które nie powinny być wypełniane (jak 'year', 'coco'), zazwyczaj nie mają NaN.
+
+    # Wybieramy tylko kolumny numeryczne do wypełnienia
+    numeric_cols = df.select_dtypes(include=np.number).columns.tolist()
+
+    # Zapamiętujemy, ile było NaN przed
+    nan_before = df[numeric_cols].isnull().sum().sum()
+
+    # Używamy forward fill, a potem back fill, aby wypełnić też ewentualne NaN na początku
+    df[numeric_cols] = df[numeric_cols].fillna(method='ffill').fillna(method='bfill')
+
+    nan_after = df[numeric_cols].isnull().sum().sum()
+    log.debug("Wypełniono %s wartości NaN.", nan_before - nan_after)
+
+    # Jeśli po tym nadal są jakieś NaN (co może się zdarzyć, jeśli cała kolumna jest pusta),
+    # wypełniamy je zerem.
+    if nan_after > 0:
+        log.debug("Pozostało %s wartości NaN. Wypełniam zerami.", nan_after)
+        df.fillna(0, inplace=True)
+    laps.lap('imputation')
+    # --- KONIEC ETAPU IMPUTACJI ---
+
+
+    # --- FINALNE CZYSZCZENIE NaN ---
+    # Ten blok teraz powinien usuwać znacznie mniej wierszy, a idealnie wcale.
+    log.debug("Usuwanie NaN po pełnej inżynierii cech (finalne)...")
+
+    # --- FINALNE CZYSZCZENIE NaN ---
+    log.debug("Usuwanie NaN po pełnej inżynierii cech (finalne)...")
+    rows_before_final_dropna = len(df)
+    # Upewnij się, że 'year' i 'coco' są w df, jeśli używasz ich w cols_to_exclude_from_dropna
+    if 'year' not in df.columns: df['year'] = df.index.year
+    if 'coco' not in df.columns: df['coco'] = 1 # Placeholder jeśli brak
+
+    potential_feature_cols = list(df.select_dtypes(include=np.number).columns)
+    cols_to_exclude_from_dropna = ['coco', 'year'] # Te kolumny nie są cechami numerycznymi do modelu
+    # Tworzymy listę cech, na podstawie których będziemy usuwać NaN
+    # Powinny to być wszystkie numeryczne cechy, które mogą być użyte w modelach
+    features_for_dropna_final = [f for f in potential_feature_cols if f not in cols_to_exclude_from_dropna and f in df.columns]
+
+    if not features_for_dropna_final:
+        log.warning("OSTRZEŻENIE: Brak numerycznych cech (poza 'coco', 'year') do sprawdzenia NaN. Nie wykonano dropna.")
+    else:
+        # Usuwamy wiersze, które mają NaN w którejkolwiek z wybranych cech numerycznych
+        # To jest ważne, bo XGBoost nie lubi NaN.
+        df.dropna(subset=features_for_dropna_final, inplace=True)
+
+    rows_after_processing_final = len(df)
+    log.debug("Usunięto %s wierszy z NaN.", rows_before_final_dropna - rows_after_processing_final)
+    log.debug("Ostateczna liczba rekordów po inżynierii cech: %s.", rows_after_processing_final)
+    laps.lap('dropna', rows_after_processing_final)
+
+    if rows_after_processing_final == 0:
+        raise FeatureEngineeringError("Brak danych po pełnym przetworzeniu i usunięciu NaN. Sprawdź logikę i dane wejściowe.")
+
+    df_processed_final = df.copy() # Wynik inżynierii cech
+    return df_processed_final, threshold_flags_names
+
+
+def resolve_feature_lists(df_processed_final, threshold_flags_names):
+    """
+    Weryfikuje, które cechy z FEATURES_M1..M4 są dostępne w danych po inżynierii cech.
+    Zwraca krotkę (słownik {model: lista cech}, posortowana lista wszystkich potrzebnych cech).
+    """
+    log.debug("Weryfikacja dostępności cech...")
+    feature_lists_final = {}
+    all_features_unpacked_for_models = [] # Zmieniona nazwa, aby uniknąć konfliktu
+    for name, features_list_for_model in [("M1", FEATURES_M1), ("M2", FEATURES_M2), ("M3", FEATURES_M3), ("M4", FEATURES_M4)]:
+        available_model_features = [f for f in features_list_for_model if f in df_processed_final.columns]
+        missing_model_features = sorted(list(set(features_list_for_model) - set(available_model_features)))
+
+        non_flag_missing_model = [m for m in missing_model_features if not m.startswith('flag_')]
+        # threshold_flags_names jest zdefiniowane w bloku FE
+        flag_missing_not_created_model = [m for m in missing_model_features if m.startswith('flag_') and m not in threshold_flags_names]
+
+        if non_flag_missing_model:
+            log.error("KRYTYCZNE OSTRZEŻENIE (%s): Nie znaleziono NIE-FLAGOWYCH cech: %s.", name, ', '.join(non_flag_missing_model))
+        if flag_missing_not_created_model:
+            log.warning("OSTRZEŻENIE (%s): Flagi nie znalezione LUB nie utworzone: %s.", name, ', '.join(flag_missing_not_created_model))
+
+        if missing_model_features:
+            log.debug("(%s): Usunięto %s brakujących/nieutworzonych cech z listy dla tego modelu.", name, len(missing_model_features))
+            current_model_features_final = available_model_features
+        else:
+            # print(f"    ({name}): Wszystkie {len(features_list_for_model)} cechy są dostępne.") # Mniej gadatliwe
+            current_model_features_final = features_list_for_model
+
+        if not current_model_features_final:
+            log.error("KRYTYCZNY BŁĄD (%s): Brak dostępnych cech po weryfikacji! Model nie może być użyty.", name)
+            feature_lists_final[name] = [] # Pusta lista spowoduje pominięcie modelu
+        else:
+            feature_lists_final[name] = current_model_features_final
+            all_features_unpacked_for_models.extend(current_model_features_final)
+
+    all_unique_features_needed_by_models = sorted(list(set(all_features_unpacked_for_models)))
+    log.debug("Łącznie unikalnych cech potrzebnych przez wszystkie modele (po weryfikacji): %s", len(all_unique_features_needed_by_models))
+    return feature_lists_final, all_unique_features_needed_by_models
+
+
+def predict_hierarchical(X_predict_source_df, models_dict, feature_lists_final, le_precip_trained_for_m3):
+    """
+    Predykcja hierarchiczna M1 -> M2/M3 -> M4 na gotowej macierzy cech (indeks musi być unikalny).
+    Zwraca serię 'predicted_category' o indeksie X_predict_source_df.
+    """
+    model_1, model_2, model_3, model_4 = (models_dict[name] for name in ('M1', 'M2', 'M3', 'M4'))
+    final_predictions_series = pd.Series(index=X_predict_source_df.index, dtype=object, name='predicted_category')
+
+    # Etap 1: Predykcja Opady/Brak (M1)
+    log.debug("Etap 1 (M1): Opady vs Brak...")
+    if feature_lists_final['M1']:
+        with measure('inference.M1', len(X_predict_source_df)):
+            pred_m1_binary = model_1.predict(X_predict_source_df[feature_lists_final['M1']])
+        indices_pred_precip = X_predict_source_df.index[pred_m1_binary == 1]
+        indices_pred_no_precip = X_predict_source_df.index[pred_m1_binary == 0]
+        log.debug("Przewidziano Opady: %s, Brak Opadów: %s.", len(indices_pred_precip), len(indices_pred_no_precip))
+    else: # Powinno być obsłużone przez weryfikację cech, ale na wszelki wypadek
+        log.error("BŁĄD: Brak cech dla Modelu 1. Wszystkie próbki traktowane jako 'Brak Opadów'.")
+        indices_pred_precip = pd.Index([])
+        indices_pred_no_precip = X_predict_source_df.index
+
+    # Etap 2: Predykcja Brak Opadów (M2 - Mgła vs Reszta)
+    log.debug("Etap 2 (M2): Mgła vs Inne Bez Opadów...")
+    indices_pred_fog = pd.Index([])
+    indices_pred_other_no_precip = pd.Index([]) # Te pójdą do M4
+    if not indices_pred_no_precip.empty:
+        if feature_lists_final['M2']:
+            X_m2_subset = X_predict_source_df.loc[indices_pred_no_precip, feature_lists_final['M2']]
+            with measure('inference.M2', len(X_m2_subset)):
+                pred_m2_binary = model_2.predict(X_m2_subset)
+            indices_pred_fog = X_m2_subset.index[pred_m2_binary == 1]
+            indices_pred_other_no_precip = X_m2_subset.index[pred_m2_binary == 0]
+            final_predictions_series.loc[indices_pred_fog] = 'Fog'
+            log.debug("Przewidziano Mgła: %s.", len(indices_pred_fog))
+            log.debug("Pozostałe próbki bez opadów (nie-mgła) do M4: %s.", len(indices_pred_other_no_precip))
+        else:
+            log.error("BŁĄD: Brak cech dla Modelu 2. Wszystkie próbki 'Brak Opadów' idą do M4.")
+            indices_pred_other_no_precip = indices_pred_no_precip # Wszystko co było "no_precip" idzie do M4
+    else:
+        log.debug("Brak próbek 'Brak Opadów' z Etapu 1 dla M2.")
+
+
+    # Etap 3: Predykcja Opady (M3 - Typy Opadów)
+    log.debug("Etap 3 (M3): Typy Opadów...")
+    if not indices_pred_precip.empty:
+        if feature_lists_final['M3'] and le_precip_trained_for_m3:
+            X_m3_subset = X_predict_source_df.loc[indices_pred_precip, feature_lists_final['M3']]
+            with measure('inference.M3', len(X_m3_subset)):
+                pred_m3_numeric = model_3.predict(X_m3_subset)
+            try:
+                pred_m3_labels = le_precip_trained_for_m3.inverse_transform(pred_m3_numeric)
+                final_predictions_series.loc[indices_pred_precip] = pred_m3_labels
+                log.debug("Przypisano typy dla %s próbek opadowych.", len(indices_pred_precip))
+                # print(f"      Rozkład przewidzianych typów opadów: {pd.Series(pred_m3_labels).value_counts().to_dict()}")
+            except ValueError as e_le:
+                log.error("BŁĄD przy odwracaniu transformacji LabelEncoder dla M3: %s. Próbki opadowe bez klasyfikacji.", e_le)
+        else:
+            missing_reason = []
+            if not feature_lists_final['M3']: missing_reason.append("brak cech dla M3")
+            if not le_precip_trained_for_m3: missing_reason.append("brak LabelEncodera dla M3")
+            log.error("BŁĄD: Nie można sklasyfikować typów opadów (%s). Próbki 'Opady' pozostaną bez szczegółowej klasyfikacji.", ', '.join(missing_reason))
+    else:
+        log.debug("Brak próbek 'Opady' z Etapu 1 dla M3.")
+
+    # Etap 4: Predykcja Inne Bez Opadów (M4 - Clear/Fair vs Cloudy/Overcast)
+    log.debug("Etap 4 (M4): Clear/Fair vs Cloudy/Overcast...")
+    if not indices_pred_other_no_precip.empty:
+        if feature_lists_final['M4']:
+            X_m4_subset = X_predict_source_df.loc[indices_pred_other_no_precip, feature_lists_final['M4']]
+            with measure('inference.M4', len(X_m4_subset)):
+                pred_m4_binary = model_4.predict(X_m4_subset)
+            # Model M4: 0 to 'Clear/Fair', 1 to 'Cloudy/Overcast'
+            final_predictions_series.loc[X_m4_subset.index[pred_m4_binary == 0]] = 'Clear/Fair'
+            final_predictions_series.loc[X_m4_subset.index[pred_m4_binary == 1]] = 'Cloudy/Overcast'
+            log.debug("Przypisano 'Clear/Fair' lub 'Cloudy/Overcast' dla %s próbek.", len(indices_pred_other_no_precip))
+        else:
+            log.error("BŁĄD: Brak cech dla Modelu 4. Próbki 'Inne Bez Opadów' pozostaną bez klasyfikacji Clear/Cloudy.")
+    else:
+        log.debug("Brak próbek 'Inne Bez Opadów' z Etapu 2 dla M4.")
+
+    # Podsumowanie predykcji
+    missing_final_preds = final_predictions_series.isnull().sum()
+    if missing_final_preds > 0:
+        log.warning("OSTRZEŻENIE: %s próbek nie otrzymało finalnej predykcji!", missing_final_preds)
+        # Można wypełnić domyślną wartością lub zostawić NaN
+        # final_predictions_series.fillna("Unknown_Pred_Error", inplace=True)
+
+    return final_predictions_series
+
+
+def registry_models():
+    """Modele z rejestru procesu; brak plików lub błąd wczytania to ModelLoadError."""
+    try:
+        return model_registry.get_models()
+    except Exception as e:
+        raise ModelLoadError(f"Wczytanie modeli z rejestru nie powiodło się: {e}") from e
+
+
+def score_hierarchical(X_predict_source_df, models):
+    """
+    Predykcja hierarchiczna M1 -> M2/M3 -> M4 skompilowanym scorerem zestawu modeli z rejestru
+    (hierarchical_scorer.py): jedna macierz float32, bez wrappera sklearn. Etykiety jak w
+    predict_hierarchical. Zwraca serię 'predicted_category' o indeksie X_predict_source_df.
+    """
+    scorer = models['scorer']
+    labels = scorer.predict(scorer.matrix(X_predict_source_df))
+    log.debug("Predykcja hierarchiczna (scorer): %s próbek.", len(labels))
+    return pd.Series(labels, index=X_predict_source_df.index, dtype=object, name='predicted_category')
+
+
+def score_hierarchical_proba(X_predict_source_df, models):
+    """
+    Jak score_hierarchical, ale w tym samym przebiegu także ścieżka prawdopodobieństw:
+    P(opady) z M1, P(mgła) z M2, rozkład typów opadów z M3 (klasy z le_M3.pkl), P(zachmurzenie)
+    z M4 i łączny rozkład sześciu kategorii (hierarchical_scorer.HierarchicalScorer.predict_proba).
+    Zwraca (seria 'predicted_category', lista słowników z prawdopodobieństwami dla kolejnych wierszy).
+    """
+    scorer = models['scorer']
+    labels, stages, categories, joint = scorer.predict_proba(scorer.matrix(X_predict_source_df))
+    m3_classes = [str(c) for c in models['LE_M3'].classes_]
+    details = []
+    for i, label in enumerate(labels):
+        probabilities = {category: round(float(p), 6) for category, p in zip(categories, joint[i])}
+        details.append({
+            'confidence': probabilities[label],
+            'probabilities': probabilities,
+            'stages': {
+                'p_precipitation': round(float(stages['precipitation'][i]), 6),
+                'p_fog': round(float(stages['fog'][i]), 6),
+                'precipitation_type': {c: round(float(p), 6) for c, p in zip(m3_classes, stages['precipitation_type'][i])},
+                'p_cloudy': round(float(stages['cloudy'][i]), 6),
+            },
+        })
+    log.debug("Predykcja hierarchiczna z prawdopodobieństwami (scorer): %s próbek.", len(labels))
+    return pd.Series(labels, index=X_predict_source_df.index, dtype=object, name='predicted_category'), details
+
+
+def predict_from_stored_features(df_features, probabilities=False, timer=None):
+    """
+    Predykcja na gotowych wierszach cech z feature store (bez pobierania surowych danych
+    i inżynierii cech). Zwraca listę słowników jak run_prediction.
+    """
+    timer = timer or StageTimer()
+    threshold_flags_names = [f for f in df_features.columns if f.startswith('flag_')]
+    _, all_unique_features_needed_by_models = resolve_feature_lists(df_features, threshold_flags_names)
+    with timer.stage('model_load'):
+        models = registry_models()
+    details = None
+    with timer.stage('inference'):
+        if probabilities:
+            final_predictions_series, details = score_hierarchical_proba(df_features[all_unique_features_needed_by_models], models)
+        else:
+            final_predictions_series = score_hierarchical(df_features[all_unique_features_needed_by_models], models)
+    results_df = pd.DataFrame({
+        'timestamp': final_predictions_series.index,
+        'predicted_category': final_predictions_series.values
+    })
+    results_df['timestamp'] = results_df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    return _with_details(results_df.to_dict('records'), details)
+
+
+def _with_details(records, details):
+    """Dołącza do wyników słowniki prawdopodobieństw z score_hierarchical_proba (o ile są)."""
+    if details is not None:
+        for record, detail in zip(records, details):
+            record.update(detail)
+    return records
+
+
+def run_prediction(start_date_str, end_date_str, mac_address=None, probabilities=False):
     """
     Główna funkcja uruchamiająca predykcję pogody dla zadanego zakresu dat.
     Argumenty:
         start_date_str (str): Data początkowa w formacie 'YYYY-MM-DD HH:MM:SS'
         end_date_str (str): Data końcowa w formacie 'YYYY-MM-DD HH:MM:SS'
+        mac_address (str): Stacja, z której pomiarów liczymy predykcję (None = wszystkie stacje)
+        probabilities (bool): Dołącz do wyników 'confidence', 'probabilities' (rozkład sześciu
+            kategorii) i 'stages' (P z M1, M2, M4 i rozkład M3) - tylko modele z rejestru
     Zwraca:
-        list: Lista słowników z predykcjami lub słownik z błędem.
+        list: Lista słowników z predykcjami lub słownik z błędem; błąd etapu (ai_pipeline)
+            ma też 'stage' i czasy etapów 'stages_ms' ('detail' tylko przy braku danych).
     """
     try:
         prediction_start_date = datetime.strptime(start_date_str, '%Y-%m-%d %H:%M:%S')
@@ -152,145 +1287,78 @@ def run_prediction(start_date_str, end_date_str):
         DB_DATA_FETCH_END_DATE = db_data_fetch_end_date
 
     except (ValueError, TypeError) as e:
-        print(f"Błąd parsowania dat: {e}")
+        log.error("Błąd parsowania dat: %s", e)
         return {'error': f'Invalid date format: {e}'}
     
 
-    print(f"--- Hierarchiczny Model XGBoost v6 ---")
+    log.info("--- Hierarchiczny Model XGBoost v6 ---")
     if USE_DATABASE_INPUT:
-        print(f"   TRYB: Predykcja na danych z bazy SQLite")
-        print(f"   Ścieżka do bazy: {DB_PATH}")
-        print(f"   Okres pobierania danych z bazy: {DB_DATA_FETCH_START_DATE.strftime('%Y-%m-%d %H:%M')} - {DB_DATA_FETCH_END_DATE.strftime('%Y-%m-%d %H:%M')}")
-        print(f"   Okres predykcji: {PREDICTION_START_DATE.strftime('%Y-%m-%d %H:%M')} - {PREDICTION_END_DATE.strftime('%Y-%m-%d %H:%M')}")
+        log.debug("TRYB: Predykcja na danych z bazy SQLite")
+        log.debug("Ścieżka do bazy: %s", DB_PATH)
+        log.debug("Stacja: %s", mac_address if mac_address is not None else 'wszystkie')
+        log.debug("Okres pobierania danych z bazy: %s - %s", DB_DATA_FETCH_START_DATE.strftime('%Y-%m-%d %H:%M'), DB_DATA_FETCH_END_DATE.strftime('%Y-%m-%d %H:%M'))
+        log.debug("Okres predykcji: %s - %s", PREDICTION_START_DATE.strftime('%Y-%m-%d %H:%M'), PREDICTION_END_DATE.strftime('%Y-%m-%d %H:%M'))
     else:
-        print(f"   TRYB: Trening/Test na danych Meteostat dla stacji: {', '.join([f'{station_names.get(sid, sid)} ({sid})' for sid in target_station_ids])}")
-        print(f"   Okres pobierania danych Meteostat: {data_fetch_start_date_meteostat.strftime('%Y-%m-%d')} - {data_fetch_end_date_meteostat.strftime('%Y-%m-%d')}")
-        print(f"   Zbiór treningowy: Lata {train_start_year}-{train_end_year}")
-        print(f"   Zbiór testowy: Rok {test_year}")
-    print(f"   (Wczytywanie modeli: {'Tak' if LOAD_MODELS_IF_EXIST else 'Nie'}, Wymuszony trening: {'Tak' if FORCE_RETRAIN else 'Nie'})")
+        log.debug("TRYB: Trening/Test na danych Meteostat dla stacji: %s", ', '.join([f'{station_names.get(sid, sid)} ({sid})' for sid in target_station_ids]))
+        log.debug("Okres pobierania danych Meteostat: %s - %s", data_fetch_start_date_meteostat.strftime('%Y-%m-%d'), data_fetch_end_date_meteostat.strftime('%Y-%m-%d'))
+        log.debug("Zbiór treningowy: Lata %s-%s", train_start_year, train_end_year)
+        log.debug("Zbiór testowy: Rok %s", test_year)
+    log.debug("(Wczytywanie modeli: %s, Wymuszony trening: %s)", 'Tak' if LOAD_MODELS_IF_EXIST else 'Nie', 'Tak' if FORCE_RETRAIN else 'Nie')
+
+    # Czasy etapów; błąd etapu (ai_pipeline.PipelineError) wraca jako ustrukturyzowany wynik zadania
+    timer = StageTimer()
+    try:
+        if USE_DATABASE_INPUT and mac_address is not None:
+            # Godzina bez pomiaru lub za krótka historia: odmowa przed pobraniem danych i inżynierią cech
+            with timer.stage('data_check'):
+                check_prediction_data(mac_address, PREDICTION_START_DATE)
+
+        # Zamknięta godzina policzona już przez feature store: jeden odczyt wiersza cech i scoring
+        if USE_DATABASE_INPUT and mac_address is not None and PREDICTION_START_DATE == PREDICTION_START_DATE.replace(minute=0, second=0, microsecond=0):
+            with timer.stage('data_fetch'):
+                stored_features = fetch_stored_features(mac_address, PREDICTION_START_DATE)
+            if stored_features is not None:
+                log.debug("Cechy godziny wczytane z feature store (hourly_features) - pomijam Etapy 1-2.")
+                return predict_from_stored_features(stored_features, probabilities, timer)
+    except PipelineError as e:
+        log.warning("Predykcja przerwana (etap %s): %s", e.stage, e.detail)
+        return e.result(timer)
+    except Exception as e:
+        log.exception("KRYTYCZNY BŁĄD w predykcji z feature store: %s", e)
+        return {'error': 'Wystąpił wewnętrzny błąd podczas analizy AI.'}
 
     try:
         # --- Pobieranie i Przetwarzanie Danych Wejściowych ---
-        print("\n--- Etap 1: Przygotowanie Danych Wejściowych ---")
+        log.info("--- Etap 1: Przygotowanie Danych Wejściowych ---")
         full_processing_start_time = time.time()
         df_for_feature_engineering = None # DataFrame, który trafi do inżynierii cech
 
         if USE_DATABASE_INPUT:
-            print("  Pobieranie i przetwarzanie danych z bazy SQLite...")
-            try:
-                conn = sqlite3.connect(DB_PATH)
-                query = f"""
-                    SELECT server_timestamp, temperature, pressure, humidity, sunshine, wind_speed, precipitation
-                    FROM measurements
-                    WHERE server_timestamp BETWEEN ? AND ?
-                    ORDER BY server_timestamp ASC
-                """
-                # Użycie parametrów w zapytaniu SQL dla bezpieczeństwa
-                df_raw = pd.read_sql_query(query, conn, params=(DB_DATA_FETCH_START_DATE.strftime('%Y-%m-%d %H:%M:%S'),
-                                                                DB_DATA_FETCH_END_DATE.strftime('%Y-%m-%d %H:%M:%S')))
-                conn.close()
-
-                if df_raw.empty:
-                    print(f"  INFO: Brak danych w bazie dla zadanego okresu: {DB_DATA_FETCH_START_DATE} - {DB_DATA_FETCH_END_DATE}. Zwracam pusty wynik.")
-                    return [] # Zwróć pustą listę zamiast kończyć program
-
-                df_raw['server_timestamp'] = pd.to_datetime(df_raw['server_timestamp'])
-                df_raw.set_index('server_timestamp', inplace=True)
-                print(f"    Wczytano {len(df_raw)} surowych rekordów z bazy.")
-
-                df_converted = df_raw.copy()
-                df_converted.rename(columns={
-                    'temperature': 'temp_celsius', 'pressure': 'pres_hpa', 'humidity': 'rhum_fraction',
-                    'sunshine': 'sunshine_analog', 'wind_speed': 'wspd_kmh', 'precipitation': 'prcp_intensity'
-                }, inplace=True)
-
-                df_converted['temp'] = df_converted['temp_celsius']
-                df_converted['pres'] = df_converted['pres_hpa']
-                df_converted['rhum'] = df_converted['rhum_fraction'] * 100
-                df_converted['wspd_mps'] = df_converted['wspd_kmh'] / 3.6
-                df_converted['is_sunny_interval'] = (df_converted['sunshine_analog'] > SUNSHINE_THRESHOLD).astype(int)
-                df_converted['sunshine_minutes_interval'] = df_converted['is_sunny_interval'] * (5.0 / 60.0)
-                _MAX_PRECIP_MM_PER_5SEC_FOR_INTENSITY_1 = (MAX_PRECIP_RATE_MM_PER_HOUR_FOR_INTENSITY_1 / 3600.0) * 5.0
-                df_converted['prcp_mm_interval'] = df_converted['prcp_intensity'] * _MAX_PRECIP_MM_PER_5SEC_FOR_INTENSITY_1
-                
-                final_cols_before_agg = ['temp', 'pres', 'rhum', 'wspd_mps', 'sunshine_minutes_interval', 'prcp_mm_interval']
-                current_cols = df_converted.columns.tolist()
-                missing_raw_cols = [col for col in final_cols_before_agg if col not in current_cols]
-                if missing_raw_cols:
-                    print(f"    BŁĄD: Brakuje kolumn do agregacji po konwersji: {missing_raw_cols}. Sprawdź nazwy w bazie i logikę konwersji.")
-                    exit()
-                df_for_aggregation = df_converted[final_cols_before_agg].copy()
-                print("    Dokonano konwersji jednostek z danych bazodanowych.")
-
-                agg_functions_db = {
-                    'temp': 'mean', 'pres': 'mean', 'rhum': 'mean',
-                    'wspd_mps': ['mean', 'max'],
-                    'sunshine_minutes_interval': 'sum', 'prcp_mm_interval': 'sum'
-                }
-                _cols_to_fill_na_db = ['wspd_mps', 'sunshine_minutes_interval', 'prcp_mm_interval', 'temp', 'pres', 'rhum']
-                for col in _cols_to_fill_na_db:
-                    if col in df_for_aggregation.columns: df_for_aggregation[col].fillna(0, inplace=True) # Wypełnij NaN przed agregacją
-
-                if df_for_aggregation.empty: print("    Brak danych do agregacji."); exit()
-                df_hourly_multiindex = df_for_aggregation.resample('H').agg(agg_functions_db)
-                if df_hourly_multiindex.empty: print("    Agregacja nie dała wyników (pusty DataFrame)."); exit()
-                
-                df_hourly_from_db = pd.DataFrame()
-                df_hourly_from_db['temp'] = df_hourly_multiindex[('temp', 'mean')]
-                df_hourly_from_db['pres'] = df_hourly_multiindex[('pres', 'mean')]
-                df_hourly_from_db['rhum'] = df_hourly_multiindex[('rhum', 'mean')]
-                df_hourly_from_db['wspd'] = df_hourly_multiindex[('wspd_mps', 'mean')]
-                df_hourly_from_db['wpgt'] = df_hourly_multiindex[('wspd_mps', 'max')]
-                df_hourly_from_db['tsun'] = df_hourly_multiindex[('sunshine_minutes_interval', 'sum')]
-                df_hourly_from_db['prcp'] = df_hourly_multiindex[('prcp_mm_interval', 'sum')]
-                
-                df_hourly_from_db['tsun'] = np.clip(df_hourly_from_db['tsun'], 0, 60)
-                df_hourly_from_db['rhum'] = np.clip(df_hourly_from_db['rhum'], 0, 100)
-                print(f"    Zagregowano dane z bazy do {len(df_hourly_from_db)} rekordów godzinowych.")
-
-                df_hourly_from_db['snow'] = 0.0
-                _snow_depth_mm = 0.0
-                df_hourly_from_db.sort_index(inplace=True)
-                _calculated_snow_values = []
-                for index, row in df_hourly_from_db.iterrows():
-                    _hourly_precip_water_eq = row['prcp']; _avg_hourly_temp = row['temp']
-                    _fresh_snow_mm = 0.0
-                    if _hourly_precip_water_eq > 0 and _avg_hourly_temp < TEMP_THRESHOLD_SNOW:
-                        _fresh_snow_mm = _hourly_precip_water_eq * WATER_TO_SNOW_RATIO
-                    _snow_depth_mm += _fresh_snow_mm
-                    _melt_mm_water_eq = 0.0
-                    if _snow_depth_mm > 0 and _avg_hourly_temp > 0:
-                        _melt_mm_water_eq = HOURLY_MELT_RATE_PER_DEG_ABOVE_FREEZING * _avg_hourly_temp
-                        _melt_snow_depth_mm = _melt_mm_water_eq * WATER_TO_SNOW_RATIO
-                        _snow_depth_mm -= _melt_snow_depth_mm
-                    _snow_depth_mm = max(0, _snow_depth_mm)
-                    _snow_depth_mm = min(_snow_depth_mm, MAX_ACCUMULATED_SNOW_DEPTH_MM)
-                    _calculated_snow_values.append(round(_snow_depth_mm, 2))
-                df_hourly_from_db['snow'] = _calculated_snow_values
-                print("    Zakończono symulację pokrywy śnieżnej dla danych z bazy.")
-
-                df_hourly_from_db['coco'] = 1 # Placeholder
-                df_hourly_from_db['weather_category'] = df_hourly_from_db['coco'].apply(aggregate_coco_FINAL_user_v2)
-                df_hourly_from_db['year'] = df_hourly_from_db.index.year
-
-                df_for_feature_engineering = df_hourly_from_db.copy()
-                print(f"    Przygotowano {len(df_for_feature_engineering)} rekordów z bazy do dalszego przetwarzania (inżynieria cech).")
+            log.debug("Pobieranie i przetwarzanie danych z bazy SQLite...")
+            with timer.stage('data_fetch'):
+                df_raw = fetch_raw_measurements(DB_DATA_FETCH_START_DATE, DB_DATA_FETCH_END_DATE, mac_address)
+                df_compacted = None
+                if mac_address is not None:
+                    df_compacted = fetch_compacted_hourly(DB_DATA_FETCH_START_DATE, DB_DATA_FETCH_END_DATE, mac_address)
 
-            except Exception as e:
-                print(f"KRYTYCZNY BŁĄD podczas przetwarzania danych z bazy: {e}"); import traceback; traceback.print_exc(); exit()
+            if df_raw.empty and (df_compacted is None or df_compacted.empty):
+                log.info("Brak danych w bazie dla zadanego okresu: %s - %s. Zwracam pusty wynik.", DB_DATA_FETCH_START_DATE, DB_DATA_FETCH_END_DATE)
+                return [] # Zwróć pustą listę zamiast kończyć program
+
+            with timer.stage('aggregation'):
+                df_for_feature_engineering = aggregate_raw_to_hourly(df_raw, df_compacted)
 
         else: # --- Oryginalna logika dla Meteostat (trening/test) ---
-            print("  Pobieranie i wstępne przetwarzanie danych z Meteostat...")
+            log.info("Pobieranie i wstępne przetwarzanie danych z Meteostat...")
             all_station_data_list = []
             _df_meteostat = None
             for station_id in target_station_ids: # Pętla wykona się raz dla Wiednia
-                print(f"    Pobieranie danych dla stacji: {station_id} ({station_names.get(station_id, '')})...", end="")
                 start_fetch_time = time.time()
                 station_hourly_data = Hourly(station_id, data_fetch_start_date_meteostat, data_fetch_end_date_meteostat)
                 station_data = station_hourly_data.fetch()
                 fetch_duration = time.time() - start_fetch_time
-                if station_data.empty: print(f" BRAK DANYCH Meteostat. Przerywanie."); exit()
-                print(f" Pobrano {len(station_data)} rek. w {fetch_duration:.1f}s.")
+                if station_data.empty: raise DataFetchError(f"Brak danych Meteostat dla stacji {station_id}.")
+                log.info("Pobrano dane stacji %s (%s): %s rek. w %.1fs.", station_id, station_names.get(station_id, ''), len(station_data), fetch_duration)
                 
                 required_cols = ['temp', 'rhum', 'coco', 'pres', 'wspd', 'prcp']
                 optional_cols = ['tsun', 'wpgt', 'snow']
@@ -306,515 +1374,48 @@ def run_prediction(start_date_str, end_date_str):
                 station_data = station_data[station_data['coco'] != 0]
                 station_data['coco'] = station_data['coco'].astype(int)
                 all_station_data_list.append(station_data)
-                print(f"      Przetworzono dane Meteostat ze stacji {station_id}.")
+                log.info("Przetworzono dane Meteostat ze stacji %s.", station_id)
             
             _df_meteostat = pd.concat(all_station_data_list)
-            print(f"    DataFrame Meteostat zawiera {len(_df_meteostat)} rekordów.")
-            print("    Sortowanie danych Meteostat wg czasu..."); _df_meteostat.sort_index(inplace=True)
+            log.info("DataFrame Meteostat zawiera %s rekordów.", len(_df_meteostat))
+            log.info("Sortowanie danych Meteostat wg czasu..."); _df_meteostat.sort_index(inplace=True)
             
-            print("    Agregowanie kategorii Meteostat (user_v2)...")
+            log.info("Agregowanie kategorii Meteostat (user_v2)...")
             _df_meteostat['weather_category'] = _df_meteostat['coco'].apply(aggregate_coco_FINAL_user_v2)
             _df_meteostat = _df_meteostat[_df_meteostat['weather_category'] != 'Unknown']
             
-            print("    Filtrowanie prcp=0 dla opadów (Meteostat)...")
+            log.info("Filtrowanie prcp=0 dla opadów (Meteostat)...")
             initial_rows_before_prcp_filter = len(_df_meteostat)
             condition_to_remove = (_df_meteostat['prcp'] == 0) & (_df_meteostat['weather_category'].isin(precip_categories_user))
             rows_to_remove_count = condition_to_remove.sum()
             if rows_to_remove_count > 0: _df_meteostat = _df_meteostat[~condition_to_remove].copy()
-            print(f"      Usunięto {rows_to_remove_count} wierszy.")
+            log.info("Usunięto %s wierszy.", rows_to_remove_count)
             if _df_meteostat['weather_category'].nunique() < 2: raise ValueError("Mniej niż 2 kategorie po filtrowaniu danych Meteostat.")
             
             _df_meteostat['year'] = _df_meteostat.index.year # Dodanie kolumny 'year'
             df_for_feature_engineering = _df_meteostat.copy()
-            print(f"  Przygotowano {len(df_for_feature_engineering)} rekordów z Meteostat do dalszego przetwarzania.")
+            log.info("Przygotowano %s rekordów z Meteostat do dalszego przetwarzania.", len(df_for_feature_engineering))
 
 
         if df_for_feature_engineering is None or df_for_feature_engineering.empty:
-            print("KRYTYCZNY BŁĄD: DataFrame do inżynierii cech jest pusty. Przerywanie."); exit()
+            raise AggregationError("DataFrame do inżynierii cech jest pusty.")
 
 
         # --- Etap 2: Rozszerzona Inżynieria Cech v2 ---
-        # Ten blok operuje na `df_for_feature_engineering` i zapisuje wynik do `df_processed_final`
-        print("\n--- Etap 2: Rozszerzona Inżynieria Cech v2 ---")
-        feature_engineering_start_time_actual = time.time() # Zmieniona nazwa zmiennej, żeby nie kolidowała
-        df = df_for_feature_engineering.copy() # Używamy nazwy 'df' tak jak w oryginalnym bloku FE
-        epsilon = 1e-6
-
-        # 1. Cechy Podstawowe i Czasowe
-        print("  Tworzenie cech podstawowych i czasowych...")
-        df['dew_point'] = df.apply(lambda row: calculateDewPoint(row['temp'], row['rhum']), axis=1)
-        df['spread'] = df['temp'] - df['dew_point']
-        df['hour'] = df.index.hour
-        df['day_of_year'] = df.index.dayofyear
-        df['month'] = df.index.month
-        # 'year' już powinno być w df
-        df['day_of_week'] = df.index.dayofweek
-        df['week_of_year'] = df.index.isocalendar().week.astype(int)
-        df['quarter'] = df.index.quarter
-        df['is_weekend'] = (df['day_of_week'] >= 5).astype(int)
-        df['hour_sin'] = np.sin(2 * np.pi * df['hour']/24.0)
-        df['hour_cos'] = np.cos(2 * np.pi * df['hour']/24.0)
-        df['day_of_year_sin'] = np.sin(2 * np.pi * df['day_of_year']/366.0)
-        df['day_of_year_cos'] = np.cos(2 * np.pi * df['day_of_year']/366.0)
-        df['month_sin'] = np.sin(2 * np.pi * df['month']/12.0)
-        df['month_cos'] = np.cos(2 * np.pi * df['month']/12.0)
-        if 'tsun' in df.columns and pd.api.types.is_numeric_dtype(df['tsun']): # Dodano sprawdzenie typu
-            df['is_daytime_approx'] = (df['tsun'] > 0).astype(int)
-        else:
-            df['is_daytime_approx'] = 0 # Jeśli tsun nie istnieje lub nie jest numeryczne
-
-        # 2. Różnice Czasowe
-        print("  Tworzenie cech różnic czasowych...")
-        periods_diff = [1, 2, 3, 6, 12, 24]
-        cols_to_diff = ['temp', 'rhum', 'dew_point', 'spread', 'pres', 'wspd', 'prcp', 'tsun', 'wpgt', 'snow']
-        diff_feature_names = []
-        for period in periods_diff:
-            for col in cols_to_diff:
-                if col in df.columns and pd.api.types.is_numeric_dtype(df[col]): # Sprawdzenie czy kolumna jest numeryczna
-                    diff_col_name = f'{col}_diff_{period}h'
-                    abs_diff_col_name = f'abs_{col}_diff_{period}h'
-                    df[diff_col_name] = df[col].diff(periods=period)
-                    df[abs_diff_col_name] = df[diff_col_name].abs()
-                    diff_feature_names.extend([diff_col_name, abs_diff_col_name])
-                elif col in df.columns:
-                    print(f"    Ostrzeżenie: Kolumna '{col}' do różnicowania nie jest numeryczna i zostanie pominięta.")
-                # else: # Kolumna nie istnieje, pomijamy po cichu
-                #    pass
-
-
-        # 3. Wartości Opóźnione
-        print("  Tworzenie cech opóźnionych...")
-        periods_lag = [1, 2, 3, 6, 12, 24]
-        # Dodajemy nowo utworzone diff_1h do listy cech do opóźniania
-        # Upewnijmy się, że bierzemy tylko te diff_1h, które faktycznie zostały utworzone i są numeryczne
-        valid_diff_1h_features = [f_name for f_name in diff_feature_names if '_diff_1h' in f_name and f_name in df.columns and pd.api.types.is_numeric_dtype(df[f_name])]
-        cols_to_lag = ['temp', 'rhum', 'dew_point', 'spread', 'pres', 'wspd', 'prcp', 'tsun', 'wpgt', 'snow'] + valid_diff_1h_features
-        lagged_feature_names = []
-        for period in periods_lag:
-            for col in cols_to_lag:
-                if col in df.columns and pd.api.types.is_numeric_dtype(df[col]): # Sprawdzenie czy kolumna jest numeryczna
-                    lag_col_name = f'{col}_lag_{period}h'
-                    df[lag_col_name] = df[col].shift(periods=period)
-                    lagged_feature_names.append(lag_col_name)
-                elif col in df.columns:
-                    print(f"    Ostrzeżenie: Kolumna '{col}' do opóźniania nie jest numeryczna i zostanie pominięta.")
-                # else: # Kolumna nie istnieje (np. diff_1h nie powstał), pomijamy
-                #    pass
-
-
-        # 4. Opóźnione Flagi Kategorii
-        print("  Tworzenie opóźnionych flag kategorii...")
-        lagged_cat_feature_names = []
-
-        # Jeśli 'weather_category' nie istnieje (np. błąd wcześniej), stwórz placeholder
-        if 'weather_category' not in df.columns:
-            print("    OSTRZEŻENIE: Brak kolumny 'weather_category' do tworzenia flag opóźnionych. Używam placeholdera 'Unknown'.")
-            df['weather_category'] = "Unknown"
-
-        # ZMIENIONE: Użyj wszystkich możliwych kategorii zdefiniowanych globalnie,
-        # a nie tylko tych, które aktualnie występują w df['weather_category']
-        # (bo w trybie predykcji z placeholderem coco, df['weather_category'] może być stałe)
-        all_possible_user_categories = ['Clear/Fair', 'Cloudy/Overcast', 'Fog', 'Rain', 'Snow/Sleet/Freezing', 'Thunderstorm/Severe']
-        # lub jeśli masz `all_categories_user` zdefiniowane globalnie:
-        # all_possible_user_categories = all_categories_user # Upewnij się, że ta lista zawiera wszystkie 6 kategorii
-
-        print(f"    Tworzenie flag opóźnionych dla potencjalnych kategorii: {all_possible_user_categories}")
-        for lag in [1, 2, 3, 6]:
-            shifted_cat = df['weather_category'].shift(lag) # To nadal bazuje na aktualnej (może być stałej) weather_category
-            
-            # Twórz flagi dla WSZYSTKICH zdefiniowanych kategorii użytkownika
-            for cat_possible in all_possible_user_categories:
-                safe_cat_name = cat_possible.replace('/', '_').replace(' ', '_').replace('-', '_').lower()
-                flag_name = f'was_{safe_cat_name}_lag{lag}h'
-                # Jeśli aktualna (przesunięta) kategoria to `cat_possible`, flaga = 1, inaczej 0.
-                # Nawet jeśli `shifted_cat` jest zawsze 'Clear/Fair', to dla `cat_possible` = 'Rain',
-                # warunek `(shifted_cat == cat_possible)` będzie False, więc flaga `was_rain_lagXh` będzie 0.
-                # To jest poprawne zachowanie.
-                df[flag_name] = (shifted_cat == cat_possible).astype(int)
-                lagged_cat_feature_names.append(flag_name)
-                
-            # Flaga dla kategorii opadowych - pozostaje bez zmian, bazuje na shifted_cat
-            precip_flag_name = f'was_precip_category_lag{lag}h'
-            # precip_categories_user powinno być zdefiniowane globalnie
-            df[precip_flag_name] = shifted_cat.isin(precip_categories_user).astype(int)
-            lagged_cat_feature_names.append(precip_flag_name)
-
-        # 5. Statystyki Kroczące
-        print("  Tworzenie statystyk kroczących...")
-        window_sizes = [3, 6, 12, 24]
-        cols_for_rolling = ['temp', 'rhum', 'dew_point', 'spread', 'pres', 'wspd', 'prcp', 'tsun', 'wpgt', 'snow'] # Dodano snow
-        rolling_feature_names = []
-        for window in window_sizes:
-            for col in cols_for_rolling:
-                if col in df.columns and pd.api.types.is_numeric_dtype(df[col]):
-                    rolling_window = df[col].rolling(window=window, closed='right', min_periods=max(1, window // 2))
-                    ops = {'mean': rolling_window.mean, 'std': rolling_window.std,
-                        'median': rolling_window.median, 'min': rolling_window.min, 'max': rolling_window.max}
-                    if col in ['prcp', 'tsun']:
-                        ops['sum'] = rolling_window.sum
-                    for op_name, op_func in ops.items():
-                        feat_name = f'{col}_roll{window}h_{op_name}'
-                        df[feat_name] = op_func()
-                        rolling_feature_names.append(feat_name)
-                elif col in df.columns:
-                    print(f"    Ostrzeżenie: Kolumna '{col}' dla statystyk kroczących nie jest numeryczna i zostanie pominięta.")
-
-
-        # 6. Interakcje i Cechy Pochodne
-        print("  Tworzenie interakcji i cech pochodnych...")
-        derived_feature_names = []
-        base_cols = ['temp', 'rhum', 'dew_point', 'spread', 'pres', 'wspd', 'tsun', 'wpgt'] # snow można dodać
-        for i in range(len(base_cols)):
-            for j in range(i, len(base_cols)):
-                col1, col2 = base_cols[i], base_cols[j]
-                # Sprawdzenie czy obie kolumny istnieją i są numeryczne
-                if col1 in df.columns and pd.api.types.is_numeric_dtype(df[col1]) and \
-                col2 in df.columns and pd.api.types.is_numeric_dtype(df[col2]):
-                    if f'{col1}_x_{col2}' not in df.columns: df[f'{col1}_x_{col2}'] = df[col1] * df[col2]; derived_feature_names.append(f'{col1}_x_{col2}')
-                    if f'{col1}_div_{col2}_safe' not in df.columns: df[f'{col1}_div_{col2}_safe'] = df[col1] / (df[col2] + epsilon); derived_feature_names.append(f'{col1}_div_{col2}_safe')
-                    if i != j and f'{col2}_div_{col1}_safe' not in df.columns: df[f'{col2}_div_{col1}_safe'] = df[col2] / (df[col1] + epsilon); derived_feature_names.append(f'{col2}_div_{col1}_safe')
-
-        cols_for_pow = base_cols + ['prcp', 'snow'] # Dodano snow
-        for col in cols_for_pow:
-            if col in df.columns and pd.api.types.is_numeric_dtype(df[col]):
-                if f'{col}_pow2' not in df.columns: df[f'{col}_pow2'] = df[col].pow(2); derived_feature_names.append(f'{col}_pow2')
-                if col in ['wspd', 'spread', 'prcp', 'snow'] and f'{col}_pow3' not in df.columns: df[f'{col}_pow3'] = df[col].pow(3); derived_feature_names.append(f'{col}_pow3')
-
-        # Sprawdzenia dla konkretnych interakcji
-        def check_and_create_interaction(df_ref, derived_list, new_feat_name, col_list, operation_str):
-            # Sprawdza czy wszystkie potrzebne kolumny istnieją i są numeryczne
-            valid_cols = all(c in df_ref.columns and pd.api.types.is_numeric_dtype(df_ref[c]) for c in col_list)
-            if valid_cols:
-                try:
-                    # Używamy eval do wykonania operacji, wymaga ostrożności
-                    # Alternatywnie, można użyć if/else dla każdej operacji
-                    df_ref[new_feat_name] = eval(operation_str, {'df': df_ref, 'epsilon': epsilon, 'abs': abs, 'np': np})
-                    derived_list.append(new_feat_name)
-                except Exception as e:
-                    print(f"    Błąd przy tworzeniu cechy interakcji '{new_feat_name}': {e}")
-            # else:
-            #    print(f"    Pominięto tworzenie '{new_feat_name}' z powodu braku/niepoprawnego typu kolumn: {col_list}")
-
-
-        check_and_create_interaction(df, derived_feature_names, 'abs_temp_diff_div_wspd_safe', ['temp_diff_1h', 'wspd'], "abs(df['temp_diff_1h']) / (df['wspd'] + epsilon)")
-        check_and_create_interaction(df, derived_feature_names, 'abs_pres_diff_div_wspd_safe', ['pres_diff_1h', 'wspd'], "abs(df['pres_diff_1h']) / (df['wspd'] + epsilon)")
-        check_and_create_interaction(df, derived_feature_names, 'temp_x_abs_pres_diff_1h', ['temp', 'pres_diff_1h'], "df['temp'] * abs(df['pres_diff_1h'])")
-        check_and_create_interaction(df, derived_feature_names, 'rhum_x_abs_spread_diff_1h', ['rhum', 'spread_diff_1h'], "df['rhum'] * abs(df['spread_diff_1h'])")
-        check_and_create_interaction(df, derived_feature_names, 'prcp_lag_1h_x_temp', ['prcp_lag_1h', 'temp'], "df['prcp_lag_1h'] * df['temp']")
-
-        for window in window_sizes:
-            for col in ['temp', 'rhum', 'spread', 'pres', 'wspd']:
-                mean_col_name = f'{col}_roll{window}h_mean'
-                rel_col_name = f'{col}_rel_to_roll{window}h_mean'
-                check_and_create_interaction(df, derived_feature_names, rel_col_name, [col, mean_col_name], f"df['{col}'] - df['{mean_col_name}']")
-
-
-        # 7. Dodatkowe Cechy Matematyczne
-        print("  Tworzenie dodatkowych cech matematycznych...")
-        additional_math_features = []
-        cols_for_adv_math = ['temp', 'rhum', 'dew_point', 'spread', 'pres', 'wspd'] # snow można dodać
-        for window in window_sizes:
-            for col in cols_for_adv_math:
-                min_col=f'{col}_roll{window}h_min'; max_col=f'{col}_roll{window}h_max'; range_col=f'{col}_roll{window}h_range'
-                std_col=f'{col}_roll{window}h_std'; ratio_std_col=f'{col}_div_roll{window}h_std_safe'
-                diff_1h_col=f'{col}_diff_1h'; volatility_col=f'{diff_1h_col}_roll{window}h_std'
-                
-                check_and_create_interaction(df, additional_math_features, range_col, [min_col, max_col], f"df['{max_col}'] - df['{min_col}']")
-                check_and_create_interaction(df, additional_math_features, ratio_std_col, [col, std_col], f"df['{col}'] / (df['{std_col}'] + epsilon)")
-                
-                if diff_1h_col in df.columns and pd.api.types.is_numeric_dtype(df[diff_1h_col]):
-                    df[volatility_col] = df[diff_1h_col].rolling(window=window, min_periods=max(1, window//2)).std()
-                    additional_math_features.append(volatility_col)
-
-        for col in cols_for_adv_math:
-            diff_1h_col = f'{col}_diff_1h'; accel_col = f'{diff_1h_col}_diff_1h'
-            if diff_1h_col in df.columns and pd.api.types.is_numeric_dtype(df[diff_1h_col]):
-                df[accel_col] = df[diff_1h_col].diff(1)
-                additional_math_features.append(accel_col)
-
-        check_and_create_interaction(df, additional_math_features, 'dp_div_temp_safe', ['dew_point', 'temp'], "df['dew_point'] / (df['temp'] + np.sign(df['temp'])*epsilon + epsilon)")
-        check_and_create_interaction(df, additional_math_features, 'spread_div_temp_safe', ['spread', 'temp'], "df['spread'] / (df['temp'] + np.sign(df['temp'])*epsilon + epsilon)")
-        check_and_create_interaction(df, additional_math_features, 'temp_x_hour_sin', ['temp', 'hour_sin'], "df['temp'] * df['hour_sin']")
-        check_and_create_interaction(df, additional_math_features, 'wspd_x_day_of_year_cos', ['wspd', 'day_of_year_cos'], "df['wspd'] * df['day_of_year_cos']")
-        check_and_create_interaction(df, additional_math_features, 'rhum_x_pres_diff_1h', ['rhum', 'pres_diff_1h'], "df['rhum'] * df['pres_diff_1h']")
-
-
-        # 8. Rozszerzone Flagi Binarne
-        print("  Obliczanie flag binarnych...")
-        thresholds = {
-            'flag_sunny': ('tsun', '>', 45), 'flag_partly_sunny': ('tsun', '>', 15), 'flag_mostly_dark': ('tsun', '<', 10), 'flag_dark': ('tsun', '<', 1),
-            'flag_very_humid': ('rhum', '>', 96), 'flag_humid': ('rhum', '>', 85), 'flag_moderate_humid': ('rhum', '<=', 85), 'flag_dry': ('rhum', '<', 65), 'flag_very_dry': ('rhum', '<', 45),
-            'flag_near_saturation': ('spread', '<', 0.7), 'flag_close_saturation': ('spread', '<', 1.5), 'flag_moderate_spread': ('spread', '>', 3.0), 'flag_far_from_saturation': ('spread', '>', 6.0),
-            'flag_calm': ('wspd', '<', 2.5), 'flag_light_breeze': ('wspd', '>', 5.0), 'flag_moderate_wind': ('wspd', '>', 8.0), 'flag_windy': ('wspd', '>', 12.0), 'flag_very_windy': ('wspd', '>', 18.0),
-            'flag_has_precip': ('prcp', '>', 0), 'flag_light_precip': ('prcp', '>', 0.1), 'flag_moderate_precip': ('prcp', '>', 1.0), 'flag_heavy_precip': ('prcp', '>', 3.0),
-            'flag_very_high_pres': ('pres', '>', 1030), 'flag_high_pres': ('pres', '>', 1020), 'flag_moderate_pres': ('pres', '<=', 1020), 'flag_low_pres': ('pres', '<', 1005), 'flag_very_low_pres': ('pres', '<', 990),
-            'flag_below_freezing': ('temp', '<=', 0), 'flag_near_freezing_low': ('temp', '<=', 2), 'flag_near_freezing_high': ('temp', '<=', 5), 'flag_cool': ('temp', '<', 10), 'flag_mild': ('temp', '>=', 10), 'flag_warm': ('temp', '>', 18), 'flag_hot': ('temp', '>', 25),
-            'flag_dp_below_freezing': ('dew_point', '<=', 0), 'flag_dp_low': ('dew_point', '<', 5), 'flag_dp_high': ('dew_point', '>', 15), 'flag_dp_very_high': ('dew_point', '>', 20),
-            'flag_has_gusts': ('wpgt', '>', 0), 'flag_strong_gusts': ('wpgt', '>', 15), 'flag_severe_gusts': ('wpgt', '>', 25),
-            'flag_has_snow_cover': ('snow', '>', 0), 'flag_sig_snow_cover': ('snow', '>', 50), # Używa oszacowanego 'snow'
-            'flag_temp_rising_fast': ('temp_diff_1h', '>', 1.5), 'flag_temp_falling_fast': ('temp_diff_1h', '<', -1.5),
-            'flag_pres_rising_fast': ('pres_diff_1h', '>', 1.0), 'flag_pres_falling_fast': ('pres_diff_1h', '<', -1.0), 'flag_pres_falling_sig': ('pres_diff_1h', '<', -0.5),
-            'flag_rhum_rising_fast': ('rhum_diff_1h', '>', 10), 'flag_rhum_falling_fast': ('rhum_diff_1h', '<', -10),
-            'flag_spread_closing_fast': ('spread_diff_1h', '<', -0.8), 'flag_spread_opening_fast': ('spread_diff_1h', '>', 1.0),
-            'flag_wspd_increasing': ('wspd_diff_1h', '>', 2.0), 'flag_wspd_decreasing': ('wspd_diff_1h', '<', -2.0),
-            'flag_fog_ratio': ('rhum_div_spread_safe', '>', 120), 'flag_clear_ratio_rhum_spread': ('rhum_div_spread_safe', '<', 20), 'flag_clear_ratio_tsun_rhum': ('tsun_div_rhum_safe', '>', 0.6),
-            'flag_high_temp_range_6h': ('temp_roll6h_range', '>', 5), 'flag_low_pres_range_12h': ('pres_roll12h_range', '<', 5),
-            'flag_temp_accel_positive': ('temp_diff_1h_diff_1h', '>', 0.5), 'flag_pres_accel_negative': ('pres_diff_1h_diff_1h', '<', -0.3),
-            'flag_high_rhum_volatility': ('rhum_diff_1h_roll6h_std', '>', 8),
-            'flag_cold_and_humid': (('temp', '<', 5), ('rhum', '>', 90)), 'flag_warm_and_dry': (('temp', '>', 20), ('rhum', '<', 50)),
-            'flag_windy_and_precip': (('flag_windy', '==', 1), ('flag_has_precip', '==', 1)), 'flag_gusty_and_precip': (('flag_strong_gusts', '==', 1), ('flag_has_precip', '==', 1)),
-            'flag_near_freezing_precip': (('flag_near_freezing_low', '==', 1), ('flag_has_precip', '==', 1)), 'flag_below_freezing_precip': (('flag_below_freezing', '==', 1), ('flag_has_precip', '==', 1)),
-            'flag_fog_conditions_met': (('flag_near_saturation', '==', 1), ('flag_calm', '==', 1), ('flag_very_humid', '==', 1)),
-            'flag_potential_thunder_convection': (('temp', '>', 15), ('spread', '<', 8), ('flag_pres_falling_sig', '==', 1)),
-            'flag_potential_snow': (('flag_near_freezing_low', '==', 1), ('flag_dp_below_freezing', '==', 1), ('flag_has_precip', '==', 1)),
-            'flag_saturating_trend': (('flag_rhum_rising_fast', '==', 1), ('flag_spread_closing_fast', '==', 1)),
-            'flag_damp_conditions': (('rhum', '>', 92), ('spread', '<', 1.5)), 'flag_frontal_drizzle_potential': (('flag_pres_falling_sig', '==', 1), ('rhum', '>', 85), ('spread', '<', 3.0)),
-        }
-        calculated_flags = set()
-        flags_to_calculate = list(thresholds.keys())
-        max_iterations = 5
-        iteration = 0
-        threshold_flags_names = [] # Lista do przechowywania nazw utworzonych flag
-        thresholds_copy = thresholds.copy() # Kopia do bezpiecznego usuwania
-
-        while flags_to_calculate and iteration < max_iterations:
-            newly_calculated_in_iter = [] # Flagi obliczone w tej iteracji
-            remaining_flags_for_next_iter = []
-            
-            for flag_name in list(flags_to_calculate): # Iterujemy po kopii listy, aby móc ją modyfikować
-                if flag_name not in thresholds_copy: # Jeśli flaga została usunięta z powodu błędu
-                    if flag_name in flags_to_calculate: flags_to_calculate.remove(flag_name) # Upewnij się, że jest usunięta
-                    continue
-
-                conditions = thresholds_copy[flag_name]
-                can_calculate_flag = True
-                
-                current_required_features_for_flag = []
-                is_combined_flag = isinstance(conditions[0], tuple)
-                if is_combined_flag:
-                    current_required_features_for_flag = [cond[0] for cond in conditions]
-                else:
-                    current_required_features_for_flag = [conditions[0]]
-
-                for feature_needed in current_required_features_for_flag:
-                    is_dependency_on_other_flag = feature_needed.startswith('flag_')
-                    if is_dependency_on_other_flag and feature_needed not in calculated_flags:
-                        can_calculate_flag = False; break
-                    elif not is_dependency_on_other_flag and (feature_needed not in df.columns or not pd.api.types.is_numeric_dtype(df[feature_needed])):
-                        print(f"    BŁĄD KRYTYCZNY: Bazowa cecha '{feature_needed}' (numeryczna) dla flagi '{flag_name}' nie istnieje lub nie jest numeryczna. Pomijam flagę '{flag_name}'.")
-                        if flag_name in thresholds_copy: del thresholds_copy[flag_name]
-                        if flag_name in flags_to_calculate: flags_to_calculate.remove(flag_name)
-                        can_calculate_flag = False; break
-                
-                if not can_calculate_flag:
-                    if flag_name in thresholds_copy: # Jeśli błąd nie był krytyczny (tylko zależność)
-                        remaining_flags_for_next_iter.append(flag_name)
-                    continue
-
-                # Obliczanie flagi
-                final_condition_series = pd.Series(True, index=df.index)
-                process_condition_lambda = lambda feat, op, thr: {
-                    '<': df[feat] < thr, '>': df[feat] > thr,
-                    '<=': df[feat] <= thr, '>=': df[feat] >= thr,
-                    '==': df[feat] == thr, '!=': df[feat] != thr
-                }.get(op, pd.Series(False, index=df.index)) # Fallback na False
-
-                try:
-                    if is_combined_flag:
-                        for feature, operator, threshold_val in conditions:
-                            if feature not in df.columns or not pd.api.types.is_numeric_dtype(df[feature]): # Podwójne sprawdzenie
-                                raise KeyError(f"Cecha '{feature}' dla flagi '{flag_name}' nie istnieje lub nie jest numeryczna w df podczas budowania warunku.")
-                            final_condition_series &= process_condition_lambda(feature, operator, threshold_val)
-                    else:
-                        feature, operator, threshold_val = conditions
-                        if feature not in df.columns or not pd.api.types.is_numeric_dtype(df[feature]): # Podwójne sprawdzenie
-                            raise KeyError(f"Cecha '{feature}' dla flagi '{flag_name}' nie istnieje lub nie jest numeryczna w df podczas budowania warunku.")
-                        final_condition_series = process_condition_lambda(feature, operator, threshold_val)
-                    
-                    df[flag_name] = final_condition_series.astype(int)
-                    threshold_flags_names.append(flag_name)
-                    calculated_flags.add(flag_name)
-                    newly_calculated_in_iter.append(flag_name)
-                    if flag_name in flags_to_calculate: flags_to_calculate.remove(flag_name)
-                    if flag_name in thresholds_copy: del thresholds_copy[flag_name]
-
-                except KeyError as ke_flag:
-                    print(f"    BŁĄD KRYTYCZNY (KeyError) przy obliczaniu flagi '{flag_name}': {ke_flag}. Pomijam flagę.")
-                    if flag_name in thresholds_copy: del thresholds_copy[flag_name]
-                    if flag_name in flags_to_calculate: flags_to_calculate.remove(flag_name)
-                except Exception as e_flag:
-                    print(f"    BŁĄD (Inny) przy obliczaniu flagi '{flag_name}': {e_flag}. Spróbuję później.")
-                    if flag_name not in remaining_flags_for_next_iter and flag_name in thresholds_copy:
-                        remaining_flags_for_next_iter.append(flag_name)
-
-            flags_to_calculate = remaining_flags_for_next_iter
-            iteration += 1
-            if not newly_calculated_in_iter and flags_to_calculate:
-                print(f"    OSTRZEŻENIE: W iteracji {iteration} nie udało się obliczyć żadnych nowych flag. Pozostałe flagi do obliczenia: {flags_to_calculate}")
-                unresolved_dependencies_report = {}
-                for fname_report in flags_to_calculate:
-                    if fname_report in thresholds_copy:
-                        conds_report = thresholds_copy[fname_report]
-                        is_comb_report = isinstance(conds_report[0], tuple)
-                        req_feats_report = [c[0] for c in conds_report] if is_comb_report else [conds_report[0]]
-                        missing_deps_report = [rf for rf in req_feats_report if rf.startswith('flag_') and rf not in calculated_flags]
-                        if missing_deps_report: unresolved_dependencies_report[fname_report] = missing_deps_report
-                if unresolved_dependencies_report: print(f"      Nierozwiązane zależności flag: {unresolved_dependencies_report}")
-                break 
-            
-        if flags_to_calculate:
-            print(f"    OSTRZEŻENIE KOŃCOWE: Nie udało się obliczyć wszystkich flag po {max_iterations} iteracjach. Nieuobliczone: {flags_to_calculate}")
-        print(f"  Utworzono {len(threshold_flags_names)} flag binarnych.")
-        # Koniec bloku flag binarnych
-
-        feature_engineering_duration_actual = time.time() - feature_engineering_start_time_actual
-        print(f"--- Zakończono Rozszerzoną Inżynierię Cech v2 ({feature_engineering_duration_actual:.1f} sek) ---")
-
-
-        print("\n  Wypełnianie brakujących wartości (NaN) metodą 'forward fill'...")
-        # Zidentyfikuj kolumny, które mają być wypełnione. Powinny to być wszystkie wygenerowane cechy.
-        # Możemy po prostu zadziałać na całym DataFrame, ale ostrożnie.
-        # Kolumny, które nie powinny być wypełniane (jak 'year', 'coco'), zazwyczaj nie mają NaN.
-
-        # Wybieramy tylko kolumny numeryczne do wypełnienia
-        numeric_cols = df.select_dtypes(include=np.number).columns.tolist()
-
-        # Zapamiętujemy, ile było NaN przed
-        nan_before = df[numeric_cols].isnull().sum().sum()
-
-        # Używamy forward fill, a potem back fill, aby wypełnić też ewentualne NaN na początku
-        df[numeric_cols] = df[numeric_cols].fillna(method='ffill').fillna(method='bfill')
-
-        nan_after = df[numeric_cols].isnull().sum().sum()
-        print(f"  Wypełniono {nan_before - nan_after} wartości NaN.")
-
-        # Jeśli po tym nadal są jakieś NaN (co może się zdarzyć, jeśli cała kolumna jest pusta),
-        # wypełniamy je zerem.
-        if nan_after > 0:
-            print(f"  Pozostało {nan_after} wartości NaN. Wypełniam zerami.")
-            df.fillna(0, inplace=True)
-        # --- KONIEC ETAPU IMPUTACJI ---
-
-
-        # --- FINALNE CZYSZCZENIE NaN ---
-        # Ten blok teraz powinien usuwać znacznie mniej wierszy, a idealnie wcale.
-        print("\n  Usuwanie NaN po pełnej inżynierii cech (finalne)...")
-
-        # --- FINALNE CZYSZCZENIE NaN ---
-        print("\n  Usuwanie NaN po pełnej inżynierii cech (finalne)...")
-        rows_before_final_dropna = len(df)
-        # Upewnij się, że 'year' i 'coco' są w df, jeśli używasz ich w cols_to_exclude_from_dropna
-        if 'year' not in df.columns: df['year'] = df.index.year
-        if 'coco' not in df.columns: df['coco'] = 1 # Placeholder jeśli brak
-
-        potential_feature_cols = list(df.select_dtypes(include=np.number).columns)
-        cols_to_exclude_from_dropna = ['coco', 'year'] # Te kolumny nie są cechami numerycznymi do modelu
-        # Tworzymy listę cech, na podstawie których będziemy usuwać NaN
-        # Powinny to być wszystkie numeryczne cechy, które mogą być użyte w modelach
-        features_for_dropna_final = [f for f in potential_feature_cols if f not in cols_to_exclude_from_dropna and f in df.columns]
-
-        if not features_for_dropna_final:
-            print("  OSTRZEŻENIE: Brak numerycznych cech (poza 'coco', 'year') do sprawdzenia NaN. Nie wykonano dropna.")
-        else:
-            # Usuwamy wiersze, które mają NaN w którejkolwiek z wybranych cech numerycznych
-            # To jest ważne, bo XGBoost nie lubi NaN.
-            df.dropna(subset=features_for_dropna_final, inplace=True)
-
-        rows_after_processing_final = len(df)
-        print(f"  Usunięto {rows_before_final_dropna - rows_after_processing_final} wierszy z NaN.")
-        print(f"  Ostateczna liczba rekordów po inżynierii cech: {rows_after_processing_final}.")
-
-        if rows_after_processing_final == 0:
-            print("KRYTYCZNY BŁĄD: Brak danych po pełnym przetworzeniu i usunięciu NaN. Sprawdź logikę i dane wejściowe."); exit()
-
-        df_processed_final = df.copy() # Wynik inżynierii cech
+        with timer.stage('feature_engineering'):
+            df_processed_final, threshold_flags_names = engineer_features(df_for_feature_engineering, required_features=MODEL_FEATURES)
         # --- KONIEC ETAPU 2 ---
 
         processing_and_fe_duration = time.time() - full_processing_start_time
-        print(f"--- Całkowity czas przygotowania danych i FE: {processing_and_fe_duration:.1f} sek ---")
-
-
-        # --- Definicje List Cech z ANOVA v8 (Wiedeń) ---
-        # UPEWNIJ SIĘ, ŻE TE LISTY SĄ IDENTYCZNE JAK W SKRYPCIE TRENINGOWYM
-        print("\n--- Etap 3: Definiowanie list cech ---")
-        FEATURES_M1 = [
-            'was_precip_category_lag1h', 'flag_light_precip', 'flag_has_precip', 'flag_gusty_and_precip',
-            'was_rain_lag1h', 'flag_windy_and_precip', 'was_precip_category_lag2h', 'was_rain_lag2h',
-            'was_precip_category_lag3h', 'was_rain_lag3h', 'prcp_roll6h_median', 'prcp_roll3h_sum',
-            'prcp_roll3h_mean', 'prcp_roll6h_mean', 'prcp_roll6h_sum', 'prcp_roll3h_median',
-            'prcp_roll3h_min', 'prcp_roll12h_mean', 'prcp_roll12h_sum', 'prcp_roll12h_median',
-            'prcp_roll3h_max', 'prcp', 'prcp_roll6h_min', 'flag_moderate_precip',
-            'prcp_roll6h_max', 'prcp_lag_1h', 'was_precip_category_lag6h', 'prcp_roll6h_std',
-            'prcp_roll3h_std', 'flag_near_freezing_precip'
-        ]
-        FEATURES_M2 = [
-            'was_fog_lag1h', 'flag_damp_conditions', 'was_fog_lag2h', 'flag_fog_ratio',
-            'flag_near_saturation', 'flag_close_saturation', 'was_fog_lag3h', 'flag_very_humid',
-            'flag_cold_and_humid', 'flag_moderate_humid', 'flag_humid', 'rhum_x_spread',
-            'was_fog_lag6h', 'rhum_pow2', 'rhum_x_rhum', 'flag_moderate_spread',
-            'rhum_roll6h_min', 'rhum_div_roll24h_std_safe', 'rhum_roll3h_min', 'rhum_roll12h_min',
-            'rhum_x_pres', 'rhum', 'rhum_roll3h_mean', 'rhum_roll24h_min',
-            'rhum_div_pres_safe', 'rhum_roll24h_mean', 'rhum_roll6h_mean', 'rhum_roll3h_median',
-            'rhum_roll12h_mean', 'rhum_lag_1h'
-        ]
-        FEATURES_M3 = [
-            'flag_potential_snow', 'flag_dp_below_freezing', 'flag_near_freezing_precip', 'flag_near_freezing_low',
-            'was_snow_sleet_freezing_lag1h', 'flag_below_freezing', 'flag_below_freezing_precip', 'was_snow_sleet_freezing_lag2h',
-            'was_snow_sleet_freezing_lag3h', 'temp_x_rhum', 'temp_div_pres_safe', 'temp',
-            'temp_x_pres', 'temp_roll3h_min', 'temp_roll3h_mean', 'dew_point_roll3h_max',
-            'dew_point_roll6h_max', 'temp_roll3h_median', 'dew_point_roll3h_mean', 'dew_point_roll12h_max',
-            'temp_lag_1h', 'dew_point',
-            'dew_point_div_pres_safe', 'dew_point_x_pres',
-            'dew_point_roll3h_median', 'dew_point_lag_1h', 'dew_point_roll24h_max', 'temp_roll3h_max',
-            'temp_roll6h_min', 'rhum_x_dew_point'
-        ]
-        FEATURES_M4 = [
-            'was_clear_fair_lag1h', 'was_cloudy_overcast_lag1h', 'was_clear_fair_lag2h', 'was_cloudy_overcast_lag2h',
-            'was_clear_fair_lag3h', 'was_cloudy_overcast_lag3h', 'was_clear_fair_lag6h', 'was_cloudy_overcast_lag6h',
-            'temp_roll12h_range', 'tsun_roll24h_sum', 'tsun_roll24h_mean', 'temp_roll12h_std',
-            'temp_roll24h_std', 'temp_roll24h_range', 'tsun_roll12h_sum', 'tsun_roll12h_mean',
-            'spread_roll24h_std', 'spread_roll12h_max', 'rhum_roll12h_min', 'rhum_roll24h_min',
-            'spread_roll12h_range', 'spread_roll24h_range', 'spread_roll24h_max', 'spread_roll12h_std',
-            'tsun_roll12h_max', 'tsun_roll12h_std', 'abs_tsun_diff_12h', 'rhum_roll24h_std',
-            'tsun_roll24h_std', 'tsun_roll6h_mean'
-        ]
-
-        print("  Weryfikacja dostępności cech...")
-        feature_lists_final = {}
-        all_features_unpacked_for_models = [] # Zmieniona nazwa, aby uniknąć konfliktu
-        for name, features_list_for_model in [("M1", FEATURES_M1), ("M2", FEATURES_M2), ("M3", FEATURES_M3), ("M4", FEATURES_M4)]:
-            available_model_features = [f for f in features_list_for_model if f in df_processed_final.columns]
-            missing_model_features = sorted(list(set(features_list_for_model) - set(available_model_features)))
-            
-            non_flag_missing_model = [m for m in missing_model_features if not m.startswith('flag_')]
-            # threshold_flags_names jest zdefiniowane w bloku FE
-            flag_missing_not_created_model = [m for m in missing_model_features if m.startswith('flag_') and m not in threshold_flags_names]
-
-            if non_flag_missing_model:
-                print(f"    KRYTYCZNE OSTRZEŻENIE ({name}): Nie znaleziono NIE-FLAGOWYCH cech: {', '.join(non_flag_missing_model)}.")
-            if flag_missing_not_created_model:
-                print(f"    OSTRZEŻENIE ({name}): Flagi nie znalezione LUB nie utworzone: {', '.join(flag_missing_not_created_model)}.")
-            
-            if missing_model_features:
-                print(f"    ({name}): Usunięto {len(missing_model_features)} brakujących/nieutworzonych cech z listy dla tego modelu.")
-                current_model_features_final = available_model_features
-            else:
-                # print(f"    ({name}): Wszystkie {len(features_list_for_model)} cechy są dostępne.") # Mniej gadatliwe
-                current_model_features_final = features_list_for_model
+        log.info("--- Całkowity czas przygotowania danych i FE: %.1f sek ---", processing_and_fe_duration)
 
-            if not current_model_features_final:
-                print(f"    KRYTYCZNY BŁĄD ({name}): Brak dostępnych cech po weryfikacji! Model nie może być użyty.")
-                feature_lists_final[name] = [] # Pusta lista spowoduje pominięcie modelu
-            else:
-                feature_lists_final[name] = current_model_features_final
-                all_features_unpacked_for_models.extend(current_model_features_final)
 
-        all_unique_features_needed_by_models = sorted(list(set(all_features_unpacked_for_models)))
-        print(f"  Łącznie unikalnych cech potrzebnych przez wszystkie modele (po weryfikacji): {len(all_unique_features_needed_by_models)}")
+        log.info("--- Etap 3: Definiowanie list cech ---")
+        feature_lists_final, all_unique_features_needed_by_models = resolve_feature_lists(df_processed_final, threshold_flags_names)
 
 
         # --- Etap 4: Przygotowanie Danych do Predykcji / Treningu i Testu ---
-        print("\n--- Etap 4: Przygotowanie Danych do Predykcji / Treningu i Testu ---")
+        log.info("--- Etap 4: Przygotowanie Danych do Predykcji / Treningu i Testu ---")
 
         if USE_DATABASE_INPUT:
             if not isinstance(df_processed_final.index, pd.DatetimeIndex):
@@ -825,11 +1426,11 @@ def run_prediction(start_date_str, end_date_str):
                 (df_processed_final.index <= PREDICTION_END_DATE)
             ].copy()
             
-            print(f"  Przygotowano {len(prediction_data_df)} próbek do predykcji (z okresu {PREDICTION_START_DATE} - {PREDICTION_END_DATE}).")
+            log.debug("Przygotowano %s próbek do predykcji (z okresu %s - %s).", len(prediction_data_df), PREDICTION_START_DATE, PREDICTION_END_DATE)
             
             # --- KLUCZOWA ZMIANA ---
             if prediction_data_df.empty:
-                print("  INFO: Brak danych w zadanym okresie predykcji po pełnym przetworzeniu. Zwracam pusty wynik.")
+                log.info("Brak danych w zadanym okresie predykcji po pełnym przetworzeniu. Zwracam pusty wynik.")
                 # Zamiast exit(), zwracamy pustą listę, co jest poprawnym, pustym wynikiem.
                 return [] 
             # W trybie predykcji nie mamy `y_test_actual_str` z góry, chyba że to re-predykcja dla ewaluacji
@@ -837,9 +1438,9 @@ def run_prediction(start_date_str, end_date_str):
         else: # Tryb Meteostat (oryginalny podział na train/test)
             train_df = df_processed_final[(df_processed_final['year'] >= train_start_year) & (df_processed_final['year'] <= train_end_year)].copy()
             test_df = df_processed_final[df_processed_final['year'] == test_year].copy()
-            print(f"  Liczba próbek treningowych (Meteostat, przed SMOTE): {len(train_df)}")
-            print(f"  Liczba próbek testowych (Meteostat): {len(test_df)}")
-            if train_df.empty or test_df.empty: print("  BŁĄD: Zbiór treningowy lub testowy Meteostat jest pusty."); exit()
+            log.info("Liczba próbek treningowych (Meteostat, przed SMOTE): %s", len(train_df))
+            log.info("Liczba próbek testowych (Meteostat): %s", len(test_df))
+            if train_df.empty or test_df.empty: raise FeatureEngineeringError("Zbiór treningowy lub testowy Meteostat jest pusty.")
             y_test_actual_str_meteostat = test_df['weather_category'] # Rzeczywiste etykiety dla danych testowych Meteostat
 
 
@@ -847,228 +1448,154 @@ def run_prediction(start_date_str, end_date_str):
         # Funkcja pomocnicza do treningu (jeśli FORCE_RETRAIN) - skopiowana z Twojego skryptu
         def train_xgboost_model(X_train, y_train, features, model_name_func, objective_func, num_class_func=None, use_smote_func=False, label_encoder_func=None):
             # ... (pełna definicja funkcji train_xgboost_model z Twojego skryptu)
-            print(f"\n--- Trenowanie {model_name_func} ---")
-            if not features: print(f"   BŁĄD: Brak cech dla {model_name_func}."); return None, None
+            log.info("--- Trenowanie %s ---", model_name_func)
+            if not features: log.error("BŁĄD: Brak cech dla %s.", model_name_func); return None, None
             X_train_model = X_train[features].copy() # Użyj .copy()
             y_train_model = y_train.copy()
-            if X_train_model.empty or len(y_train_model) == 0: print(f"   BŁĄD: Brak danych dla {model_name_func}."); return None, None
+            if X_train_model.empty or len(y_train_model) == 0: log.error("BŁĄD: Brak danych dla %s.", model_name_func); return None, None
             for col in X_train_model.columns:
                 if X_train_model[col].dtype == 'object':
                     try: X_train_model[col] = pd.to_numeric(X_train_model[col])
-                    except ValueError: print(f"OSTRZEŻENIE: Nie udało się przekonwertować {col} na typ numeryczny.")
+                    except ValueError: log.warning("OSTRZEŻENIE: Nie udało się przekonwertować %s na typ numeryczny.", col)
                 if X_train_model[col].dtype == 'bool': X_train_model[col] = X_train_model[col].astype(int)
-            print(f"   Rozkład klas przed SMOTE ({model_name_func}): {np.bincount(y_train_model) if len(np.unique(y_train_model)) > 0 else 'brak klas'}")
+            log.info("Rozkład klas przed SMOTE (%s): %s", model_name_func, np.bincount(y_train_model) if len(np.unique(y_train_model)) > 0 else 'brak klas')
             X_train_resampled, y_train_resampled = X_train_model, y_train_model; scale_pos_weight_val = 1
             if use_smote_func and SMOTE_AVAILABLE:
                 unique_classes, counts = np.unique(y_train_model, return_counts=True); min_class_count = counts.min() if len(counts)>0 else 0
                 if len(unique_classes) > 1 and min_class_count >= 2: # Zmieniono na >=2 dla SMOTE
                     k_neighbors_smote = min(5, min_class_count - 1) if min_class_count > 1 else 1
                     if k_neighbors_smote < 1: k_neighbors_smote = 1
-                    print(f"   Stosowanie SMOTE (min klasa: {min_class_count}, k_neighbors={k_neighbors_smote})...")
+                    log.info("Stosowanie SMOTE (min klasa: %s, k_neighbors=%s)...", min_class_count, k_neighbors_smote)
                     smote = SMOTE(random_state=42, k_neighbors=k_neighbors_smote)
-                    try: X_train_resampled, y_train_resampled = smote.fit_resample(X_train_model, y_train_model); print(f"   Rozkład klas PO SMOTE: {np.bincount(y_train_resampled)}")
-                    except ValueError as e: print(f"   OSTRZ.: Błąd SMOTE: {e}. Używam oryg. danych.")
+                    try: X_train_resampled, y_train_resampled = smote.fit_resample(X_train_model, y_train_model); log.info("Rozkład klas PO SMOTE: %s", np.bincount(y_train_resampled))
+                    except ValueError as e: log.warning("OSTRZ.: Błąd SMOTE: %s. Używam oryg. danych.", e)
                 elif len(unique_classes) > 1:
-                    print(f"   OSTRZ.: Za mało próbek ({min_class_count}) dla SMOTE (wymagane min. 2).")
+                    log.warning("OSTRZ.: Za mało próbek (%s) dla SMOTE (wymagane min. 2).", min_class_count)
                     if objective_func == 'binary:logistic' and len(counts) == 2 and counts[0] > 0 and counts[1] > 0 :
-                        scale_pos_weight_val = counts[0] / counts[1]; print(f"   Używam scale_pos_weight = {scale_pos_weight_val:.2f}")
+                        scale_pos_weight_val = counts[0] / counts[1]; log.info("Używam scale_pos_weight = %.2f", scale_pos_weight_val)
                 elif len(unique_classes) <=1:
-                    print(f"   OSTRZ.: Tylko jedna klasa ({unique_classes}) w danych treningowych. SMOTE nie zostanie zastosowane.")
+                    log.warning("OSTRZ.: Tylko jedna klasa (%s) w danych treningowych. SMOTE nie zostanie zastosowane.", unique_classes)
             elif not use_smote_func and objective_func == 'binary:logistic':
                 counts = np.bincount(y_train_model)
-                if len(counts) == 2 and counts[0] > 0 and counts[1] > 0: scale_pos_weight_val = counts[0] / counts[1]; print(f"   SMOTE wyłączone. Używam scale_pos_weight = {scale_pos_weight_val:.2f}")
+                if len(counts) == 2 and counts[0] > 0 and counts[1] > 0: scale_pos_weight_val = counts[0] / counts[1]; log.info("SMOTE wyłączone. Używam scale_pos_weight = %.2f", scale_pos_weight_val)
             xgb_params = {'objective': objective_func, 'n_estimators': 200, 'learning_rate': 0.05, 'max_depth': 7, 'subsample': 0.7, 'colsample_bytree': 0.7, 'eval_metric': 'logloss' if 'binary' in objective_func else 'mlogloss', 'random_state': 42, 'n_jobs': -1}
             if objective_func == 'binary:logistic' and scale_pos_weight_val != 1: xgb_params['scale_pos_weight'] = scale_pos_weight_val
             if num_class_func: xgb_params['num_class'] = num_class_func
-            model_xgb = xgb.XGBClassifier(**xgb_params); print(f"   Trenowanie XGBoost dla {model_name_func}..."); _start_time_train = time.time()
-            try: model_xgb.fit(X_train_resampled, y_train_resampled); print(f"   Trening {model_name_func} zakończony w {time.time() - _start_time_train:.1f} sek."); return model_xgb, label_encoder_func
-            except Exception as e_train: print(f"   BŁĄD treningu {model_name_func}: {e_train}"); return None, None
+            model_xgb = xgb.XGBClassifier(**xgb_params); log.info("Trenowanie XGBoost dla %s...", model_name_func); _start_time_train = time.time()
+            try: model_xgb.fit(X_train_resampled, y_train_resampled); log.info("Trening %s zakończony w %.1f sek.", model_name_func, time.time() - _start_time_train); return model_xgb, label_encoder_func
+            except Exception as e_train: log.error("BŁĄD treningu %s: %s", model_name_func, e_train); return None, None
 
 
-        print("\n--- Etap 5: Trening lub Wczytywanie Modeli ---")
+        log.info("--- Etap 5: Trening lub Wczytywanie Modeli ---")
+        # Modele pochodzą z rejestru procesu - JSON-y są parsowane raz, a nie przy każdej predykcji
+        loaded_models = {}
+        if LOAD_MODELS_IF_EXIST and not FORCE_RETRAIN:
+            try:
+                with timer.stage('model_load'):
+                    loaded_models = registry_models()
+                log.debug("Modele pobrane z rejestru (wersja zestawu: %s).", loaded_models['model_set_version'])
+            except ModelLoadError as e:
+                log.error("BŁĄD wczytywania modeli z rejestru: %s.", e.detail)
+                if USE_DATABASE_INPUT: raise # Bez modeli nie ma predykcji z bazy (trening tylko w trybie Meteostat)
+
         # Model 1
-        model_1_path = os.path.join(MODEL_SAVE_DIR, "model_M1.json"); model_1 = None
-        if LOAD_MODELS_IF_EXIST and not FORCE_RETRAIN and os.path.exists(model_1_path):
-            print(f"  Wczytywanie Modelu 1 z: {model_1_path}")
-            try: model_1 = xgb.XGBClassifier(); model_1.load_model(model_1_path); print("    Model 1 wczytany.")
-            except Exception as e: print(f"    BŁĄD wczytywania M1: {e}."); model_1 = None
+        model_1_path = os.path.join(MODEL_SAVE_DIR, "model_M1.json"); model_1 = loaded_models.get('M1')
         if (model_1 is None or FORCE_RETRAIN) and not USE_DATABASE_INPUT: # Trening tylko jeśli nie predykcja z bazy i trzeba
-            print(f"  {'Wymuszono' if FORCE_RETRAIN else 'Rozpoczynam'} trening Modelu 1...")
+            log.info("%s trening Modelu 1...", 'Wymuszono' if FORCE_RETRAIN else 'Rozpoczynam')
             y_train_m1 = train_df['weather_category'].isin(precip_categories_user).astype(int)
             model_1, _ = train_xgboost_model(train_df, y_train_m1, feature_lists_final['M1'], "Model 1", 'binary:logistic', use_smote_func=USE_SMOTE)
             if model_1: 
-                try: model_1.save_model(model_1_path); print(f"    Model 1 zapisany: {model_1_path}")
-                except Exception as e: print(f"    BŁĄD zapisu M1: {e}")
-        elif model_1 is None and USE_DATABASE_INPUT: print("  KRYTYCZNY BŁĄD: Model 1 nie został wczytany, a jest potrzebny do predykcji."); exit()
+                try: model_1.save_model(model_1_path); log.info("Model 1 zapisany: %s", model_1_path)
+                except Exception as e: log.error("BŁĄD zapisu M1: %s", e)
+        elif model_1 is None and USE_DATABASE_INPUT: raise ModelLoadError("Model 1 nie został wczytany, a jest potrzebny do predykcji.")
 
         # Model 2
-        model_2_path = os.path.join(MODEL_SAVE_DIR, "model_M2.json"); model_2 = None
-        if LOAD_MODELS_IF_EXIST and not FORCE_RETRAIN and os.path.exists(model_2_path):
-            print(f"  Wczytywanie Modelu 2 z: {model_2_path}")
-            try: model_2 = xgb.XGBClassifier(); model_2.load_model(model_2_path); print("    Model 2 wczytany.")
-            except Exception as e: print(f"    BŁĄD wczytywania M2: {e}."); model_2 = None
+        model_2_path = os.path.join(MODEL_SAVE_DIR, "model_M2.json"); model_2 = loaded_models.get('M2')
         if (model_2 is None or FORCE_RETRAIN) and not USE_DATABASE_INPUT:
-            print(f"  {'Wymuszono' if FORCE_RETRAIN else 'Rozpoczynam'} trening Modelu 2...")
+            log.info("%s trening Modelu 2...", 'Wymuszono' if FORCE_RETRAIN else 'Rozpoczynam')
             train_df_m2_subset = train_df[train_df['weather_category'].isin(no_precip_categories_user)].copy()
             y_train_m2 = (train_df_m2_subset['weather_category'] == 'Fog').astype(int)
             model_2, _ = train_xgboost_model(train_df_m2_subset, y_train_m2, feature_lists_final['M2'], "Model 2", 'binary:logistic', use_smote_func=USE_SMOTE)
             if model_2: 
-                try: model_2.save_model(model_2_path); print(f"    Model 2 zapisany: {model_2_path}")
-                except Exception as e: print(f"    BŁĄD zapisu M2: {e}")
-        elif model_2 is None and USE_DATABASE_INPUT: print("  KRYTYCZNY BŁĄD: Model 2 nie został wczytany."); exit()
+                try: model_2.save_model(model_2_path); log.info("Model 2 zapisany: %s", model_2_path)
+                except Exception as e: log.error("BŁĄD zapisu M2: %s", e)
+        elif model_2 is None and USE_DATABASE_INPUT: raise ModelLoadError("Model 2 nie został wczytany.")
 
         # Model 3 i LabelEncoder
         model_3_path = os.path.join(MODEL_SAVE_DIR, "model_M3.json"); le_3_path = os.path.join(MODEL_SAVE_DIR, "le_M3.pkl")
-        model_3 = None; le_precip_trained_for_m3 = None
-        if LOAD_MODELS_IF_EXIST and not FORCE_RETRAIN and os.path.exists(model_3_path) and os.path.exists(le_3_path):
-            print(f"  Wczytywanie Modelu 3 i LabelEncodera...")
-            try:
-                model_3 = xgb.XGBClassifier(); model_3.load_model(model_3_path)
-                le_precip_trained_for_m3 = joblib.load(le_3_path)
-                print(f"    Model 3 wczytany. LE dla M3 wczytany. Klasy: {list(le_precip_trained_for_m3.classes_)}")
-            except Exception as e: print(f"    BŁĄD wczytywania M3/LE: {e}."); model_3 = None; le_precip_trained_for_m3 = None
+        model_3 = loaded_models.get('M3'); le_precip_trained_for_m3 = loaded_models.get('LE_M3')
         if (model_3 is None or le_precip_trained_for_m3 is None or FORCE_RETRAIN) and not USE_DATABASE_INPUT:
-            print(f"  {'Wymuszono' if FORCE_RETRAIN else 'Rozpoczynam'} trening Modelu 3...")
+            log.info("%s trening Modelu 3...", 'Wymuszono' if FORCE_RETRAIN else 'Rozpoczynam')
             train_df_m3_subset = train_df[train_df['weather_category'].isin(precip_categories_user)].copy()
             if not train_df_m3_subset.empty:
                 current_le_m3 = LabelEncoder()
                 y_train_m3 = current_le_m3.fit_transform(train_df_m3_subset['weather_category'])
                 num_classes_m3 = len(current_le_m3.classes_)
-                print(f"    Mapowanie klas M3 (trening): {dict(zip(current_le_m3.classes_, range(num_classes_m3)))}")
+                log.info("Mapowanie klas M3 (trening): %s", dict(zip(current_le_m3.classes_, range(num_classes_m3))))
                 model_3, le_precip_trained_for_m3 = train_xgboost_model(train_df_m3_subset, y_train_m3, feature_lists_final['M3'], "Model 3", 'multi:softmax', num_class_func=num_classes_m3, use_smote_func=USE_SMOTE, label_encoder_func=current_le_m3)
                 if model_3 and le_precip_trained_for_m3:
-                    try: model_3.save_model(model_3_path); joblib.dump(le_precip_trained_for_m3, le_3_path); print(f"    Model 3 i LE zapisane.")
-                    except Exception as e: print(f"    BŁĄD zapisu M3/LE: {e}")
-            else: print("    Brak danych treningowych dla M3.")
-        elif (model_3 is None or le_precip_trained_for_m3 is None) and USE_DATABASE_INPUT: print("  KRYTYCZNY BŁĄD: Model 3 lub LE nie został wczytany."); exit()
+                    try: model_3.save_model(model_3_path); joblib.dump(le_precip_trained_for_m3, le_3_path); log.info("Model 3 i LE zapisane.")
+                    except Exception as e: log.error("BŁĄD zapisu M3/LE: %s", e)
+            else: log.info("Brak danych treningowych dla M3.")
+        elif (model_3 is None or le_precip_trained_for_m3 is None) and USE_DATABASE_INPUT: raise ModelLoadError("Model 3 lub LE nie został wczytany.")
 
         # Model 4
-        model_4_path = os.path.join(MODEL_SAVE_DIR, "model_M4.json"); model_4 = None
-        if LOAD_MODELS_IF_EXIST and not FORCE_RETRAIN and os.path.exists(model_4_path):
-            print(f"  Wczytywanie Modelu 4 z: {model_4_path}")
-            try: model_4 = xgb.XGBClassifier(); model_4.load_model(model_4_path); print("    Model 4 wczytany.")
-            except Exception as e: print(f"    BŁĄD wczytywania M4: {e}."); model_4 = None
+        model_4_path = os.path.join(MODEL_SAVE_DIR, "model_M4.json"); model_4 = loaded_models.get('M4')
         if (model_4 is None or FORCE_RETRAIN) and not USE_DATABASE_INPUT:
-            print(f"  {'Wymuszono' if FORCE_RETRAIN else 'Rozpoczynam'} trening Modelu 4...")
+            log.info("%s trening Modelu 4...", 'Wymuszono' if FORCE_RETRAIN else 'Rozpoczynam')
             train_df_m4_subset = train_df[train_df['weather_category'].isin(['Clear/Fair', 'Cloudy/Overcast'])].copy()
             y_train_m4 = (train_df_m4_subset['weather_category'] == 'Cloudy/Overcast').astype(int)
             model_4, _ = train_xgboost_model(train_df_m4_subset, y_train_m4, feature_lists_final['M4'], "Model 4", 'binary:logistic', use_smote_func=USE_SMOTE)
             if model_4: 
-                try: model_4.save_model(model_4_path); print(f"    Model 4 zapisany: {model_4_path}")
-                except Exception as e: print(f"    BŁĄD zapisu M4: {e}")
-        elif model_4 is None and USE_DATABASE_INPUT: print("  KRYTYCZNY BŁĄD: Model 4 nie został wczytany."); exit()
+                try: model_4.save_model(model_4_path); log.info("Model 4 zapisany: %s", model_4_path)
+                except Exception as e: log.error("BŁĄD zapisu M4: %s", e)
+        elif model_4 is None and USE_DATABASE_INPUT: raise ModelLoadError("Model 4 nie został wczytany.")
 
 
         # --- Etap 6: Predykcja Hierarchiczna ---
-        print("\n--- Etap 6: Predykcja Hierarchiczna ---")
+        log.info("--- Etap 6: Predykcja Hierarchiczna ---")
         models_dict = {'M1': model_1, 'M2': model_2, 'M3': model_3, 'M4': model_4}
         models_all_available = all(m is not None for m in models_dict.values())
-        if not models_all_available: print("  KRYTYCZNY BŁĄD: Nie wszystkie modele są dostępne. Przerywam predykcję."); exit()
+        if not models_all_available: raise ModelLoadError("Nie wszystkie modele są dostępne.")
         if le_precip_trained_for_m3 is None and model_3 is not None: # Dodatkowe sprawdzenie dla M3
-            print("  KRYTYCZNY BŁĄD: Model M3 jest dostępny, ale jego LabelEncoder (le_precip_trained_for_m3) nie. Przerywam."); exit()
+            raise ModelLoadError("Model M3 jest dostępny, ale jego LabelEncoder (le_precip_trained_for_m3) nie.")
 
 
         # Wybór danych do predykcji
         if USE_DATABASE_INPUT:
-            if prediction_data_df.empty: print("  Brak danych do predykcji z bazy. Przerywam."); exit()
+            if prediction_data_df.empty: raise FeatureEngineeringError("Brak danych do predykcji z bazy.")
             # Sprawdzenie czy wszystkie potrzebne cechy są w prediction_data_df
             missing_cols_in_pred_data = [col for col in all_unique_features_needed_by_models if col not in prediction_data_df.columns]
             if missing_cols_in_pred_data:
-                print(f"  BŁĄD KRYTYCZNY: Brakuje następujących cech w danych do predykcji: {missing_cols_in_pred_data}"); exit()
+                raise FeatureEngineeringError(f"Brakuje następujących cech w danych do predykcji: {missing_cols_in_pred_data}")
             X_predict_source_df = prediction_data_df[all_unique_features_needed_by_models].copy()
-            print(f"  Predykcja na {len(X_predict_source_df)} próbkach z bazy danych.")
+            log.debug("Predykcja na %s próbkach z bazy danych.", len(X_predict_source_df))
         elif not test_df.empty: # Tryb Meteostat, użyj test_df
             missing_cols_in_test_df = [col for col in all_unique_features_needed_by_models if col not in test_df.columns]
             if missing_cols_in_test_df:
-                print(f"  BŁĄD KRYTYCZNY: Brakuje następujących cech w test_df (Meteostat): {missing_cols_in_test_df}"); exit()
+                raise FeatureEngineeringError(f"Brakuje następujących cech w test_df (Meteostat): {missing_cols_in_test_df}")
             X_predict_source_df = test_df[all_unique_features_needed_by_models].copy()
-            print(f"  Predykcja/Ewaluacja na {len(X_predict_source_df)} próbkach testowych z Meteostat (rok {test_year}).")
-        else:
-            print("  BŁĄD: Brak danych do predykcji (ani z bazy, ani test_df z Meteostat)."); exit()
-
-        final_predictions_series = pd.Series(index=X_predict_source_df.index, dtype=object, name='predicted_category')
-
-        # Etap 1: Predykcja Opady/Brak (M1)
-        print("  Etap 1 (M1): Opady vs Brak...")
-        if feature_lists_final['M1']:
-            pred_m1_binary = model_1.predict(X_predict_source_df[feature_lists_final['M1']])
-            indices_pred_precip = X_predict_source_df.index[pred_m1_binary == 1]
-            indices_pred_no_precip = X_predict_source_df.index[pred_m1_binary == 0]
-            print(f"    Przewidziano Opady: {len(indices_pred_precip)}, Brak Opadów: {len(indices_pred_no_precip)}.")
-        else: # Powinno być obsłużone przez weryfikację cech, ale na wszelki wypadek
-            print("    BŁĄD: Brak cech dla Modelu 1. Wszystkie próbki traktowane jako 'Brak Opadów'.")
-            indices_pred_precip = pd.Index([])
-            indices_pred_no_precip = X_predict_source_df.index
-
-        # Etap 2: Predykcja Brak Opadów (M2 - Mgła vs Reszta)
-        print("  Etap 2 (M2): Mgła vs Inne Bez Opadów...")
-        indices_pred_fog = pd.Index([])
-        indices_pred_other_no_precip = pd.Index([]) # Te pójdą do M4
-        if not indices_pred_no_precip.empty:
-            if feature_lists_final['M2']:
-                X_m2_subset = X_predict_source_df.loc[indices_pred_no_precip, feature_lists_final['M2']]
-                pred_m2_binary = model_2.predict(X_m2_subset)
-                indices_pred_fog = X_m2_subset.index[pred_m2_binary == 1]
-                indices_pred_other_no_precip = X_m2_subset.index[pred_m2_binary == 0]
-                final_predictions_series.loc[indices_pred_fog] = 'Fog'
-                print(f"    Przewidziano Mgła: {len(indices_pred_fog)}.")
-                print(f"    Pozostałe próbki bez opadów (nie-mgła) do M4: {len(indices_pred_other_no_precip)}.")
-            else:
-                print("    BŁĄD: Brak cech dla Modelu 2. Wszystkie próbki 'Brak Opadów' idą do M4.")
-                indices_pred_other_no_precip = indices_pred_no_precip # Wszystko co było "no_precip" idzie do M4
+            log.debug("Predykcja/Ewaluacja na %s próbkach testowych z Meteostat (rok %s).", len(X_predict_source_df), test_year)
         else:
-            print("    Brak próbek 'Brak Opadów' z Etapu 1 dla M2.")
-
-
-        # Etap 3: Predykcja Opady (M3 - Typy Opadów)
-        print("  Etap 3 (M3): Typy Opadów...")
-        if not indices_pred_precip.empty:
-            if feature_lists_final['M3'] and le_precip_trained_for_m3:
-                X_m3_subset = X_predict_source_df.loc[indices_pred_precip, feature_lists_final['M3']]
-                pred_m3_numeric = model_3.predict(X_m3_subset)
-                try:
-                    pred_m3_labels = le_precip_trained_for_m3.inverse_transform(pred_m3_numeric)
-                    final_predictions_series.loc[indices_pred_precip] = pred_m3_labels
-                    print(f"    Przypisano typy dla {len(indices_pred_precip)} próbek opadowych.")
-                    # print(f"      Rozkład przewidzianych typów opadów: {pd.Series(pred_m3_labels).value_counts().to_dict()}")
-                except ValueError as e_le:
-                    print(f"    BŁĄD przy odwracaniu transformacji LabelEncoder dla M3: {e_le}. Próbki opadowe bez klasyfikacji.")
-            else:
-                missing_reason = []
-                if not feature_lists_final['M3']: missing_reason.append("brak cech dla M3")
-                if not le_precip_trained_for_m3: missing_reason.append("brak LabelEncodera dla M3")
-                print(f"    BŁĄD: Nie można sklasyfikować typów opadów ({', '.join(missing_reason)}). Próbki 'Opady' pozostaną bez szczegółowej klasyfikacji.")
-        else:
-            print("    Brak próbek 'Opady' z Etapu 1 dla M3.")
-
-        # Etap 4: Predykcja Inne Bez Opadów (M4 - Clear/Fair vs Cloudy/Overcast)
-        print("  Etap 4 (M4): Clear/Fair vs Cloudy/Overcast...")
-        if not indices_pred_other_no_precip.empty:
-            if feature_lists_final['M4']:
-                X_m4_subset = X_predict_source_df.loc[indices_pred_other_no_precip, feature_lists_final['M4']]
-                pred_m4_binary = model_4.predict(X_m4_subset)
-                # Model M4: 0 to 'Clear/Fair', 1 to 'Cloudy/Overcast'
-                final_predictions_series.loc[X_m4_subset.index[pred_m4_binary == 0]] = 'Clear/Fair'
-                final_predictions_series.loc[X_m4_subset.index[pred_m4_binary == 1]] = 'Cloudy/Overcast'
-                print(f"    Przypisano 'Clear/Fair' lub 'Cloudy/Overcast' dla {len(indices_pred_other_no_precip)} próbek.")
+            raise FeatureEngineeringError("Brak danych do predykcji (ani z bazy, ani test_df z Meteostat).")
+
+        details = None
+        with timer.stage('inference'):
+            if 'scorer' in loaded_models and all(models_dict[name] is loaded_models[name] for name in models_dict):
+                # Modele z rejestru (predykcja z bazy) - skompilowany scorer
+                if probabilities:
+                    final_predictions_series, details = score_hierarchical_proba(X_predict_source_df, loaded_models)
+                else:
+                    final_predictions_series = score_hierarchical(X_predict_source_df, loaded_models)
             else:
-                print("    BŁĄD: Brak cech dla Modelu 4. Próbki 'Inne Bez Opadów' pozostaną bez klasyfikacji Clear/Cloudy.")
-        else:
-            print("    Brak próbek 'Inne Bez Opadów' z Etapu 2 dla M4.")
-
-        # Podsumowanie predykcji
-        missing_final_preds = final_predictions_series.isnull().sum()
-        if missing_final_preds > 0:
-            print(f"\n  OSTRZEŻENIE: {missing_final_preds} próbek nie otrzymało finalnej predykcji!")
-            # Można wypełnić domyślną wartością lub zostawić NaN
-            # final_predictions_series.fillna("Unknown_Pred_Error", inplace=True)
+                final_predictions_series = predict_hierarchical(X_predict_source_df, models_dict, feature_lists_final, le_precip_trained_for_m3)
 
         # --- Etap 7: Wyniki i Ewaluacja (jeśli dotyczy) ---
-        print("\n--- Etap 7: Wyniki Predykcji / Ewaluacja ---")
+        log.info("--- Etap 7: Wyniki Predykcji / Ewaluacja ---")
 
         # Zapis predykcji do pliku CSV
         if not final_predictions_series.empty:
-            print("\n  Przygotowywanie wyników do zwrócenia...")
+            log.debug("Przygotowywanie wyników do zwrócenia...")
 
             # --- POPRAWIONA LOGIKA ---
             # Tworzymy DataFrame bezpośrednio z serii, używając jej indeksu jako kolumny.
@@ -1082,27 +1609,27 @@ def run_prediction(start_date_str, end_date_str):
             results_df['timestamp'] = results_df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
 
             # Przekształcamy DataFrame w listę słowników.
-            output_data = results_df.to_dict('records')
+            output_data = _with_details(results_df.to_dict('records'), details)
             return output_data
             # --- KONIEC POPRAWIONEJ LOGIKI ---
 
         else:
-            print("  Brak wygenerowanych predykcji do zwrócenia.")
+            log.debug("Brak wygenerowanych predykcji do zwrócenia.")
             return [] # Zwróć pustą listę
 
 
         # Ewaluacja - tylko jeśli nie używamy danych z bazy (czyli tryb Meteostat z test_df)
         # i jeśli y_test_actual_str_meteostat jest dostępne
         if not USE_DATABASE_INPUT and 'y_test_actual_str_meteostat' in locals() and not y_test_actual_str_meteostat.empty:
-            print(f"\n  Rozpoczynam ewaluację dla danych testowych Meteostat (rok {test_year})...")
+            log.info("Rozpoczynam ewaluację dla danych testowych Meteostat (rok %s)...", test_year)
             
             # Funkcja ewaluacji (skopiowana z Twojego skryptu)
             def evaluate_model_performance(model_obj, X_test_data, y_test_actuals, model_eval_name, label_enc=None):
                 # ... (pełna definicja funkcji evaluate_model z Twojego skryptu)
-                print(f"\n--- Ewaluacja: {model_eval_name} ---")
-                if model_obj is None: print("   Model nie jest dostępny."); return
-                if X_test_data.empty: print("   Brak danych X_test."); return
-                if y_test_actuals.empty: print("   Brak danych y_test."); return
+                log.info("--- Ewaluacja: %s ---", model_eval_name)
+                if model_obj is None: log.info("Model nie jest dostępny."); return
+                if X_test_data.empty: log.info("Brak danych X_test."); return
+                if y_test_actuals.empty: log.info("Brak danych y_test."); return
                 try:
                     y_pred_proba_eval = model_obj.predict_proba(X_test_data)
                     present_labels_true_eval = sorted(y_test_actuals.unique())
@@ -1115,17 +1642,17 @@ def run_prediction(start_date_str, end_date_str):
                         elif "Model 4" in model_eval_name: map_0, map_1 = 'Clear/Fair', 'Cloudy/Overcast'
                         else:
                             if len(present_labels_true_eval) == 2: map_0, map_1 = present_labels_true_eval[0], present_labels_true_eval[1]
-                            else: print("   BŁĄD: Nie można ustalić mapowania binarnego."); return
+                            else: log.error("BŁĄD: Nie można ustalić mapowania binarnego."); return
                         y_pred_str_eval = np.where(y_pred_numeric_eval == 1, map_1, map_0)
                         labels_for_cm_eval = [map_0, map_1]
                     elif model_obj.objective == 'multi:softmax':
                         if label_enc is not None:
                             y_pred_numeric_eval = np.argmax(y_pred_proba_eval, axis=1)
                             try: y_pred_str_eval = label_enc.inverse_transform(y_pred_numeric_eval); labels_for_cm_eval = sorted(list(label_enc.classes_))
-                            except ValueError as e_le_inv: print(f"   BŁĄD dekodowania M3: {e_le_inv}"); return
-                        else: print("   BŁĄD: Brak label_encodera dla M3."); return
-                    else: print(f"   BŁĄD: Nieobsługiwany cel: {model_obj.objective}"); return
-                    if y_pred_str_eval is None: print("   BŁĄD: Nie wygenerowano predykcji stringów."); return
+                            except ValueError as e_le_inv: log.error("BŁĄD dekodowania M3: %s", e_le_inv); return
+                        else: log.error("BŁĄD: Brak label_encodera dla M3."); return
+                    else: log.error("BŁĄD: Nieobsługiwany cel: %s", model_obj.objective); return
+                    if y_pred_str_eval is None: log.error("BŁĄD: Nie wygenerowano predykcji stringów."); return
                     
                     all_present_labels_eval = sorted(list(set(y_test_actuals.unique()) | set(np.unique(y_pred_str_eval))))
                     final_labels_order_eval = [lbl for lbl in labels_for_cm_eval if lbl in all_present_labels_eval] if labels_for_cm_eval else all_present_labels_eval
@@ -1133,28 +1660,27 @@ def run_prediction(start_date_str, end_date_str):
                     final_labels_order_eval.extend(missing_in_order_eval)
 
                     accuracy_val = accuracy_score(y_test_actuals, y_pred_str_eval)
-                    print(f"   Dokładność: {accuracy_val:.4f}")
-                    print("   Raport Klasyfikacji:"); print(classification_report(y_test_actuals, y_pred_str_eval, labels=final_labels_order_eval, zero_division=0, digits=3))
+                    log.info("Dokładność: %.4f", accuracy_val)
+                    log.info("Raport Klasyfikacji:\n%s", classification_report(y_test_actuals, y_pred_str_eval, labels=final_labels_order_eval, zero_division=0, digits=3))
                     cm_eval = confusion_matrix(y_test_actuals, y_pred_str_eval, labels=final_labels_order_eval)
                     cm_df_eval = pd.DataFrame(cm_eval, index=final_labels_order_eval, columns=final_labels_order_eval)
-                    print("   Macierz Pomyłek:"); print(cm_df_eval)
+                    log.info("Macierz Pomyłek:\n%s", cm_df_eval)
                     if VIZ_AVAILABLE:
                         try:
                             plt.figure(figsize=(max(6, len(final_labels_order_eval)*1.5), max(5, len(final_labels_order_eval)*1.2)))
                             sns.heatmap(cm_df_eval, annot=True, fmt='d', cmap='Blues'); plt.title(f'Macierz Pomyłek - {model_eval_name}\n(Acc: {accuracy_val:.3f})'); plt.xlabel('Przewidywana'); plt.ylabel('Rzeczywista'); plt.xticks(rotation=45, ha='right'); plt.yticks(rotation=0); plt.tight_layout()
                             plt.savefig(os.path.join(MODEL_SAVE_DIR, f"cm_{model_eval_name.replace(':', '').replace('/', '').replace(' ', '_')}_eval.png"), dpi=150, bbox_inches='tight'); plt.close()
-                        except Exception as plot_e: print(f"   OSTRZ.: Błąd wizualizacji CM: {plot_e}")
-                    print("\n   Top 10 Cech:")
+                        except Exception as plot_e: log.warning("OSTRZ.: Błąd wizualizacji CM: %s", plot_e)
                     try:
                         importances = model_obj.feature_importances_; feature_names_imp = X_test_data.columns
                         fi_df = pd.DataFrame({'feature': feature_names_imp, 'importance': importances}).sort_values(by='importance', ascending=False)
-                        print(fi_df.head(10).to_string(index=False))
+                        log.info("Top 10 Cech:\n%s", fi_df.head(10).to_string(index=False))
                         if VIZ_AVAILABLE:
                             plt.figure(figsize=(10, 6)); sns.barplot(x='importance', y='feature', data=fi_df.head(10), palette='viridis'); plt.title(f'Top 10 Cech - {model_eval_name}'); plt.xlabel('Ważność'); plt.ylabel('Cecha'); plt.tight_layout()
                             plt.savefig(os.path.join(MODEL_SAVE_DIR, f"fi_{model_eval_name.replace(':', '').replace('/', '').replace(' ', '_')}_eval.png"), dpi=150, bbox_inches='tight'); plt.close()
-                    except Exception as fi_e: print(f"   BŁĄD przetwarzania ważności cech: {fi_e}")
-                except Exception as e_eval_main: print(f"   KRYTYCZNY BŁĄD ewaluacji {model_eval_name}: {e_eval_main}"); traceback.print_exc()
-                print(f"--- Koniec Ewaluacji: {model_eval_name} ---")
+                    except Exception as fi_e: log.error("BŁĄD przetwarzania ważności cech: %s", fi_e)
+                except Exception as e_eval_main: log.exception("KRYTYCZNY BŁĄD ewaluacji %s: %s", model_eval_name, e_eval_main)
+                log.info("--- Koniec Ewaluacji: %s ---", model_eval_name)
 
             # Ewaluacja ogólna dla danych Meteostat
             common_indices_eval = y_test_actual_str_meteostat.index.intersection(final_predictions_series.index)
@@ -1163,17 +1689,17 @@ def run_prediction(start_date_str, end_date_str):
                 y_pred_eval = final_predictions_series.loc[common_indices_eval]
                 
                 if not y_pred_eval.empty:
-                    print(f"\n--- === Ewaluacja Końcowa Modelu Hierarchicznego (Meteostat, rok {test_year}, {len(y_test_eval)} próbek) === ---")
+                    log.info("--- === Ewaluacja Końcowa Modelu Hierarchicznego (Meteostat, rok %s, %s próbek) === ---", test_year, len(y_test_eval))
                     overall_accuracy_eval = accuracy_score(y_test_eval, y_pred_eval)
-                    print(f"   Dokładność Ogólna: {overall_accuracy_eval:.4f}")
+                    log.info("Dokładność Ogólna: %.4f", overall_accuracy_eval)
                     present_labels_overall_eval = sorted(list(set(y_test_eval.unique()) | set(y_pred_eval.unique())))
                     labels_for_cm_overall_eval = sorted(list(set(all_categories_user) | set(present_labels_overall_eval)))
-                    print(classification_report(y_test_eval, y_pred_eval, labels=present_labels_overall_eval, zero_division=0, digits=3))
+                    log.info("Raport Klasyfikacji Ogólny:\n%s", classification_report(y_test_eval, y_pred_eval, labels=present_labels_overall_eval, zero_division=0, digits=3))
                     cm_overall_eval = confusion_matrix(y_test_eval, y_pred_eval, labels=labels_for_cm_overall_eval)
                     cm_overall_df_eval = pd.DataFrame(cm_overall_eval, index=labels_for_cm_overall_eval, columns=labels_for_cm_overall_eval)
                     cm_overall_df_filtered_eval = cm_overall_df_eval.loc[present_labels_overall_eval, present_labels_overall_eval]
                     cm_overall_df_filtered_eval = cm_overall_df_filtered_eval.loc[(cm_overall_df_filtered_eval.sum(axis=1) != 0), (cm_overall_df_filtered_eval.sum(axis=0) != 0)]
-                    print("\n   Macierz Pomyłek Ogólna (Meteostat):"); print(cm_overall_df_filtered_eval)
+                    log.info("Macierz Pomyłek Ogólna (Meteostat):\n%s", cm_overall_df_filtered_eval)
                     if VIZ_AVAILABLE and not cm_overall_df_filtered_eval.empty:
                         plt.figure(figsize=(max(8, len(cm_overall_df_filtered_eval.columns)*1.2), max(6, len(cm_overall_df_filtered_eval.index)*1)))
                         sns.heatmap(cm_overall_df_filtered_eval, annot=True, fmt='d', cmap='YlGnBu')
@@ -1181,12 +1707,12 @@ def run_prediction(start_date_str, end_date_str):
                         plt.xlabel('Przewidywana Kategoria'); plt.ylabel('Rzeczywista Kategoria'); plt.xticks(rotation=45, ha='right'); plt.yticks(rotation=0); plt.tight_layout()
                         plt.savefig(os.path.join(MODEL_SAVE_DIR, f"cm_OGOLNA_Meteostat_rok{test_year}.png"), dpi=150, bbox_inches='tight'); plt.close()
                 else:
-                    print("  Brak predykcji do ewaluacji dla danych Meteostat.")
+                    log.info("Brak predykcji do ewaluacji dla danych Meteostat.")
             else:
-                print("  Brak wspólnych indeksów do ewaluacji dla danych Meteostat.")
+                log.info("Brak wspólnych indeksów do ewaluacji dla danych Meteostat.")
 
             # Ewaluacja indywidualnych modeli dla danych Meteostat
-            print("\n--- === Ewaluacja Modeli Składowych (Meteostat) === ---")
+            log.info("--- === Ewaluacja Modeli Składowych (Meteostat) === ---")
             if model_1 and feature_lists_final['M1']:
                 y_test_m1_actual = y_test_actual_str_meteostat.apply(lambda x: 'Opady' if x in precip_categories_user else 'Brak Opadów')
                 X_test_m1_data = test_df[feature_lists_final['M1']].copy()
@@ -1218,13 +1744,223 @@ def run_prediction(start_date_str, end_date_str):
                     if not common_m4_idx.empty: evaluate_model_performance(model_4, X_test_m4_data.loc[common_m4_idx], y_test_m4_actual.loc[common_m4_idx], "M4 (Meteostat)")
         else:
             if USE_DATABASE_INPUT:
-                print("  Ewaluacja nie jest przeprowadzana w trybie predykcji z bazy (brak rzeczywistych etykiet dla tego okresu).")
+                log.debug("Ewaluacja nie jest przeprowadzana w trybie predykcji z bazy (brak rzeczywistych etykiet dla tego okresu).")
+
+        log.info("--- Skrypt zakończył działanie o %s ---", datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    except PipelineError as e:
+        log.warning("Predykcja przerwana (etap %s): %s", e.stage, e.detail)
+        return e.result(timer)
+    except Exception as e:
+        log.exception("KRYTYCZNY BŁĄD w run_prediction: %s", e)
+        return {'error': 'Wystąpił wewnętrzny błąd podczas analizy AI.'}
+
+def _merge_prediction_windows(hours, buffer_hours=48):
+    """
+    Scala okna danych [godzina - 48h, godzina:59:59] kolejnych godzin jednej stacji
+    w rozłączne, ciągłe przedziały. Zwraca listę [początek, koniec, lista godzin docelowych].
+    Scalony przedział służy tylko pobraniu i agregacji danych - cechy liczone są na oknie każdej godziny.
+    """
+    windows = []
+    for hour in sorted(hours):
+        window_start = hour - timedelta(hours=buffer_hours)
+        window_end = hour.replace(minute=59, second=59)
+        if windows and window_start <= windows[-1][1] + timedelta(seconds=1):
+            windows[-1][1] = window_end
+            windows[-1][2].append(hour)
+        else:
+            windows.append([window_start, window_end, [hour]])
+    return windows
 
-        print(f"\n--- Skrypt zakończył działanie o {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
+
+def fetch_raw_measurements_windows(windows, chunk_size=200):
+    """
+    Pobiera surowe pomiary dla listy okien (mac_address, początek, koniec) jednym zapytaniem
+    na paczkę okien (OR zakresów zamiast osobnego zapytania na każdą predykcję).
+    """
+    with db.reader() as conn:
+        frames = []
+        for i in range(0, len(windows), chunk_size):
+            chunk = windows[i:i + chunk_size]
+            conditions = " OR ".join(["(mac_address = ? AND server_timestamp BETWEEN ? AND ?)"] * len(chunk))
+            params = []
+            for mac_address, start_dt, end_dt in chunk:
+                params.extend([mac_address, start_dt.strftime('%Y-%m-%d %H:%M:%S'), end_dt.strftime('%Y-%m-%d %H:%M:%S')])
+            query = f"""
+                SELECT mac_address, server_timestamp, temperature, pressure, humidity, sunshine, wind_speed, precipitation
+                FROM measurements
+                WHERE {conditions}
+                ORDER BY mac_address, server_timestamp ASC
+            """
+            with measure('data_fetch.sql_windows') as stage:
+                frames.append(pd.read_sql_query(query, conn, params=params))
+                stage['rows'] = len(frames[-1])
+        return pd.concat(frames, ignore_index=True)
+
+
+def run_prediction_batch(targets, probabilities=False):
+    """
+    Predykcja dla wielu par (stacja, godzina) w jednym przebiegu.
+    Każda godzina przechodzi to samo sprawdzenie historii co run_prediction (maski daily_coverage
+    czytane raz na stację), godziny z wierszem cech w hourly_features idą prosto do modeli, dla
+    pozostałych surowe pomiary pobierane są raz dla sumy okien 48h i agregowane do godzin raz na scalony przedział,
+    a cechy każdej godziny liczone są na jej własnym oknie [godzina - 48h, godzina] (hourly_window_frame:
+    śnieg od początku okna, uzupełnianie braków w obrębie okna), więc wynik jest taki sam jak z run_prediction.
+    Każdy z modeli M1-M4 uruchamiany jest raz na wszystkich trafiających do niego wierszach.
+    Argumenty:
+        targets (iterable): Pary (mac_address, 'YYYY-MM-DD HH:MM:SS'); minuty i sekundy są pomijane.
+        probabilities (bool): Prawdopodobieństwa jak w run_prediction.
+    Zwraca:
+        dict: {'predictions': [...], 'missing': [...]} lub słownik z błędem (jak w run_prediction).
+        Godzina bez pomiaru, z za krótką historią albo bez wiersza cech trafia do 'missing'.
+    """
+    try:
+        hours_by_station = {}
+        for mac_address, timestamp_str in targets:
+            hour = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S').replace(minute=0, second=0)
+            hours_by_station.setdefault(mac_address, set()).add(hour)
+    except (ValueError, TypeError) as e:
+        log.error("Błąd parsowania celów predykcji: %s", e)
+        return {'error': f'Invalid target: {e}'}
+
+    timer = StageTimer()
+    try:
+        batch_start_time = time.time()
+        n_targets = sum(len(hours) for hours in hours_by_station.values())
+
+        # Ta sama reguła historii co w run_prediction - przed pobraniem danych,
+        # z masek daily_coverage wczytanych jednym zapytaniem na stację
+        missing = []
+        checked_hours = {}
+        with timer.stage('data_check'):
+            for mac_address, hours in sorted(hours_by_station.items()):
+                hours = sorted(hours)
+                try:
+                    with db.reader() as conn:
+                        masks = data_coverage.hour_masks(
+                            conn, mac_address,
+                            (hours[0] - timedelta(hours=data_coverage.HISTORY_HOURS)).strftime('%Y-%m-%d'),
+                            hours[-1].strftime('%Y-%m-%d'))
+                except sqlite3.OperationalError:
+                    masks = None # Baza bez tabeli daily_coverage (przed migracją) - decyduje pełny przebieg
+                for hour in hours:
+                    try:
+                        if masks is not None:
+                            _check_availability(hour, *data_coverage.mask_availability(masks, hour))
+                    except InsufficientDataError as e:
+                        log.debug("Godzina %s %s pominięta: %s", mac_address, hour, e.detail)
+                        missing.append((mac_address, hour))
+                        continue
+                    checked_hours.setdefault(mac_address, []).append(hour)
+
+        # Godziny policzone już przez feature store (jak w run_prediction) - bez pobierania pomiarów i inżynierii cech
+        station_frames = []
+        threshold_flags_names = []
+        with timer.stage('data_fetch'):
+            for mac_address, hours in list(checked_hours.items()):
+                stored = fetch_stored_features_bulk(mac_address, hours)
+                if stored.empty:
+                    continue
+                stored['mac_address'] = mac_address
+                station_frames.append(stored)
+                stored_hours = set(stored.index)
+                checked_hours[mac_address] = [hour for hour in hours if hour not in stored_hours]
+        n_stored = sum(len(frame) for frame in station_frames)
+
+        windows = [(mac_address, window_start, window_end, window_hours)
+                   for mac_address, hours in sorted(checked_hours.items()) if hours
+                   for window_start, window_end, window_hours in _merge_prediction_windows(hours)]
+        log.info("--- Predykcja wsadowa: %s godzin, %s stacji, %s z feature store, %s okien danych ---",
+                 n_targets, len(hours_by_station), n_stored, len(windows))
+
+        if windows:
+            with timer.stage('data_fetch'):
+                df_raw_all = fetch_raw_measurements_windows([(mac, start, end) for mac, start, end, _ in windows])
+            df_raw_all['server_timestamp'] = pd.to_datetime(df_raw_all['server_timestamp'])
+            raw_by_station = {mac: group for mac, group in df_raw_all.groupby('mac_address')}
+            log.debug("Wczytano %s surowych rekordów z bazy.", len(df_raw_all))
+            empty_raw = df_raw_all.iloc[0:0]
+
+        for mac_address, window_start, window_end, window_hours in windows:
+            station_raw = raw_by_station.get(mac_address, empty_raw)
+            in_window = (station_raw['server_timestamp'] >= window_start) & (station_raw['server_timestamp'] <= window_end)
+            window_raw = station_raw.loc[in_window].drop(columns='mac_address').set_index('server_timestamp')
+            with timer.stage('data_fetch'):
+                window_compacted = fetch_compacted_hourly(window_start, window_end, mac_address)
+            # Tak jak w run_prediction: godzina bez żadnego pomiaru nie jest przewidywana
+            hours_with_data = set(window_raw.index.floor('H')) | set(window_compacted.index)
+            predictable_hours = [hour for hour in window_hours if hour in hours_with_data]
+            missing.extend((mac_address, hour) for hour in window_hours if hour not in hours_with_data)
+            if not predictable_hours:
+                continue
+
+            try:
+                # Agregaty godzinowe są lokalne dla godziny, więc liczymy je raz dla całego scalonego przedziału
+                with timer.stage('aggregation'):
+                    df_hourly = resample_raw_to_hourly(window_raw) if not window_raw.empty else None
+                    if not window_compacted.empty:
+                        df_hourly = merge_compacted_hourly(df_hourly, window_compacted)
+                    df_hourly = df_hourly[df_hourly.index.isin(hours_with_data)]
+            except ValueError as e:
+                log.debug("Okno %s %s - %s pominięte (agregacja): %s", mac_address, window_start, window_end, e)
+                missing.extend((mac_address, hour) for hour in predictable_hours)
+                continue
+
+            for hour in predictable_hours:
+                try:
+                    with timer.stage('aggregation'):
+                        df_window = hourly_window_frame(df_hourly, hour)
+                    with timer.stage('feature_engineering'):
+                        df_features, window_flags = engineer_features(df_window, required_features=MODEL_FEATURES)
+                except (InsufficientDataError, AggregationError, FeatureEngineeringError) as e:
+                    # Błąd jednej godziny nie przerywa całej partii
+                    log.debug("Godzina %s %s pominięta (etap %s): %s", mac_address, hour, e.stage, e.detail)
+                    missing.append((mac_address, hour))
+                    continue
+                if hour not in df_features.index:
+                    missing.append((mac_address, hour))
+                    continue
+                threshold_flags_names = window_flags
+                df_target = df_features.loc[[hour]].copy()
+                df_target['mac_address'] = mac_address
+                station_frames.append(df_target)
+
+        predictions = []
+        if station_frames:
+            df_all = pd.concat(station_frames)
+            df_all = df_all.iloc[np.lexsort((df_all.index.values, df_all['mac_address'].values))]
+            threshold_flags_names = threshold_flags_names or [f for f in df_all.columns if f.startswith('flag_')]
+            _, all_unique_features_needed_by_models = resolve_feature_lists(df_all, threshold_flags_names)
+            # Indeks czasowy powtarza się między stacjami, więc do predykcji używamy indeksu pozycyjnego
+            X_predict_source_df = df_all[all_unique_features_needed_by_models].reset_index(drop=True)
+
+            with timer.stage('model_load'):
+                models = registry_models()
+            details = None
+            with timer.stage('inference'):
+                if probabilities:
+                    final_predictions_series, details = score_hierarchical_proba(X_predict_source_df, models)
+                else:
+                    final_predictions_series = score_hierarchical(X_predict_source_df, models)
+
+            for mac_address, timestamp, category in zip(df_all['mac_address'], df_all.index, final_predictions_series.values):
+                predictions.append({
+                    'mac_address': mac_address,
+                    'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                    'predicted_category': category,
+                })
+            _with_details(predictions, details)
+
+        log.info("--- Predykcja wsadowa zakończona: %s predykcji, %s godzin bez danych (%.1f sek) ---", len(predictions), len(missing), time.time() - batch_start_time)
+        return {
+            'predictions': predictions,
+            'missing': [{'mac_address': mac_address, 'timestamp': hour.strftime('%Y-%m-%d %H:%M:%S')}
+                        for mac_address, hour in sorted(missing)],
+        }
+    except PipelineError as e:
+        log.warning("Predykcja wsadowa przerwana (etap %s): %s", e.stage, e.detail)
+        return e.result(timer)
     except Exception as e:
-        import traceback
-        print(f"KRYTYCZNY BŁĄD w run_prediction: {e}")
-        traceback.print_exc()
+        log.exception("KRYTYCZNY BŁĄD w run_prediction_batch: %s", e)
         return {'error': 'Wystąpił wewnętrzny błąd podczas analizy AI.'}
 
 # Definicje kategorii pogodowych (potrzebne wcześniej dla bloku inżynierii cech)
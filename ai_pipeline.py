@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Typed failures and stage timing of the AI prediction pipeline (ai_main).
+
+Every stage of run_prediction / run_prediction_batch raises a PipelineError subclass
+instead of calling exit(): the error names the stage it came from, carries a user-facing
+(Polish) message and is turned into a structured task result ({'error', 'stage', 'stages_ms'})
+that ai_tasks stores as a FAILURE. StageTimer measures the stages of one run and converts any
+other exception raised inside a stage into that stage's error, so an unexpected failure still
+reports where it happened and how long each stage took. The technical detail (exception text)
+stays in the server log; only InsufficientDataError, whose detail is written for the user
+(missing hours), returns it in 'detail'.
+
+Stages and their sub-stages (measure, Laps: SQL fetch, resample, feature families, the
+inference of every model, ...) also leave a record (stage, seconds, rows, peak RSS) for the
+metrics of metrics.py. In the server process the records go straight to the sink set by
+set_sink; an AI worker process keeps them until ai_tasks drains them with the task result.
+
+The peak RSS is that of the stage itself, not of the process lifetime. In the AI worker
+processes (enable_hwm_reset, called by ai_tasks) the kernel's resident high-water mark (VmHWM
+in /proc/self/status) is reset when a stage starts (writing 5 to /proc/self/clear_refs) and
+read when it ends; before a reset the current mark is handed to the stages still open, so an
+outer stage keeps the peaks of its sub-stages. The reset clears the mark of the whole process,
+so the web server never does it: there the record carries the larger of the RSS (VmRSS)
+sampled at the start and at the end of the stage. Without /proc records carry no peak.
+"""
+import collections
+import logging
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+GENERIC_MESSAGE = 'Wystąpił wewnętrzny błąd podczas analizy AI.'
+
+MAX_PENDING_RECORDS = 10000
+
+_records = collections.deque(maxlen=MAX_PENDING_RECORDS)
+_sink = None
+
+
+def set_sink(sink):
+    """sink(stage, seconds, rows, peak_rss_bytes) receives every record of this process from now on."""
+    global _sink
+    _sink = sink
+
+
+PROC_STATUS = '/proc/self/status'
+PROC_CLEAR_REFS = '/proc/self/clear_refs'
+
+_peak_lock = threading.Lock()
+_open_peaks = weakref.WeakSet()   # otwarte etapy (PeakRss), porzucone znikają same
+_peak_supported = None
+_hwm_reset = False                # tylko procesy robocze AI (enable_hwm_reset)
+
+
+def _read_status(field):
+    with open(PROC_STATUS) as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024  # kB
+    raise OSError(f'{field} missing')
+
+
+def _read_hwm():
+    return _read_status('VmHWM:')
+
+
+def _reset_hwm():
+    with open(PROC_CLEAR_REFS, 'w') as f:
+        f.write('5')
+
+
+def enable_hwm_reset():
+    """Per-stage VmHWM resets in this process; only for processes running nothing but the AI pipeline."""
+    global _hwm_reset, _peak_supported
+    _hwm_reset, _peak_supported = True, None
+
+
+def _peaks_available():
+    global _peak_supported, _hwm_reset
+    if _peak_supported is None:
+        try:
+            _read_status('VmRSS:')
+            _read_hwm()
+        except OSError:  # nie-Linux
+            _peak_supported = False
+            return False
+        if _hwm_reset:
+            try:
+                _reset_hwm()
+            except OSError:  # kontener bez prawa zapisu do clear_refs - próbkowanie RSS
+                _hwm_reset = False
+        _peak_supported = True
+    return _peak_supported
+
+
+class PeakRss:
+    """Peak resident memory of the process between start() and stop() (None where unsupported)."""
+
+    def __init__(self, sampled=False):
+        self.value = 0
+        self.sampled = sampled
+
+    @classmethod
+    def start(cls):
+        if not _peaks_available():
+            return None
+        if not _hwm_reset:
+            peak = cls(sampled=True)
+            peak.value = _read_status('VmRSS:')
+            return peak
+        peak = cls()
+        with _peak_lock:
+            hwm = _read_hwm()
+            for other in _open_peaks:
+                other.value = max(other.value, hwm)
+            _reset_hwm()
+            _open_peaks.add(peak)
+        return peak
+
+    def stop(self):
+        if self.sampled:
+            return max(self.value, _read_status('VmRSS:'))
+        with _peak_lock:
+            _open_peaks.discard(self)
+            return max(self.value, _read_hwm())
+
+
+def _stop_peak(peak):
+    return peak.stop() if peak is not None else None
+
+
+def record(stage, seconds, rows=None, peak_rss_bytes=None):
+    entry = (stage, seconds, rows, peak_rss_bytes)
+    if _sink is not None:
+        _sink(*entry)
+    else:
+        _records.append(entry)
+
+
+def drain_records():
+    """Records kept since the last call (worker process), oldest first."""
+    records = []
+    while _records:
+        records.append(_records.popleft())
+    return records
+
+
+@contextmanager
+def measure(stage, rows=None):
+    """Records the block as `stage`; the yielded dict's 'rows' may be set inside the block."""
+    info = {'rows': rows}
+    peak = PeakRss.start()
+    start = time.perf_counter()
+    try:
+        yield info
+    finally:
+        record(stage, time.perf_counter() - start, info['rows'], _stop_peak(peak))
+
+
+class Laps:
+    """Consecutive sub-stages of one function: lap(name) records the time since the previous lap."""
+
+    def __init__(self, prefix, rows=None):
+        self.prefix = prefix
+        self.rows = rows
+        self._peak = PeakRss.start()
+        self._last = time.perf_counter()
+
+    def lap(self, name, rows=None):
+        now = time.perf_counter()
+        record(f'{self.prefix}.{name}', now - self._last, self.rows if rows is None else rows, _stop_peak(self._peak))
+        self._peak = PeakRss.start()
+        self._last = time.perf_counter()
+
+
+class PipelineError(Exception):
+    stage = 'pipeline'
+    message = GENERIC_MESSAGE
+    public_detail = False   # detail trafia do wyniku zadania (przeglądarki) tylko, gdy jest pisany dla użytkownika
+
+    def __init__(self, detail, message=None):
+        super().__init__(detail)
+        self.detail = detail
+        if message is not None:
+            self.message = message
+
+    def result(self, timer=None):
+        """Structured failure returned by the pipeline (stored as the task result)."""
+        result = {
+            'error': self.message,
+            'stage': self.stage,
+            'stages_ms': timer.as_ms() if timer is not None else {},
+        }
+        if self.public_detail:
+            result['detail'] = self.detail
+        return result
+
+
+class InsufficientDataError(PipelineError):
+    """Not enough readings for the requested hour; detected before fetching and feature engineering."""
+    stage = 'data_check'
+    message = 'Niewystarczająca ilość danych do predykcji.'
+    public_detail = True
+
+
+class DataFetchError(PipelineError):
+    stage = 'data_fetch'
+
+
+class AggregationError(PipelineError):
+    stage = 'aggregation'
+
+
+class FeatureEngineeringError(PipelineError):
+    stage = 'feature_engineering'
+
+
+class ModelLoadError(PipelineError):
+    stage = 'model_load'
+    message = 'Modele AI są niedostępne.'
+
+
+class InferenceError(PipelineError):
+    stage = 'inference'
+
+
+STAGE_ERRORS = {cls.stage: cls for cls in (InsufficientDataError, DataFetchError, AggregationError,
+                                           FeatureEngineeringError, ModelLoadError, InferenceError)}
+
+
+class StageTimer:
+    def __init__(self):
+        self.durations = {}   # etap -> sekundy (sumowane przy kilku wejściach w ten sam etap)
+
+    @contextmanager
+    def stage(self, name):
+        """Times the block as stage `name`; other exceptions become the stage's PipelineError."""
+        peak = PeakRss.start()
+        start = time.perf_counter()
+        try:
+            yield
+        except PipelineError:
+            raise
+        except Exception as e:
+            log.exception("AI pipeline stage %s failed", name)
+            raise STAGE_ERRORS.get(name, PipelineError)(f'{type(e).__name__}: {e}') from e
+        finally:
+            elapsed = time.perf_counter() - start
+            self.durations[name] = self.durations.get(name, 0.0) + elapsed
+            record(name, elapsed, peak_rss_bytes=_stop_peak(peak))
+
+    def as_ms(self):
+        return {name: round(seconds * 1000, 3) for name, seconds in self.durations.items()}
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded queue of AI prediction tasks executed by a fixed pool of worker processes.
+
+`TaskQueue.submit` stores the task in the ai_tasks table and hands it to a
+ProcessPoolExecutor (spawned processes, so XGBoost and pandas work runs in parallel
+outside the GIL of the web server). At most `max_workers` tasks run and at most
+`max_queue` wait; beyond that `submit` returns None and the caller answers 503.
+The worker returns the result with its start/end times, the parent process writes it
+to ai_tasks (single writer, see db.py). A result with an 'error' key is a FAILURE;
+pipeline failures also name their stage (ai_pipeline), counted in the stats. The stage records
+of the task (ai_pipeline.drain_records) come back with the result and go to metrics.py
+together with the wait and run time. Unfinished tasks found at startup are queued
+again; finished tasks are evicted `ttl` seconds after they completed.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import ai_pipeline
+import db
+import logs
+import metrics
+
+log = logging.getLogger(__name__)
+
+MAX_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+MAX_QUEUE = 32
+TASK_TTL = 24 * 3600.0        # s - czas przechowywania zakończonych zadań
+EVICT_INTERVAL = 300.0        # s
+
+SCHEMA_STATEMENTS = [
+    '''CREATE TABLE IF NOT EXISTS ai_tasks (
+        task_id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        params TEXT NOT NULL,
+        status TEXT NOT NULL,
+        result TEXT,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_ai_tasks_status_finished ON ai_tasks (status, finished_at)',
+]
+
+# Rodzaj zadania -> nazwa funkcji w ai_main (wywoływana w procesie roboczym)
+TASK_FUNCTIONS = {
+    'predict': 'run_prediction',
+    'predict_batch': 'run_prediction_batch',
+}
+
+
+def _init_worker(db_path, log_settings=None):
+    """Initializer of a worker process: same database file and logging setup, models loaded once per process."""
+    db.configure(db_path)
+    if log_settings is not None:
+        logs.configure(**log_settings)
+    ai_pipeline.enable_hwm_reset()  # szczyt RSS każdego etapu; w procesie serwera tylko próbki RSS
+    import ai_main
+    try:
+        ai_main.model_registry.get_models()
+    except Exception as e:
+        log.error("Nie udało się wczytać modeli AI w procesie roboczym: %s", e)
+
+
+def _run_task(task_id, kind, params):
+    """Runs one task in a worker process. Returns (status, result, started_at, finished_at, stage records)."""
+    import ai_main
+    ai_pipeline.drain_records()  # np. rekordy z wczytania modeli w _init_worker
+    started_at = time.time()
+    log.debug("Rozpoczynam zadanie AI: %s (proces %s)", task_id, os.getpid())
+    try:
+        result = getattr(ai_main, TASK_FUNCTIONS[kind])(*params)
+        # Słownik z kluczem 'error' to błąd zwrócony przez ai_main
+        status = 'FAILURE' if isinstance(result, dict) and 'error' in result else 'SUCCESS'
+    except BaseException as e:  # ai_main zwraca błędy etapów jako wynik; tu tylko nieoczekiwane
+        log.exception("KRYTYCZNY błąd w procesie AI dla zadania %s: %s", task_id, e)
+        status, result = 'FAILURE', {'error': 'Wystąpił nieoczekiwany błąd serwera.'}
+    log.info("Zakończono zadanie AI: %s ze statusem %s", task_id, status)
+    return status, result, started_at, time.time(), ai_pipeline.drain_records()
+
+
+class TaskQueue:
+    def __init__(self, max_workers=MAX_WORKERS, max_queue=MAX_QUEUE, ttl=TASK_TTL, evict_interval=EVICT_INTERVAL):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.ttl = ttl
+        self.evict_interval = evict_interval
+        self._executor = None
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)  # budzi long-poll statusu (wait)
+        self._active = {}          # task_id -> Future (zadania w kolejce i w trakcie)
+        self._reserved = 0         # miejsca zajęte przez submit w toku (przed dispatch)
+        self._on_done = {}         # task_id -> callback(status, result) (nie przeżywa restartu)
+        self._stop = threading.Event()
+        self._thread = None
+        self._submitted = 0
+        self._rejected_full = 0
+        self._succeeded = 0
+        self._failed = 0
+        self._failed_by_stage = {}  # etap potoku AI (ai_pipeline) -> liczba błędów
+        self._evicted = 0
+        self._requeued = 0
+        self._wait_total = 0.0
+        self._max_wait = 0.0
+        self._run_total = 0.0
+        self._max_run = 0.0
+        self._last_error = None
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(db.database.path, logs.settings()),
+        )
+
+    def start(self):
+        """Creates the worker pool, queues the tasks left unfinished by the last run and starts the eviction thread."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        with self._lock:
+            self._executor = self._new_executor()
+        with db.reader() as conn:
+            unfinished = conn.execute(
+                "SELECT task_id, kind, params FROM ai_tasks WHERE status IN ('PENDING', 'RUNNING') ORDER BY created_at"
+            ).fetchall()
+        for task_id, kind, params in unfinished:
+            self._dispatch(task_id, kind, json.loads(params))
+            self._requeued += 1
+        if unfinished:
+            log.info("AI task queue: %s unfinished tasks queued again", len(unfinished))
+        self._thread = threading.Thread(target=self._run, name='ai-task-evict', daemon=True)
+        self._thread.start()
+        log.info("AI task queue started (%s worker processes, queue limit %s)", self.max_workers, self.max_queue)
+
+    def stop(self, timeout=None):
+        """Stops the eviction thread and the worker pool; queued tasks stay PENDING in ai_tasks."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, kind, *params, on_done=None):
+        """
+        Stores and queues a task. Returns its id, or None when the queue is full
+        (max_workers running + max_queue waiting). on_done(status, result) is called in the
+        parent process when the task finishes (e.g. to fill the prediction cache).
+        """
+        # Miejsce w kolejce rezerwowane pod tą samą blokadą co sprawdzenie limitu, zwalniane po dispatch lub błędzie
+        with self._lock:
+            if len(self._active) + self._reserved >= self.max_workers + self.max_queue:
+                self._rejected_full += 1
+                return None
+            self._reserved += 1
+        task_id = str(uuid.uuid4())
+        try:
+            with db.writer() as conn:
+                conn.execute(
+                    "INSERT INTO ai_tasks (task_id, kind, params, status, created_at) VALUES (?, ?, ?, 'PENDING', ?)",
+                    (task_id, kind, json.dumps(params), time.time())
+                )
+            if on_done is not None:
+                with self._lock:
+                    self._on_done[task_id] = on_done
+            self._dispatch(task_id, kind, params)
+        except BaseException:
+            with self._lock:
+                self._reserved -= 1
+                self._on_done.pop(task_id, None)
+            raise
+        with self._lock:
+            self._reserved -= 1
+            self._submitted += 1
+        return task_id
+
+    def _dispatch(self, task_id, kind, params):
+        with self._lock:
+            try:
+                future = self._executor.submit(_run_task, task_id, kind, params)
+            except BrokenProcessPool:
+                # Proces roboczy zginął (np. brak pamięci) - nowa pula dla kolejnych zadań
+                log.error("AI worker pool broken, starting a new one")
+                self._executor = self._new_executor()
+                future = self._executor.submit(_run_task, task_id, kind, params)
+            self._active[task_id] = future
+        dispatcher = threading.get_ident()
+
+        def done(f):
+            if threading.get_ident() == dispatcher:
+                # Zadanie skończyło się przed powrotem z submit (np. szybka odmowa przy braku danych):
+                # add_done_callback woła wtedy od razu, w wątku zlecającym, który może trzymać swoje blokady
+                threading.Thread(target=self._task_done, args=(task_id, kind, f), daemon=True).start()
+            else:
+                self._task_done(task_id, kind, f)
+        future.add_done_callback(done)
+
+    def _task_done(self, task_id, kind, future):
+        try:
+            status, result, started_at, finished_at, stage_records = future.result()
+        except Exception as e:
+            if future.cancelled():
+                # Anulowane przy zamykaniu serwera zostają PENDING i wrócą do kolejki po restarcie
+                with self._lock:
+                    self._active.pop(task_id, None)
+                    self._on_done.pop(task_id, None)
+                    self._finished.notify_all()
+                return
+            log.error("AI task %s failed in the worker pool: %r", task_id, e)
+            self._last_error = repr(e)
+            status, result, started_at, finished_at = 'FAILURE', {'error': 'Wystąpił nieoczekiwany błąd serwera.'}, None, time.time()
+            stage_records = []
+        try:
+            with db.writer() as conn:
+                created_at = conn.execute('SELECT created_at FROM ai_tasks WHERE task_id = ?', (task_id,)).fetchone()[0]
+                conn.execute(
+                    'UPDATE ai_tasks SET status = ?, result = ?, started_at = ?, finished_at = ? WHERE task_id = ?',
+                    (status, json.dumps(result), started_at, finished_at, task_id)
+                )
+        except Exception as e:
+            log.error("Could not store the result of AI task %s: %s", task_id, e)
+            self._last_error = str(e)
+            created_at = None
+        metrics.registry.observe_stages(stage_records)
+        if started_at is not None:
+            wait = max(0.0, started_at - created_at) if created_at is not None else None
+            metrics.registry.observe_task(kind, status, wait, finished_at - started_at)
+        with self._lock:
+            self._active.pop(task_id, None)
+            on_done = self._on_done.pop(task_id, None)
+            self._finished.notify_all()
+            if status == 'SUCCESS':
+                self._succeeded += 1
+            else:
+                self._failed += 1
+                stage = result.get('stage', 'unknown') if isinstance(result, dict) else 'unknown'
+                self._failed_by_stage[stage] = self._failed_by_stage.get(stage, 0) + 1
+            if started_at is not None and created_at is not None:
+                wait, run = max(0.0, started_at - created_at), finished_at - started_at
+                self._wait_total += wait
+                self._max_wait = max(self._max_wait, wait)
+                self._run_total += run
+                self._max_run = max(self._max_run, run)
+        if on_done is not None:
+            try:
+                on_done(status, result)
+            except Exception as e:
+                log.error("AI task %s: on_done callback failed: %s", task_id, e)
+
+    def is_active(self, task_id):
+        """True while the task is queued or running in this process."""
+        with self._lock:
+            future = self._active.get(task_id)
+        return future is not None and not future.done()
+
+    def wait(self, task_id, timeout):
+        """
+        Blocks until the task finishes (its result is already stored) or `timeout` seconds
+        pass, then returns get(task_id).
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while task_id in self._active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._finished.wait(remaining)
+        return self.get(task_id)
+
+    def get(self, task_id):
+        """{'status': ..., 'result': ...} of a task, None when unknown or already evicted."""
+        with self._lock:
+            future = self._active.get(task_id)
+        if future is not None and not future.done():
+            return {'status': 'RUNNING' if future.running() else 'PENDING', 'result': None}
+        with db.reader() as conn:
+            row = conn.execute('SELECT status, result FROM ai_tasks WHERE task_id = ?', (task_id,)).fetchone()
+        if row is None:
+            return None
+        return {'status': row[0], 'result': json.loads(row[1]) if row[1] is not None else None}
+
+    def evict(self, now=None):
+        """Deletes the tasks finished more than `ttl` seconds ago. Returns the number of deleted tasks."""
+        cutoff = (now or time.time()) - self.ttl
+        with db.writer() as conn:
+            cur = conn.execute("DELETE FROM ai_tasks WHERE status IN ('SUCCESS', 'FAILURE') AND finished_at < ?", (cutoff,))
+        with self._lock:
+            self._evicted += cur.rowcount
+        return cur.rowcount
+
+    def _run(self):
+        while not self._stop.wait(self.evict_interval):
+            try:
+                self.evict()
+            except Exception as e:
+                self._last_error = str(e)
+                log.error("AI task eviction failed: %s", e)
+
+    def stats(self):
+        """Queue depth, wait and run times, exposed by the /api/ai/tasks/stats endpoint."""
+        with self._lock:
+            running = sum(1 for future in self._active.values() if future.running())
+            completed = self._succeeded + self._failed
+            return {
+                'running': self._executor is not None,
+                'workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'queue_depth': len(self._active) - running,
+                'tasks_running': running,
+                'submitted': self._submitted,
+                'rejected_full': self._rejected_full,
+                'requeued_at_start': self._requeued,
+                'succeeded': self._succeeded,
+                'failed': self._failed,
+                'failed_by_stage': dict(self._failed_by_stage),
+                'evicted': self._evicted,
+                'avg_wait_ms': round(self._wait_total / completed * 1000, 1) if completed else None,
+                'max_wait_ms': round(self._max_wait * 1000, 1),
+                'avg_run_ms': round(self._run_total / completed * 1000, 1) if completed else None,
+                'max_run_ms': round(self._max_run * 1000, 1),
+                'ttl_s': self.ttl,
+                'last_error': self._last_error,
+            }
@@ -1,49 +1,164 @@
 from routes import home, login, register, boards, device_data, ai_service
-from flask import Flask, jsonify, request, g
+from flask import Flask, jsonify, request, g, Response
 import config
+import ai_main
 import sqlite3
 import logging
+import db
+import time
+import atexit
+import os
+import gzip
+import json
+from io import BytesIO
+from ingest import IngestQueue, validate_measurement, validate_measurements_bulk, insert_rows, register_write_hook
+import ingest
+from feature_store import FeatureStore
+from retention import RetentionJob
+import retention
+import rollups
+import ai_tasks
+import prediction_cache
+import data_coverage
+import ai_pipeline
+import metrics
+import logs
 
-DB_PATH = 'measurements.db'
+DB_PATH = db.DB_PATH
+
+log = logging.getLogger('app')
+# Per-reading ingest log (a reading every 5 s per station), sampled per station in create_app
+readings_log = logging.getLogger('app.readings')
+
+# Write-behind buffer for readings from the boards (see ingest.py)
+ingest_queue = IngestQueue()
+
+# Hourly aggregates and model features of closed hours (see feature_store.py)
+feature_store = FeatureStore()
+
+# Compaction of old raw readings into the 1-minute and hourly tiers (see retention.py)
+retention_job = RetentionJob(before_compact=feature_store.ensure_aggregates)
+
+# Limits for the bulk upload of buffered readings
+MAX_BULK_READINGS = 20000
+MAX_BULK_BODY_BYTES = 32 * 1024 * 1024  # przesłana treść i treść po dekompresji
+
+# Versioned schema migrations applied in order by init_db.
+# PRAGMA user_version holds the number of the last applied migration.
+SCHEMA_MIGRATIONS = [
+    # 1: per-station time range reads (dashboard, CSV export, available dates, AI data fetch)
+    [
+        'CREATE INDEX IF NOT EXISTS idx_measurements_mac_ts ON measurements (mac_address, server_timestamp)',
+    ],
+    # 2: covering index for time range scans across all stations (hourly availability checks)
+    [
+        'CREATE INDEX IF NOT EXISTS idx_measurements_ts_mac ON measurements (server_timestamp, mac_address)',
+    ],
+    # 3: incremental hourly feature store (feature_store.py), filled by the ingest hook and `python -m feature_store`
+    [
+        '''CREATE TABLE IF NOT EXISTS hourly_aggregates (
+            mac_address TEXT NOT NULL,
+            hour TEXT NOT NULL,
+            temp REAL, pres REAL, rhum REAL, wspd REAL, wpgt REAL, tsun REAL, prcp REAL,
+            readings INTEGER NOT NULL,
+            PRIMARY KEY (mac_address, hour)
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS hourly_features (
+            mac_address TEXT NOT NULL,
+            hour TEXT NOT NULL,
+            features TEXT NOT NULL,
+            computed_at TEXT NOT NULL,
+            PRIMARY KEY (mac_address, hour)
+        ) WITHOUT ROWID''',
+    ],
+    # 4: 30-minute and 1-hour rollups for the dashboard (rollups.py), filled from the existing measurements
+    rollups.schema_statements(),
+    # 5: 1-minute tier and per-station watermarks of the retention job (retention.py)
+    retention.schema_statements(),
+    # 6: persistent state and results of the AI prediction tasks (ai_tasks.py)
+    ai_tasks.SCHEMA_STATEMENTS,
+    # 7: cached single-hour predictions (prediction_cache.py)
+    prediction_cache.SCHEMA_STATEMENTS,
+    # 8: per-station daily coverage (hours, readings, first/last reading) for the AI panel (data_coverage.py)
+    data_coverage.SCHEMA_STATEMENTS,
+    # 9: id ranges of measurements whose write hook failed, replayed by the ingest writer (ingest.py)
+    ingest.SCHEMA_STATEMENTS,
+]
+
+def migrate_db(conn):
+    """
+    Applies pending SCHEMA_MIGRATIONS. Each migration runs in its own transaction together
+    with the user_version bump, so an interrupted index build on a large database is rolled
+    back and simply retried on the next start.
+    Returns the schema version after migrating.
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    pending = [(number, statements) for number, statements in enumerate(SCHEMA_MIGRATIONS, start=1) if number > version]
+    if not pending:
+        return version
+
+    # Larger page cache speeds up sorting while building indexes over existing rows
+    previous_cache_size = conn.execute('PRAGMA cache_size').fetchone()[0]
+    conn.execute('PRAGMA cache_size = -262144')
+    for number, statements in pending:
+        log.info("Applying schema migration %s...", number)
+        start = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        log.info("Schema migration %s applied in %.1fs", number, time.time() - start)
+        version = number
+
+    # Refresh planner statistics for the new indexes
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.execute(f'PRAGMA cache_size = {previous_cache_size}')
+    return version
 
 # initialize the measurements database and tables
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    # users and user_boards tables
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL UNIQUE,
-            password TEXT NOT NULL
-        )
-    ''')
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS user_boards (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        mac_address TEXT NOT NULL,
-        board_name TEXT,
-        FOREIGN KEY (user_id) REFERENCES users (id),
-        UNIQUE (user_id, mac_address)
-    );
-    ''')
-    # measurements table: include client timestamp, sunshine, wind data
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS measurements (
+    with db.writer() as conn:
+        c = conn.cursor()
+        # users and user_boards tables
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL UNIQUE,
+                password TEXT NOT NULL
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS user_boards (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
             mac_address TEXT NOT NULL,
-            server_timestamp TIMESTAMP,
-            temperature REAL,
-            pressure REAL,
-            humidity REAL,
-            sunshine INTEGER,
-            wind_speed REAL,
-            precipitation REAL            
-        )
-    ''')
-    conn.commit()
-    conn.close()
+            board_name TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE (user_id, mac_address)
+        );
+        ''')
+        # measurements table: include client timestamp, sunshine, wind data
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS measurements (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                mac_address TEXT NOT NULL,
+                server_timestamp TIMESTAMP,
+                temperature REAL,
+                pressure REAL,
+                humidity REAL,
+                sunshine INTEGER,
+                wind_speed REAL,
+                precipitation REAL            
+            )
+        ''')
+        conn.commit()
+        migrate_db(conn)
 
 # helper to associate boards with users
 def save_mac_to_db(username, mac_address):
@@ -54,8 +169,8 @@ def save_mac_to_db(username, mac_address):
     Raises ValueError if the user is not found.
     """
     try:
-        # Use 'with' statement for automatic connection closing
-        with sqlite3.connect(DB_PATH) as conn:
+        # Shared writer connection, committed when the block exits
+        with db.writer() as conn:
             cur = conn.cursor()
             
             # Find the user ID
@@ -73,7 +188,7 @@ def save_mac_to_db(username, mac_address):
             )
             if cur.fetchone():
                 # Pair already exists, log and return False
-                logging.warning(f"Device {mac_address} already associated with user {username}")
+                log.warning("Device %s already associated with user %s", mac_address, username)
                 return False # Indicate that it was a duplicate
 
             # If not exists, insert the new record
@@ -87,91 +202,52 @@ def save_mac_to_db(username, mac_address):
     except sqlite3.IntegrityError:
         # This block is a fallback for race conditions, though the SELECT check minimizes its necessity.
         # It catches the UNIQUE constraint violation.
-        logging.error(f"IntegrityError when adding device {mac_address} for user {username}. Duplicate entry?")
+        log.error("IntegrityError when adding device %s for user %s. Duplicate entry?", mac_address, username)
         # Depending on desired behavior, you might want to handle this differently.
         # Returning False here indicates it wasn't successfully inserted (likely due to duplicate).
         return False
     except Exception as e:
         # Catch any other unexpected errors
-        logging.error(f"An unexpected error occurred in save_mac_to_db: {e}")
+        log.error("An unexpected error occurred in save_mac_to_db: %s", e)
         # Re-raise the exception after logging it
         raise e
 
 # save measurement record
 def save_measurement(data):
     """
-    Validates and saves a measurement record to the measurements table.
+    Validates and synchronously saves a single measurement record to the measurements table.
+    The /<mac_address>/data endpoint goes through ingest_queue instead.
     """
-    # --- NOWA SEKCJA: WALIDACJA DANYCH ---
-    try:
-        raw_temp = float(data.get('temperature'))
-        temp = raw_temp + 2.0
-        pressure = float(data.get('pressure'))
-        humidity = float(data.get('humidity'))
-
-        # Sprawdzanie temperatury
-        if not (-40 < temp < 40): # Realistyczny zakres dla Polski/Europy
-            logging.warning(f"Odrzucono nierealistyczną temperaturę: {temp}°C dla MAC: {data.get('mac_address')}")
-            return # Zakończ funkcję, nie zapisuj danych
-
-        # Sprawdzanie ciśnienia (w hPa)
-        if not (950 < pressure < 1060):
-            logging.warning(f"Odrzucono nierealistyczne ciśnienie: {pressure} hPa dla MAC: {data.get('mac_address')}")
-            return
-
-        # Sprawdzanie wilgotności (wartość od 0.0 do 1.0)
-        if not (0 <= humidity <= 1):
-             logging.warning(f"Odrzucono nierealistyczną wilgotność: {humidity} dla MAC: {data.get('mac_address')}")
-             return
-
-    except (ValueError, TypeError):
-        logging.warning(f"Odrzucono pomiar z powodu błędu konwersji danych na liczby. Dane: {data}")
-        return
-    # --- KONIEC SEKCJI WALIDACJI ---
+    row = validate_measurement(data)
+    if row is None:
+        return # Pomiar odrzucony przez walidację
 
-    """
-    Saves a measurement record to the measurements table.
-    """
     try:
-        # Use 'with' statement for automatic connection closing
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            cur.execute(
-                '''
-                INSERT INTO measurements (
-                    mac_address,
-                    server_timestamp, -- Use CURRENT_TIMESTAMP directly in SQL
-                    temperature,
-                    pressure,
-                    humidity,
-                    sunshine,
-                    wind_speed, 
-                    precipitation                  
-                ) VALUES (?, datetime(CURRENT_TIMESTAMP, '+2 hours'), ?, ?, ?, ?, ?, ?)
-                ''',
-                (\
-                    data.get('mac_address'), # Use .get() for safer access
-                    temp, 
-                    data.get('pressure'),
-                    data.get('humidity'),
-                    data.get('sunshine'),
-                    data.get('wind_speed'),
-                    data.get('precipitation'),
-                )
-            )
-            conn.commit() # Commit the transaction
+        with db.writer() as conn:
+            insert_rows(conn, [row])
     except Exception as e:
-        logging.error(f"Error saving measurement: {e}")
+        log.error("Error saving measurement: %s", e)
         # Depending on requirements, you might want to re-raise or handle differently
         raise e
 
 # create Flask app and routes
-def create_app():
+def create_app(start_services=True):
+    """
+    Builds the app. start_services=False skips the background threads and the AI worker pool:
+    the parent process of the Werkzeug reloader only watches files and must not run them
+    (the reloaded child, which serves the requests, starts its own).
+    """
     app = Flask(__name__)
     app.config.from_object('config.Config')
 
-    # enable request logging
-    logging.basicConfig(level=logging.INFO)
+    # logging: per-module levels, writes off the request threads, sampled per-reading log (see logs.py)
+    logs.configure(app.config['LOG_LEVEL'], app.config['LOG_LEVELS'], app.config['LOG_QUEUE'], app.config['LOG_JSON'])
+    readings_log.filters.clear()
+    readings_log.addFilter(logs.SampleFilter(app.config['LOG_READING_SAMPLE']))
+
+    # request latency per blueprint route, AI stage timings of this process (see metrics.py)
+    metrics.init_app(app)
+    ai_pipeline.set_sink(metrics.registry.observe_stage)
 
     # register blueprints
     app.register_blueprint(boards.bp)
@@ -181,6 +257,33 @@ def create_app():
     app.register_blueprint(device_data.bp)
     app.register_blueprint(ai_service.bp)
 
+    # keep the rollups and the hourly feature store up to date with every insert into measurements
+    register_write_hook(rollups.rows_written)
+    register_write_hook(feature_store.rows_written)
+    # daily coverage of the stations (available days) and the in-memory hour bitmap of the AI panel
+    register_write_hook(data_coverage.rows_written)
+    register_write_hook(ai_service.hour_bitmap.rows_written)
+    # drop cached predictions whose 48-hour window gets new (late) readings
+    register_write_hook(ai_service.prediction_cache.rows_written)
+    # push new readings and 30-minute buckets to open dashboards (after the rollup hook)
+    register_write_hook(device_data.live_broker.rows_written)
+
+    if start_services:
+        # start the ingest writer thread; queued readings are flushed on interpreter shutdown
+        ingest_queue.start()
+        atexit.register(ingest_queue.stop)
+
+        feature_store.start()
+        atexit.register(feature_store.stop)
+
+        # compact readings older than retention.RAW_RETENTION in the background
+        retention_job.start()
+        atexit.register(retention_job.stop)
+
+        # worker processes for the AI predictions; unfinished tasks of the last run are queued again
+        ai_service.task_queue.start()
+        atexit.register(ai_service.task_queue.stop)
+
     @app.route('/<username>/add_device/<mac_address>', methods=['GET'])
     def add_device(username, mac_address):
         """
@@ -201,12 +304,12 @@ def create_app():
 
         except ValueError as e:
             # Handle the specific case where the user is not found
-            logging.warning(f"Attempted to add device for non-existent user {username}: {e}")
+            log.warning("Attempted to add device for non-existent user %s: %s", username, e)
             return jsonify({'error': str(e)}), 404 # Not Found
 
         except Exception as e:
             # Catch any other unexpected errors from save_mac_to_db
-            logging.error(f"Error in add_device route: {e}")
+            log.error("Error in add_device route: %s", e)
             return jsonify({'error': 'An internal error occurred'}), 500
 
     @app.route('/<mac_address>/data', methods=['POST'])
@@ -215,12 +318,12 @@ def create_app():
         API endpoint to receive measurement data from a device.
         """
         data = request.get_json(force=True)
-        logging.info(f"Received data for {mac_address}: {data}")
+        readings_log.info("Received data for %s: %s", mac_address, data)
 
         # Ensure mac_address from URL matches data if provided, or add it
         # This adds robustness if the payload also contains mac_address
         if 'mac_address' in data and data['mac_address'] != mac_address:
-             logging.warning(f"MAC address mismatch in URL ({mac_address}) and payload ({data['mac_address']})")
+             log.warning("MAC address mismatch in URL (%s) and payload (%s)", mac_address, data['mac_address'])
              # Decide how to handle this - maybe return an error?
              # For now, we'll use the one from the URL as it's part of the route
              pass # Or return jsonify({'error': 'MAC address mismatch'}), 400
@@ -231,35 +334,120 @@ def create_app():
         missing = [f for f in required if f not in data]
         if missing:
             msg = f"Missing fields in JSON: {', '.join(missing)}"
-            logging.warning(msg)
+            log.warning(msg)
             return jsonify({'error': msg}), 400
 
+        row = validate_measurement(data)
+        if row is None:
+            # Odrzucony pomiar jest tylko logowany (jak wcześniej w save_measurement)
+            return jsonify({'message': 'Measurement rejected by validation'}), 201
+
+        if not ingest_queue.enqueue(row):
+            log.warning("Ingest queue full, rejecting measurement from %s", mac_address)
+            return jsonify({'error': 'Server busy, retry later'}), 503, {'Retry-After': '5'}
+        # Use 201 Created status code for successful resource creation via POST
+        return jsonify({'message': 'Measurement queued'}), 201
+
+    @app.route('/<mac_address>/data/bulk', methods=['POST'])
+    def receive_measurements_bulk(mac_address):
+        """
+        API endpoint for readings buffered by a device while it was offline.
+        Accepts a JSON array (or {"readings": [...]}) or NDJSON (Content-Type: application/x-ndjson),
+        optionally gzip-compressed (Content-Encoding: gzip). Every reading carries its own
+        'timestamp'. Valid readings are inserted in one transaction; the response lists
+        the accepted and rejected indices.
+        """
+        # Limit sprawdzany przed wczytaniem treści (także bez Content-Length, np. chunked)
+        if request.content_length is not None and request.content_length > MAX_BULK_BODY_BYTES:
+            return jsonify({'error': f'Body too large (max {MAX_BULK_BODY_BYTES} bytes)'}), 413
         try:
-            save_measurement(data)
-            # Use 201 Created status code for successful resource creation via POST
-            return jsonify({'message': 'Measurement saved'}), 201
-        except Exception as e:
-            logging.error(f"Error in receive_measurement route: {e}")
-            return jsonify({'error': 'Failed to save measurement'}), 500
-        
-        # Helper to get database connection
-    def get_db():
-        db = getattr(g, '_database', None)
-        if db is None:
-            db = g._database = sqlite3.connect(DB_PATH)
-            db.row_factory = sqlite3.Row
-        return db
-    # Close database connection at the end of the request
-    @app.teardown_appcontext
-    def close_db(error):
-        db = getattr(g, '_database', None)
-        if db is not None:
-            db.close()
+            body = request.stream.read(MAX_BULK_BODY_BYTES + 1)
+            if len(body) > MAX_BULK_BODY_BYTES:
+                return jsonify({'error': f'Body too large (max {MAX_BULK_BODY_BYTES} bytes)'}), 413
+            if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+                with gzip.GzipFile(fileobj=BytesIO(body)) as f:
+                    body = f.read(MAX_BULK_BODY_BYTES + 1)
+                if len(body) > MAX_BULK_BODY_BYTES:
+                    return jsonify({'error': 'Decompressed body too large'}), 413
+            text = body.decode('utf-8')
+            if 'ndjson' in (request.mimetype or ''):
+                readings = [json.loads(line) for line in text.splitlines() if line.strip()]
+            else:
+                readings = json.loads(text)
+                if isinstance(readings, dict):
+                    readings = readings.get('readings')
+        except (OSError, EOFError, UnicodeDecodeError, ValueError) as e:
+            log.warning("Invalid bulk upload from %s: %s", mac_address, e)
+            return jsonify({'error': f'Invalid body: {e}'}), 400
+
+        if not isinstance(readings, list) or not readings:
+            return jsonify({'error': 'Expected a non-empty list of readings'}), 400
+        if len(readings) > MAX_BULK_READINGS:
+            return jsonify({'error': f'Too many readings (max {MAX_BULK_READINGS})'}), 413
+
+        rows, accepted, rejected = validate_measurements_bulk(readings, mac_address)
+        if rows:
+            try:
+                with db.writer() as conn:
+                    insert_rows(conn, rows)
+            except Exception as e:
+                log.error("Error saving bulk upload from %s: %s", mac_address, e)
+                return jsonify({'error': 'Failed to save measurements'}), 500
+
+        log.info("Bulk upload from %s: %s accepted, %s rejected", mac_address, len(accepted), len(rejected))
+        return jsonify({
+            'accepted_count': len(accepted),
+            'rejected_count': len(rejected),
+            'accepted': accepted,
+            'rejected': rejected,
+        }), 201 if rows else 200
+
+    @app.route('/api/ingest/stats', methods=['GET'])
+    def ingest_stats():
+        """Queue depth and flush latency of the ingest writer."""
+        return jsonify(ingest_queue.stats())
+
+    @app.route('/api/feature_store/stats', methods=['GET'])
+    def feature_store_stats():
+        """Pending hours and update counters of the hourly feature store."""
+        return jsonify(feature_store.stats())
+
+    @app.route('/api/live/stats', methods=['GET'])
+    def live_stats():
+        """Subscribers and delivered/dropped events of the live dashboard push."""
+        return jsonify(device_data.live_broker.stats())
+
+    @app.route('/api/coverage/stats', methods=['GET'])
+    def coverage_stats():
+        """Stations and memory of the in-memory hourly presence bitmap."""
+        return jsonify(ai_service.hour_bitmap.stats())
+
+    @app.route('/api/retention/stats', methods=['GET'])
+    def retention_stats():
+        """Last run report and totals of the retention job."""
+        return jsonify(retention_job.stats())
+
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        """AI stage and task histograms and request latency in the Prometheus text format."""
+        return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+    # return per-request reader connections to the shared pool
+    db.init_app(app)
 
     return app
 
 if __name__ == '__main__':
+    # With DEBUG the reloader runs this file twice: a watching parent and the serving child
+    # (WERKZEUG_RUN_MAIN=true). Only the serving process starts the background services.
+    serving = not config.Config.DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
     init_db()
-    app = create_app()
+    app = create_app(start_services=serving)
+    if serving:
+        # Wczytaj modele AI od razu, aby pierwsza predykcja nie płaciła kosztu ładowania
+        try:
+            ai_main.model_registry.get_models()
+        except Exception as e:
+            log.error("Could not preload AI models: %s", e)
     # Consider using a more robust server like Gunicorn or uWSGI in production
     app.run(host="localhost", port=5000, debug=config.Config.DEBUG)
\ No newline at end of file
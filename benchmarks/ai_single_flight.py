@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of the request coalescing in routes/ai_service.py.
+
+Fills a temporary database with three days of synthetic readings of one station, then
+fires `--requests` concurrent identical POST /api/ai/predict requests (same station and
+hour) from as many threads. All of them must get the same task id, the ai_tasks table
+must hold a single task (one pipeline execution) and every poller must see the same
+result. A second wave of identical requests must be answered from the prediction cache.
+
+Usage (from the repository root, needs the models in trained_models_wien/):
+    python -m benchmarks.ai_single_flight --requests 50
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+import app
+import db
+from benchmarks.feature_store import MAC, START, make_rows
+from ingest import insert_rows
+from routes import ai_service
+
+
+def fire(client_factory, n, body):
+    """Sends n identical requests at once (released by a barrier), returns the responses."""
+    barrier = threading.Barrier(n)
+    responses = [None] * n
+
+    def worker(i):
+        client = client_factory()
+        barrier.wait()
+        r = client.post('/api/ai/predict', json=body)
+        responses[i] = (r.status_code, r.get_json())
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return responses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.configure(os.path.join(tmp, 'measurements.db'))
+        app.init_db()
+        flask_app = app.create_app()
+        # Po create_app: hooki zapisu wypełniają daily_coverage, z której zadanie sprawdza dane przed predykcją
+        with db.writer() as conn:
+            insert_rows(conn, make_rows(START, 72))
+        hour = (START + timedelta(hours=60)).strftime('%Y-%m-%d %H:%M:%S')
+        body = {'start_date': hour, 'end_date': hour, 'mac_address': MAC}
+
+        start = time.perf_counter()
+        responses = fire(flask_app.test_client, args.requests, body)
+        task_ids = {data['task_id'] for status, data in responses if status == 202}
+        print(f"{args.requests} concurrent requests: statuses {sorted({status for status, _ in responses})}, "
+              f"{len(task_ids)} distinct task id(s), {sum(1 for _, data in responses if data.get('coalesced'))} coalesced")
+
+        client = flask_app.test_client()
+        results = []
+        for task_id in task_ids:
+            while True:
+                data = client.get(f'/api/ai/predict/status/{task_id}').get_json()
+                if data['status'] in ('SUCCESS', 'FAILURE'):
+                    break
+                time.sleep(0.1)
+            results.append(data)
+        print(f"task finished in {time.perf_counter() - start:.1f}s with status {[r['status'] for r in results]}: {results[0].get('result')}")
+
+        with db.reader() as conn:
+            executions = conn.execute("SELECT COUNT(*) FROM ai_tasks WHERE kind = 'predict'").fetchone()[0]
+        print(f"pipeline executions (rows in ai_tasks): {executions}")
+
+        responses = fire(flask_app.test_client, args.requests, body)
+        cached = sum(1 for status, data in responses if status == 200 and data.get('cached'))
+        print(f"second wave: {cached}/{args.requests} answered from the prediction cache")
+        print(f"queue stats: {client.get('/api/ai/tasks/stats').get_json()}")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            ai_service.task_queue.stop()
+        ok = len(task_ids) == 1 and executions == 1 and results[0]['status'] == 'SUCCESS' and cached == args.requests
+        if not ok:
+            raise SystemExit("Identical concurrent predictions were not coalesced into one execution")
+
+
+if __name__ == '__main__':
+    main()
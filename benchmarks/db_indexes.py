@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the measurements queries before and after the schema migrations from app.py.
+
+Builds a synthetic measurements table (default: 10M rows, 50 stations, one reading per
+station every 5 seconds), times the queries used by the dashboard, CSV export, available
+dates, AI availability check and AI data fetch, applies app.migrate_db and times them again.
+
+Usage (from the repository root):
+    python -m benchmarks.db_indexes --rows 10000000 --stations 50
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import app
+
+START = datetime(2025, 1, 1)
+
+QUERIES = {
+    'latest timestamp (dashboard)': (
+        "SELECT MAX(server_timestamp) FROM measurements WHERE mac_address = :mac",
+    ),
+    '30-min aggregation, 3 days (dashboard)': (
+        """
+        SELECT strftime('%Y-%m-%d %H', server_timestamp) || ':' ||
+               printf('%02d', (strftime('%M', server_timestamp) / 30) * 30) as time_window,
+               AVG(temperature), AVG(pressure), AVG(humidity), MAX(wind_speed), AVG(sunshine), MAX(precipitation)
+        FROM measurements
+        WHERE mac_address = :mac AND server_timestamp BETWEEN :from_3d AND :to
+        GROUP BY time_window ORDER BY time_window
+        """,
+    ),
+    'full history (CSV export)': (
+        """
+        SELECT server_timestamp, temperature, pressure, humidity, sunshine, wind_speed, precipitation
+        FROM measurements WHERE mac_address = :mac ORDER BY server_timestamp
+        """,
+    ),
+    'distinct days (available dates)': (
+        """
+        SELECT DISTINCT strftime('%Y-%m-%d', server_timestamp) as date
+        FROM measurements WHERE mac_address = :mac ORDER BY date DESC
+        """,
+    ),
+    'target hour probe (availability)': (
+        "SELECT 1 FROM measurements WHERE server_timestamp BETWEEN :hour_start AND :hour_end LIMIT 1",
+    ),
+    '48h distinct hours (availability)': (
+        """
+        SELECT COUNT(DISTINCT strftime('%Y-%m-%d %H', server_timestamp))
+        FROM measurements WHERE server_timestamp BETWEEN :from_48h AND :to
+        """,
+    ),
+    '49h window, all stations (AI fetch)': (
+        """
+        SELECT server_timestamp, temperature, pressure, humidity, sunshine, wind_speed, precipitation
+        FROM measurements WHERE server_timestamp BETWEEN :from_48h AND :hour_end
+        ORDER BY server_timestamp ASC
+        """,
+    ),
+    '49h window, one station (AI fetch)': (
+        """
+        SELECT server_timestamp, temperature, pressure, humidity, sunshine, wind_speed, precipitation
+        FROM measurements WHERE mac_address = :mac AND server_timestamp BETWEEN :from_48h AND :hour_end
+        ORDER BY server_timestamp ASC
+        """,
+    ),
+}
+
+
+def populate(conn, rows, stations):
+    conn.execute('''
+        CREATE TABLE measurements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            mac_address TEXT NOT NULL,
+            server_timestamp TIMESTAMP,
+            temperature REAL,
+            pressure REAL,
+            humidity REAL,
+            sunshine INTEGER,
+            wind_speed REAL,
+            precipitation REAL
+        )
+    ''')
+    macs = [f"AA:BB:CC:00:{i // 256:02X}:{i % 256:02X}" for i in range(stations)]
+    steps = rows // stations
+
+    def generate():
+        rnd = random.Random(42)
+        for step in range(steps):
+            ts = (START + timedelta(seconds=5 * step)).strftime('%Y-%m-%d %H:%M:%S')
+            for mac in macs:
+                yield (mac, ts, rnd.uniform(-5, 30), rnd.uniform(990, 1030), rnd.uniform(0.3, 1.0),
+                       rnd.randint(0, 100), rnd.uniform(0, 30), rnd.uniform(0, 1))
+
+    start = time.time()
+    conn.executemany(
+        'INSERT INTO measurements (mac_address, server_timestamp, temperature, pressure, humidity, '
+        'sunshine, wind_speed, precipitation) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        generate()
+    )
+    conn.commit()
+    print(f"Inserted {steps * stations:,} rows in {time.time() - start:.1f}s")
+    return macs, START + timedelta(seconds=5 * (steps - 1))
+
+
+def time_queries(conn, params, repeat):
+    timings = {}
+    for name, (sql,) in QUERIES.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.execute(sql, params).fetchall()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--stations', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--db', help='Database file to create (default: temporary file, removed afterwards)')
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), 'bench_measurements.db')
+    if os.path.exists(db_path):
+        parser.error(f"{db_path} already exists")
+    conn = sqlite3.connect(db_path)
+    try:
+        macs, last_ts = populate(conn, args.rows, args.stations)
+        # Godzina docelowa w 3/4 zakresu danych, żeby okna 48h/3 dni trafiały w istniejące wiersze
+        target = (START + (last_ts - START) * 3 / 4).replace(minute=0, second=0, microsecond=0)
+        fmt = '%Y-%m-%d %H:%M:%S'
+        params = {
+            'mac': macs[len(macs) // 2],
+            'to': target.strftime(fmt),
+            'from_3d': (target - timedelta(days=3)).strftime(fmt),
+            'from_48h': (target - timedelta(hours=48)).strftime(fmt),
+            'hour_start': target.strftime(fmt),
+            'hour_end': target.replace(minute=59, second=59).strftime(fmt),
+        }
+
+        before = time_queries(conn, params, args.repeat)
+        start = time.time()
+        version = app.migrate_db(conn)
+        print(f"Migrated to schema version {version} in {time.time() - start:.1f}s")
+        after = time_queries(conn, params, args.repeat)
+
+        print(f"\n{'query':<42}{'before [ms]':>14}{'after [ms]':>14}{'speedup':>10}")
+        for name in QUERIES:
+            b, a = before[name] * 1000, after[name] * 1000
+            print(f"{name:<42}{b:>14.1f}{a:>14.1f}{b / a if a else float('inf'):>9.1f}x")
+    finally:
+        conn.close()
+        if not args.db:
+            os.remove(db_path)
+
+
+if __name__ == '__main__':
+    main()
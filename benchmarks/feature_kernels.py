@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Equivalence checks and micro-benchmark for the vectorized feature kernels in ai_main:
+calculateDewPoint_array vs. calculateDewPoint applied row by row, and simulate_snow_cover
+vs. the previous iterrows() loop (kept below as the reference implementation).
+
+Usage (from the repository root):
+    python -m benchmarks.feature_kernels --rows 100000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import ai_main
+
+
+def snow_cover_reference(df_hourly):
+    """The snow cover loop from aggregate_raw_to_hourly before vectorization."""
+    _snow_depth_mm = 0.0
+    _calculated_snow_values = []
+    for index, row in df_hourly.iterrows():
+        _hourly_precip_water_eq = row['prcp']; _avg_hourly_temp = row['temp']
+        _fresh_snow_mm = 0.0
+        if _hourly_precip_water_eq > 0 and _avg_hourly_temp < ai_main.TEMP_THRESHOLD_SNOW:
+            _fresh_snow_mm = _hourly_precip_water_eq * ai_main.WATER_TO_SNOW_RATIO
+        _snow_depth_mm += _fresh_snow_mm
+        _melt_mm_water_eq = 0.0
+        if _snow_depth_mm > 0 and _avg_hourly_temp > 0:
+            _melt_mm_water_eq = ai_main.HOURLY_MELT_RATE_PER_DEG_ABOVE_FREEZING * _avg_hourly_temp
+            _melt_snow_depth_mm = _melt_mm_water_eq * ai_main.WATER_TO_SNOW_RATIO
+            _snow_depth_mm -= _melt_snow_depth_mm
+        _snow_depth_mm = max(0, _snow_depth_mm)
+        _snow_depth_mm = min(_snow_depth_mm, ai_main.MAX_ACCUMULATED_SNOW_DEPTH_MM)
+        _calculated_snow_values.append(round(_snow_depth_mm, 2))
+    return pd.Series(_calculated_snow_values, index=df_hourly.index, dtype=np.float64)
+
+
+def dew_point_reference(df_hourly):
+    return df_hourly.apply(lambda row: ai_main.calculateDewPoint(row['temp'], row['rhum']), axis=1)
+
+
+def make_hourly(rows, seed=0):
+    """Synthetic hourly data with winter periods, NaN gaps and out-of-range humidity."""
+    rnd = np.random.default_rng(seed)
+    index = pd.date_range('2015-01-01', periods=rows, freq='h')
+    seasonal = 10 - 15 * np.cos(2 * np.pi * index.dayofyear.to_numpy() / 365.25)
+    temp = seasonal + rnd.normal(0, 4, rows)
+    rhum = rnd.uniform(-5, 105, rows)
+    prcp = np.where(rnd.random(rows) < 0.15, rnd.exponential(1.5, rows), 0.0)
+    for column in (temp, rhum, prcp):
+        column[rnd.random(rows) < 0.01] = np.nan
+    # Wartości brzegowe
+    rhum[:6] = [0.0, 100.0, 100.0000001, 1e-300, np.nan, 50.0]
+    temp[:6] = [5.0, -30.0, 10.0, 20.0, 1.0, np.nan]
+    return pd.DataFrame({'temp': temp, 'rhum': rhum, 'prcp': prcp}, index=index)
+
+
+def bit_equal(a, b):
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    nan_a, nan_b = np.isnan(a), np.isnan(b)
+    return a.shape == b.shape and np.array_equal(nan_a, nan_b) and np.array_equal(a[~nan_a].view(np.int64), b[~nan_b].view(np.int64))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000)
+    args = parser.parse_args()
+
+    df = make_hourly(args.rows)
+    ok = True
+
+    dew_ref, t_dew_ref = timed(dew_point_reference, df)
+    dew_new, t_dew_new = timed(ai_main.calculateDewPoint_array, df['temp'].to_numpy(), df['rhum'].to_numpy())
+    same = bit_equal(dew_ref, dew_new)
+    ok &= same
+    print(f"dew_point:  reference {t_dew_ref * 1000:9.1f} ms   vectorized {t_dew_new * 1000:7.1f} ms   "
+          f"speedup {t_dew_ref / t_dew_new:7.1f}x   identical: {same}")
+
+    # Pierwsze wywołanie z numbą zawiera kompilację - mierzymy drugie
+    ai_main.simulate_snow_cover(df['prcp'].to_numpy()[:10], df['temp'].to_numpy()[:10])
+    snow_ref, t_snow_ref = timed(snow_cover_reference, df)
+    snow_new, t_snow_new = timed(ai_main.simulate_snow_cover, df['prcp'].to_numpy(), df['temp'].to_numpy())
+    same = bit_equal(snow_ref, snow_new)
+    ok &= same
+    print(f"snow cover: reference {t_snow_ref * 1000:9.1f} ms   {'numba' if ai_main.NUMBA_AVAILABLE else 'loop '}      "
+          f"{t_snow_new * 1000:7.1f} ms   speedup {t_snow_ref / t_snow_new:7.1f}x   identical: {same}")
+    print(f"  (max snow depth {snow_ref.max():.1f} mm, {int((snow_ref > 0).sum())} hours with snow cover)")
+
+    if not ok:
+        raise SystemExit("Vectorized kernels differ from the reference implementation")
+
+
+if __name__ == '__main__':
+    main()
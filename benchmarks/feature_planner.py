@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Validation and benchmark of the feature planner in ai_main.engineer_features.
+
+Runs the full feature engineering and the planned one (required_features=MODEL_FEATURES)
+on the same synthetic hourly data, checks that every model input column is bit-identical
+(same rows, same values, same NaN positions) and reports time, column count and peak memory.
+
+Usage (from the repository root):
+    python -m benchmarks.feature_planner --rows 20000
+"""
+import argparse
+import contextlib
+import io
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import ai_main
+from benchmarks.feature_kernels import bit_equal
+
+
+def make_hourly(rows, seed=0):
+    """Synthetic hourly frame in the shape returned by aggregate_raw_to_hourly."""
+    rnd = np.random.default_rng(seed)
+    index = pd.date_range('2020-01-01', periods=rows, freq='h')
+    seasonal = 10 - 15 * np.cos(2 * np.pi * index.dayofyear.to_numpy() / 365.25)
+    df = pd.DataFrame(index=index)
+    df['temp'] = seasonal + rnd.normal(0, 4, rows)
+    df['pres'] = 1013 + rnd.normal(0, 10, rows)
+    df['rhum'] = np.clip(rnd.normal(75, 15, rows), 0, 100)
+    df['wspd'] = rnd.gamma(2, 2.5, rows)
+    df['wpgt'] = df['wspd'] * rnd.uniform(1, 2, rows)
+    df['tsun'] = np.clip(rnd.normal(20, 25, rows), 0, 60)
+    df['prcp'] = np.where(rnd.random(rows) < 0.15, rnd.exponential(1.5, rows), 0.0)
+    for column in ['pres', 'wspd', 'wpgt']:
+        df.loc[rnd.random(rows) < 0.01, column] = np.nan
+    df['snow'] = ai_main.simulate_snow_cover(df['prcp'].to_numpy(), df['temp'].to_numpy())
+    df['coco'] = rnd.integers(1, 28, rows)
+    df['weather_category'] = df['coco'].apply(ai_main.aggregate_coco_FINAL_user_v2)
+    df['year'] = df.index.year
+    return df
+
+
+def run(df, required_features):
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result, _ = ai_main.engineer_features(df, required_features=required_features)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20_000)
+    args = parser.parse_args()
+
+    df = make_hourly(args.rows)
+    full, t_full, peak_full = run(df, None)
+    planned, t_planned, peak_planned = run(df, ai_main.MODEL_FEATURES)
+
+    mismatched = [f for f in ai_main.MODEL_FEATURES
+                  if f not in planned.columns or f not in full.columns or not bit_equal(full[f], planned[f])]
+    same_index = full.index.equals(planned.index)
+
+    print(f"{'':<10}{'time [s]':>10}{'columns':>10}{'peak memory [MB]':>20}")
+    print(f"{'full':<10}{t_full:>10.2f}{full.shape[1]:>10}{peak_full / 2**20:>20.1f}")
+    print(f"{'planned':<10}{t_planned:>10.2f}{planned.shape[1]:>10}{peak_planned / 2**20:>20.1f}")
+    print(f"speedup {t_full / t_planned:.1f}x, peak memory {peak_full / peak_planned:.1f}x lower")
+    print(f"model inputs ({len(ai_main.MODEL_FEATURES)} features) identical: {same_index and not mismatched}")
+    if not same_index or mismatched:
+        raise SystemExit(f"Planned features differ from the full run: index equal={same_index}, columns={mismatched}")
+
+
+if __name__ == '__main__':
+    main()
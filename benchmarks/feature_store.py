@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Validation and benchmark of the hourly feature store (feature_store.py).
+
+Fills a temporary database with synthetic 5-second readings of one station (with a few
+missing hours), builds the store with FeatureStore.rebuild and checks for a sample of hours
+that the stored feature row is bit-identical to the one the full run_prediction path builds
+(fetch_raw_measurements -> aggregate_raw_to_hourly -> engineer_features over 48 hours).
+Then inserts late readings into a closed hour through the ingest write hook and checks that
+the affected rows are invalidated and recomputed. Reports time per hour of both paths.
+
+Usage (from the repository root):
+    python -m benchmarks.feature_store --days 5 --samples 20
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import ai_main
+import app
+import db
+from benchmarks.feature_kernels import bit_equal
+from feature_store import FeatureStore
+from ingest import insert_rows, register_write_hook
+
+MAC = 'AA:BB:CC:DD:EE:FF'
+START = datetime(2025, 1, 10)
+
+
+def make_rows(start, hours, seed=0):
+    rnd = np.random.default_rng(seed)
+    n = hours * 720
+    seconds = np.arange(n) * 5
+    day = np.sin(2 * np.pi * seconds / 86400)
+    temp = 2 + 6 * day + np.cumsum(rnd.normal(0, 0.01, n))
+    pres = 1005 + np.cumsum(rnd.normal(0, 0.002, n))
+    hum = np.clip(0.8 - 0.2 * day + rnd.normal(0, 0.02, n), 0, 1)
+    sun = np.clip(600 * day + rnd.normal(0, 50, n), 0, 1023).astype(int)
+    wind = rnd.gamma(2, 4, n)
+    prcp = np.where(rnd.random(n) < 0.1, rnd.random(n), 0.0)
+    return [(MAC, (start + timedelta(seconds=s)).strftime('%Y-%m-%d %H:%M:%S'), *values)
+            for s, *values in zip(seconds.tolist(), temp.tolist(), pres.tolist(), hum.tolist(), sun.tolist(), wind.tolist(), prcp.tolist())]
+
+
+def full_path_features(hour):
+    """Feature row of `hour` as built by run_prediction from the raw measurements."""
+    df_raw = ai_main.fetch_raw_measurements(hour - timedelta(hours=48), hour.replace(minute=59, second=59), MAC)
+    df_features, _ = ai_main.engineer_features(ai_main.aggregate_raw_to_hourly(df_raw), required_features=ai_main.MODEL_FEATURES)
+    return df_features.loc[[hour], ai_main.MODEL_FEATURES] if hour in df_features.index else None
+
+
+def compare(hours):
+    mismatched = []
+    t_full = t_stored = 0.0
+    for hour in hours:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = full_path_features(hour)
+        t_full += time.perf_counter() - start
+        start = time.perf_counter()
+        stored = ai_main.fetch_stored_features(MAC, hour)
+        t_stored += time.perf_counter() - start
+        if expected is None or stored is None:
+            if (expected is None) != (stored is None):
+                mismatched.append((hour, 'missing'))
+            continue
+        bad = [f for f in ai_main.MODEL_FEATURES if not bit_equal(expected[f], stored[f])]
+        if bad:
+            mismatched.append((hour, bad))
+    return mismatched, t_full / len(hours), t_stored / len(hours)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--samples', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.configure(os.path.join(tmp, 'measurements.db'))
+        app.init_db()
+
+        hours = args.days * 24
+        rows = make_rows(START, hours)
+        # Kilka godzin bez pomiarów (przerwy w zasilaniu stacji)
+        gap_hours = {START + timedelta(hours=h) for h in (30, 31, 57, 80)}
+        rows = [row for row in rows if datetime.strptime(row[1][:13], '%Y-%m-%d %H') not in gap_hours]
+        with db.writer() as conn:
+            insert_rows(conn, rows)
+        print(f"{len(rows)} raw readings, {hours} hours, {len(gap_hours)} hours without readings")
+
+        store = FeatureStore()
+        end = START + timedelta(hours=hours)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            aggregated, written = store.rebuild(MAC, START, end)
+        print(f"rebuild: {aggregated} hourly aggregates, {written} feature rows in {time.perf_counter() - start:.1f}s")
+
+        sample = sorted(random.Random(0).sample([START + timedelta(hours=h) for h in range(hours)], args.samples))
+        sample += [START + timedelta(hours=h) for h in (32, 33, 58, 79)]  # zaraz po przerwach
+        mismatched, t_full, t_stored = compare(sample)
+        print(f"full path {t_full * 1000:8.1f} ms/hour   store lookup {t_stored * 1000:6.2f} ms/hour   "
+              f"speedup {t_full / t_stored:.0f}x   identical: {not mismatched}")
+
+        # Spóźnione pomiary w zamkniętej godzinie: unieważnienie i przeliczenie
+        register_write_hook(store.rows_written)
+        late_hour = START + timedelta(hours=31)
+        late_rows = [(MAC, (late_hour + timedelta(minutes=m)).strftime('%Y-%m-%d %H:%M:%S'), 25.0, 1020.0, 0.3, 900, 10.0, 0.0)
+                     for m in range(0, 60, 2)]
+        with db.writer() as conn:
+            insert_rows(conn, late_rows)
+        invalidated = ai_main.fetch_stored_features(MAC, late_hour + timedelta(hours=1)) is None
+        with contextlib.redirect_stdout(io.StringIO()):
+            store.refresh()
+        affected = [late_hour + timedelta(hours=h) for h in range(0, 49, 4)]
+        late_mismatched, _, _ = compare(affected)
+        print(f"late readings: following rows invalidated: {invalidated}, recomputed rows identical: {not late_mismatched}")
+
+        db.database.close()
+        if mismatched or late_mismatched or not invalidated:
+            raise SystemExit(f"Feature store differs from the full path: {mismatched + late_mismatched}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Equivalence check and benchmark of the fused hierarchical scorer (hierarchical_scorer.py)
+against predict_hierarchical (sklearn wrapper, DataFrame slices per stage).
+
+Builds model inputs with engineer_features from synthetic hourly data, scores them with the
+models in MODEL_SAVE_DIR through both paths and checks that every label is identical (for
+the whole block, scored with inplace_predict, and for single rows and small blocks, scored
+with the exported tree arrays) and that the tree-array margins are bit-identical to the ones
+of XGBoost. Checks the probability path of predict_proba against XGBClassifier.predict_proba
+of every stage (same labels, joint distribution summing to 1; single rows within one float32
+ulp of the sigmoid). Then times single-row scoring
+(as for one predicted hour) and the whole block, with and without probabilities.
+
+Usage (from the repository root, needs the models in trained_models_wien/):
+    python -m benchmarks.hierarchical_scorer --rows 100000 --repeat 200
+"""
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+
+import ai_main
+import hierarchical_scorer
+from benchmarks.feature_kernels import bit_equal
+from benchmarks.feature_planner import make_hourly
+
+
+def timed(func, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=200, help='repetitions of the single-row timing')
+    parser.add_argument('--margin-rows', type=int, default=20_000, help='rows of the tree-array margin check')
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        df_features, flags = ai_main.engineer_features(make_hourly(args.rows + 48), required_features=ai_main.MODEL_FEATURES)
+        feature_lists, all_features = ai_main.resolve_feature_lists(df_features, flags)
+        models = ai_main.model_registry.get_models()
+    X_df = df_features[all_features].iloc[-args.rows:]
+    scorer = models['scorer']
+
+    def reference(frame):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return ai_main.predict_hierarchical(frame, models, feature_lists, models['LE_M3']).to_numpy()
+
+    def fused(frame):
+        return scorer.predict(scorer.matrix(frame))
+
+    expected, t_ref = timed(lambda: reference(X_df))
+    labels, t_fused = timed(lambda: fused(X_df))
+    same = np.array_equal(expected, labels)
+    categories, counts = np.unique(labels.astype(str), return_counts=True)
+    print(f"{len(X_df)} rows: labels identical: {same}; {dict(zip(categories.tolist(), counts.tolist()))}")
+    print(f"  predict_hierarchical {t_ref:.3f}s, fused scorer {t_fused:.3f}s (matrix included), x{t_ref / t_fused:.1f}")
+
+    # Ścieżka prawdopodobieństw vs predict_proba wrappera sklearn każdego etapu
+    proba_labels, stages, categories, joint = scorer.predict_proba(scorer.matrix(X_df))
+    proba_same = (np.array_equal(proba_labels, labels)
+                  and bit_equal(stages['precipitation'], models['M1'].predict_proba(X_df[feature_lists['M1']])[:, 1])
+                  and bit_equal(stages['fog'], models['M2'].predict_proba(X_df[feature_lists['M2']])[:, 1])
+                  and bit_equal(stages['cloudy'], models['M4'].predict_proba(X_df[feature_lists['M4']])[:, 1])
+                  and np.allclose(stages['precipitation_type'], models['M3'].predict_proba(X_df[feature_lists['M3']]), atol=1e-6)
+                  and np.allclose(joint.sum(axis=1), 1.0))
+    print(f"predict_proba: labels and stage probabilities match XGBClassifier, joint over {categories} sums to 1: {proba_same}")
+
+    # Marginesy tablic drzew vs XGBoost (próbka bloku, porcjami)
+    X = scorer.matrix(X_df.iloc[:args.margin_rows])
+    margins_same = all(bit_equal(scorer._inplace(name, X[i:i + 2000], None, 'margin').reshape(-1),
+                                 scorer._trees[name].margins(X[i:i + 2000]).reshape(-1))
+                       for name in hierarchical_scorer.STAGES for i in range(0, len(X), 2000))
+    print(f"tree-array margins bit-identical to XGBoost on {len(X)} rows: {margins_same}")
+
+    # Pojedyncze godziny z różnych gałęzi hierarchii i małe bloki (tablice drzew)
+    rng = np.random.default_rng(0)
+    rows = [int(np.flatnonzero(labels == category)[0]) for category in categories] + rng.integers(0, len(X_df), 200).tolist()
+    single_same = all(np.array_equal(expected[[i]], fused(X_df.iloc[[i]])) for i in rows)
+    blocks = [np.sort(rng.choice(len(X_df), hierarchical_scorer.SMALL_BLOCK_ROWS, replace=False)) for _ in range(20)]
+    single_same &= all(np.array_equal(expected[block], fused(X_df.iloc[block])) for block in blocks)
+    # Tablice drzew w trybie prawdopodobieństw: te same etykiety, P z dokładnością do 1 ulp float32 (expf XGBoost)
+    for i in rows[:50]:
+        small = scorer.predict_proba(scorer.matrix(X_df.iloc[[i]]))
+        single_same &= np.array_equal(small[0], labels[[i]]) and np.allclose(small[3], joint[[i]], rtol=1e-6, atol=0)
+    one_row = X_df.iloc[[rows[0]]]
+    _, t_ref_1 = timed(lambda: reference(one_row), args.repeat)
+    _, t_fused_1 = timed(lambda: fused(one_row), args.repeat)
+    _, t_proba_1 = timed(lambda: scorer.predict_proba(scorer.matrix(one_row)), args.repeat)
+    _, t_proba = timed(lambda: scorer.predict_proba(scorer.matrix(X_df)))
+    print(f"{len(rows)} single rows and {len(blocks)} blocks of {hierarchical_scorer.SMALL_BLOCK_ROWS} rows identical: {single_same}")
+    print(f"1 row: predict_hierarchical {t_ref_1 * 1000:.2f} ms, "
+          f"fused scorer {t_fused_1 * 1000:.2f} ms, x{t_ref_1 / t_fused_1:.1f}; with probabilities {t_proba_1 * 1000:.2f} ms")
+    print(f"{len(X_df)} rows with probabilities: {t_proba:.3f}s")
+
+    if not (same and proba_same and margins_same and single_same):
+        raise SystemExit("Fused scorer labels differ from predict_hierarchical")
+
+
+if __name__ == '__main__':
+    main()
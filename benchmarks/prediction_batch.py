@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Equivalence check and benchmark of the batch prediction (ai_main.run_prediction_batch).
+
+Fills a temporary database with synthetic readings of one station with a few missing hours
+and a six-hour outage, stores the feature rows of the first --stored-hours hours in the feature
+store, then predicts every hour of the range once with run_prediction_batch and once per hour
+with run_prediction. Both must agree for every hour: the same predicted
+category and probabilities, and the same hours refused (no reading in the hour, fewer than
+data_coverage.MIN_HISTORY_HOURS hours of history). Reports the time per hour of both paths.
+
+Usage (from the repository root, needs the models in trained_models_wien/):
+    python -m benchmarks.prediction_batch --days 5 --stored-hours 60
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import ai_main
+import app
+import db
+from benchmarks.feature_store import MAC, START, make_rows
+from ingest import insert_rows
+
+HOUR_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def max_difference(expected, actual):
+    """Largest absolute difference of the probabilities of two prediction records."""
+    pairs = [(expected.get('confidence'), actual.get('confidence'))]
+    pairs += [(value, actual.get('probabilities', {}).get(name)) for name, value in expected.get('probabilities', {}).items()]
+    if any(b is None for a, b in pairs if a is not None):
+        return float('inf')
+    return max((abs(a - b) for a, b in pairs if a is not None), default=0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--stored-hours', type=int, default=60, help='hours with feature rows in hourly_features')
+    parser.add_argument('--tolerance', type=float, default=1e-9)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.configure(os.path.join(tmp, 'measurements.db'))
+        app.init_db()
+        app.create_app(start_services=False)  # hooki zapisu wypełniają daily_coverage (reguła historii)
+        logging.getLogger('ai_main').setLevel(logging.ERROR)  # odmowy godzin bez historii są tu oczekiwane
+
+        hours = args.days * 24
+        # Pojedyncze godziny bez pomiarów i sześciogodzinna przerwa w zasilaniu stacji
+        gap_hours = {START + timedelta(hours=h) for h in [30, 31, 57] + list(range(62, 68))}
+        rows = [row for row in make_rows(START, hours)
+                if datetime.strptime(row[1][:13], '%Y-%m-%d %H') not in gap_hours]
+        with db.writer() as conn:
+            insert_rows(conn, rows)
+        targets = [START + timedelta(hours=h) for h in range(hours)]
+        # Część godzin policzona przez feature store - obie ścieżki biorą je z hourly_features
+        _, stored_rows = app.feature_store.rebuild(MAC, START, START + timedelta(hours=args.stored_hours))
+        print(f"{len(rows)} raw readings, {hours} hours, {len(gap_hours)} hours without readings, "
+              f"{stored_rows} stored feature rows")
+
+        start = time.perf_counter()
+        batch = ai_main.run_prediction_batch([(MAC, hour.strftime(HOUR_FORMAT)) for hour in targets], probabilities=True)
+        t_batch = time.perf_counter() - start
+        if 'error' in batch:
+            raise SystemExit(f"Batch prediction failed: {batch}")
+        batch_by_hour = {record['timestamp']: record for record in batch['predictions']}
+
+        mismatched = []
+        t_single = 0.0
+        for hour in targets:
+            hour_str = hour.strftime(HOUR_FORMAT)
+            start = time.perf_counter()
+            single = ai_main.run_prediction(hour_str, hour_str, MAC, probabilities=True)
+            t_single += time.perf_counter() - start
+            expected = single[0] if isinstance(single, list) and single else None
+            actual = batch_by_hour.get(hour_str)
+            if expected is None or actual is None:
+                if (expected is None) != (actual is None):
+                    mismatched.append((hour_str, 'refused only by one path'))
+                continue
+            if expected['predicted_category'] != actual['predicted_category']:
+                mismatched.append((hour_str, expected['predicted_category'], actual['predicted_category']))
+            elif max_difference(expected, actual) > args.tolerance:
+                mismatched.append((hour_str, 'probabilities', max_difference(expected, actual)))
+
+        print(f"batch {len(batch['predictions'])} predictions, {len(batch['missing'])} refused   "
+              f"batch {t_batch / hours * 1000:7.1f} ms/hour   single {t_single / hours * 1000:7.1f} ms/hour   "
+              f"identical: {not mismatched}")
+        db.database.close()
+        if mismatched:
+            raise SystemExit(f"Batch prediction differs from run_prediction: {mismatched}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Validation and benchmark of the retention tiers (retention.py).
+
+Fills a temporary database with synthetic 5-second readings of two stations (rollups kept by
+the ingest write hook), records the answers of the readers before compaction, runs one
+retention pass with short retention periods and checks that:
+  * the 1-minute tier holds the per-minute averages (wind and precipitation: maxima) of the
+    deleted raw rows,
+  * the dashboard rollups over whole buckets are unchanged and `rollups.check` still passes,
+  * feature rows built by the ai_main path for hours whose 48-hour window reaches into the
+    compacted range are bit-identical to the ones built from the raw rows, both directly and
+    through FeatureStore.rebuild (aggregates stored by the before_compact hook),
+  * late readings older than the watermark are folded into the 1-minute tier on the next run.
+Reports the compacted/deleted rows, the reusable bytes and the database size.
+
+Usage (from the repository root):
+    python -m benchmarks.retention --days 8 --raw-days 3 --minute-days 5
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import ai_main
+import app
+import db
+import retention
+import rollups
+from benchmarks.feature_kernels import bit_equal
+from feature_store import FeatureStore
+from ingest import insert_rows, register_write_hook
+
+STATIONS = ['AA:BB:CC:DD:EE:01', 'AA:BB:CC:DD:EE:02']
+START = datetime(2025, 2, 1)
+
+
+def make_rows(mac, start, hours, seed):
+    rnd = np.random.default_rng(seed)
+    n = hours * 720
+    seconds = np.arange(n) * 5
+    day = np.sin(2 * np.pi * seconds / 86400)
+    temp = 2 + 6 * day + np.cumsum(rnd.normal(0, 0.01, n))
+    pres = 1005 + np.cumsum(rnd.normal(0, 0.002, n))
+    hum = np.clip(0.8 - 0.2 * day + rnd.normal(0, 0.02, n), 0, 1)
+    sun = np.clip(600 * day + rnd.normal(0, 50, n), 0, 1023).astype(int)
+    wind = rnd.gamma(2, 4, n)
+    prcp = np.where(rnd.random(n) < 0.1, rnd.random(n), 0.0)
+    return [(mac, (start + timedelta(seconds=s)).strftime('%Y-%m-%d %H:%M:%S'), *values)
+            for s, *values in zip(seconds.tolist(), temp.tolist(), pres.tolist(), hum.tolist(), sun.tolist(), wind.tolist(), prcp.tolist())]
+
+
+def path_features(mac, hour):
+    """Feature row of `hour` as built by run_prediction (raw rows plus compacted hourly aggregates)."""
+    window_start, window_end = hour - timedelta(hours=48), hour.replace(minute=59, second=59)
+    with contextlib.redirect_stdout(io.StringIO()):
+        df_raw = ai_main.fetch_raw_measurements(window_start, window_end, mac)
+        df_compacted = ai_main.fetch_compacted_hourly(window_start, window_end, mac)
+        df_hourly = ai_main.aggregate_raw_to_hourly(df_raw, df_compacted)
+        df_features, _ = ai_main.engineer_features(df_hourly, required_features=ai_main.MODEL_FEATURES)
+    return df_features.loc[[hour], ai_main.MODEL_FEATURES]
+
+
+def minute_averages(conn, mac, end):
+    rows = conn.execute('''
+        SELECT substr(server_timestamp, 1, 16) || ':00' AS minute,
+               AVG(temperature), AVG(pressure), AVG(humidity), AVG(sunshine), MAX(wind_speed), MAX(precipitation)
+        FROM measurements
+        WHERE mac_address = ? AND server_timestamp < ?
+        GROUP BY minute ORDER BY minute
+    ''', (mac, end.strftime('%Y-%m-%d %H:%M:%S'))).fetchall()
+    return [tuple(row) for row in rows]
+
+
+def same_rows(a, b):
+    return len(a) == len(b) and all(len(x) == len(y) and all(rollups._same(p, q) for p, q in zip(x, y)) for x, y in zip(a, b))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=8)
+    parser.add_argument('--raw-days', type=int, default=3)
+    parser.add_argument('--minute-days', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'measurements.db')
+        db.configure(path)
+        app.init_db()
+        register_write_hook(rollups.rows_written)
+
+        hours = args.days * 24
+        for seed, mac in enumerate(STATIONS):
+            rows = make_rows(mac, START, hours, seed)
+            for i in range(0, len(rows), 5000):
+                with db.writer() as conn:
+                    insert_rows(conn, rows[i:i + 5000])
+        end = START + timedelta(hours=hours)
+        now = end + timedelta(minutes=30)
+        raw_cutoff = (now - timedelta(days=args.raw_days)).replace(minute=0, second=0)
+        minute_cutoff = (now - timedelta(days=args.minute_days)).replace(minute=0, second=0)
+        print(f"{hours * 720 * len(STATIONS)} raw readings, {len(STATIONS)} stations, raw cutoff {raw_cutoff}, 1-min cutoff {minute_cutoff}")
+
+        # Odpowiedzi przed kompakcją
+        mac = STATIONS[0]
+        sample = [raw_cutoff + timedelta(hours=h) for h in (-30, -1, 0, 1, 20, 47)]
+        with db.reader() as conn:
+            expected_minutes = minute_averages(conn, mac, raw_cutoff)
+            expected_minutes = [row for row in expected_minutes if row[0] >= minute_cutoff.strftime('%Y-%m-%d %H:%M:%S')]
+            expected_dashboard = {r: rollups.query_aggregated_raw(conn, mac, START, end, r) for r in rollups.ROLLUPS}
+        expected_features = {hour: path_features(mac, hour) for hour in sample}
+        size_before = os.path.getsize(path)
+
+        store = FeatureStore()
+        job = retention.RetentionJob(timedelta(days=args.raw_days), timedelta(days=args.minute_days),
+                                     batch_pause=0, before_compact=store.ensure_aggregates)
+        start = time.perf_counter()
+        report = job.run_once(now)
+        print(f"run: {report['raw_rows_compacted']} raw rows compacted, {report['minute_rows_deleted']} 1-min rows deleted, "
+              f"{report['bytes_reclaimed'] / 2**20:.1f} MiB reusable in {time.perf_counter() - start:.1f}s")
+
+        ok = True
+        with db.reader() as conn:
+            left = conn.execute('SELECT COUNT(*), MIN(server_timestamp) FROM measurements WHERE mac_address = ?', (mac,)).fetchone()
+            ok &= left[1] >= raw_cutoff.strftime('%Y-%m-%d %H:%M:%S')
+            print(f"raw rows left for {mac}: {left[0]} (oldest {left[1]})")
+
+            series = retention.read_series(conn, mac, minute_cutoff, raw_cutoff)
+            minutes_ok = same_rows([tuple(row) for row in series], expected_minutes)
+            ok &= minutes_ok
+            print(f"1-min tier equals per-minute aggregates of the raw rows: {minutes_ok} ({len(series)} minutes)")
+
+            raw_since = retention.compacted_before(conn, mac, 'raw')
+            dashboard_ok = all(same_rows(
+                [tuple(row.values()) for row in rollups.query_aggregated(conn, mac, START, end, r, raw_since=raw_since)],
+                [tuple(row.values()) for row in expected_dashboard[r]]) for r in rollups.ROLLUPS)
+            ok &= dashboard_ok
+            print(f"dashboard rollups unchanged: {dashboard_ok}")
+        check_ok = not any(rollups.check(days=args.days).values())
+        ok &= check_ok
+        print(f"rollups.check after compaction: {check_ok}")
+
+        features_ok = all(all(bit_equal(expected_features[h][f], path_features(mac, h)[f]) for f in ai_main.MODEL_FEATURES)
+                          for h in sample)
+        with contextlib.redirect_stdout(io.StringIO()):
+            store.rebuild(mac, START, end)
+        stored = {hour: ai_main.fetch_stored_features(mac, hour) for hour in sample}
+        store_ok = all(stored[h] is not None and all(bit_equal(expected_features[h][f], stored[h][f]) for f in ai_main.MODEL_FEATURES)
+                       for h in sample)
+        ok &= features_ok and store_ok
+        print(f"features over the watermark identical: prediction path {features_ok}, feature store {store_ok}")
+
+        # Spóźnione odczyty sprzed znacznika trafiają do tabeli 1-min przy kolejnym przebiegu
+        late_minute = raw_cutoff - timedelta(hours=5)
+        with db.writer() as conn:
+            insert_rows(conn, [(mac, (late_minute + timedelta(seconds=s)).strftime('%Y-%m-%d %H:%M:%S'), 30.0, 1000.0, 0.5, 0, 0.0, 0.0)
+                               for s in (1, 3)])
+        job.run_once(now)
+        with db.reader() as conn:
+            readings = conn.execute(f'SELECT readings FROM {retention.MINUTE_TABLE} WHERE mac_address = ? AND minute = ?',
+                                    (mac, late_minute.strftime('%Y-%m-%d %H:%M'))).fetchone()[0]
+        late_ok = readings == 12 + 2
+        ok &= late_ok
+        print(f"late readings folded into the 1-min tier: {late_ok}")
+
+        with db.writer() as conn:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        with db.reader() as conn:
+            free = retention._free_bytes(conn)
+        print(f"database file {size_before / 2**20:.1f} MiB -> {os.path.getsize(path) / 2**20:.1f} MiB, "
+              f"{free / 2**20:.1f} MiB free pages reused by new rows")
+
+        db.database.close()
+        if not ok:
+            raise SystemExit("Retention changed the data seen by the readers")
+
+
+if __name__ == '__main__':
+    main()
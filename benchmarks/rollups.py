@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Validation and benchmark of the dashboard rollups (rollups.py).
+
+Fills a temporary database through ingest.insert_rows in ingest-sized batches (so the
+rollups are maintained by the write hook, not rebuilt), with some NULL fields, then:
+  * runs rollups.check (rollup-based vs raw aggregation of the last 3 days, both resolutions),
+  * compares both on random [start, end] ranges with arbitrary second boundaries,
+  * checks that `rebuild` reproduces the incrementally maintained tables,
+  * times the dashboard aggregation from the raw table and from the rollups.
+
+Usage (from the repository root):
+    python -m benchmarks.rollups --stations 5 --days 4
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import app
+import db
+import rollups
+from ingest import insert_rows, register_write_hook
+
+START = datetime(2025, 3, 1)
+
+
+def make_rows(mac, start, days, rnd):
+    rows = []
+    for i in range(days * 17280):
+        ts = (start + timedelta(seconds=5 * i)).strftime('%Y-%m-%d %H:%M:%S')
+        rows.append((
+            mac, ts, rnd.uniform(-5, 25), rnd.uniform(990, 1030), rnd.random(),
+            None if rnd.random() < 0.01 else rnd.randint(0, 1023),
+            None if rnd.random() < 0.01 else rnd.uniform(0, 30),
+            rnd.random() if rnd.random() < 0.1 else 0.0,
+        ))
+    return rows
+
+
+def timed(func, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stations', type=int, default=5)
+    parser.add_argument('--days', type=int, default=4)
+    parser.add_argument('--ranges', type=int, default=200)
+    args = parser.parse_args()
+    rnd = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.configure(os.path.join(tmp, 'measurements.db'))
+        app.init_db()
+        register_write_hook(rollups.rows_written)
+
+        stations = [f'AA:BB:CC:00:00:{i:02d}' for i in range(args.stations)]
+        rows = [row for mac in stations for row in make_rows(mac, START, args.days, rnd)]
+        rows.sort(key=lambda row: row[1])  # przeplatane stacje, jak przy prawdziwym ingeście
+        start = time.perf_counter()
+        for i in range(0, len(rows), 500):
+            with db.writer() as conn:
+                insert_rows(conn, rows[i:i + 500])
+        print(f"{len(rows)} readings ingested with rollup hook in {time.perf_counter() - start:.1f}s")
+
+        mismatches = rollups.check(days=3)
+        ok = not any(mismatches.values())
+        print(f"check (last 3 days): " + ', '.join(f"{r}: {len(m)} mismatched" for r, m in mismatches.items()))
+
+        bad_ranges = 0
+        with db.reader() as conn:
+            for _ in range(args.ranges):
+                mac = rnd.choice(stations)
+                range_start = START + timedelta(seconds=rnd.randrange(0, args.days * 86400))
+                range_end = range_start + timedelta(seconds=rnd.randrange(0, 86400))
+                resolution = rnd.choice(list(rollups.ROLLUPS))
+                a = rollups.query_aggregated(conn, mac, range_start, range_end, resolution)
+                b = rollups.query_aggregated_raw(conn, mac, range_start, range_end, resolution)
+                if len(a) != len(b) or not all(
+                        x['time_window'] == y['time_window'] and all(rollups._same(x[k], y[k]) for k in x)
+                        for x, y in zip(a, b)):
+                    bad_ranges += 1
+        ok &= bad_ranges == 0
+        print(f"random ranges: {bad_ranges}/{args.ranges} differ")
+
+        with db.reader() as conn:
+            before = {table: conn.execute(f'SELECT * FROM {table} ORDER BY mac_address, bucket').fetchall()
+                      for table, _, _ in rollups.ROLLUPS.values()}
+        rollups.rebuild()
+        with db.reader() as conn:
+            after = {table: conn.execute(f'SELECT * FROM {table} ORDER BY mac_address, bucket').fetchall()
+                     for table, _, _ in rollups.ROLLUPS.values()}
+        same_rebuild = all(
+            len(before[t]) == len(after[t]) and all(all(rollups._same(x, y) for x, y in zip(r1, r2)) for r1, r2 in zip(before[t], after[t]))
+            for t in before)
+        ok &= same_rebuild
+        print(f"rebuild matches incremental rollups: {same_rebuild}")
+
+        mac = stations[0]
+        with db.reader() as conn:
+            latest = datetime.strptime(conn.execute('SELECT MAX(server_timestamp) FROM measurements WHERE mac_address = ?', (mac,)).fetchone()[0], '%Y-%m-%d %H:%M:%S')
+            range_start = latest - timedelta(days=3)
+            _, t_raw = timed(lambda: rollups.query_aggregated_raw(conn, mac, range_start, latest))
+            _, t_rollup = timed(lambda: rollups.query_aggregated(conn, mac, range_start, latest))
+        print(f"dashboard 3 days: raw {t_raw * 1000:.1f} ms   rollup {t_rollup * 1000:.2f} ms   speedup {t_raw / t_rollup:.0f}x")
+
+        db.database.close()
+        if not ok:
+            raise SystemExit("Rollups differ from the raw aggregation")
+
+
+if __name__ == '__main__':
+    main()
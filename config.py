@@ -2,4 +2,11 @@ class Config:
     SECRET_KEY = 'sekrecik'
     DEBUG = True
 
+    # Logowanie (logs.py): poziom główny i poziomy modułów; 'ai_main' na WARNING wycisza kroki potoku AI
+    LOG_LEVEL = 'INFO'
+    LOG_LEVELS = {'ai_main': 'WARNING', 'werkzeug': 'WARNING'}
+    LOG_READING_SAMPLE = 120   # co który odczyt stacji trafia do logu (odczyt co 5 s -> raz na 10 min)
+    LOG_QUEUE = True           # zapis logów w osobnym wątku (QueueHandler)
+    LOG_JSON = False           # jeden obiekt JSON na linię zamiast tekstu
+
 mqtt_broker = "192.168.1.15"
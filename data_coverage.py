@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Per-station daily data coverage: which hours of a day have readings.
+
+One daily_coverage row per (mac_address, day) holds the 24-bit mask of hours with readings,
+their count, the number of readings and the first/last reading timestamp. The rows are kept
+by an ingest write hook in the insert transaction and are not touched by the retention job,
+so the list of available days and the availability check of the AI panel read a few rows by
+primary key instead of formatting every raw reading of the station. `added_at` (unix time)
+records when a day first appeared and drives the ETag/Last-Modified of the dates list.
+
+HourBitmap keeps the same hour masks in memory as one bytearray per station (3 bytes per
+day, bit = hour since the station's first day), loaded from daily_coverage on first use and
+updated by its own write hook, so "is hour H present" and "how many of the 48 hours before H
+are present" read a few bytes, independent of the length of the station's history.
+"""
+import calendar
+import hashlib
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import db
+
+HISTORY_HOURS = 48
+MIN_HISTORY_HOURS = 39   # ~80% okresu 48h wymagane do predykcji
+
+SCHEMA_STATEMENTS = [
+    '''CREATE TABLE IF NOT EXISTS daily_coverage (
+        mac_address TEXT NOT NULL,
+        day TEXT NOT NULL,
+        hour_mask INTEGER NOT NULL,
+        hours INTEGER NOT NULL,
+        readings INTEGER NOT NULL,
+        first_timestamp TEXT NOT NULL,
+        last_timestamp TEXT NOT NULL,
+        added_at REAL NOT NULL,
+        PRIMARY KEY (mac_address, day)
+    ) WITHOUT ROWID''',
+    # Wypełnienie z rollupu godzinowego (obejmuje też godziny usuniętych przez retencję odczytów);
+    # pierwszy/ostatni odczyt dokładnie z tabeli measurements, tam gdzie surowe wiersze jeszcze są
+    '''INSERT OR REPLACE INTO daily_coverage
+        SELECT mac_address, substr(bucket, 1, 10) AS day,
+               SUM(1 << CAST(substr(bucket, 12, 2) AS INTEGER)), COUNT(*), SUM(readings),
+               MIN(bucket) || ':00', MAX(bucket) || ':00', CAST(strftime('%s', 'now') AS REAL)
+        FROM measurement_rollups_1h
+        GROUP BY mac_address, day''',
+    '''UPDATE daily_coverage SET
+        first_timestamp = COALESCE((SELECT MIN(server_timestamp) FROM measurements m
+                                    WHERE m.mac_address = daily_coverage.mac_address
+                                      AND m.server_timestamp >= daily_coverage.day || ' 00:00:00'
+                                      AND m.server_timestamp <= daily_coverage.day || ' 23:59:59'), first_timestamp),
+        last_timestamp = COALESCE((SELECT MAX(server_timestamp) FROM measurements m
+                                   WHERE m.mac_address = daily_coverage.mac_address
+                                     AND m.server_timestamp >= daily_coverage.day || ' 00:00:00'
+                                     AND m.server_timestamp <= daily_coverage.day || ' 23:59:59'), last_timestamp)''',
+]
+
+
+def rows_written(conn, rows, first_id, last_id):
+    """Ingest write hook: merges the hours, counts and first/last timestamps of the new readings."""
+    days = {}
+    for row in rows:
+        mac_address, timestamp = row[0], row[1]
+        key = (mac_address, timestamp[:10])
+        mask, readings, first, last = days.get(key, (0, 0, timestamp, timestamp))
+        days[key] = (mask | 1 << int(timestamp[11:13]), readings + 1, min(first, timestamp), max(last, timestamp))
+
+    now = time.time()
+    merged = []
+    for (mac_address, day), (mask, readings, first, last) in days.items():
+        row = conn.execute(
+            'SELECT hour_mask, readings, first_timestamp, last_timestamp, added_at FROM daily_coverage WHERE mac_address = ? AND day = ?',
+            (mac_address, day)
+        ).fetchone()
+        added_at = now
+        if row is not None:
+            mask |= row[0]
+            readings += row[1]
+            first, last, added_at = min(first, row[2]), max(last, row[3]), row[4]
+        merged.append((mac_address, day, mask, mask.bit_count(), readings, first, last, added_at))
+    conn.executemany('INSERT OR REPLACE INTO daily_coverage VALUES (?, ?, ?, ?, ?, ?, ?, ?)', merged)
+
+
+def available_dates(conn, mac_address):
+    """Days with readings, newest first."""
+    return [row[0] for row in conn.execute(
+        'SELECT day FROM daily_coverage WHERE mac_address = ? ORDER BY day DESC', (mac_address,))]
+
+
+def dates_version(conn, mac_address):
+    """
+    (etag, last_modified) of the dates list: changes only when a day is added, not with
+    every reading. last_modified is a unix time, None for a station without data.
+    """
+    count, newest_day, added_at = conn.execute(
+        'SELECT COUNT(*), MAX(day), MAX(added_at) FROM daily_coverage WHERE mac_address = ?', (mac_address,)
+    ).fetchone()
+    etag = hashlib.sha1(f'{mac_address}|{count}|{newest_day}|{added_at}'.encode()).hexdigest()[:20]
+    return etag, added_at
+
+
+def hour_masks(conn, mac_address, first_day, last_day):
+    """{day: hour_mask} of the days first_day..last_day ('YYYY-MM-DD') that have readings."""
+    return dict(conn.execute(
+        'SELECT day, hour_mask FROM daily_coverage WHERE mac_address = ? AND day BETWEEN ? AND ?',
+        (mac_address, first_day, last_day)
+    ).fetchall())
+
+
+def mask_availability(masks, hour, hours=HISTORY_HOURS):
+    """
+    (target hour present, hours present among the `hours` before it) from {day: hour_mask}
+    already read with hour_masks (any range of days that covers the window).
+    """
+    hour = hour.replace(minute=0, second=0, microsecond=0)
+    first_hour = hour - timedelta(hours=hours)
+    bits = 0
+    for offset in range((hour.date() - first_hour.date()).days + 1):
+        bits |= masks.get((first_hour.date() + timedelta(days=offset)).isoformat(), 0) << offset * 24
+    bits >>= first_hour.hour
+    return bool(bits >> hours & 1), (bits & ((1 << hours) - 1)).bit_count()
+
+
+def window_availability(conn, mac_address, hour, hours=HISTORY_HOURS):
+    """
+    (target hour present, hours present among the `hours` before it) read from daily_coverage,
+    for processes without the HourBitmap of the web server (AI worker processes).
+    """
+    first_hour = hour - timedelta(hours=hours)
+    masks = hour_masks(conn, mac_address, first_hour.strftime('%Y-%m-%d'), hour.strftime('%Y-%m-%d'))
+    return mask_availability(masks, hour, hours)
+
+
+class HourBitmap:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stations = {}   # mac_address -> [pierwszy dzień (date), bytearray masek 24-bitowych]
+        self._loaded = set()
+
+    def _set_day(self, mac_address, day, mask):
+        """ORs a 24-bit hour mask into the station's bitmap (caller holds the lock)."""
+        entry = self._stations.get(mac_address)
+        if entry is None:
+            entry = self._stations[mac_address] = [day, bytearray()]
+        if day < entry[0]:
+            entry[1][:0] = bytes(3 * (entry[0] - day).days)
+            entry[0] = day
+        offset = 3 * (day - entry[0]).days
+        if offset + 3 > len(entry[1]):
+            entry[1].extend(bytes(offset + 3 - len(entry[1])))
+        for i, byte in enumerate(mask.to_bytes(3, 'little')):
+            entry[1][offset + i] |= byte
+
+    def _station(self, mac_address):
+        """(first day, bitmap) of the station, loaded from daily_coverage on first use."""
+        with self._lock:
+            if mac_address in self._loaded:
+                return self._stations.get(mac_address)
+        with db.reader() as conn:
+            masks = hour_masks(conn, mac_address, '0000-00-00', '9999-99-99')
+        with self._lock:
+            # OR: bity dopisane przez hook w trakcie wczytywania zostają
+            for day, mask in masks.items():
+                self._set_day(mac_address, date.fromisoformat(day), mask)
+            self._loaded.add(mac_address)
+            return self._stations.get(mac_address)
+
+    def rows_written(self, conn, rows, first_id, last_id):
+        """Ingest write hook: sets the hours of the new readings."""
+        days = {}
+        for row in rows:
+            key = (row[0], row[1][:10])
+            days[key] = days.get(key, 0) | 1 << int(row[1][11:13])
+        with self._lock:
+            for (mac_address, day), mask in days.items():
+                self._set_day(mac_address, date.fromisoformat(day), mask)
+
+    def forget(self, mac_address):
+        """Drops the station's bitmap (board deleted); the next use reloads it from daily_coverage."""
+        with self._lock:
+            self._stations.pop(mac_address, None)
+            self._loaded.discard(mac_address)
+
+    def _bits(self, mac_address, first_hour, count):
+        """`count` (<= 64) hour bits starting at first_hour as an int, bit 0 = first_hour."""
+        entry = self._station(mac_address)
+        if entry is None:
+            return 0
+        first_day, bitmap = entry
+        index = (first_hour.date() - first_day).days * 24 + first_hour.hour
+        lo, hi = max(index, 0), min(index + count, len(bitmap) * 8)
+        if lo >= hi:
+            return 0
+        value = int.from_bytes(bitmap[lo // 8:(hi - 1) // 8 + 1], 'little') >> lo % 8
+        return (value & ((1 << (hi - lo)) - 1)) << (lo - index)
+
+    def has_hour(self, mac_address, hour):
+        return self._bits(mac_address, hour, 1) == 1
+
+    def hours_before(self, mac_address, hour, hours=HISTORY_HOURS):
+        """Number of hours with readings among the `hours` hours before `hour`."""
+        return self._bits(mac_address, hour - timedelta(hours=hours), hours).bit_count()
+
+    def availability(self, mac_address, hour):
+        """(target hour present, hours present in the 48 hours before it)."""
+        hour = hour.replace(minute=0, second=0, microsecond=0)
+        return self.has_hour(mac_address, hour), self.hours_before(mac_address, hour)
+
+    def month(self, mac_address, year, month):
+        """
+        {day: {'hours': [...], 'available': [...]}} of the days of a month with readings:
+        hours present and hours a prediction can be run for (present, MIN_HISTORY_HOURS of 48).
+        """
+        days = {}
+        for day_number in range(1, calendar.monthrange(year, month)[1] + 1):
+            day = datetime(year, month, day_number)
+            mask = self._bits(mac_address, day, 24)
+            if not mask:
+                continue
+            hours = [h for h in range(24) if mask >> h & 1]
+            days[day.strftime('%Y-%m-%d')] = {
+                'hours': hours,
+                'available': [h for h in hours
+                              if self.hours_before(mac_address, day + timedelta(hours=h)) >= MIN_HISTORY_HOURS],
+            }
+        return days
+
+    def stats(self):
+        with self._lock:
+            return {
+                'stations': len(self._stations),
+                'stations_loaded': len(self._loaded),
+                'bytes': sum(len(entry[1]) for entry in self._stations.values()),
+            }
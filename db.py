@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Central SQLite access layer shared by app.py, the blueprints, the ingest writer and ai_main.
+
+The database runs in WAL mode, so readers never block the writer and the writer never
+blocks readers. Reads borrow a connection from a small pool of reusable reader
+connections; all writes in the process go through a single writer connection guarded
+by a lock, so in-process writers queue up instead of failing with 'database is locked'.
+
+    with db.reader() as conn:    # SELECT ...
+    with db.writer() as conn:    # INSERT/UPDATE/DELETE, committed on exit
+        db.after_commit(callback)  # e.g. notify in-memory listeners once the rows are visible
+
+Inside a Flask request `get_db()` returns a reader bound to the request (`g`).
+
+A thread must not borrow a second reader while it still holds one (nested reader() inside
+reader()/get_db()): with the pool exhausted every holder would wait for the others. A borrower
+waits at most READER_WAIT_S for a free connection and then gets PoolExhausted (503 in Flask).
+"""
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from flask import g, jsonify
+
+log = logging.getLogger(__name__)
+
+DB_PATH = 'measurements.db'
+
+BUSY_TIMEOUT_MS = 30000
+CACHE_SIZE_KIB = 65536             # 64 MiB page cache na połączenie
+MMAP_SIZE = 256 * 1024 * 1024      # 256 MiB mapowania pliku bazy
+MAX_READERS = 8
+READER_WAIT_S = 10                 # maksymalne czekanie na wolne połączenie z puli
+
+
+class PoolExhausted(RuntimeError):
+    """No reader connection became free within READER_WAIT_S."""
+
+
+def _connect(path, read_only):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KIB}')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    if read_only:
+        conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+class Database:
+    def __init__(self, path, max_readers=MAX_READERS):
+        self.path = path
+        self.max_readers = max_readers
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._after_commit = []
+
+    def _writer_connection(self):
+        if self._writer is None:
+            conn = _connect(self.path, read_only=False)
+            mode = conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+            if mode.lower() != 'wal':
+                log.warning("Database %s: could not enable WAL (journal_mode=%s)", self.path, mode)
+            self._writer = conn
+        return self._writer
+
+    def acquire_reader(self):
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._reader_lock:
+            if self._reader_count < self.max_readers:
+                self._reader_count += 1
+                create = True
+            else:
+                create = False
+        if create:
+            # Pierwsze połączenie w procesie włącza WAL, zanim zaczniemy czytać
+            with self._writer_lock:
+                self._writer_connection()
+            return _connect(self.path, read_only=True)
+        try:
+            return self._readers.get(timeout=READER_WAIT_S)
+        except queue.Empty:
+            raise PoolExhausted(f"no free reader connection to {self.path} "
+                                f"after {READER_WAIT_S} s ({self.max_readers} in use)") from None
+
+    def release_reader(self, conn):
+        conn.row_factory = None
+        if conn.in_transaction:
+            conn.rollback()
+        self._readers.put(conn)
+
+    @contextmanager
+    def reader(self):
+        """Borrows a read-only connection from the pool."""
+        conn = self.acquire_reader()
+        try:
+            yield conn
+        finally:
+            self.release_reader(conn)
+
+    @contextmanager
+    def writer(self):
+        """Exclusive access to the writer connection; commits on success, rolls back on error."""
+        with self._writer_lock:
+            conn = self._writer_connection()
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                self._after_commit.clear()
+                conn.rollback()
+                raise
+            callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                log.exception("Database %s: after-commit callback failed", self.path)
+
+    def after_commit(self, callback):
+        """Runs callback() once the current writer transaction commits (dropped on rollback); call inside writer()."""
+        with self._writer_lock:
+            self._after_commit.append(callback)
+
+    def close(self):
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._reader_lock:
+            self._reader_count = 0
+
+
+database = Database(DB_PATH)
+
+
+def configure(path, max_readers=MAX_READERS):
+    """Points the shared database at another file (closes the current connections)."""
+    global database, DB_PATH
+    database.close()
+    DB_PATH = path
+    database = Database(path, max_readers)
+
+
+def reader():
+    return database.reader()
+
+
+def writer():
+    return database.writer()
+
+
+def after_commit(callback):
+    return database.after_commit(callback)
+
+
+def get_db():
+    """Reader connection (rows as sqlite3.Row) for the current Flask request."""
+    conn = getattr(g, '_db_reader', None)
+    if conn is None:
+        conn = g._db_reader = database.acquire_reader()
+        conn.row_factory = sqlite3.Row
+    return conn
+
+
+def close_db(error=None):
+    conn = g.pop('_db_reader', None)
+    if conn is not None:
+        database.release_reader(conn)
+
+
+def _pool_exhausted(error):
+    log.warning("Request refused: %s", error)
+    return jsonify({'error': 'Serwer jest przeciążony, spróbuj ponownie za chwilę.'}), 503, {'Retry-After': str(READER_WAIT_S)}
+
+
+def init_app(app):
+    """Returns the request's reader connection to the pool when the app context ends."""
+    app.teardown_appcontext(close_db)
+    app.register_error_handler(PoolExhausted, _pool_exhausted)
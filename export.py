@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of a station's time series (CSV, optionally gzipped, or Parquet).
+
+The rows come from retention.iter_series_pages in chunks of EXPORT_CHUNK_ROWS, each chunk is
+encoded and handed to the response before the next one is fetched, so the memory used by
+an export does not grow with the station's history. CSV keeps the format of the old
+pandas export (UTF-8 BOM for Excel, Polish headers); Parquet (pyarrow, optional) is written
+with one row group per chunk.
+"""
+import csv
+import io
+import zlib
+from contextlib import nullcontext
+
+import db
+import retention
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Eksport Parquet niedostępny, CSV działa bez pyarrow
+    pa = pq = None
+
+EXPORT_CHUNK_ROWS = 10000
+
+CSV_HEADER = [
+    'Timestamp', 'Temperatura (°C)', 'Ciśnienie (hPa)', 'Wilgotność (%)',
+    'Wykryto Światło (Surowa Wartość)', 'Prędkość Wiatru (m/s)', 'Opady (%)'
+]
+# Kolumny Parquet (nazwy jak w tabeli measurements)
+PARQUET_COLUMNS = ['timestamp', 'temperature', 'pressure', 'humidity', 'sunshine', 'wind_speed', 'precipitation']
+
+
+def parquet_available():
+    return pq is not None
+
+
+def iter_chunks(mac_address, start=None, end=None, chunk_size=EXPORT_CHUNK_ROWS, conn=None):
+    """
+    Chunks of retention.iter_series_pages. Every chunk borrows a pooled reader only for its own
+    query (the first one runs on `conn`, the request's connection, when given), so a slow client
+    does not hold a connection for the whole download and the request never waits for a
+    second reader while it holds one.
+    """
+    first = [conn] if conn is not None else []
+
+    def borrow():
+        return nullcontext(first.pop()) if first else db.reader()
+
+    return retention.iter_series_pages(borrow, mac_address, start, end, chunk_size)
+
+
+def iter_csv(chunks):
+    """CSV bytes: BOM and header, then one encoded piece per chunk of rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    buffer.write('\ufeff')  # BOM - lepsza kompatybilność z Excel
+    writer.writerow(CSV_HEADER)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')  # Sam nagłówek (pusty zakres)
+
+
+def iter_gzip(pieces, level=6):
+    """Compresses a byte stream into one gzip member, piece by piece."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for piece in pieces:
+        data = compressor.compress(piece)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class _StreamSink:
+    """Write-only file object for ParquetWriter; the written bytes are taken out with drain()."""
+
+    def __init__(self):
+        self._pieces = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._pieces.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def writable(self):
+        return True
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._pieces)
+        self._pieces = []
+        return data
+
+
+def iter_parquet(chunks):
+    """Parquet bytes: one row group per chunk, the footer after the last one. Needs pyarrow."""
+    schema = pa.schema([('timestamp', pa.string())] + [(name, pa.float64()) for name in PARQUET_COLUMNS[1:]])
+    sink = _StreamSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for rows in chunks:
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
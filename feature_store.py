@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental hourly feature store for the AI predictions.
+
+run_prediction used to rebuild the hourly aggregates and all rolling features of the
+48-hour window from ~35k raw 5-second rows for every single prediction. Here every
+closed hour of a station is aggregated once (hourly_aggregates) and its model input
+row (MODEL_FEATURES) is computed once from the 48 previous hourly aggregates and stored
+in hourly_features, keyed by (mac_address, hour). A prediction for a stored hour is then
+one row lookup plus model scoring (ai_main.fetch_stored_features).
+
+The features are computed by the same ai_main code on the same 48-hour window that
+run_prediction uses (snow cover simulated from the window start, ffill/bfill imputation
+within the window), so a stored row is identical to the one run_prediction would build.
+
+An hour closes CLOSE_DELAY after its end (server time). The ingest write hook records
+the hours that received readings; readings arriving for an already closed hour (bulk
+uploads from offline boards) invalidate that hour and the 48 following feature rows in
+the same transaction, and the worker recomputes them.
+
+Rebuild for historical data:
+    python -m feature_store --since 2024-01-01 [--mac AA:BB:...] [--db measurements.db]
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import ai_main
+import db
+import retention
+from ingest import server_now
+
+log = logging.getLogger(__name__)
+
+# Okno danych jednej predykcji - jak db_data_fetch_buffer_hours w run_prediction
+WINDOW_HOURS = 48
+# Godzina jest zamknięta tyle czasu po swoim końcu (bufor ingestu, rozjazd zegarów)
+CLOSE_DELAY = timedelta(seconds=90)
+# Po starcie serwera nadrabiamy godziny bez agregatu z tylu ostatnich godzin
+CATCHUP_HOURS = 72
+# Przebudowa historii idzie paczkami po tyle godzin na stację
+REBUILD_CHUNK_HOURS = 24 * 7
+
+HOUR_FORMAT = '%Y-%m-%d %H:00:00'
+
+UPSERT_AGGREGATE_SQL = f'''
+    INSERT OR REPLACE INTO hourly_aggregates (mac_address, hour, {', '.join(ai_main.HOURLY_AGGREGATE_COLS)}, readings)
+    VALUES (?, ?, {', '.join('?' * len(ai_main.HOURLY_AGGREGATE_COLS))}, ?)
+'''
+UPSERT_FEATURES_SQL = '''
+    INSERT OR REPLACE INTO hourly_features (mac_address, hour, features, computed_at) VALUES (?, ?, ?, ?)
+'''
+
+
+def _hour_str(hour):
+    return hour.strftime(HOUR_FORMAT)
+
+
+def _split_runs(hours):
+    """Splits sorted hours into runs of consecutive hours: [(first, last), ...]."""
+    runs = []
+    for hour in hours:
+        if runs and hour - runs[-1][1] <= timedelta(hours=1):
+            runs[-1][1] = hour
+        else:
+            runs.append([hour, hour])
+    return runs
+
+
+def fetch_hour_range(conn, mac_address, first_hour, last_hour):
+    """Raw measurements of one station from first_hour:00:00 to last_hour:59:59."""
+    df_raw = pd.read_sql_query('''
+        SELECT server_timestamp, temperature, pressure, humidity, sunshine, wind_speed, precipitation
+        FROM measurements
+        WHERE mac_address = ? AND server_timestamp BETWEEN ? AND ?
+        ORDER BY server_timestamp ASC
+    ''', conn, params=(mac_address, _hour_str(first_hour), last_hour.strftime('%Y-%m-%d %H:59:59')))
+    df_raw['server_timestamp'] = pd.to_datetime(df_raw['server_timestamp'])
+    return df_raw.set_index('server_timestamp')
+
+
+def load_aggregates(conn, mac_address, first_hour, last_hour):
+    """Stored hourly aggregates of one station, indexed by hour."""
+    df = pd.read_sql_query(f'''
+        SELECT hour, {', '.join(ai_main.HOURLY_AGGREGATE_COLS)}
+        FROM hourly_aggregates
+        WHERE mac_address = ? AND hour BETWEEN ? AND ?
+        ORDER BY hour ASC
+    ''', conn, params=(mac_address, _hour_str(first_hour), _hour_str(last_hour)))
+    df['hour'] = pd.to_datetime(df['hour'])
+    return df.set_index('hour')
+
+
+def window_frame(aggregates, hour):
+    """
+    Input of engineer_features for a prediction of `hour`: the stored aggregates of
+    [hour - WINDOW_HOURS, hour] reindexed to a continuous hourly range starting at the
+    first hour with data, exactly like resample('H') over the raw window in run_prediction
+    (hours without readings: NaN means, zero sums).
+    """
+    return ai_main.hourly_window_frame(aggregates, hour, WINDOW_HOURS)
+
+
+def compute_feature_row(aggregates, hour):
+    """MODEL_FEATURES of `hour` as a dict, or None when feature engineering drops the hour."""
+    df_features, _ = ai_main.engineer_features(window_frame(aggregates, hour), required_features=ai_main.MODEL_FEATURES)
+    if hour not in df_features.index:
+        return None
+    row = df_features.loc[hour, ai_main.MODEL_FEATURES]
+    return {name: value.item() if hasattr(value, 'item') else value for name, value in row.items()}
+
+
+class FeatureStore:
+    def __init__(self, interval=30.0, close_delay=CLOSE_DELAY, catchup_hours=CATCHUP_HOURS):
+        self.interval = interval
+        self.close_delay = close_delay
+        self.catchup_hours = catchup_hours
+        self._pending = {}             # mac_address -> set godzin z nowymi pomiarami
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._hours_aggregated = 0
+        self._feature_rows_written = 0
+        self._invalidated = 0
+        self._refreshes = 0
+        self._last_refresh_ms = None
+        self._last_error = None
+
+    def closed_before(self, now=None):
+        """Hours strictly before the returned hour are closed."""
+        limit = (now or server_now()) - self.close_delay
+        return limit.replace(minute=0, second=0, microsecond=0)
+
+    def start(self):
+        """Starts the background worker (idempotent)."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='feature-store', daemon=True)
+        self._thread.start()
+        log.info("Feature store started (interval=%ss, close_delay=%s)", self.interval, self.close_delay)
+
+    def stop(self, timeout=10.0):
+        thread = self._thread
+        if thread is None:
+            return
+        self._stop.set()
+        thread.join(timeout)
+        self._thread = None
+
+    def rows_written(self, conn, rows, first_id, last_id):
+        """
+        Ingest write hook (runs inside the insert transaction). Records the hours that got
+        new readings and drops the stored feature rows that late readings made stale.
+        """
+        hours = {(row[0], row[1][:13]) for row in rows}
+        limit = self.closed_before()
+        late = []
+        with self._lock:
+            for mac_address, hour_prefix in hours:
+                hour = datetime.strptime(hour_prefix, '%Y-%m-%d %H')
+                self._pending.setdefault(mac_address, set()).add(hour)
+                if hour < limit:
+                    late.append((mac_address, hour))
+        for mac_address, hour in late:
+            cur = conn.execute(
+                'DELETE FROM hourly_features WHERE mac_address = ? AND hour BETWEEN ? AND ?',
+                (mac_address, _hour_str(hour), _hour_str(hour + timedelta(hours=WINDOW_HOURS)))
+            )
+            self._invalidated += cur.rowcount
+
+    def refresh(self, now=None):
+        """Aggregates every pending closed hour and recomputes the affected feature rows."""
+        start = time.perf_counter()
+        limit = self.closed_before(now)
+        with self._lock:
+            due = {}
+            for mac_address, hours in self._pending.items():
+                closed = {hour for hour in hours if hour < limit}
+                if closed:
+                    due[mac_address] = closed
+                    hours -= closed
+            self._pending = {mac_address: hours for mac_address, hours in self._pending.items() if hours}
+
+        for mac_address, hours in due.items():
+            try:
+                self.update_station(mac_address, sorted(hours), limit)
+            except Exception as e:  # m.in. ai_pipeline.FeatureEngineeringError przy braku danych
+                self._last_error = str(e)
+                log.error("Feature store: update of %s failed, will retry: %r", mac_address, e)
+                with self._lock:
+                    self._pending.setdefault(mac_address, set()).update(hours)
+        self._refreshes += 1
+        self._last_refresh_ms = round((time.perf_counter() - start) * 1000, 3)
+
+    def _aggregate(self, conn, mac_address, hours):
+        """Hourly aggregates (plus 'readings') of the given hours from the raw measurements."""
+        fresh = []
+        for first_hour, last_hour in _split_runs(hours):
+            df_raw = fetch_hour_range(conn, mac_address, first_hour, last_hour)
+            if not df_raw.empty:
+                df_hourly = ai_main.resample_raw_to_hourly(df_raw)
+                df_hourly['readings'] = df_raw['temperature'].resample('H').size()
+                fresh.append(df_hourly[df_hourly['readings'] > 0])
+        return pd.concat(fresh) if fresh else pd.DataFrame(columns=ai_main.HOURLY_AGGREGATE_COLS + ['readings'])
+
+    def _store_aggregates(self, conn, mac_address, fresh, hours):
+        conn.executemany(UPSERT_AGGREGATE_SQL, [
+            (mac_address, _hour_str(hour), *(None if pd.isna(v) else float(v) for v in row[ai_main.HOURLY_AGGREGATE_COLS]), int(row['readings']))
+            for hour, row in fresh.iterrows()
+        ])
+        empty_hours = [(mac_address, _hour_str(hour)) for hour in hours if hour not in fresh.index]
+        conn.executemany('DELETE FROM hourly_aggregates WHERE mac_address = ? AND hour = ?', empty_hours)
+        self._hours_aggregated += len(fresh)
+
+    def update_station(self, mac_address, hours, limit, include_following=True):
+        """
+        Re-aggregates the given closed hours of one station from the raw measurements and
+        recomputes their feature rows and (with include_following) the rows of the 48 hours
+        after them, whose windows contain the changed aggregates. Hours already compacted by
+        retention.py keep their stored aggregates.
+        Returns (aggregated hours, feature rows written).
+        """
+        window = timedelta(hours=WINDOW_HOURS)
+        with db.reader() as conn:
+            raw_since = retention.compacted_before(conn, mac_address, 'raw')
+            if raw_since is not None:
+                hours_to_aggregate = [hour for hour in hours if hour >= raw_since]
+            else:
+                hours_to_aggregate = list(hours)
+            fresh = self._aggregate(conn, mac_address, hours_to_aggregate)
+
+            # Godziny, których cechy zależą od zmienionych agregatów
+            targets = set(hours)
+            if include_following:
+                for hour in hours:
+                    targets.update(pd.date_range(hour, min(hour + window, limit - timedelta(hours=1)), freq='H'))
+            stored = load_aggregates(conn, mac_address, min(hours) - window, max(targets, default=max(hours)))
+
+        aggregates = pd.concat([
+            stored[~stored.index.isin(hours_to_aggregate)],
+            fresh[ai_main.HOURLY_AGGREGATE_COLS],
+        ]).sort_index()
+        targets = sorted(hour for hour in targets if hour in aggregates.index)
+
+        feature_rows = []
+        dropped = [hour for hour in hours if hour not in aggregates.index]
+        computed_at = server_now().strftime('%Y-%m-%d %H:%M:%S')
+        for hour in targets:
+            features = compute_feature_row(aggregates, hour)
+            if features is None:
+                dropped.append(hour)
+            else:
+                feature_rows.append((mac_address, _hour_str(hour), json.dumps(features), computed_at))
+
+        with db.writer() as conn:
+            self._store_aggregates(conn, mac_address, fresh, hours_to_aggregate)
+            conn.executemany('DELETE FROM hourly_features WHERE mac_address = ? AND hour = ?',
+                             [(mac_address, _hour_str(hour)) for hour in dropped])
+            conn.executemany(UPSERT_FEATURES_SQL, feature_rows)
+
+        self._feature_rows_written += len(feature_rows)
+        return len(fresh), len(feature_rows)
+
+    def ensure_aggregates(self, mac_address, first_hour, end_hour):
+        """
+        Retention hook: stores the missing hourly aggregates of [first_hour, end_hour) before
+        the raw rows are compacted, so predictions over that range can still be built.
+        """
+        with db.reader() as conn:
+            rows = conn.execute('''
+                SELECT DISTINCT substr(m.server_timestamp, 1, 13)
+                FROM measurements m
+                WHERE m.mac_address = ? AND m.server_timestamp >= ? AND m.server_timestamp < ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM hourly_aggregates a
+                      WHERE a.mac_address = m.mac_address AND a.hour = substr(m.server_timestamp, 1, 13) || ':00:00'
+                  )
+            ''', (mac_address, _hour_str(first_hour), _hour_str(end_hour))).fetchall()
+            hours = sorted(datetime.strptime(row[0], '%Y-%m-%d %H') for row in rows)
+            if not hours:
+                return 0
+            fresh = self._aggregate(conn, mac_address, hours)
+        with db.writer() as conn:
+            self._store_aggregates(conn, mac_address, fresh, hours)
+        return len(fresh)
+
+    def catch_up(self, now=None):
+        """Queues the recent hours with readings but without an aggregate (e.g. after a restart)."""
+        since = (now or server_now()) - timedelta(hours=self.catchup_hours)
+        with db.reader() as conn:
+            rows = conn.execute('''
+                SELECT DISTINCT m.mac_address, substr(m.server_timestamp, 1, 13)
+                FROM measurements m
+                WHERE m.server_timestamp >= ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM hourly_aggregates a
+                      WHERE a.mac_address = m.mac_address AND a.hour = substr(m.server_timestamp, 1, 13) || ':00:00'
+                  )
+            ''', (_hour_str(since),)).fetchall()
+        with self._lock:
+            for mac_address, hour_prefix in rows:
+                self._pending.setdefault(mac_address, set()).add(datetime.strptime(hour_prefix, '%Y-%m-%d %H'))
+        return len(rows)
+
+    def rebuild(self, mac_address=None, since=None, until=None):
+        """
+        Recomputes aggregates and feature rows of every closed hour with readings in [since, until).
+        Hours compacted by retention.py are recomputed from their stored aggregates.
+        """
+        limit = self.closed_before()
+        until = min(until, limit) if until is not None else limit
+        params = [_hour_str(since) if since is not None else '', _hour_str(until)]
+        station_filter = ''
+        if mac_address is not None:
+            station_filter = 'AND mac_address = ?'
+            params.append(mac_address)
+        with db.reader() as conn:
+            rows = conn.execute(f'''
+                SELECT mac_address, substr(server_timestamp, 1, 13)
+                FROM measurements
+                WHERE server_timestamp >= ? AND server_timestamp < ? {station_filter}
+                UNION
+                SELECT mac_address, substr(hour, 1, 13)
+                FROM hourly_aggregates
+                WHERE hour >= ? AND hour < ? {station_filter}
+            ''', params + params).fetchall()
+        hours_by_station = {}
+        for mac, hour_prefix in rows:
+            hours_by_station.setdefault(mac, []).append(datetime.strptime(hour_prefix, '%Y-%m-%d %H'))
+
+        total_hours = total_rows = 0
+        for mac, hours in sorted(hours_by_station.items()):
+            hours.sort()
+            for i in range(0, len(hours), REBUILD_CHUNK_HOURS):
+                # Godziny kolejnych paczek przelicza ich własna paczka
+                last_chunk = i + REBUILD_CHUNK_HOURS >= len(hours)
+                aggregated, written = self.update_station(mac, hours[i:i + REBUILD_CHUNK_HOURS], limit, include_following=last_chunk)
+                total_hours += aggregated
+                total_rows += written
+            log.info("Feature store rebuild: %s done (%s hours)", mac, len(hours))
+        return total_hours, total_rows
+
+    def _run(self):
+        try:
+            queued = self.catch_up()
+            if queued:
+                log.info("Feature store: %s recent hours queued for aggregation", queued)
+        except Exception as e:
+            self._last_error = str(e)
+            log.error("Feature store: catch-up failed: %s", e)
+        while not self._stop.wait(self.interval):
+            self.refresh()
+
+    def stats(self):
+        with self._lock:
+            pending_hours = sum(len(hours) for hours in self._pending.values())
+        return {
+            'running': self._thread is not None and self._thread.is_alive(),
+            'pending_hours': pending_hours,
+            'hours_aggregated': self._hours_aggregated,
+            'feature_rows_written': self._feature_rows_written,
+            'feature_rows_invalidated': self._invalidated,
+            'refreshes': self._refreshes,
+            'last_refresh_ms': self._last_refresh_ms,
+            'last_error': self._last_error,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuilds the hourly feature store from the raw measurements.')
+    parser.add_argument('--db', default=db.DB_PATH)
+    parser.add_argument('--mac', help='only this station')
+    parser.add_argument('--since', help="'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' (default: all data)")
+    parser.add_argument('--until', help='exclusive end, same format (default: last closed hour)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db.configure(args.db)
+    since = pd.Timestamp(args.since).to_pydatetime() if args.since else None
+    until = pd.Timestamp(args.until).to_pydatetime() if args.until else None
+    start = time.time()
+    hours, rows = FeatureStore().rebuild(args.mac, since, until)
+    log.info("Feature store rebuilt: %s hourly aggregates, %s feature rows in %.1fs", hours, rows, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
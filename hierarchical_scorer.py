@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Fused scorer of the hierarchical classifier (M1 -> M2/M3 -> M4) for the prediction paths.
+
+predict_hierarchical in ai_main goes through the sklearn wrapper: every stage slices a
+DataFrame with .loc and validates/converts it again, which dominates the cost of scoring a
+single hour. The scorer is built once per model set (ModelRegistry): it resolves every
+booster's input columns to positions in one float32 feature block and routes the rows with
+boolean masks. Large blocks are scored with Booster.inplace_predict on row/column takes of
+the block; small ones (up to SMALL_BLOCK_ROWS rows, e.g. a single hour) by _TreeArrays, the
+trees exported to flat NumPy arrays and walked for all trees at once, which avoids the fixed
+cost of an XGBoost call. Both give the margins of XGBoost bit for bit (float32 leaf sums in
+tree order), so the labels are the ones of XGBClassifier.predict (binary: P > 0.5, M3:
+multi:softmax class decoded with the LabelEncoder).
+Every stage call is recorded as the sub-stage inference.<M1..M4> (ai_pipeline.measure).
+"""
+import json
+
+import numpy as np
+
+from ai_pipeline import measure
+
+STAGES = ('M1', 'M2', 'M3', 'M4')
+
+# Etykiety etapów binarnych (0, 1); M1 = 1 to opady (dalej M3), M2 = 0 to "inne bez opadów" (dalej M4)
+FOG = 'Fog'
+M4_LABELS = ('Clear/Fair', 'Cloudy/Overcast')
+
+SMALL_BLOCK_ROWS = 64
+
+
+class _TreeArrays:
+    """Trees of one booster as flat arrays (leaves point to themselves), walked with NumPy."""
+
+    def __init__(self, booster, columns):
+        """columns: block column of every booster feature (booster.feature_names order)."""
+        learner = json.loads(booster.save_raw('json'))['learner']
+        model = learner['gradient_booster']['model']
+        left, right, feature, threshold, default_left, roots = [], [], [], [], [], []
+        depth = offset = 0
+        for tree in model['trees']:
+            roots.append(offset)
+            tree_left = np.asarray(tree['left_children'], dtype=np.intp)
+            tree_right = np.asarray(tree['right_children'], dtype=np.intp)
+            nodes = np.arange(len(tree_left))
+            leaf = tree_left == -1
+            left.append(np.where(leaf, nodes, tree_left) + offset)
+            right.append(np.where(leaf, nodes, tree_right) + offset)
+            feature.append(np.where(leaf, 0, columns[np.asarray(tree['split_indices'], dtype=np.intp)]))
+            threshold.append(np.asarray(tree['split_conditions'], dtype=np.float32))  # liść: wartość liścia
+            default_left.append(np.asarray(tree['default_left'], dtype=bool))
+            depth = max(depth, _tree_depth(tree_left, tree_right))
+            offset += len(tree_left)
+        self.left, self.right = np.concatenate(left), np.concatenate(right)
+        self.feature, self.threshold = np.concatenate(feature), np.concatenate(threshold)
+        self.default_left = np.concatenate(default_left)
+        self.roots = np.asarray(roots, dtype=np.intp)
+        self.depth = depth
+        self.groups = np.asarray(model['tree_info'], dtype=np.intp)
+        self.num_groups = int(self.groups.max()) + 1
+        base_score = np.asarray(learner['learner_model_param']['base_score'].strip('[]').split(','), dtype=np.float32)
+        if learner['objective']['name'] == 'binary:logistic':
+            base_score = -np.log(np.float32(1) / base_score - np.float32(1))
+        self.base_margin = np.broadcast_to(base_score, (self.num_groups,)).astype(np.float32)
+
+    def margins(self, X):
+        """Margins (rows x groups, float32) of the rows of the block X."""
+        nodes = np.repeat(self.roots[:, None], len(X), axis=1)   # drzewa x wiersze
+        rows = np.arange(len(X))
+        for _ in range(self.depth):
+            values = X[rows, self.feature[nodes]]
+            go_left = np.where(np.isnan(values), self.default_left[nodes], values < self.threshold[nodes])
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        leaves = self.threshold[nodes]
+        margins = np.empty((len(X), self.num_groups), dtype=np.float32)
+        for group in range(self.num_groups):
+            # Sumowanie sekwencyjne w float32 w kolejności drzew, od marginesu bazowego (jak XGBoost)
+            column = np.concatenate([np.full((1, len(X)), self.base_margin[group], dtype=np.float32),
+                                     leaves[self.groups == group]])
+            margins[:, group] = np.cumsum(column, axis=0, dtype=np.float32)[-1]
+        return margins
+
+
+def _tree_depth(left, right):
+    depth, level = 0, [0]
+    while True:
+        level = [child for node in level if left[node] != -1 for child in (left[node], right[node])]
+        if not level:
+            return depth
+        depth += 1
+
+
+class HierarchicalScorer:
+    def __init__(self, models):
+        """models: the dict of ModelRegistry (XGBClassifier 'M1'..'M4', LabelEncoder 'LE_M3')."""
+        self._boosters = {name: models[name].get_booster() for name in STAGES}
+        self._missing = {name: models[name].missing for name in STAGES}
+        self.columns = sorted({f for booster in self._boosters.values() for f in booster.feature_names})
+        position = {f: i for i, f in enumerate(self.columns)}
+        # Kolejność kolumn jak przy treningu (booster.feature_names), bez walidacji nazw przy predykcji
+        self._columns_of = {name: np.array([position[f] for f in booster.feature_names], dtype=np.intp)
+                            for name, booster in self._boosters.items()}
+        self._m3_classes = np.asarray(models['LE_M3'].classes_, dtype=object)
+        self._trees = {name: _TreeArrays(booster, self._columns_of[name]) for name, booster in self._boosters.items()}
+
+    def matrix(self, df):
+        """C-contiguous float32 feature block of a DataFrame, columns in self.columns order."""
+        if list(df.columns) != self.columns:
+            df = df[self.columns]
+        return np.ascontiguousarray(df.to_numpy(dtype=np.float32))
+
+    def _small(self, X, rows):
+        return (len(X) if rows is None else len(rows)) <= SMALL_BLOCK_ROWS
+
+    def _inplace(self, name, X, rows, predict_type):
+        columns = self._columns_of[name]
+        block = X[:, columns] if rows is None else X[np.ix_(rows, columns)]
+        return self._boosters[name].inplace_predict(block, predict_type=predict_type, missing=self._missing[name],
+                                                    validate_features=False)
+
+    def _margins(self, name, X, rows):
+        if self._small(X, rows):
+            margins = self._trees[name].margins(X if rows is None else X[rows])
+            return margins if margins.shape[1] > 1 else margins[:, 0]
+        return self._inplace(name, X, rows, 'margin')
+
+    def margins(self, name, X, rows=None):
+        """Margins (rows x classes for M3) of one stage for the selected rows of the block."""
+        with measure(f'inference.{name}', len(X) if rows is None else len(rows)):
+            return self._margins(name, X, rows)
+
+    def probability(self, name, X, rows=None):
+        """
+        P(class 1) of a binary stage, XGBoost's 'value' output (float32 sigmoid of the margin).
+        The tree-array path rounds exp to float32 itself and may differ from XGBoost's expf by
+        one float32 ulp; the labels (P > 0.5) are the same.
+        """
+        with measure(f'inference.{name}', len(X) if rows is None else len(rows)):
+            if self._small(X, rows):
+                margins = self._margins(name, X, rows)
+                return np.float32(1) / (np.float32(1) + np.exp(-margins.astype(np.float64)).astype(np.float32))
+            return self._inplace(name, X, rows, 'value')
+
+    def predict(self, X):
+        """Category labels (object array) for every row of the float32 block X."""
+        labels = np.empty(len(X), dtype=object)
+        if not len(X):
+            return labels
+        precip = self.probability('M1', X) > 0.5
+        precip_rows = np.flatnonzero(precip)
+        dry_rows = np.flatnonzero(~precip)
+
+        if len(dry_rows):
+            fog = self.probability('M2', X, dry_rows) > 0.5
+            labels[dry_rows[fog]] = FOG
+            other_rows = dry_rows[~fog]
+            if len(other_rows):
+                cloudy = self.probability('M4', X, other_rows) > 0.5
+                labels[other_rows] = np.where(cloudy, M4_LABELS[1], M4_LABELS[0])
+        if len(precip_rows):
+            classes = np.argmax(self.margins('M3', X, precip_rows), axis=1)
+            labels[precip_rows] = self._m3_classes[classes]
+        return labels
+
+    def predict_proba(self, X):
+        """
+        Labels and the probability path of every row in one pass (all stages on all rows):
+        returns (labels, stages, categories, joint) where stages holds P(precip) of M1, P(fog)
+        of M2, the M3 class distribution (rows x m3_classes) and P(cloudy) of M4, and joint is
+        the distribution over `categories` (rows x 6):
+            precipitation type c: P1 * P3(c), Fog: (1 - P1) * P2,
+            Clear/Fair and Cloudy/Overcast: (1 - P1) * (1 - P2) * (1 - P4) and * P4.
+        The labels are the ones of predict (same stage outputs).
+        """
+        p_precip, p_fog, p_cloudy = (self.probability(name, X) for name in ('M1', 'M2', 'M4'))
+        m3_margins = np.asarray(self.margins('M3', X), dtype=np.float64).reshape(len(X), len(self._m3_classes))
+        m3_proba = np.exp(m3_margins - m3_margins.max(axis=1, keepdims=True))
+        m3_proba /= m3_proba.sum(axis=1, keepdims=True)
+
+        precip, fog, cloudy = p_precip > 0.5, p_fog > 0.5, p_cloudy > 0.5
+        labels = np.where(precip, self._m3_classes[np.argmax(m3_margins, axis=1)],
+                          np.where(fog, FOG, np.where(cloudy, M4_LABELS[1], M4_LABELS[0]))).astype(object)
+
+        p1, p2, p4 = (np.asarray(p, dtype=np.float64) for p in (p_precip, p_fog, p_cloudy))
+        by_category = {FOG: (1 - p1) * p2,
+                       M4_LABELS[0]: (1 - p1) * (1 - p2) * (1 - p4),
+                       M4_LABELS[1]: (1 - p1) * (1 - p2) * p4}
+        for i, category in enumerate(self._m3_classes):
+            by_category[category] = p1 * m3_proba[:, i]
+        categories = sorted(by_category)
+        joint = np.column_stack([by_category[category] for category in categories]).reshape(len(X), len(categories))
+        stages = {'precipitation': p1, 'fog': p2, 'precipitation_type': m3_proba, 'cloudy': p4}
+        return labels, stages, categories, joint
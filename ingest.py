@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind buffer for the measurements sent by the boards.
+
+`receive_measurement` only validates a reading and puts it on a bounded in-memory queue.
+A single writer thread drains the queue and inserts the readings with `executemany`
+in one transaction every `batch_size` rows or `flush_interval` seconds, whichever comes
+first, so the database sees one commit per batch instead of one per 5-second reading.
+When the queue is full `enqueue` returns False and the caller answers 503.
+
+A write hook that raises does not cost the batch its raw rows: the hook's writes are rolled
+back to its savepoint, its id range is kept in write_hook_backlog and the writer thread runs
+it again later (replay_write_hooks).
+"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+import db
+
+log = logging.getLogger(__name__)
+
+# Pomiary zapisujemy w czasie serwera UTC+2 (tak jak wcześniej datetime(CURRENT_TIMESTAMP, '+2 hours'))
+SERVER_TIME_OFFSET = timedelta(hours=2)
+
+INSERT_SQL = '''
+    INSERT INTO measurements (
+        mac_address, server_timestamp, temperature, pressure, humidity, sunshine, wind_speed, precipitation
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+MEASUREMENT_FIELDS = ['temperature', 'pressure', 'humidity', 'sunshine', 'wind_speed', 'precipitation']
+# Pola wymagane (jak w validate_measurement); pozostałe mogą być puste i trafiają do bazy jako NULL
+REQUIRED_FIELDS = ['temperature', 'pressure', 'humidity']
+
+# Odczyty z zegara urządzenia mogą wyprzedzać serwer najwyżej o tyle
+MAX_DEVICE_CLOCK_AHEAD = timedelta(minutes=10)
+
+
+def server_now(now=None):
+    """Current server time (naive datetime, same clock as measurements.server_timestamp)."""
+    now = now or datetime.now(timezone.utc)
+    return (now + SERVER_TIME_OFFSET).replace(tzinfo=None)
+
+
+def server_timestamp(now=None):
+    """Current server time as stored in measurements.server_timestamp ('YYYY-MM-DD HH:MM:SS')."""
+    return server_now(now).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def validate_measurement(data, timestamp=None):
+    """
+    Validates a measurement dict and returns the row tuple for INSERT_SQL,
+    or None when the reading is rejected (the reason is logged).
+    `timestamp` defaults to the current server time.
+    """
+    try:
+        raw_temp = float(data.get('temperature'))
+        temp = raw_temp + 2.0
+        pressure = float(data.get('pressure'))
+        humidity = float(data.get('humidity'))
+
+        # Sprawdzanie temperatury
+        if not (-40 < temp < 40): # Realistyczny zakres dla Polski/Europy
+            log.warning("Odrzucono nierealistyczną temperaturę: %s°C dla MAC: %s", temp, data.get('mac_address'))
+            return None
+
+        # Sprawdzanie ciśnienia (w hPa)
+        if not (950 < pressure < 1060):
+            log.warning("Odrzucono nierealistyczne ciśnienie: %s hPa dla MAC: %s", pressure, data.get('mac_address'))
+            return None
+
+        # Sprawdzanie wilgotności (wartość od 0.0 do 1.0)
+        if not (0 <= humidity <= 1):
+            log.warning("Odrzucono nierealistyczną wilgotność: %s dla MAC: %s", humidity, data.get('mac_address'))
+            return None
+
+    except (ValueError, TypeError):
+        log.warning("Odrzucono pomiar z powodu błędu konwersji danych na liczby (MAC: %s).", data.get('mac_address'))
+        log.debug("Odrzucone dane: %r", data)
+        return None
+
+    return (
+        data.get('mac_address'),
+        timestamp or server_timestamp(),
+        temp,
+        data.get('pressure'),
+        data.get('humidity'),
+        data.get('sunshine'),
+        data.get('wind_speed'),
+        data.get('precipitation'),
+    )
+
+
+def validate_measurements_bulk(readings, mac_address, now=None):
+    """
+    Validates a list of buffered readings (dicts with MEASUREMENT_FIELDS and a device
+    'timestamp') in one vectorized pass, using the same bounds as validate_measurement.
+    Only REQUIRED_FIELDS must be present; the other fields may be missing (stored as NULL)
+    but are rejected when given as non-numbers.
+
+    'timestamp' is either server time as 'YYYY-MM-DD HH:MM:SS' or Unix epoch seconds.
+    Returns (rows, accepted, rejected): row tuples for INSERT_SQL, the indices of the
+    accepted readings and a list of {'index', 'reason'} for the rejected ones.
+    """
+    reasons = pd.Series(None, index=range(len(readings)), dtype=object)
+    positions = [i for i, r in enumerate(readings) if isinstance(r, dict)]
+    reasons[[i for i, r in enumerate(readings) if not isinstance(r, dict)]] = 'not an object'
+
+    df = pd.DataFrame.from_records([readings[i] for i in positions], columns=MEASUREMENT_FIELDS + ['timestamp'])
+    df.index = positions
+
+    values = df[MEASUREMENT_FIELDS].apply(pd.to_numeric, errors='coerce')
+    values['temperature'] = values['temperature'] + 2.0  # ta sama korekta co w validate_measurement
+
+    # Znacznik czasu urządzenia: epoch (liczba) albo tekst w czasie serwera
+    epoch = pd.to_numeric(df['timestamp'], errors='coerce')
+    parsed = pd.to_datetime(df['timestamp'].where(epoch.isna()), format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    from_epoch = (pd.to_datetime(epoch, unit='s', errors='coerce') + SERVER_TIME_OFFSET)
+    timestamps = parsed.fillna(from_epoch)
+    latest_allowed = pd.Timestamp(datetime.strptime(server_timestamp(now), '%Y-%m-%d %H:%M:%S') + MAX_DEVICE_CLOCK_AHEAD)
+
+    optional = [field for field in MEASUREMENT_FIELDS if field not in REQUIRED_FIELDS]
+    checks = [
+        (values[REQUIRED_FIELDS].isna().any(axis=1), 'missing or non-numeric field'),
+        ((values[optional].isna() & df[optional].notna()).any(axis=1), 'non-numeric field'),
+        (timestamps.isna(), 'invalid timestamp'),
+        (timestamps > latest_allowed, 'timestamp in the future'),
+        (~((values['temperature'] > -40) & (values['temperature'] < 40)), 'temperature out of range'),
+        (~((values['pressure'] > 950) & (values['pressure'] < 1060)), 'pressure out of range'),
+        (~((values['humidity'] >= 0) & (values['humidity'] <= 1)), 'humidity out of range'),
+    ]
+    row_reasons = pd.Series(
+        np.select([mask.to_numpy() for mask, _ in checks], [reason for _, reason in checks], default=''),
+        index=df.index
+    )
+    reasons[df.index] = row_reasons.where(row_reasons != '', None)
+
+    ok = row_reasons == ''
+    good = values[ok].astype(object)
+    good = good.where(good.notna(), None)  # brakujące pola opcjonalne -> NULL
+    rows = list(zip(
+        [mac_address] * len(good),
+        timestamps[ok].dt.strftime('%Y-%m-%d %H:%M:%S').tolist(),
+        *(good[field].tolist() for field in MEASUREMENT_FIELDS)
+    ))
+    accepted = good.index.tolist()
+    rejected = [{'index': i, 'reason': reason} for i, reason in reasons.dropna().items()]
+    return rows, accepted, rejected
+
+
+# Called as hook(conn, rows, first_id, last_id) after every insert_rows, inside the same
+# transaction (derived tables that must stay consistent with measurements, e.g. rollups).
+# Every hook runs in its own savepoint: a failing hook is rolled back alone and its id range
+# goes to write_hook_backlog for replay_write_hooks, the raw rows are committed anyway.
+_write_hooks = []
+
+SCHEMA_STATEMENTS = [
+    '''CREATE TABLE IF NOT EXISTS write_hook_backlog (
+        hook TEXT NOT NULL,
+        first_id INTEGER NOT NULL,
+        last_id INTEGER NOT NULL,
+        failed_at TEXT NOT NULL,
+        error TEXT NOT NULL,
+        PRIMARY KEY (hook, first_id)
+    ) WITHOUT ROWID''',
+]
+
+SELECT_ROWS_SQL = '''
+    SELECT mac_address, server_timestamp, temperature, pressure, humidity, sunshine, wind_speed, precipitation
+    FROM measurements WHERE id BETWEEN ? AND ? ORDER BY id
+'''
+
+
+def register_write_hook(hook):
+    """Registers hook(conn, rows, first_id, last_id) to run after measurement rows are inserted (idempotent)."""
+    if hook not in _write_hooks:
+        _write_hooks.append(hook)
+
+
+def hook_name(hook):
+    return f'{hook.__module__}.{hook.__qualname__}'
+
+
+def _run_hook(conn, hook, rows, first_id, last_id):
+    """Runs one write hook in a savepoint; returns the exception it raised (its writes rolled back) or None."""
+    conn.execute('SAVEPOINT write_hook')
+    try:
+        hook(conn, rows, first_id, last_id)
+    except Exception as e:
+        conn.execute('ROLLBACK TO write_hook')
+        conn.execute('RELEASE write_hook')
+        return e
+    conn.execute('RELEASE write_hook')
+    return None
+
+
+def _mark_for_rebuild(conn, hook, first_id, last_id, error):
+    try:
+        conn.execute('INSERT OR REPLACE INTO write_hook_backlog VALUES (?, ?, ?, ?, ?)',
+                     (hook_name(hook), first_id, last_id, server_timestamp(), f'{type(error).__name__}: {error}'))
+    except sqlite3.OperationalError:
+        log.error("Write hook %s: no write_hook_backlog table, measurements %s-%s will not be replayed",
+                  hook_name(hook), first_id, last_id)
+
+
+def insert_rows(conn, rows):
+    """Inserts validated measurement rows and runs the write hooks; the caller owns the transaction."""
+    if not rows:
+        return
+    conn.executemany(INSERT_SQL, rows)
+    # Jeden zapisujący w transakcji, więc nowe wiersze mają kolejne id
+    last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+    first_id = last_id - len(rows) + 1
+    for hook in _write_hooks:
+        error = _run_hook(conn, hook, rows, first_id, last_id)
+        if error is not None:
+            log.error("Write hook %s failed for measurements %s-%s, marked for rebuild: %s",
+                      hook_name(hook), first_id, last_id, error, exc_info=error)
+            _mark_for_rebuild(conn, hook, first_id, last_id, error)
+
+
+def replay_write_hooks(conn):
+    """
+    Runs the write hooks recorded in write_hook_backlog again on the rows still in measurements;
+    the ranges that succeed are removed from the backlog. Returns the number of replayed ranges.
+    """
+    try:
+        entries = conn.execute('SELECT hook, first_id, last_id FROM write_hook_backlog ORDER BY first_id').fetchall()
+    except sqlite3.OperationalError:
+        return 0 # Baza sprzed migracji
+    hooks = {hook_name(hook): hook for hook in _write_hooks}
+    replayed = 0
+    for name, first_id, last_id in entries:
+        hook = hooks.get(name)
+        if hook is None:
+            continue # Hook niezarejestrowany w tym procesie - zostaje w backlogu
+        rows = conn.execute(SELECT_ROWS_SQL, (first_id, last_id)).fetchall()
+        error = _run_hook(conn, hook, rows, first_id, last_id) if rows else None
+        if error is not None:
+            log.warning("Write hook %s still failing for measurements %s-%s: %s", name, first_id, last_id, error)
+            continue
+        conn.execute('DELETE FROM write_hook_backlog WHERE hook = ? AND first_id = ?', (name, first_id))
+        replayed += 1
+    if replayed:
+        log.info("Replayed %s failed write hook ranges", replayed)
+    return replayed
+
+
+class IngestQueue:
+    def __init__(self, max_size=50000, batch_size=500, flush_interval=0.5,
+                 max_retries=5, retry_delay=0.2, replay_interval=60.0):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.replay_interval = replay_interval
+        self._next_replay = 0.0
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._enqueued = 0
+        self._rejected_full = 0
+        self._written = 0
+        self._failed = 0
+        self._flushes = 0
+        self._flush_time_total = 0.0
+        self._last_flush_latency = None
+        self._max_flush_latency = 0.0
+        self._last_batch_size = 0
+        self._last_error = None
+
+    def start(self):
+        """Starts the writer thread (idempotent)."""
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+            self._thread.start()
+            log.info("Ingest queue started (max_size=%s, batch_size=%s, flush_interval=%ss)",
+                     self.max_size, self.batch_size, self.flush_interval)
+
+    def stop(self, timeout=10.0):
+        """Stops the writer thread after flushing everything already queued."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._stop.set()
+        thread.join(timeout)
+        if thread.is_alive():
+            log.error("Ingest queue: writer did not finish within %ss, %s readings not saved", timeout, self._queue.qsize())
+        else:
+            log.info("Ingest queue stopped, %s readings written in total", self._written)
+        self._thread = None
+
+    def enqueue(self, row):
+        """Queues a validated row. Returns False when the queue is full (back-pressure)."""
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            with self._stats_lock:
+                self._rejected_full += 1
+            return False
+        with self._stats_lock:
+            self._enqueued += 1
+        return True
+
+    def flush(self, timeout=None):
+        """Blocks until every row queued so far has been written (or dropped after failed retries)."""
+        if self._thread is None or not self._thread.is_alive():
+            self._drain()
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._queue.all_tasks_done.wait(remaining)
+
+    def _collect_batch(self):
+        """Waits for the first row, then gathers more until batch_size or flush_interval is reached."""
+        try:
+            first = self._queue.get(timeout=0.5)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, batch):
+        start = time.perf_counter()
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                with db.writer() as conn:
+                    insert_rows(conn, batch)
+                break
+            except sqlite3.OperationalError as e:
+                # Np. 'database is locked' - ponawiamy z rosnącym odstępem
+                self._last_error = str(e)
+                if attempt == self.max_retries:
+                    log.error("Ingest queue: dropping batch of %s readings after %s attempts: %s", len(batch), attempt, e)
+                    with self._stats_lock:
+                        self._failed += len(batch)
+                    return
+                time.sleep(self.retry_delay * attempt)
+            except Exception as e:
+                self._last_error = str(e)
+                log.error("Ingest queue: dropping batch of %s readings: %s", len(batch), e)
+                with self._stats_lock:
+                    self._failed += len(batch)
+                return
+        latency = time.perf_counter() - start
+        with self._stats_lock:
+            self._written += len(batch)
+            self._flushes += 1
+            self._flush_time_total += latency
+            self._last_flush_latency = latency
+            self._max_flush_latency = max(self._max_flush_latency, latency)
+            self._last_batch_size = len(batch)
+
+    def _replay_hooks(self):
+        """Every replay_interval seconds: write hooks that failed earlier are run again (replay_write_hooks)."""
+        if time.monotonic() < self._next_replay:
+            return
+        self._next_replay = time.monotonic() + self.replay_interval
+        try:
+            with db.writer() as conn:
+                replay_write_hooks(conn)
+        except Exception as e:
+            log.error("Ingest queue: replay of failed write hooks failed: %s", e)
+
+    def _finish(self, batch):
+        for _ in batch:
+            self._queue.task_done()
+
+    def _drain(self):
+        """Writes whatever is left in the queue (used on shutdown)."""
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            try:
+                self._write_batch(batch)
+            finally:
+                self._finish(batch)
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect_batch()
+            if not batch:
+                continue
+            try:
+                self._write_batch(batch)
+            finally:
+                self._finish(batch)
+            self._replay_hooks()
+        self._drain()
+
+    def stats(self):
+        """Queue depth and flush counters, exposed by the /api/ingest/stats endpoint."""
+        with self._stats_lock:
+            return {
+                'running': self._thread is not None and self._thread.is_alive(),
+                'queue_depth': self._queue.qsize(),
+                'max_size': self.max_size,
+                'batch_size': self.batch_size,
+                'flush_interval_s': self.flush_interval,
+                'enqueued': self._enqueued,
+                'rejected_full': self._rejected_full,
+                'written': self._written,
+                'failed': self._failed,
+                'flushes': self._flushes,
+                'last_batch_size': self._last_batch_size,
+                'last_flush_latency_ms': round(self._last_flush_latency * 1000, 3) if self._last_flush_latency is not None else None,
+                'avg_flush_latency_ms': round(self._flush_time_total / self._flushes * 1000, 3) if self._flushes else None,
+                'max_flush_latency_ms': round(self._max_flush_latency * 1000, 3),
+                'last_error': self._last_error,
+            }
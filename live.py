@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+In-process broker pushing new measurements to open device dashboards (server-sent events).
+
+Every dashboard subscribes to the stream of one mac_address and gets a small bounded queue.
+The broker is fed by an ingest write hook: for every station with subscribers it publishes
+the new readings ('reading' events) and the current 30-minute rollup bucket ('bucket'
+events, closed=true once a reading of a later bucket arrived). The events are built inside
+the insert transaction and published once it commits (db.after_commit), so a dashboard never
+sees readings that were rolled back. Each event is encoded once and
+the same string is put on every subscriber queue, so fan-out costs one queue put per
+dashboard; stations nobody watches cost one dict lookup per insert batch. A subscriber that
+does not keep up loses events (counted in `dropped`) instead of slowing down the ingest.
+"""
+import json
+import queue
+import threading
+
+import db
+import rollups
+from ingest import MEASUREMENT_FIELDS
+
+SUBSCRIBER_QUEUE_SIZE = 256
+HEARTBEAT_INTERVAL = 15.0   # s - komentarz SSE utrzymujący połączenie przez proxy
+RESOLUTION = '30m'
+
+
+def _bucket(timestamp):
+    """30-minute bucket label of a 'YYYY-MM-DD HH:MM:SS' timestamp (as in rollups.ROLLUPS['30m'])."""
+    return f"{timestamp[:14]}{int(timestamp[14:16]) // 30 * 30:02d}"
+
+
+class LiveBroker:
+    def __init__(self, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = {}   # mac_address -> set(queue.Queue)
+        self._open_bucket = {}   # mac_address -> etykieta ostatniego (otwartego) kubełka
+        self._published = 0
+        self._delivered = 0
+        self._dropped = 0
+
+    def subscribe(self, mac_address):
+        q = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(mac_address, set()).add(q)
+        return q
+
+    def unsubscribe(self, mac_address, q):
+        with self._lock:
+            subscribers = self._subscribers.get(mac_address)
+            if subscribers is not None:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self._subscribers[mac_address]
+                    self._open_bucket.pop(mac_address, None)
+
+    def publish(self, mac_address, event, data):
+        """Encodes the event once and puts it on every subscriber queue of the station."""
+        message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        with self._lock:
+            subscribers = list(self._subscribers.get(mac_address, ()))
+            self._published += 1
+        delivered = dropped = 0
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+                delivered += 1
+            except queue.Full:
+                dropped += 1
+        with self._lock:
+            self._delivered += delivered
+            self._dropped += dropped
+
+    def rows_written(self, conn, rows, first_id, last_id):
+        """Ingest write hook (after rollups.rows_written): pushes readings and buckets of watched stations."""
+        with self._lock:
+            if not self._subscribers:
+                return
+            watched = set(self._subscribers)
+            watched_buckets = {mac_address: self._open_bucket.get(mac_address) for mac_address in watched}
+        by_station = {}
+        for row in rows:
+            if row[0] in watched:
+                by_station.setdefault(row[0], []).append(row)
+
+        events = []
+        open_buckets = {}
+        for mac_address, station_rows in by_station.items():
+            open_bucket = watched_buckets[mac_address]
+            # Odczyty starsze niż otwarty kubełek (np. z bufora urządzenia) nie są "na żywo"
+            station_rows = sorted((row for row in station_rows if open_bucket is None or _bucket(row[1]) >= open_bucket),
+                                  key=lambda row: row[1])
+            if not station_rows:
+                continue
+            for row in station_rows:
+                events.append((mac_address, 'reading', {'timestamp': row[1], **dict(zip(MEASUREMENT_FIELDS, row[2:]))}))
+
+            buckets = sorted({_bucket(row[1]) for row in station_rows} | ({open_bucket} if open_bucket else set()))
+            for bucket_row in rollups.read_buckets(conn, mac_address, buckets, RESOLUTION):
+                bucket_row['closed'] = bucket_row['time_window'] < buckets[-1]
+                events.append((mac_address, 'bucket', bucket_row))
+            open_buckets[mac_address] = buckets[-1]
+        if events:
+            db.after_commit(lambda: self._publish_committed(events, open_buckets))
+
+    def _publish_committed(self, events, open_buckets):
+        with self._lock:
+            # Stacja, której panel zamknięto w międzyczasie, nie wraca do _open_bucket
+            for mac_address, bucket in open_buckets.items():
+                if mac_address in self._subscribers:
+                    self._open_bucket[mac_address] = max(bucket, self._open_bucket.get(mac_address, bucket))
+        for mac_address, event, data in events:
+            self.publish(mac_address, event, data)
+
+    def stream(self, mac_address, heartbeat=HEARTBEAT_INTERVAL):
+        """Generator of SSE messages for one dashboard; unsubscribes when the client disconnects."""
+        q = self.subscribe(mac_address)
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    yield q.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': ping\n\n'
+        finally:
+            self.unsubscribe(mac_address, q)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'stations': len(self._subscribers),
+                'subscribers': sum(len(s) for s in self._subscribers.values()),
+                'events_published': self._published,
+                'messages_delivered': self._delivered,
+                'messages_dropped': self._dropped,
+            }
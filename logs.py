@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Logging setup of the web server and the AI worker processes.
+
+configure sets the root level and per-logger levels (config.Config.LOG_LEVELS, e.g. 'ai_main':
+'WARNING' keeps the step-by-step messages of the prediction pipeline out of the log while
+its warnings and errors stay). With use_queue the root logger gets a QueueHandler: request,
+ingest and pool threads only merge the message with its arguments and put the record on a
+queue, a QueueListener thread formats and writes it, so a slow stdout or log file does not
+hold up a request. Messages use lazy %-formatting,
+so records below the logger's level are never formatted.
+
+SampleFilter keeps 1 of every N records per key (the first message argument, e.g. the
+station of the per-reading ingest log). The settings are kept (settings()) and passed to
+the worker processes of ai_tasks, which configure their own logging the same way.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s [%(threadName)s]: %(message)s'
+
+_listener = None
+_settings = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message (and the traceback, if any)."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        """Message merged with its arguments in the caller (they may change later), traceback kept apart for the formatter."""
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, int(every))
+        self._lock = threading.Lock()
+        self._counts = {}   # klucz (np. adres MAC) -> liczba rekordów
+
+    def filter(self, record):
+        if self.every == 1:
+            return True
+        key = record.args[0] if isinstance(record.args, tuple) and record.args else record.msg
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        return count % self.every == 0
+
+
+def configure(level='INFO', levels=None, use_queue=False, json_format=False):
+    """(Re)configures the root logger; levels: {logger name: level} applied on top of `level`."""
+    global _listener, _settings
+    stop()
+    _settings = {'level': level, 'levels': dict(levels or {}), 'use_queue': use_queue, 'json_format': json_format}
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    if use_queue:
+        records = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(records, handler)
+        _listener.start()
+        root.addHandler(_QueueHandler(records))
+    else:
+        root.addHandler(handler)
+    root.setLevel(level)
+    for name, logger_level in _settings['levels'].items():
+        logging.getLogger(name).setLevel(logger_level)
+
+
+def settings():
+    """Arguments of the last configure call (None before it), for the worker processes."""
+    return _settings
+
+
+def stop():
+    """Writes out the queued records and stops the listener thread."""
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+
+
+atexit.register(stop)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Latency histograms of the AI pipeline stages and of the HTTP routes in the Prometheus text format.
+
+The records of ai_pipeline (stage and sub-stage: SQL fetch, unit conversion, resample, snow
+simulation, every feature family, imputation, the inference of every model) arrive through
+the sink set in app.create_app, or with the task results of the AI worker processes
+(ai_tasks). Every record adds to the duration and row-count histograms of its stage and
+raises the gauge of the stage's peak RSS (measured over the stage itself, see ai_pipeline).
+init_app times every Flask request per blueprint and route rule (not per URL, so the label
+set stays bounded). GET /metrics renders it all.
+"""
+import bisect
+import threading
+import time
+
+from flask import g, request
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+ROW_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000, 500000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}   # krotka etykiet -> [liczniki kubełków (niekumulatywne), suma, liczba]
+
+    def observe(self, labels, value):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = f'le="{_number(bound)}"' if bound != '+Inf' else 'le="+Inf"'
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, labels, [le])} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {count}')
+        return lines
+
+
+class MaxGauge:
+    """Gauge keeping the highest value seen per label set."""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+
+    def observe(self, labels, value):
+        if labels not in self._values or value > self._values[labels]:
+            self._values[labels] = value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        for labels, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_labels(self.label_names, labels)} {_number(value)}')
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_duration = Histogram(
+            'ai_stage_duration_seconds', 'Duration of AI pipeline stages and sub-stages.', ['stage'])
+        self.stage_rows = Histogram(
+            'ai_stage_rows', 'Rows processed by AI pipeline stages and sub-stages.', ['stage'], ROW_BUCKETS)
+        self.stage_peak_rss = MaxGauge(
+            'ai_stage_peak_rss_bytes', 'Highest resident memory of the process during one run of the stage.', ['stage'])
+        self.task_wait = Histogram(
+            'ai_task_wait_seconds', 'Time AI tasks spent queued before a worker started them.', ['kind', 'status'])
+        self.task_run = Histogram(
+            'ai_task_run_seconds', 'Run time of AI tasks in the worker processes.', ['kind', 'status'])
+        self.request_duration = Histogram(
+            'http_request_duration_seconds', 'Latency of HTTP requests per route.',
+            ['blueprint', 'route', 'method', 'status'])
+        self._all = (self.stage_duration, self.stage_rows, self.stage_peak_rss,
+                     self.task_wait, self.task_run, self.request_duration)
+
+    def observe_stage(self, stage, seconds, rows=None, peak_rss_bytes=None):
+        """ai_pipeline sink: one stage record."""
+        with self._lock:
+            self.stage_duration.observe((stage,), seconds)
+            if rows is not None:
+                self.stage_rows.observe((stage,), rows)
+            if peak_rss_bytes is not None:
+                self.stage_peak_rss.observe((stage,), peak_rss_bytes)
+
+    def observe_stages(self, records):
+        """Stage records drained in a worker process (ai_pipeline.drain_records)."""
+        for record in records:
+            self.observe_stage(*record)
+
+    def observe_task(self, kind, status, wait, run):
+        with self._lock:
+            if wait is not None:
+                self.task_wait.observe((kind, status), wait)
+            self.task_run.observe((kind, status), run)
+
+    def observe_request(self, blueprint, route, method, status, seconds):
+        with self._lock:
+            self.request_duration.observe((blueprint, route, method, str(status)), seconds)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format (0.0.4)."""
+        with self._lock:
+            lines = [line for metric in self._all for line in metric.render()]
+        return '\n'.join(lines) + '\n'
+
+
+registry = Metrics()
+
+
+def _request_started():
+    g.request_started = time.perf_counter()
+
+
+def _request_finished(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        registry.observe_request(request.blueprint or 'app', route, request.method, response.status_code,
+                                 time.perf_counter() - started)
+    return response
+
+
+def init_app(app):
+    """Times every request of the app into http_request_duration_seconds."""
+    app.before_request(_request_started)
+    app.after_request(_request_finished)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide registry of the hierarchical XGBoost models (M1-M4 and the M3 LabelEncoder).
+
+The boosters are parsed from MODEL_SAVE_DIR once and shared by every prediction thread.
+Before handing the models out the registry (at most every `check_interval` seconds)
+compares the mtime/size of the model files with the ones it loaded and re-reads the
+whole set when any of them changed, so a retrained model can be dropped in without
+restarting the server.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import joblib
+import xgboost as xgb
+
+from hierarchical_scorer import HierarchicalScorer
+
+log = logging.getLogger(__name__)
+
+# Model name -> file name inside the model directory
+MODEL_FILES = {
+    'M1': 'model_M1.json',
+    'M2': 'model_M2.json',
+    'M3': 'model_M3.json',
+    'M4': 'model_M4.json',
+    'LE_M3': 'le_M3.pkl',
+}
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _set_digest(versions):
+    return hashlib.sha256(''.join(versions[n] for n in sorted(versions)).encode()).hexdigest()[:12]
+
+
+class ModelRegistry:
+    def __init__(self, model_dir, check_interval=5.0):
+        self.model_dir = model_dir
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._models = None        # dict: 'M1'..'M4', 'LE_M3', 'scorer', 'model_set_version'
+        self._signature = None     # {name: (mtime_ns, size)} of the loaded files
+        self._versions = {}        # {name: sha256 prefix}
+        self._last_check = 0.0
+        self._loaded_at = None
+        self._load_duration = None
+        self._load_count = 0
+        self._warm_hits = 0
+        self._last_error = None
+        self._disk_version = None  # (signature, model_set_version) plików bez wczytywania modeli
+
+    def _path(self, name):
+        return os.path.join(self.model_dir, MODEL_FILES[name])
+
+    def _stat_signature(self):
+        signature = {}
+        for name in MODEL_FILES:
+            st = os.stat(self._path(name))  # FileNotFoundError gdy brakuje pliku
+            signature[name] = (st.st_mtime_ns, st.st_size)
+        return signature
+
+    def _load(self, signature):
+        start = time.perf_counter()
+        models = {}
+        for name in ('M1', 'M2', 'M3', 'M4'):
+            model = xgb.XGBClassifier()
+            model.load_model(self._path(name))
+            models[name] = model
+        models['LE_M3'] = joblib.load(self._path('LE_M3'))
+        # Kolumny boosterów rozwiązane raz na zestaw modeli (predykcja bez wrappera sklearn)
+        models['scorer'] = HierarchicalScorer(models)
+
+        versions = {name: _file_sha256(self._path(name))[:12] for name in MODEL_FILES}
+        set_digest = _set_digest(versions)
+        models['model_set_version'] = set_digest
+
+        # Podmiana całego zestawu naraz - wątki, które już pobrały stary słownik, dokończą na nim
+        self._models = models
+        self._signature = signature
+        self._versions = versions
+        self._load_duration = time.perf_counter() - start
+        self._loaded_at = datetime.now()
+        self._load_count += 1
+        self._last_error = None
+        log.info("Model registry: loaded model set %s from %s in %.2fs", set_digest, self.model_dir, self._load_duration)
+
+    def get_models(self):
+        """
+        Returns the shared dict of loaded models, loading them on first use and
+        reloading them when the files on disk have changed.
+        Raises if the models cannot be loaded and no previous set is available.
+        """
+        models = self._models
+        if models is not None and time.monotonic() - self._last_check < self.check_interval:
+            self._warm_hits += 1
+            return models
+
+        with self._lock:
+            try:
+                signature = self._stat_signature()
+                if self._models is None or signature != self._signature:
+                    self._load(signature)
+                else:
+                    self._warm_hits += 1
+            except Exception as e:
+                self._last_error = str(e)
+                if self._models is None:
+                    raise
+                # Nieudane przeładowanie (np. plik w trakcie zapisu) - serwujemy poprzedni zestaw
+                log.error("Model registry: reload failed, keeping model set %s: %s", self._models['model_set_version'], e)
+            self._last_check = time.monotonic()
+            return self._models
+
+    def disk_version(self):
+        """
+        model_set_version of the model files currently on disk, without loading the models
+        (the web process only needs it as a cache key; the files are hashed when they change).
+        """
+        signature = self._stat_signature()
+        cached = self._disk_version
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        version = _set_digest({name: _file_sha256(self._path(name))[:12] for name in MODEL_FILES})
+        self._disk_version = (signature, version)
+        return version
+
+    def status(self):
+        """Load statistics of the registry, exposed by the /api/ai/models endpoint."""
+        return {
+            'loaded': self._models is not None,
+            'model_dir': self.model_dir,
+            'model_set_version': self._models['model_set_version'] if self._models else None,
+            'model_versions': dict(self._versions),
+            'last_reload': self._loaded_at.strftime('%Y-%m-%d %H:%M:%S') if self._loaded_at else None,
+            'load_duration_s': round(self._load_duration, 4) if self._load_duration is not None else None,
+            'load_count': self._load_count,
+            'warm_hits': self._warm_hits,
+            'check_interval_s': self.check_interval,
+            'last_error': self._last_error,
+        }
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of single-hour AI predictions.
+
+A prediction of (mac_address, hour) is a deterministic function of the readings in its
+48-hour window and of the model files, so results are stored under the key
+(mac_address, hour, model_set_version, data watermark), where the watermark is the newest
+measurement id in the window (it changes with every reading that lands in the window).
+Entries live in an in-memory LRU and in the prediction_cache table, so they survive a
+restart. The ingest write hook drops the entries of every hour whose window receives new
+readings, before the watermark would tell.
+"""
+import json
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import db
+
+log = logging.getLogger(__name__)
+
+MAX_ENTRIES = 4096
+WINDOW_HOURS = 48
+
+SCHEMA_STATEMENTS = [
+    '''CREATE TABLE IF NOT EXISTS prediction_cache (
+        mac_address TEXT NOT NULL,
+        hour TEXT NOT NULL,
+        model_version TEXT NOT NULL,
+        data_watermark INTEGER NOT NULL,
+        result TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (mac_address, hour)
+    ) WITHOUT ROWID''',
+]
+
+
+def data_watermark(conn, mac_address, hour):
+    """Newest measurement id in the 48-hour window of `hour` (0 when the window has no raw rows)."""
+    row = conn.execute(
+        'SELECT MAX(id) FROM measurements WHERE mac_address = ? AND server_timestamp BETWEEN ? AND ?',
+        (mac_address, (hour - timedelta(hours=WINDOW_HOURS)).strftime('%Y-%m-%d %H:%M:%S'),
+         hour.strftime('%Y-%m-%d %H:59:59'))
+    ).fetchone()
+    return row[0] or 0
+
+
+def _hour_runs(hours):
+    """Sorted hours -> list of (first, last) runs of consecutive hours."""
+    runs = []
+    for hour in hours:
+        if runs and hour - runs[-1][1] == timedelta(hours=1):
+            runs[-1][1] = hour
+        else:
+            runs.append([hour, hour])
+    return runs
+
+
+class PredictionCache:
+    def __init__(self, model_version, max_entries=MAX_ENTRIES):
+        """model_version() returns the current model_set_version (ModelRegistry.disk_version)."""
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self._entries = {}              # mac_address -> {hour: (model_version, watermark, result)}
+        self._order = OrderedDict()     # (mac_address, hour) w kolejności LRU
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._db_hits = 0
+        self._misses = 0
+        self._stored = 0
+        self._invalidated = 0
+
+    def key(self, conn, mac_address, hour):
+        """Cache key of a prediction: (mac_address, hour, model_set_version, data watermark)."""
+        return (mac_address, hour, self.model_version(), data_watermark(conn, mac_address, hour))
+
+    def _remember(self, mac_address, hour, entry):
+        with self._lock:
+            self._entries.setdefault(mac_address, {})[hour] = entry
+            self._order[(mac_address, hour)] = None
+            self._order.move_to_end((mac_address, hour))
+            while len(self._order) > self.max_entries:
+                self._forget(*self._order.popitem(last=False)[0])
+
+    def _forget(self, mac_address, hour):
+        """Drops one in-memory entry (caller holds the lock); True when it was there."""
+        station = self._entries.get(mac_address)
+        if station is None or station.pop(hour, None) is None:
+            return False
+        if not station:
+            del self._entries[mac_address]
+        self._order.pop((mac_address, hour), None)
+        return True
+
+    def forget_station(self, mac_address):
+        """Drops every in-memory entry of a station (board deleted)."""
+        with self._lock:
+            for hour in list(self._entries.get(mac_address, ())):
+                self._forget(mac_address, hour)
+
+    def get(self, conn, key):
+        """Cached result for the key, None on a miss."""
+        mac_address, hour, model_version, watermark = key
+        with self._lock:
+            entry = self._entries.get(mac_address, {}).get(hour)
+            if entry is not None and entry[:2] == (model_version, watermark):
+                self._order.move_to_end((mac_address, hour))
+                self._hits += 1
+                return entry[2]
+        try:
+            row = conn.execute(
+                'SELECT result FROM prediction_cache WHERE mac_address = ? AND hour = ? AND model_version = ? AND data_watermark = ?',
+                (mac_address, hour.strftime('%Y-%m-%d %H:%M:%S'), model_version, watermark)
+            ).fetchone()
+        except sqlite3.OperationalError:
+            row = None  # Baza sprzed migracji
+        if row is None:
+            with self._lock:
+                self._misses += 1
+            return None
+        result = json.loads(row[0])
+        self._remember(mac_address, hour, (model_version, watermark, result))
+        with self._lock:
+            self._db_hits += 1
+        return result
+
+    def put(self, key, result):
+        """Stores a successful prediction under the key it was requested with."""
+        mac_address, hour, model_version, watermark = key
+        self._remember(mac_address, hour, (model_version, watermark, result))
+        try:
+            with db.writer() as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO prediction_cache (mac_address, hour, model_version, data_watermark, result, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (mac_address, hour.strftime('%Y-%m-%d %H:%M:%S'), model_version, watermark, json.dumps(result),
+                      datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        except sqlite3.Error as e:
+            log.error("Prediction cache: could not store %s %s: %s", mac_address, hour, e)
+            return
+        with self._lock:
+            self._stored += 1
+
+    def rows_written(self, conn, rows, first_id, last_id):
+        """Ingest write hook: drops the predictions whose 48-hour window contains the new readings."""
+        hours_by_station = {}
+        for row in rows:
+            hours_by_station.setdefault(row[0], set()).add(row[1][:13])
+        # Godziny, których okno obejmuje nowe odczyty: od godziny odczytu do 48 h po niej
+        stale_by_station = {}
+        for mac_address, hours in hours_by_station.items():
+            stale = stale_by_station[mac_address] = set()
+            for hour in hours:
+                first = datetime.strptime(hour, '%Y-%m-%d %H')
+                stale.update(first + timedelta(hours=h) for h in range(WINDOW_HOURS + 1))
+
+        params = []
+        for mac_address, stale in stale_by_station.items():
+            for first, last in _hour_runs(sorted(stale)):
+                params.append((mac_address, first.strftime('%Y-%m-%d %H:%M:%S'), last.strftime('%Y-%m-%d %H:%M:%S')))
+        cur = conn.executemany('DELETE FROM prediction_cache WHERE mac_address = ? AND hour BETWEEN ? AND ?', params)
+        with self._lock:
+            dropped = sum(self._forget(mac_address, hour)
+                          for mac_address, stale in stale_by_station.items() if mac_address in self._entries
+                          for hour in stale)
+            self._invalidated += max(cur.rowcount, dropped)
+
+    def stats(self):
+        """Hit/miss counters, exposed by the /api/ai/cache/stats endpoint."""
+        with self._lock:
+            lookups = self._hits + self._db_hits + self._misses
+            return {
+                'entries_in_memory': len(self._order),
+                'max_entries': self.max_entries,
+                'hits': self._hits,
+                'db_hits': self._db_hits,
+                'misses': self._misses,
+                'hit_ratio': round((self._hits + self._db_hits) / lookups, 4) if lookups else None,
+                'stored': self._stored,
+                'invalidated': self._invalidated,
+            }
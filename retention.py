@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+Retention tiers for the measurements.
+
+    raw 5-second rows (measurements)        RAW_RETENTION      (default 14 days)
+    1-minute aggregates (measurements_1m)   MINUTE_RETENTION   (default 90 days)
+    hourly aggregates                       forever: measurement_rollups_30m/_1h (rollups.py)
+                                            and hourly_aggregates (feature_store.py)
+
+A background job compacts the raw rows older than RAW_RETENTION into 1-minute aggregates
+and deletes them, then deletes the 1-minute aggregates older than MINUTE_RETENTION. It works
+per station in small transactions (BATCH_HOURS of data each, with a pause in between), so the
+ingest writer never waits for more than one batch. Every batch moves the station's watermark
+in retention_watermarks: data of a tier older than its watermark has been compacted, and
+readers pick the tier for a time range with `tier_ranges` / `read_series`.
+
+Watermarks are whole hours. Late readings older than the raw watermark stay in measurements
+until the next run folds them into the 1-minute tier; hourly aggregates below the watermark
+are final.
+
+    python -m retention [--raw-days 14] [--minute-days 90] [--db measurements.db]
+"""
+import argparse
+import logging
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+
+import db
+from sensors import SUNSHINE_THRESHOLD
+from ingest import server_now
+
+log = logging.getLogger(__name__)
+
+RAW_RETENTION = timedelta(days=14)
+MINUTE_RETENTION = timedelta(days=90)
+BATCH_HOURS = 6            # ok. 4300 surowych wierszy stacji na transakcję
+BATCH_PAUSE = 0.05         # s między transakcjami - okno dla kolejki ingestu
+
+MINUTE_TABLE = 'measurements_1m'
+HOURLY_TABLE = 'measurement_rollups_1h'
+
+# Sumy z liczbą wartości nie-NULL i maksima; 'sunny' = liczba odczytów > SUNSHINE_THRESHOLD
+_MINUTE_SUMS = {'temp': 'temperature', 'pres': 'pressure', 'hum': 'humidity', 'sun': 'sunshine',
+                'wind': 'wind_speed', 'prcp': 'precipitation'}
+_MINUTE_MAX = {'wind': 'wind_speed', 'prcp': 'precipitation'}
+
+
+def schema_statements():
+    sums = ',\n            '.join(f'{name}_sum REAL NOT NULL, {name}_n INTEGER NOT NULL' for name in _MINUTE_SUMS)
+    maxima = ',\n            '.join(f'{name}_max REAL' for name in _MINUTE_MAX)
+    return [
+        f'''CREATE TABLE IF NOT EXISTS {MINUTE_TABLE} (
+            mac_address TEXT NOT NULL,
+            minute TEXT NOT NULL,
+            readings INTEGER NOT NULL,
+            sunny INTEGER NOT NULL,
+            {sums},
+            {maxima},
+            PRIMARY KEY (mac_address, minute)
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS retention_watermarks (
+            mac_address TEXT NOT NULL,
+            tier TEXT NOT NULL,
+            compacted_before TEXT NOT NULL,
+            PRIMARY KEY (mac_address, tier)
+        ) WITHOUT ROWID''',
+    ]
+
+
+def _compact_raw_sql():
+    columns = ['readings', 'sunny'] + [f'{name}_{part}' for name in _MINUTE_SUMS for part in ('sum', 'n')]
+    sums = ', '.join(f'TOTAL({column}), COUNT({column})' for column in _MINUTE_SUMS.values())
+    maxima = ', '.join(f'MAX({column})' for column in _MINUTE_MAX.values())
+    additions = ', '.join(f'{column} = {column} + excluded.{column}' for column in columns)
+    max_updates = ', '.join(
+        f'{name}_max = MAX(COALESCE({name}_max, excluded.{name}_max), COALESCE(excluded.{name}_max, {name}_max))'
+        for name in _MINUTE_MAX
+    )
+    return f'''
+        INSERT INTO {MINUTE_TABLE} (mac_address, minute, readings, sunny,
+            {', '.join(f'{name}_sum, {name}_n' for name in _MINUTE_SUMS)}, {', '.join(f'{name}_max' for name in _MINUTE_MAX)})
+        SELECT * FROM (
+            SELECT mac_address, substr(server_timestamp, 1, 16) AS minute, COUNT(*),
+                   COUNT(CASE WHEN sunshine > {SUNSHINE_THRESHOLD} THEN 1 END), {sums}, {maxima}
+            FROM measurements
+            WHERE mac_address = ? AND server_timestamp < ?
+            GROUP BY minute
+        ) WHERE true
+        ON CONFLICT (mac_address, minute) DO UPDATE SET {additions}, {max_updates}
+    '''
+
+
+def compacted_before(conn, mac_address, tier):
+    """Watermark of a tier ('raw' or 'minute') for a station as datetime, None when never compacted."""
+    row = conn.execute(
+        'SELECT compacted_before FROM retention_watermarks WHERE mac_address = ? AND tier = ?', (mac_address, tier)
+    ).fetchone()
+    return datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S') if row else None
+
+
+def tier_ranges(conn, mac_address, start=None, end=None):
+    """
+    Splits [start, end) into [(tier, range_start, range_end), ...] in time order, where tier is
+    'hourly', 'minute' or 'raw' - the finest tier that still holds data for that range.
+    None bounds mean open ranges.
+    """
+    raw_since = compacted_before(conn, mac_address, 'raw')
+    minute_since = compacted_before(conn, mac_address, 'minute')
+    bounds = [('hourly', None, minute_since), ('minute', minute_since, raw_since), ('raw', raw_since, None)]
+    ranges = []
+    for tier, tier_start, tier_end in bounds:
+        lo = max((t for t in (start, tier_start) if t is not None), default=None)
+        hi = min((t for t in (end, tier_end) if t is not None), default=None)
+        if (tier == 'minute' and raw_since is None) or (tier == 'hourly' and minute_since is None):
+            continue
+        if lo is None or hi is None or lo < hi:
+            ranges.append((tier, lo, hi))
+    return ranges
+
+
+# Zapytania stronicowane po kluczu: pierwsze dwie kolumny (czas, id) to klucz ostatniego wiersza strony,
+# od którego zaczyna się następna; kubełki i minuty są unikalne, więc ich drugą kolumną jest stałe 0
+SERIES_QUERIES = {
+    'hourly': f'''
+        SELECT bucket, 0, bucket || ':00', temp_sum / NULLIF(temp_n, 0), pres_sum / NULLIF(pres_n, 0),
+               hum_sum / NULLIF(hum_n, 0), sun_sum / NULLIF(sun_n, 0), wind_max, prcp_max
+        FROM {HOURLY_TABLE}
+        WHERE mac_address = ? AND bucket >= ? AND bucket < ? AND (bucket > ? OR 0 > ?)
+        ORDER BY bucket LIMIT ?
+    ''',
+    'minute': f'''
+        SELECT minute, 0, minute || ':00', temp_sum / NULLIF(temp_n, 0), pres_sum / NULLIF(pres_n, 0),
+               hum_sum / NULLIF(hum_n, 0), sun_sum / NULLIF(sun_n, 0), wind_max, prcp_max
+        FROM {MINUTE_TABLE}
+        WHERE mac_address = ? AND minute >= ? AND minute < ? AND (minute > ? OR 0 > ?)
+        ORDER BY minute LIMIT ?
+    ''',
+    'raw': '''
+        SELECT server_timestamp, id, server_timestamp, temperature, pressure, humidity, sunshine, wind_speed, precipitation
+        FROM measurements
+        WHERE mac_address = ? AND server_timestamp >= ? AND server_timestamp < ? AND (server_timestamp > ? OR id > ?)
+        ORDER BY server_timestamp, id LIMIT ?
+    ''',
+}
+
+
+def iter_series_pages(borrow, mac_address, start=None, end=None, chunk_size=10000):
+    """
+    Time series (timestamp, temperature, pressure, humidity, sunshine, wind_speed, precipitation)
+    of a station in [start, end) over all tiers, in lists of at most `chunk_size` rows: raw rows
+    where they are kept, per-minute and hourly averages (wind speed and precipitation: per-minute
+    and hourly maxima, as in the dashboard rollups) for compacted ranges.
+
+    Every page is a separate keyset query over a connection from `borrow()` (a context manager),
+    so no connection or read transaction is held between pages. A compaction running between
+    two pages can move the rows not yet read to a coarser tier, where the export skips them.
+    """
+    # Kubełki i minuty mają postać 'YYYY-MM-DD HH:MM', granice zakresów to pełne godziny
+    formats = {'hourly': '%Y-%m-%d %H:%M', 'minute': '%Y-%m-%d %H:%M', 'raw': '%Y-%m-%d %H:%M:%S'}
+    with borrow() as conn:
+        ranges = tier_ranges(conn, mac_address, start, end)
+    for tier, lo, hi in ranges:
+        fmt = formats[tier]
+        # Otwarta górna granica nie może wyglądać na liczbę: server_timestamp ma typ TIMESTAMP
+        # (afinitet NUMERIC), więc '9999' byłoby porównane jako liczba i wykluczyłoby każdy tekst
+        after, after_id = lo.strftime(fmt) if lo else '', -1
+        hi = hi.strftime(fmt) if hi else '9999-12-31 23:59:59'
+        while True:
+            with borrow() as conn:
+                rows = conn.execute(SERIES_QUERIES[tier], (mac_address, after, hi, after, after_id, chunk_size)).fetchall()
+            if not rows:
+                break
+            after, after_id = rows[-1][0], rows[-1][1]
+            yield [tuple(row)[2:] for row in rows]
+            if len(rows) < chunk_size:
+                break
+
+
+def iter_series(conn, mac_address, start=None, end=None, chunk_size=10000):
+    """iter_series_pages over one connection."""
+    return iter_series_pages(lambda: nullcontext(conn), mac_address, start, end, chunk_size)
+
+
+def read_series(conn, mac_address, start=None, end=None):
+    """The whole iter_series range as one list."""
+    return [row for rows in iter_series(conn, mac_address, start, end) for row in rows]
+
+
+def latest_timestamp(conn, mac_address):
+    """Newest reading of a station ('YYYY-MM-DD HH:MM:SS'), looking into the compacted tiers when no raw rows are left."""
+    for query in (
+        'SELECT MAX(server_timestamp) FROM measurements WHERE mac_address = ?',
+        f"SELECT MAX(minute) || ':00' FROM {MINUTE_TABLE} WHERE mac_address = ?",
+        f"SELECT MAX(bucket) || ':00' FROM {HOURLY_TABLE} WHERE mac_address = ?",
+    ):
+        latest = conn.execute(query, (mac_address,)).fetchone()[0]
+        if latest:
+            return latest
+    return None
+
+
+def _free_bytes(conn):
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    return conn.execute('PRAGMA freelist_count').fetchone()[0] * page_size
+
+
+class RetentionJob:
+    def __init__(self, raw_retention=RAW_RETENTION, minute_retention=MINUTE_RETENTION, interval=3600.0,
+                 batch_hours=BATCH_HOURS, batch_pause=BATCH_PAUSE, before_compact=None):
+        """
+        before_compact(mac_address, first_hour, end_hour) is called before raw rows of
+        [first_hour, end_hour) are deleted (feature_store: make sure the hourly aggregates exist).
+        """
+        self.raw_retention = raw_retention
+        self.minute_retention = minute_retention
+        self.interval = interval
+        self.batch_hours = batch_hours
+        self.batch_pause = batch_pause
+        self.before_compact = before_compact
+        self._stop = threading.Event()
+        self._thread = None
+        self._runs = 0
+        self._last_run = None
+        self._last_error = None
+        self._totals = {'raw_rows_compacted': 0, 'minute_rows_deleted': 0, 'bytes_reclaimed': 0}
+
+    def start(self):
+        """Starts the background job (idempotent); the first run starts after one interval."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+        self._thread.start()
+        log.info("Retention job started (raw %s d, 1-min %s d, every %ss)",
+                 self.raw_retention.days, self.minute_retention.days, self.interval)
+
+    def stop(self, timeout=10.0):
+        thread = self._thread
+        if thread is None:
+            return
+        self._stop.set()
+        thread.join(timeout)
+        self._thread = None
+
+    def _stations_before(self, table, column, cutoff):
+        with db.reader() as conn:
+            return [row[0] for row in conn.execute(
+                f'SELECT DISTINCT mac_address FROM {table} WHERE {column} < ?', (cutoff,)
+            )]
+
+    def _set_watermark(self, conn, mac_address, tier, value):
+        conn.execute('''
+            INSERT INTO retention_watermarks (mac_address, tier, compacted_before) VALUES (?, ?, ?)
+            ON CONFLICT (mac_address, tier) DO UPDATE SET compacted_before = MAX(compacted_before, excluded.compacted_before)
+        ''', (mac_address, tier, value))
+
+    def compact_raw(self, mac_address, cutoff):
+        """Moves the raw rows of a station older than `cutoff` (whole hour) into the 1-minute tier."""
+        fmt = '%Y-%m-%d %H:%M:%S'
+        compacted = 0
+        compact_sql = _compact_raw_sql()
+        while not self._stop.is_set():
+            with db.reader() as conn:
+                first = conn.execute('SELECT MIN(server_timestamp) FROM measurements WHERE mac_address = ? AND server_timestamp < ?',
+                                     (mac_address, cutoff.strftime(fmt))).fetchone()[0]
+            if first is None:
+                break
+            first_hour = datetime.strptime(first[:13], '%Y-%m-%d %H')
+            batch_end = min(cutoff, first_hour + timedelta(hours=self.batch_hours))
+            if self.before_compact is not None:
+                self.before_compact(mac_address, first_hour, batch_end)
+            with db.writer() as conn:
+                conn.execute(compact_sql, (mac_address, batch_end.strftime(fmt)))
+                cur = conn.execute('DELETE FROM measurements WHERE mac_address = ? AND server_timestamp < ?',
+                                   (mac_address, batch_end.strftime(fmt)))
+                self._set_watermark(conn, mac_address, 'raw', batch_end.strftime(fmt))
+            compacted += cur.rowcount
+            time.sleep(self.batch_pause)
+        return compacted
+
+    def expire_minutes(self, mac_address, cutoff):
+        """Deletes the 1-minute aggregates of a station older than `cutoff` (the hourly rollups stay)."""
+        deleted = 0
+        while not self._stop.is_set():
+            with db.reader() as conn:
+                first = conn.execute(f'SELECT MIN(minute) FROM {MINUTE_TABLE} WHERE mac_address = ? AND minute < ?',
+                                     (mac_address, cutoff.strftime('%Y-%m-%d %H:%M'))).fetchone()[0]
+            if first is None:
+                break
+            batch_end = min(cutoff, datetime.strptime(first[:13], '%Y-%m-%d %H') + timedelta(hours=self.batch_hours * 12))
+            with db.writer() as conn:
+                cur = conn.execute(f'DELETE FROM {MINUTE_TABLE} WHERE mac_address = ? AND minute < ?',
+                                   (mac_address, batch_end.strftime('%Y-%m-%d %H:%M')))
+                self._set_watermark(conn, mac_address, 'minute', batch_end.strftime('%Y-%m-%d %H:%M:%S'))
+            deleted += cur.rowcount
+            time.sleep(self.batch_pause)
+        return deleted
+
+    def run_once(self, now=None):
+        """One retention pass over all stations. Returns the report dict."""
+        start = time.time()
+        now = now or server_now()
+        raw_cutoff = (now - self.raw_retention).replace(minute=0, second=0, microsecond=0)
+        minute_cutoff = (now - self.minute_retention).replace(minute=0, second=0, microsecond=0)
+        with db.reader() as conn:
+            free_before = _free_bytes(conn)
+
+        raw_rows = 0
+        for mac_address in self._stations_before('measurements', 'server_timestamp', raw_cutoff.strftime('%Y-%m-%d %H:%M:%S')):
+            raw_rows += self.compact_raw(mac_address, raw_cutoff)
+        minute_rows = 0
+        for mac_address in self._stations_before(MINUTE_TABLE, 'minute', minute_cutoff.strftime('%Y-%m-%d %H:%M')):
+            minute_rows += self.expire_minutes(mac_address, minute_cutoff)
+
+        with db.reader() as conn:
+            reclaimed = max(0, _free_bytes(conn) - free_before)
+        report = {
+            'raw_cutoff': raw_cutoff.strftime('%Y-%m-%d %H:%M:%S'),
+            'minute_cutoff': minute_cutoff.strftime('%Y-%m-%d %H:%M:%S'),
+            'raw_rows_compacted': raw_rows,
+            'minute_rows_deleted': minute_rows,
+            'bytes_reclaimed': reclaimed,
+            'duration_s': round(time.time() - start, 3),
+        }
+        self._runs += 1
+        self._last_run = report
+        for key in self._totals:
+            self._totals[key] += report[key]
+        if raw_rows or minute_rows:
+            log.info("Retention: compacted %s raw rows, deleted %s 1-min rows, %.1f MiB reusable in %ss",
+                     raw_rows, minute_rows, reclaimed / 2 ** 20, report['duration_s'])
+        return report
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self._last_error = str(e)
+                log.error("Retention run failed: %s", e)
+
+    def stats(self):
+        return {
+            'running': self._thread is not None and self._thread.is_alive(),
+            'raw_retention_days': self.raw_retention.days,
+            'minute_retention_days': self.minute_retention.days,
+            'runs': self._runs,
+            'last_run': self._last_run,
+            'totals': dict(self._totals),
+            'last_error': self._last_error,
+        }
+
+
+def main():
+    from feature_store import FeatureStore
+
+    parser = argparse.ArgumentParser(description='Runs one retention pass (compaction of old measurements).')
+    parser.add_argument('--db', default=db.DB_PATH)
+    parser.add_argument('--raw-days', type=int, default=RAW_RETENTION.days)
+    parser.add_argument('--minute-days', type=int, default=MINUTE_RETENTION.days)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    db.configure(args.db)
+
+    job = RetentionJob(timedelta(days=args.raw_days), timedelta(days=args.minute_days),
+                       before_compact=FeatureStore().ensure_aggregates)
+    log.info("Retention report: %s", job.run_once())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Materialized 30-minute and 1-hour rollups of the measurements for the device dashboard.
+
+Each rollup row holds, per (mac_address, bucket), the number of readings, the sums and
+non-NULL counts of temperature/pressure/humidity/sunshine and the maxima of wind speed and
+precipitation, so AVG and MAX of any set of whole buckets can be read without touching the
+raw 5-second rows. Buckets are labelled like the dashboard query ('YYYY-MM-DD HH:MM').
+
+The rollups are maintained by an ingest write hook in the same transaction as the INSERT
+(the new rows are re-read by rowid and folded into the buckets with an UPSERT), and can be
+rebuilt or checked against the raw-table query:
+
+    python -m rollups rebuild [--mac AA:BB:...] [--db measurements.db]
+    python -m rollups check [--mac AA:BB:...] [--days 3]
+"""
+import argparse
+import logging
+import math
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+import db
+
+log = logging.getLogger(__name__)
+
+# Rozdzielczość -> (tabela, wyrażenie kubełka na server_timestamp, długość kubełka)
+ROLLUPS = {
+    '30m': (
+        'measurement_rollups_30m',
+        "strftime('%Y-%m-%d %H', server_timestamp) || ':' || printf('%02d', (strftime('%M', server_timestamp) / 30) * 30)",
+        timedelta(minutes=30),
+    ),
+    '1h': (
+        'measurement_rollups_1h',
+        "strftime('%Y-%m-%d %H', server_timestamp) || ':00'",
+        timedelta(hours=1),
+    ),
+}
+
+# Klucze wierszy zwracanych panelowi (jak w dawnym zapytaniu GROUP BY)
+AGGREGATED_KEYS = ['time_window', 'avg_temp', 'avg_pres', 'avg_hum', 'max_wind', 'avg_sun', 'max_perc']
+
+# Kolumny uśredniane (suma + liczba wartości nie-NULL) i maksymalizowane
+AVG_COLUMNS = {'temp': 'temperature', 'pres': 'pressure', 'hum': 'humidity', 'sun': 'sunshine'}
+MAX_COLUMNS = {'wind': 'wind_speed', 'prcp': 'precipitation'}
+
+
+def _create_table_sql(table):
+    avg_cols = ', '.join(f'{name}_sum REAL NOT NULL, {name}_n INTEGER NOT NULL' for name in AVG_COLUMNS)
+    max_cols = ', '.join(f'{name}_max REAL' for name in MAX_COLUMNS)
+    return f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            mac_address TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            readings INTEGER NOT NULL,
+            {avg_cols},
+            {max_cols},
+            PRIMARY KEY (mac_address, bucket)
+        ) WITHOUT ROWID
+    '''
+
+
+def _aggregate_select_sql(bucket_expr, where):
+    # TOTAL zamiast SUM: zawsze REAL, nigdy NULL (wygodne przy dodawaniu w UPSERT)
+    sums = ', '.join(f'TOTAL({column}), COUNT({column})' for column in AVG_COLUMNS.values())
+    maxima = ', '.join(f'MAX({column})' for column in MAX_COLUMNS.values())
+    return f'''
+        SELECT mac_address, {bucket_expr} AS bucket, COUNT(*), {sums}, {maxima}
+        FROM measurements
+        WHERE {where}
+        GROUP BY mac_address, bucket
+    '''
+
+
+def _upsert_sql(table, bucket_expr, where):
+    columns = ['readings'] + [f'{name}_{part}' for name in AVG_COLUMNS for part in ('sum', 'n')]
+    additions = ', '.join(f'{column} = {column} + excluded.{column}' for column in columns)
+    # Skalarny MAX(a, b) zwraca NULL, gdy któryś argument jest NULL
+    maxima = ', '.join(
+        f'{name}_max = MAX(COALESCE({name}_max, excluded.{name}_max), COALESCE(excluded.{name}_max, {name}_max))'
+        for name in MAX_COLUMNS
+    )
+    # "WHERE true" rozstrzyga niejednoznaczność składni INSERT ... SELECT ... ON CONFLICT
+    return f'''
+        INSERT INTO {table}
+        SELECT * FROM ({_aggregate_select_sql(bucket_expr, where)}) WHERE true
+        ON CONFLICT (mac_address, bucket) DO UPDATE SET {additions}, {maxima}
+    '''
+
+
+def schema_statements():
+    """Tables plus the initial fill from the existing measurements (schema migration)."""
+    statements = []
+    for table, bucket_expr, _ in ROLLUPS.values():
+        statements.append(_create_table_sql(table))
+        statements.append(f'INSERT OR REPLACE INTO {table} {_aggregate_select_sql(bucket_expr, "1")}')
+    return statements
+
+
+def rows_written(conn, rows, first_id, last_id):
+    """Ingest write hook: folds the measurements with ids first_id..last_id into every rollup."""
+    for table, bucket_expr, _ in ROLLUPS.values():
+        conn.execute(_upsert_sql(table, bucket_expr, 'id BETWEEN ? AND ?'), (first_id, last_id))
+
+
+def _raw_since(conn, mac_address):
+    """Raw-tier watermark of retention.py (None when nothing was compacted or before its migration)."""
+    try:
+        row = conn.execute("SELECT compacted_before FROM retention_watermarks WHERE mac_address = ? AND tier = 'raw'",
+                           (mac_address,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S') if row else None
+
+
+def rebuild(mac_address=None):
+    """
+    Recomputes the rollups from the raw measurements (one station per transaction). Buckets
+    older than the retention watermark have no raw rows left and are kept as they are.
+    """
+    with db.reader() as conn:
+        if mac_address is None:
+            stations = [row[0] for row in conn.execute('SELECT DISTINCT mac_address FROM measurements')]
+        else:
+            stations = [mac_address]
+    for mac in stations:
+        start = time.time()
+        with db.writer() as conn:
+            raw_since = _raw_since(conn, mac) or datetime.min
+            for table, bucket_expr, _ in ROLLUPS.values():
+                conn.execute(f'DELETE FROM {table} WHERE mac_address = ? AND bucket >= ?', (mac, raw_since.strftime('%Y-%m-%d %H:%M')))
+                conn.execute(f'INSERT INTO {table} {_aggregate_select_sql(bucket_expr, "mac_address = ? AND server_timestamp >= ?")}',
+                             (mac, raw_since.strftime('%Y-%m-%d %H:%M:%S')))
+        log.info("Rollups rebuilt for %s in %.1fs", mac, time.time() - start)
+    return len(stations)
+
+
+def _bucket_start(timestamp, length):
+    seconds = (timestamp - datetime(timestamp.year, timestamp.month, timestamp.day)).total_seconds()
+    return datetime(timestamp.year, timestamp.month, timestamp.day) + timedelta(seconds=seconds // length.total_seconds() * length.total_seconds())
+
+
+def query_aggregated(conn, mac_address, start, end, resolution='30m', raw_since=None):
+    """
+    Averages/maxima per bucket for readings in [start, end], like the raw GROUP BY query of
+    the dashboard. Whole buckets come from the rollup table; a bucket cut by `start` or `end`
+    is aggregated from the raw rows of its covered part only, unless it lies before `raw_since`
+    (retention watermark: no raw rows left), where the whole bucket is used.
+    Returns dicts with time_window, avg_temp, avg_pres, avg_hum, max_wind, avg_sun, max_perc.
+    """
+    table, bucket_expr, length = ROLLUPS[resolution]
+    first_whole = _bucket_start(start, length)
+    if first_whole < start and (raw_since is None or first_whole + length > raw_since):
+        first_whole += length
+    last_whole = _bucket_start(end, length)
+    if end < last_whole + length - timedelta(seconds=1) and (raw_since is None or last_whole + length > raw_since):
+        last_whole -= length  # koniec zakresu tnie kubełek - policz go z surowych danych
+
+    fmt = '%Y-%m-%d %H:%M:%S'
+    edge_ranges = []
+    if start < first_whole:
+        edge_ranges.append((start, min(end, first_whole - timedelta(seconds=1))))
+    if last_whole >= first_whole and end >= last_whole + length:
+        edge_ranges.append((last_whole + length, end))
+    elif last_whole < first_whole and end >= first_whole:
+        edge_ranges.append((first_whole, end))
+
+    rows = []
+    for edge_start, edge_end in edge_ranges:
+        rows.extend(conn.execute(f'''
+            SELECT {bucket_expr} AS time_window,
+                   AVG(temperature), AVG(pressure), AVG(humidity), MAX(wind_speed), AVG(sunshine), MAX(precipitation)
+            FROM measurements
+            WHERE mac_address = ? AND server_timestamp BETWEEN ? AND ?
+            GROUP BY time_window
+        ''', (mac_address, edge_start.strftime(fmt), edge_end.strftime(fmt))).fetchall())
+    if last_whole >= first_whole:
+        rows.extend(conn.execute(f'''
+            SELECT bucket,
+                   temp_sum / NULLIF(temp_n, 0), pres_sum / NULLIF(pres_n, 0), hum_sum / NULLIF(hum_n, 0),
+                   wind_max, sun_sum / NULLIF(sun_n, 0), prcp_max
+            FROM {table}
+            WHERE mac_address = ? AND bucket BETWEEN ? AND ?
+        ''', (mac_address, first_whole.strftime('%Y-%m-%d %H:%M'), last_whole.strftime('%Y-%m-%d %H:%M'))).fetchall())
+
+    return sorted((dict(zip(AGGREGATED_KEYS, tuple(row))) for row in rows), key=lambda row: row['time_window'])
+
+
+def read_buckets(conn, mac_address, buckets, resolution='30m'):
+    """Rollup rows of the given bucket labels, in the format of query_aggregated (live dashboard push)."""
+    table, _, _ = ROLLUPS[resolution]
+    rows = conn.execute(f'''
+        SELECT bucket,
+               temp_sum / NULLIF(temp_n, 0), pres_sum / NULLIF(pres_n, 0), hum_sum / NULLIF(hum_n, 0),
+               wind_max, sun_sum / NULLIF(sun_n, 0), prcp_max
+        FROM {table}
+        WHERE mac_address = ? AND bucket IN ({', '.join('?' * len(buckets))})
+        ORDER BY bucket
+    ''', (mac_address, *buckets)).fetchall()
+    return [dict(zip(AGGREGATED_KEYS, tuple(row))) for row in rows]
+
+
+def query_aggregated_raw(conn, mac_address, start, end, resolution='30m'):
+    """The same aggregation straight from the raw measurements (reference for `check`)."""
+    _, bucket_expr, _ = ROLLUPS[resolution]
+    fmt = '%Y-%m-%d %H:%M:%S'
+    rows = conn.execute(f'''
+        SELECT {bucket_expr} AS time_window,
+               AVG(temperature), AVG(pressure), AVG(humidity), MAX(wind_speed), AVG(sunshine), MAX(precipitation)
+        FROM measurements
+        WHERE mac_address = ? AND server_timestamp BETWEEN ? AND ?
+        GROUP BY time_window
+        ORDER BY time_window ASC
+    ''', (mac_address, start.strftime(fmt), end.strftime(fmt))).fetchall()
+    return [dict(zip(AGGREGATED_KEYS, tuple(row))) for row in rows]
+
+
+def _same(a, b):
+    if isinstance(a, float) or isinstance(b, float):
+        return a is not None and b is not None and math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9)
+    return a == b
+
+
+def check(mac_address=None, days=3):
+    """
+    Compares the rollup-based aggregation of the last `days` days of every station (not older
+    than the retention watermark) with the raw-table query. Sums are folded batch by batch, so averages may differ from AVG over the
+    raw rows in the last bits; they are compared with a relative tolerance of 1e-9.
+    Returns {resolution: [(mac_address, time_window, rollup row, raw row), ...]}.
+    """
+    mismatches = {}
+    with db.reader() as conn:
+        if mac_address is None:
+            stations = [row[0] for row in conn.execute('SELECT DISTINCT mac_address FROM measurements')]
+        else:
+            stations = [mac_address]
+        for resolution in ROLLUPS:
+            mismatches[resolution] = []
+            for mac in stations:
+                latest = conn.execute('SELECT MAX(server_timestamp) FROM measurements WHERE mac_address = ?', (mac,)).fetchone()[0]
+                if latest is None:
+                    continue
+                end = datetime.strptime(latest, '%Y-%m-%d %H:%M:%S')
+                start = max(end - timedelta(days=days), _raw_since(conn, mac) or datetime.min)
+                from_rollup = {row['time_window']: row for row in query_aggregated(conn, mac, start, end, resolution)}
+                from_raw = {row['time_window']: row for row in query_aggregated_raw(conn, mac, start, end, resolution)}
+                for window in sorted(from_rollup.keys() | from_raw.keys()):
+                    a, b = from_rollup.get(window), from_raw.get(window)
+                    if a is None or b is None or not all(_same(a[key], b[key]) for key in a):
+                        mismatches[resolution].append((mac, window, a, b))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuilds or checks the measurement rollup tables.')
+    parser.add_argument('command', choices=['rebuild', 'check'])
+    parser.add_argument('--db', default=db.DB_PATH)
+    parser.add_argument('--mac', help='only this station')
+    parser.add_argument('--days', type=int, default=3, help='check: days back from the latest reading')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    db.configure(args.db)
+
+    if args.command == 'rebuild':
+        start = time.time()
+        stations = rebuild(args.mac)
+        log.info("Rollups rebuilt for %s stations in %.1fs", stations, time.time() - start)
+        return
+
+    mismatches = check(args.mac, args.days)
+    for resolution, rows in mismatches.items():
+        log.info("Rollup %s: %s mismatched buckets", resolution, len(rows))
+        for mac, window, from_rollup, from_raw in rows[:20]:
+            log.warning("  %s %s: rollup=%s raw=%s", mac, window, from_rollup, from_raw)
+    if any(mismatches.values()):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
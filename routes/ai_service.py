@@ -1,123 +1,199 @@
-from flask import Blueprint, request, jsonify, g
-import sqlite3
+from flask import Blueprint, request, jsonify
+import logging
+import db
+import data_coverage
+from data_coverage import HourBitmap
 import threading
-import uuid
 import ai_main  # Importujemy nasz zrefaktoryzowany skrypt AI
+from ai_tasks import TaskQueue
+from prediction_cache import PredictionCache
 from datetime import datetime, timedelta
 
 bp = Blueprint('ai_service', __name__, url_prefix='/api/ai')
+log = logging.getLogger(__name__)
 
-# Globalny "magazyn" na zadania i ich wyniki
-# W produkcji lepiej użyć bazy danych lub Redis
-tasks = {}
+# Zadania AI: ograniczona kolejka wykonywana przez pulę procesów, stan i wyniki w tabeli ai_tasks
+# (start/stop w app.create_app)
+task_queue = TaskQueue()
 
-def run_ai_task(task_id, start_date, end_date):
-    """Funkcja, która będzie uruchomiona w osobnym wątku."""
-    print(f"Rozpoczynam zadanie AI: {task_id}")
-    tasks[task_id]['status'] = 'RUNNING'
+# Wyniki predykcji pojedynczych godzin (klucz: stacja, godzina, wersja modeli, znacznik danych);
+# unieważniane przez hook zapisu pomiarów zarejestrowany w app.create_app
+prediction_cache = PredictionCache(ai_main.model_registry.disk_version)
+
+# Godziny z danymi każdej stacji (bitmapa w pamięci, trwała w daily_coverage), aktualizowana
+# hookiem zapisu pomiarów zarejestrowanym w app.create_app
+hour_bitmap = HourBitmap()
+
+# Single-flight: identyczne żądania predykcji (stacja, zakres) złożone w trakcie liczenia
+# dołączają do już zleconego zadania zamiast uruchamiać własny przebieg
+_inflight = {}  # (mac_address, start_date, end_date, probabilities) -> task_id
+_inflight_lock = threading.Lock()
+_coalesced = 0
+
+# Maksymalna liczba par (stacja, godzina) w jednym żądaniu predict_batch
+MAX_BATCH_TARGETS = 20000
+
+# Najdłuższe oczekiwanie long-poll statusu zadania (s); każde czekające żądanie zajmuje wątek serwera
+MAX_STATUS_WAIT = 30.0
+
+def _cached_hour(start_date, end_date):
+    """Godzina predykcji, którą można cache'ować (start = koniec, pełna godzina), inaczej None."""
     try:
-        result = ai_main.run_prediction(start_date, end_date)
-        
-        # --- NOWA LOGIKA OBSŁUGI WYNIKU ---
-        # Sprawdzamy, czy wynik jest słownikiem z kluczem 'error'
-        if isinstance(result, dict) and 'error' in result:
-            # Jeśli tak, to jest to błąd zwrócony przez ai_main
-            tasks[task_id]['status'] = 'FAILURE'
-            tasks[task_id]['result'] = result # Przekazujemy słownik z błędem
-        else:
-            # W przeciwnym razie, wszystko jest ok
-            tasks[task_id]['status'] = 'SUCCESS'
-            tasks[task_id]['result'] = result
-            
-    except Exception as e:
-        # Ten blok złapie błędy, które nie zostały obsłużone wewnątrz run_prediction
-        import traceback
-        print(f"KRYTYCZNY błąd w wątku AI dla zadania {task_id}: {e}")
-        traceback.print_exc()
-        tasks[task_id]['status'] = 'FAILURE'
-        tasks[task_id]['result'] = {'error': 'Wystąpił nieoczekiwany błąd serwera.'}
-        
-    print(f"Zakończono zadanie AI: {task_id} ze statusem {tasks[task_id]['status']}")
+        start_dt = datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+    if start_date != end_date or start_dt != start_dt.replace(minute=0, second=0):
+        return None
+    return start_dt
+
+def _prediction_done(flight_key, task_id, cache_key, status, result):
+    """Koniec zadania predict: zwolnij klucz single-flight i zapisz udany wynik w cache."""
+    with _inflight_lock:
+        if _inflight.get(flight_key) == task_id:
+            del _inflight[flight_key]
+    if status == 'SUCCESS' and cache_key is not None:
+        prediction_cache.put(cache_key, result)
 
+def _queue_full_response():
+    return jsonify({'error': 'Serwer jest zajęty innymi analizami AI, spróbuj ponownie za chwilę.'}), 503, {'Retry-After': '10'}
 
-def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect('measurements.db')
-    return db
+
+# Pooled reader connection for the current request, see db.py
+get_db = db.get_db
 
 @bp.route('/check_data_availability', methods=['POST'])
 def check_data_availability():
     data = request.get_json()
-    if not data or 'target_timestamp' not in data:
-        return jsonify({'error': 'Missing target_timestamp'}), 400
+    if not data or 'target_timestamp' not in data or 'mac_address' not in data:
+        return jsonify({'error': 'Missing target_timestamp or mac_address'}), 400
+    mac_address = data['mac_address']
 
     try:
         target_dt = datetime.strptime(data['target_timestamp'], '%Y-%m-%d %H:%M:%S')
-        start_check_dt = target_dt - timedelta(hours=48)
-        
-        conn = get_db()
-        cur = conn.cursor()
-        
+        # Bitmapa godzin stacji w pamięci (data_coverage.HourBitmap) - bez zapytań do bazy
+        has_data_for_target_hour, hours_with_data = hour_bitmap.availability(mac_address, target_dt)
+
         # --- ZMIANA 1: SPRAWDZENIE DANYCH DLA WYBRANEJ GODZINY ---
         # Sprawdzamy, czy istnieje jakikolwiek pomiar w godzinie, którą chcemy przewidzieć.
-        # Tworzymy okno czasowe od HH:00:00 do HH:59:59.
-        target_hour_start = target_dt.strftime('%Y-%m-%d %H:00:00')
-        target_hour_end = target_dt.strftime('%Y-%m-%d %H:59:59')
-        
-        cur.execute("""
-            SELECT 1 FROM measurements WHERE server_timestamp BETWEEN ? AND ? LIMIT 1
-        """, (target_hour_start, target_hour_end))
-        
-        has_data_for_target_hour = cur.fetchone() is not None
-        
         if not has_data_for_target_hour:
             return jsonify({'available': False, 'reason': 'Brak danych dla wybranej godziny.'})
 
         # --- ZMIANA 2: SPRAWDZENIE DANYCH HISTORYCZNYCH ---
-        # Ta logika pozostaje, ale teraz wiemy, że godzina docelowa ma dane.
-        cur.execute("""
-            SELECT COUNT(DISTINCT strftime('%Y-%m-%d %H', server_timestamp))
-            FROM measurements
-            WHERE server_timestamp BETWEEN ? AND ?
-        """, (start_check_dt.strftime('%Y-%m-%d %H:%M:%S'), target_dt.strftime('%Y-%m-%d %H:%M:%S')))
-        
-        hours_with_data = cur.fetchone()[0]
-        
-        is_available = hours_with_data > 38 # Wymagamy danych z ~80% okresu 48h
+        # hours_with_data: godziny z danymi w 48 godzinach poprzedzających godzinę docelową
+        is_available = hours_with_data >= data_coverage.MIN_HISTORY_HOURS # Wymagamy danych z ~80% okresu 48h
         
         reason = "Dane dostępne." if is_available else "Niewystarczająca ilość danych historycznych (48h)."
         
         return jsonify({'available': is_available, 'reason': reason})
 
     except Exception as e:
-        print(f"Błąd w check_data_availability: {e}")
+        log.error("Błąd w check_data_availability: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+@bp.route('/coverage/<mac_address>', methods=['GET'])
+def coverage_month(mac_address):
+    """Pokrycie godzinowe całego miesiąca (?month=YYYY-MM): godziny z danymi i godziny gotowe do predykcji."""
+    try:
+        month = datetime.strptime(request.args.get('month', ''), '%Y-%m')
+    except ValueError:
+        return jsonify({'error': 'Invalid or missing month, use YYYY-MM'}), 400
+    try:
+        days = hour_bitmap.month(mac_address, month.year, month.month)
+        return jsonify({'month': month.strftime('%Y-%m'), 'min_history_hours': data_coverage.MIN_HISTORY_HOURS, 'days': days})
+    except Exception as e:
+        log.error("Błąd w coverage_month: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 @bp.route('/predict', methods=['POST'])
 def start_prediction():
     data = request.get_json()
-    if not data or 'start_date' not in data or 'end_date' not in data:
-        return jsonify({'error': 'Missing start_date or end_date'}), 400
+    if not data or 'start_date' not in data or 'end_date' not in data or 'mac_address' not in data:
+        return jsonify({'error': 'Missing start_date, end_date or mac_address'}), 400
 
     start_date = data['start_date']
     end_date = data['end_date']
-    
-    # Generujemy unikalne ID dla zadania
-    task_id = str(uuid.uuid4())
-    tasks[task_id] = {'status': 'PENDING', 'result': None}
+    mac_address = data['mac_address']
+    # Tryb z prawdopodobieństwami: pełna ścieżka M1-M4 i łączny rozkład kategorii w wyniku
+    probabilities = bool(data.get('probabilities', False))
+
+    # Ta sama godzina, te same dane i modele - wynik z cache, bez uruchamiania zadania
+    cache_key = None
+    hour = _cached_hour(start_date, end_date)
+    if hour is not None:
+        try:
+            conn = get_db()
+            cache_key = prediction_cache.key(conn, mac_address, hour)
+            cached = prediction_cache.get(conn, cache_key)
+        except Exception as e:
+            # Brak plików modeli albo błąd bazy - liczymy bez cache, zadanie zgłosi właściwy błąd
+            log.warning("Cache predykcji niedostępny: %s", e)
+            cache_key, cached = None, None
+        # Wynik zapisany bez prawdopodobieństw nie wystarcza dla trybu z prawdopodobieństwami
+        if cached is not None and (not probabilities or all('probabilities' in row for row in cached)):
+            return jsonify({'status': 'SUCCESS', 'result': cached, 'cached': True}), 200
 
-    # Uruchamiamy AI w osobnym wątku, aby nie blokować odpowiedzi
-    thread = threading.Thread(target=run_ai_task, args=(task_id, start_date, end_date))
-    thread.daemon = True # Wątek zakończy się, gdy główna aplikacja się zamknie
-    thread.start()
+    # Zadanie trafia do kolejki puli procesów AI; przy pełnej kolejce odpowiadamy 503
+    global _coalesced
+    flight_key = (mac_address, start_date, end_date, probabilities)
+    with _inflight_lock:
+        task_id = _inflight.get(flight_key)
+        if task_id is not None and task_queue.is_active(task_id):
+            _coalesced += 1
+            return jsonify({'task_id': task_id, 'coalesced': True}), 202
+        # on_done czyta task_id dopiero po zwolnieniu _inflight_lock, czyli już po przypisaniu
+        task_id = task_queue.submit('predict', start_date, end_date, mac_address, probabilities,
+                                    on_done=lambda status, result: _prediction_done(flight_key, task_id, cache_key, status, result))
+        if task_id is None:
+            return _queue_full_response()
+        _inflight[flight_key] = task_id
 
     # Natychmiast zwracamy ID zadania
     return jsonify({'task_id': task_id}), 202 # 202 Accepted
 
+def _expand_batch_targets(data):
+    """
+    Zamienia treść żądania predict_batch na listę par (mac_address, 'YYYY-MM-DD HH:00:00').
+    Obsługuje jawne cele ('targets') oraz zakresy godzin ('ranges').
+    """
+    targets = []
+    for item in data.get('targets', []):
+        targets.append((item['mac_address'], item['timestamp']))
+    for item in data.get('ranges', []):
+        current = datetime.strptime(item['start'], '%Y-%m-%d %H:%M:%S').replace(minute=0, second=0)
+        end = datetime.strptime(item['end'], '%Y-%m-%d %H:%M:%S')
+        while current <= end:
+            targets.append((item['mac_address'], current.strftime('%Y-%m-%d %H:%M:%S')))
+            current += timedelta(hours=1)
+            if len(targets) > MAX_BATCH_TARGETS:
+                raise ValueError(f'Too many targets (max {MAX_BATCH_TARGETS})')
+    return targets
+
+@bp.route('/predict_batch', methods=['POST'])
+def start_batch_prediction():
+    data = request.get_json()
+    if not data or not (data.get('targets') or data.get('ranges')):
+        return jsonify({'error': 'Missing targets or ranges'}), 400
+
+    try:
+        targets = _expand_batch_targets(data)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid batch request: {e}'}), 400
+    if len(targets) > MAX_BATCH_TARGETS:
+        return jsonify({'error': f'Too many targets (max {MAX_BATCH_TARGETS})'}), 400
+
+    task_id = task_queue.submit('predict_batch', targets, bool(data.get('probabilities', False)))
+    if task_id is None:
+        return _queue_full_response()
+    return jsonify({'task_id': task_id, 'targets': len(targets)}), 202 # 202 Accepted
+
 @bp.route('/predict/status/<task_id>', methods=['GET'])
 def get_prediction_status(task_id):
-    task = tasks.get(task_id)
+    # Long-poll: ?wait=N wstrzymuje odpowiedź do zakończenia zadania (najwyżej N sekund)
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0.0), MAX_STATUS_WAIT)
+    except ValueError:
+        return jsonify({'error': 'Invalid wait'}), 400
+    task = task_queue.wait(task_id, wait) if wait > 0 else task_queue.get(task_id)
     if not task:
         return jsonify({'error': 'Task not found'}), 404
     
@@ -129,4 +205,19 @@ def get_prediction_status(task_id):
     if task['status'] in ['SUCCESS', 'FAILURE']:
         response['result'] = task['result']
     
-    return jsonify(response)
\ No newline at end of file
+    return jsonify(response)
+
+@bp.route('/models', methods=['GET'])
+def get_models_status():
+    """Stan rejestru modeli: wersje plików, czas wczytania i ostatnie przeładowanie."""
+    return jsonify(ai_main.model_registry.status())
+
+@bp.route('/tasks/stats', methods=['GET'])
+def get_task_queue_stats():
+    """Głębokość kolejki zadań AI, czasy oczekiwania i wykonania."""
+    return jsonify(dict(task_queue.stats(), coalesced=_coalesced, in_flight=len(_inflight)))
+
+@bp.route('/cache/stats', methods=['GET'])
+def get_prediction_cache_stats():
+    """Trafienia i chybienia cache predykcji."""
+    return jsonify(prediction_cache.stats())
@@ -1,80 +1,89 @@
 from flask import Blueprint, render_template, request, redirect, url_for, session
 import sqlite3
+import logging
+import db
+import retention
+import rollups
+from routes import ai_service
 
 bp = Blueprint('boards', __name__)
+log = logging.getLogger(__name__)
 
 def delete_related_journey_data(mac_address):
-    conn = sqlite3.connect('measurements.db')
-    c = conn.cursor()
-
-    c.execute('DELETE FROM measurements WHERE mac_address = ?', (mac_address,))
-
-    conn.commit()
-    conn.close()
+    with db.writer() as conn:
+        c = conn.cursor()
+
+        c.execute('DELETE FROM measurements WHERE mac_address = ?', (mac_address,))
+        # Agregaty panelu (rollups.py) w tej samej transakcji co pomiary
+        for table, _, _ in rollups.ROLLUPS.values():
+            c.execute(f'DELETE FROM {table} WHERE mac_address = ?', (mac_address,))
+        # Warstwa minutowa retencji i jej znaczniki (retention.py)
+        c.execute(f'DELETE FROM {retention.MINUTE_TABLE} WHERE mac_address = ?', (mac_address,))
+        c.execute('DELETE FROM retention_watermarks WHERE mac_address = ?', (mac_address,))
+        # Pokrycie dni (data_coverage.py) - kalendarz i dostępność prognoz
+        c.execute('DELETE FROM daily_coverage WHERE mac_address = ?', (mac_address,))
+        # Zapisane agregaty godzinowe i cechy modelu (feature_store.py)
+        c.execute('DELETE FROM hourly_aggregates WHERE mac_address = ?', (mac_address,))
+        c.execute('DELETE FROM hourly_features WHERE mac_address = ?', (mac_address,))
+        c.execute('DELETE FROM prediction_cache WHERE mac_address = ?', (mac_address,))
+        db.after_commit(lambda: ai_service.hour_bitmap.forget(mac_address))
+        db.after_commit(lambda: ai_service.prediction_cache.forget_station(mac_address))
 
 def delete_board_and_related_data(board_id, mac_address):
-    conn = sqlite3.connect('measurements.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM user_boards WHERE id = ?', (board_id,))
-    conn.commit()
-    conn.close()
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute('DELETE FROM user_boards WHERE id = ?', (board_id,))
 
     delete_related_journey_data(mac_address)
 
 def delete_board_from_user(board_id, username, mac_address):
-    conn = sqlite3.connect('measurements.db')
-    c = conn.cursor()
-
     try:
-        # Znajdź ID użytkownika
-        c.execute('SELECT id FROM users WHERE username = ?', (username,))
-        user = c.fetchone()
-        if not user:
-            print(f"User '{username}' not found.")
-            return False
+        with db.writer() as conn:
+            c = conn.cursor()
+
+            # Znajdź ID użytkownika
+            c.execute('SELECT id FROM users WHERE username = ?', (username,))
+            user = c.fetchone()
+            if not user:
+                log.warning("User '%s' not found.", username)
+                return False
         
-        user_id = user[0]
+            user_id = user[0]
 
-        # Usuń rekord z user_boards
-        c.execute('''
-            DELETE FROM user_boards 
-            WHERE id = ? AND user_id = ? AND mac_address = ?
-        ''', (board_id, user_id, mac_address))
+            # Usuń rekord z user_boards
+            c.execute('''
+                DELETE FROM user_boards 
+                WHERE id = ? AND user_id = ? AND mac_address = ?
+            ''', (board_id, user_id, mac_address))
 
-        if c.rowcount == 0:
-            print("No matching board found to delete.")
-            return False
+            if c.rowcount == 0:
+                log.warning("No matching board found to delete.")
+                return False
 
-        conn.commit()
-        print("Board successfully deleted.")
-        return True
+            conn.commit()
+            log.info("Board successfully deleted.")
+            return True
 
     except sqlite3.Error as e:
-        print(f"Database error: {e}")
+        log.error("Database error: %s", e)
         return False
 
-    finally:
-        conn.close()
-
 def get_user_boards(username):
-    conn = sqlite3.connect('measurements.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('''SELECT user_boards.id, user_boards.mac_address, user_boards.board_name 
-                 FROM user_boards 
-                 INNER JOIN users ON user_boards.user_id = users.id 
-                 WHERE users.username = ? 
-                 ORDER BY user_boards.id ASC''', (username,))
-    boards = c.fetchall()
-    conn.close()
+    with db.reader() as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute('''SELECT user_boards.id, user_boards.mac_address, user_boards.board_name 
+                     FROM user_boards 
+                     INNER JOIN users ON user_boards.user_id = users.id 
+                     WHERE users.username = ? 
+                     ORDER BY user_boards.id ASC''', (username,))
+        boards = c.fetchall()
     return boards
 
 def update_board_name(board_id, new_name):
-    conn = sqlite3.connect('measurements.db')
-    c = conn.cursor()
-    c.execute('UPDATE user_boards SET board_name = ? WHERE id = ?', (new_name, board_id))
-    conn.commit()
-    conn.close()
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute('UPDATE user_boards SET board_name = ? WHERE id = ?', (new_name, board_id))
 
 @bp.route('/<username>/boards', methods=['GET', 'POST'])
 def boards(username):
@@ -1,46 +1,38 @@
 # routes/device_data.py
-from flask import Blueprint, render_template, session, redirect, url_for, abort, g, jsonify, make_response
+from flask import Blueprint, render_template, session, redirect, url_for, abort, jsonify, request, Response
 import sqlite3
 import logging
-import pandas as pd
-from io import BytesIO
+import itertools
+import db
+import data_coverage
+import export
+import retention
+import rollups
+from live import LiveBroker
 from datetime import datetime, timedelta
 
-
-# Assuming DB_PATH is available or imported (it's in app.py)
-DB_PATH = 'measurements.db'
-
 # Zmieniona nazwa blueprintu
 bp = Blueprint('device_data', __name__)
+log = logging.getLogger(__name__)
+
+# Pooled reader connection for the current request (rows as sqlite3.Row), see db.py
+get_db = db.get_db
 
-# Helper to get database connection (standard Flask/SQLite pattern)
-def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DB_PATH)
-        db.row_factory = sqlite3.Row # Allows accessing columns by name
-    return db
-
-# Close database connection at the end of the request
-@bp.teardown_request
-def close_db(error):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+# Nowe pomiary i kubełki 30-min dla otwartych paneli (SSE); zasilany hookiem zapisu z app.create_app
+live_broker = LiveBroker()
 
 # --- NOWA FUNKCJA DO AGREGACJI DANYCH ---
-def get_aggregated_data(mac_address, days=3):
+def get_aggregated_data(mac_address, days=3, resolution='30m'):
     """
     Pobiera i agreguje dane pomiarowe dla danego MAC adresu z ostatnich X dni
-    względem ostatniego zapisu w bazie danych.
+    względem ostatniego zapisu w bazie danych, w kubełkach 30-minutowych lub godzinowych.
     """
     conn = get_db()
     cur = conn.cursor()
 
     # --- NOWA LOGIKA: ZNAJDOWANIE OSTATNIEGO POMIARU ---
-    # 1. Znajdź najnowszy timestamp dla tego urządzenia
-    cur.execute("SELECT MAX(server_timestamp) FROM measurements WHERE mac_address = ?", (mac_address,))
-    latest_timestamp_str = cur.fetchone()[0]
+    # 1. Znajdź najnowszy timestamp dla tego urządzenia (także w danych skompaktowanych, retention.py)
+    latest_timestamp_str = retention.latest_timestamp(conn, mac_address)
 
     # Jeśli nie ma żadnych pomiarów dla tego urządzenia, zwróć pustą listę
     if not latest_timestamp_str:
@@ -54,36 +46,14 @@ def get_aggregated_data(mac_address, days=3):
         start_date = latest_timestamp - timedelta(days=days)
     except (ValueError, TypeError) as e:
         # Zabezpieczenie na wypadek problemów z formatem daty
-        logging.error(f"Nie można sparsować daty '{latest_timestamp_str}': {e}")
+        log.error("Nie można sparsować daty '%s': %s", latest_timestamp_str, e)
         return []
     # --- KONIEC NOWEJ LOGIKI ---
 
-    # Zapytanie SQL do agregacji danych (pozostaje prawie bez zmian,
-    # ale teraz używa dynamicznego 'start_date' i dodatkowo 'end_date')
-    query = """
-        SELECT
-            strftime('%Y-%m-%d %H', server_timestamp) || ':' || 
-            printf('%02d', (strftime('%M', server_timestamp) / 30) * 30) as time_window,
-            AVG(temperature) as avg_temp,
-            AVG(pressure) as avg_pres,
-            AVG(humidity) as avg_hum,
-            MAX(wind_speed) as max_wind,
-            AVG(sunshine) as avg_sun,
-            MAX(precipitation) as max_perc
-        FROM
-            measurements
-        WHERE
-            mac_address = ? AND server_timestamp BETWEEN ? AND ?
-        GROUP BY
-            time_window
-        ORDER BY
-            time_window ASC;
-    """
-    
-    # Przekazujemy do zapytania mac_address, dynamiczną datę początkową i końcową
-    cur.execute(query, (mac_address, start_date, latest_timestamp))
-    aggregated_data = [dict(row) for row in cur.fetchall()]
-    return aggregated_data
+    # Agregaty z tabel rollupów (rollups.py) - surowe pomiary czytamy tylko dla
+    # kubełka przeciętego początkiem zakresu, o ile nie został już skompaktowany
+    raw_since = retention.compacted_before(conn, mac_address, 'raw')
+    return rollups.query_aggregated(conn, mac_address, start_date, latest_timestamp, resolution, raw_since=raw_since)
 
 # --- NOWY ENDPOINT API ---
 @bp.route('/api/device_data/<mac_address>/aggregated', methods=['GET'])
@@ -92,21 +62,48 @@ def aggregated_device_data(mac_address):
     if 'username' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
 
+    resolution = request.args.get('resolution', '30m')
+    if resolution not in rollups.ROLLUPS:
+        return jsonify({'error': f"Unknown resolution, use one of: {', '.join(rollups.ROLLUPS)}"}), 400
+
     try:
         # Pobieramy dane z ostatnich 3 dni
-        data = get_aggregated_data(mac_address, days=3)
+        data = get_aggregated_data(mac_address, days=3, resolution=resolution)
         return jsonify(data)
     except Exception as e:
-        logging.error(f"Błąd podczas pobierania zagregowanych danych dla {mac_address}: {e}")
+        log.error("Błąd podczas pobierania zagregowanych danych dla %s: %s", mac_address, e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+
+@bp.route('/api/device_data/<mac_address>/live', methods=['GET'])
+def live_device_data(mac_address):
+    """Strumień SSE nowych odczytów ('reading') i kubełków 30-min ('bucket') urządzenia."""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        cur = get_db().cursor()
+        cur.execute(
+            "SELECT COUNT(*) FROM user_boards WHERE user_id = (SELECT id FROM users WHERE username = ?) AND mac_address = ?",
+            (session['username'], mac_address)
+        )
+        if cur.fetchone()[0] == 0:
+            return jsonify({'error': 'Forbidden'}), 403
+    except sqlite3.Error as e:
+        log.error("Database error in live_device_data: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
+    # Generator nie korzysta z bazy - połączenie żądania wraca do puli od razu
+    return Response(live_broker.stream(mac_address), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 
 # Zmieniona nazwa endpointu i URL
 @bp.route('/device_data/<mac_address>', methods=['GET'])
 def device_data_by_mac(mac_address):
     # 1. Sprawdzenie czy użytkownik jest zalogowany (pierwsza linia obrony)
     if 'username' not in session:
-        logging.warning(f"Attempted access to /device_data/{mac_address} by unauthenticated user.")
+        log.warning("Attempted access to /device_data/%s by unauthenticated user.", mac_address)
         return redirect(url_for('login.login'))
 
     # 2. Pobranie nazwy użytkownika z sesji (bez zmian)
@@ -157,7 +154,7 @@ def device_data_by_mac(mac_address):
             latest_conditions = measurements[-1]
 
     except sqlite3.Error as e:
-        logging.error(f"Database error in device_data_by_mac: {e}")
+        log.error("Database error in device_data_by_mac: %s", e)
         abort(500, description="Błąd bazy danych.")
     # --- KONIEC ZMIANY LOGIKI ---
 
@@ -171,14 +168,45 @@ def device_data_by_mac(mac_address):
         latest_conditions=latest_conditions
     )
 
+def _parse_export_bound(value, inclusive_end=False):
+    """'YYYY-MM-DD' lub 'YYYY-MM-DD HH:MM[:SS]' (także z 'T'); koniec zakresu włącznie -> granica wyłączna."""
+    value = value.strip().replace('T', ' ')
+    for fmt, step in (('%Y-%m-%d %H:%M:%S', timedelta(seconds=1)), ('%Y-%m-%d %H:%M', timedelta(minutes=1)),
+                      ('%Y-%m-%d', timedelta(days=1))):
+        try:
+            bound = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return bound + step if inclusive_end else bound
+    raise ValueError(value)
+
+
 # Dodanie endpointu do pobierania CSV dla konkretnego MAC adresu z zabezpieczeniem
 @bp.route('/device_data/<mac_address>/download', methods=['GET'])
 def download_csv(mac_address):
+    """
+    Eksport strumieniowy: ?format=csv|parquet, ?gzip=1 (CSV), ?from=/?to= (data lub data i godzina,
+    oba końce włącznie). Wiersze są czytane i kodowane porcjami, więc pamięć nie rośnie z historią stacji.
+    """
     # 1. Sprawdzenie czy użytkownik jest zalogowany
     if 'username' not in session:
-        logging.warning(f"Attempted CSV download for {mac_address} by unauthenticated user.")
+        log.warning("Attempted CSV download for %s by unauthenticated user.", mac_address)
         return redirect(url_for('login.login'))
 
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in ('csv', 'parquet'):
+        return "Nieznany format eksportu, użyj: csv, parquet.", 400
+    if export_format == 'parquet' and not export.parquet_available():
+        return "Eksport Parquet jest niedostępny (brak biblioteki pyarrow na serwerze).", 501
+    compress = export_format == 'csv' and request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    try:
+        start = _parse_export_bound(request.args['from']) if request.args.get('from') else None
+        end = _parse_export_bound(request.args['to'], inclusive_end=True) if request.args.get('to') else None
+    except ValueError as e:
+        return f"Nieprawidłowa data zakresu: {e}. Użyj formatu YYYY-MM-DD lub YYYY-MM-DD HH:MM:SS.", 400
+    if start is not None and end is not None and start >= end:
+        return "Początek zakresu musi być wcześniejszy niż jego koniec.", 400
+
     # 2. Pobranie nazwy użytkownika z sesji
     username = session['username']
     conn = get_db()
@@ -194,42 +222,37 @@ def download_csv(mac_address):
 
         if board_count == 0:
              # Urządzenie nie przypisane do tego użytkownika lub nie istnieje
-             logging.warning(f"Access denied: User '{username}' attempted to download data for unauthorized MAC '{mac_address}'")
+             log.warning("Access denied: User '%s' attempted to download data for unauthorized MAC '%s'", username, mac_address)
              abort(403, description="To urządzenie nie jest przypisane do Twojego konta lub nie istnieje w systemie.") # Zwróć 403 Forbidden
 
         # Jeśli dotarliśmy tutaj, użytkownik jest zalogowany I posiada to urządzenie
-        # 4. Pobranie wszystkich pomiarów dla tego mac_address (istniejąca logika)
-        cur.execute(
-            "SELECT server_timestamp, temperature, pressure, humidity, sunshine, wind_speed, precipitation FROM measurements WHERE mac_address = ? ORDER BY server_timestamp",
-            (mac_address,)
-        )
-        all_measurements = cur.fetchall()
-
-        if not all_measurements:
-            # Brak danych pomiarowych DLA TEGO urządzenia, ale użytkownik je posiada
-            return "Brak danych do pobrania dla tego urządzenia.", 404 # Zwróć 404 Not Found (danych)
-
-        # 5. Konwersja danych na CSV i zwrócenie odpowiedzi (istniejąca logika)
-        df = pd.DataFrame(all_measurements, columns=[
-            'Timestamp', 'Temperatura (°C)', 'Ciśnienie (hPa)', 'Wilgotność (%)',
-            'Wykryto Światło (Surowa Wartość)', 'Prędkość Wiatru (m/s)', 'Opady (%)'
-        ])
-
-        csv_buffer = BytesIO()
-        df.to_csv(csv_buffer, index=False, encoding='utf-8-sig') # Użyj utf-8-sig dla BOM (lepsza kompatybilność z Excel)
-        csv_buffer.seek(0)
+        # 4. Pomiary czytane porcjami - starsze okresy jako średnie minutowe/godzinowe
+        # z tabel retencji (retention.py). Pierwsza porcja już tutaj (na połączeniu żądania), żeby zwrócić
+        # 404 zamiast pustego pliku; kolejne porcje pożyczają czytnik z puli tylko na czas swojego zapytania.
+        chunks = export.iter_chunks(mac_address, start, end, conn=conn)
+        first_chunk = next(chunks, None)
+    except sqlite3.Error as e:
+        log.error("Database error in download_csv during authorization or fetch: %s", e)
+        abort(500, description="Błąd bazy danych podczas generowania pliku CSV.")
 
-        response = make_response(csv_buffer.getvalue())
-        response.headers['Content-Disposition'] = f'attachment; filename=device_data_{mac_address.replace(":", "-")}.csv'
-        response.headers['Content-type'] = 'text/csv'
+    if first_chunk is None:
+        # Brak danych pomiarowych DLA TEGO urządzenia (w zakresie), ale użytkownik je posiada
+        return "Brak danych do pobrania dla tego urządzenia.", 404 # Zwróć 404 Not Found (danych)
 
-        return response
+    # Połączenie żądania wraca do puli przed wysyłaniem - wolny klient nie blokuje czytnika
+    db.close_db()
 
-    except sqlite3.Error as e:
-        logging.error(f"Database error in download_csv during authorization or fetch: {e}")
-        abort(500, description="Błąd bazy danych podczas generowania pliku CSV.") 
+    # 5. Kodowanie porcjami w trakcie wysyłania odpowiedzi
+    chunks = itertools.chain([first_chunk], chunks)
+    filename = f'device_data_{mac_address.replace(":", "-")}'
+    if export_format == 'parquet':
+        body, mimetype, filename = export.iter_parquet(chunks), 'application/vnd.apache.parquet', f'{filename}.parquet'
+    elif compress:
+        body, mimetype, filename = export.iter_gzip(export.iter_csv(chunks)), 'application/gzip', f'{filename}.csv.gz'
+    else:
+        body, mimetype, filename = export.iter_csv(chunks), 'text/csv', f'{filename}.csv'
 
-    # Połączenie z bazą danych zostanie automatycznie zamknięte przez bp.teardown_appcontext
+    return Response(body, mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 @bp.route('/api/device_data/<mac_address>/available_dates', methods=['GET'])
 def get_available_dates(mac_address):
@@ -239,18 +262,19 @@ def get_available_dates(mac_address):
 
     try:
         conn = get_db()
-        cur = conn.cursor()
-        # Zapytanie grupujące po dacie i zwracające unikalne dni
-        cur.execute("""
-            SELECT DISTINCT strftime('%Y-%m-%d', server_timestamp) as date
-            FROM measurements
-            WHERE mac_address = ?
-            ORDER BY date DESC
-        """, (mac_address,))
-        
-        # Zwracamy listę stringów z datami
-        dates = [row['date'] for row in cur.fetchall()]
-        return jsonify(dates)
+        # Dni z tabeli pokrycia (data_coverage.py) - kilka wierszy po kluczu głównym, obejmuje też
+        # okresy, których surowe pomiary usunęła retencja. ETag/Last-Modified zmieniają się tylko
+        # po pojawieniu się nowego dnia, więc przeglądarka zwykle dostaje 304 bez treści.
+        etag, last_modified = data_coverage.dates_version(conn, mac_address)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = jsonify(data_coverage.available_dates(conn, mac_address))
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
     except Exception as e:
-        logging.error(f"Błąd podczas pobierania dostępnych dat dla {mac_address}: {e}")
+        log.error("Błąd podczas pobierania dostępnych dat dla %s: %s", mac_address, e)
         return jsonify({'error': 'Internal server error'}), 500
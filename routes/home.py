@@ -1,24 +1,25 @@
 from flask import Blueprint, render_template, session, request, jsonify
-import sqlite3
+import logging
+import db
 
 bp = Blueprint('home', __name__)
+log = logging.getLogger(__name__)
 
 def send_code(username):
-    conn = sqlite3.connect('measurements.db')
-    c = conn.cursor()
+    with db.reader() as conn:
+        c = conn.cursor()
 
-    c.execute("SELECT pin FROM users WHERE username = ?", (username,))
+        c.execute("SELECT pin FROM users WHERE username = ?", (username,))
 
-    result = c.fetchone()
+        result = c.fetchone()
     
     if result:
         pin = result[0]
-        print("Received configuration code:", pin)
+        log.debug("Received configuration code: %s", pin)
     else:
-        print("User not found.")
+        log.warning("User not found.")
         pin = None
     
-    conn.close()
     return pin
 
 
@@ -29,14 +30,12 @@ def home():
     if request.method == 'POST':
         newCode = request.json
         try:
-            conn = sqlite3.connect('measurements.db')
-            c = conn.cursor()
-            c.execute("UPDATE users SET pin = ? WHERE username = ?", (newCode['code'], username))
-            print("Received configuration code:", newCode['code'])
-            conn.commit()
-            conn.close()
+            with db.writer() as conn:
+                c = conn.cursor()
+                c.execute("UPDATE users SET pin = ? WHERE username = ?", (newCode['code'], username))
+                log.debug("Received configuration code: %s", newCode['code'])
             return jsonify({'message': 'Kod został zapisany!'}), 200
         except Exception as e:
-            print(f"Error: {e}")
+            log.error("Error: %s", e)
             return jsonify({'message': 'Wystąpił błąd podczas zapisywania kodu.'}), 500
     return render_template('home.html', username=username)
\ No newline at end of file
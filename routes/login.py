@@ -1,5 +1,5 @@
 from flask import Blueprint, render_template, flash, redirect, url_for, session, request
-import sqlite3
+import db
 
 bp = Blueprint('login', __name__)
 
@@ -9,11 +9,10 @@ def login():
         username = request.form['username']
         password = request.form['password']
 
-        conn = sqlite3.connect('measurements.db')
-        c = conn.cursor()
-        c.execute("SELECT * FROM users WHERE username = ? AND password = ?", (username, password))
-        user = c.fetchone()
-        conn.close()
+        with db.reader() as conn:
+            c = conn.cursor()
+            c.execute("SELECT * FROM users WHERE username = ? AND password = ?", (username, password))
+            user = c.fetchone()
 
         if user:
             session['username'] = username
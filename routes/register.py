@@ -1,5 +1,6 @@
 from flask import Blueprint, render_template, request, flash, redirect, url_for
 import sqlite3
+import db
 
 bp = Blueprint('register', __name__)
 
@@ -15,11 +16,9 @@ def register():
             flash('Hasła nie są zgodne! Spróbuj ponownie.')
             return redirect(url_for('register.register'))
         try:
-            conn = sqlite3.connect('measurements.db')
-            c = conn.cursor()
-            c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
-            conn.commit()
-            conn.close()
+            with db.writer() as conn:
+                c = conn.cursor()
+                c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
         except sqlite3.IntegrityError:
             flash('Użytkownik o podanej nazwie już istnieje!')
             return redirect(url_for('register.register'))
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+Sensor constants shared by the modules that aggregate readings: ai_main (hourly features)
+and retention (1-minute tier), so retention does not have to import the whole AI pipeline.
+"""
+
+# Odczyt czujnika światła powyżej progu = interwał słoneczny (DOSTOSUJ DO SWOICH CZUJNIKÓW!)
+SUNSHINE_THRESHOLD = 30